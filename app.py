@@ -1,4 +1,5 @@
 import dashscope
+import numpy as np
 import pandas as pd
 import re
 import time
@@ -6,9 +7,41 @@ import streamlit as st
 import matplotlib.pyplot as plt
 from rapidfuzz import fuzz, process
 from dashscope import Generation
-from collections import deque
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import contextlib
+import functools
+import hashlib
+import io
+import json
+import math
 import os
+import sys
+import threading
+import unicodedata
+import urllib.request
+import uuid
+import atexit
 import matplotlib
+from fuzzy_shards import FuzzyShardService
+from kb_ingest import KnowledgeBaseFormatError, ingest_knowledge_base
+from session_store import create_session_store
+from traffic_recorder import DEFAULT_PATH_PATTERN as DEFAULT_TRAFFIC_PATH, TrafficRecorder
+from profiling import RequestProfiler
+from usage_ledger import UsageLedger
+from conversation_export import EXPORT_FORMATS, ConversationExportJob
+from tenant_registry import TenantRegistry
+from kb_loader import KnowledgeBaseLoadJob
+from rule_config import RuleConfigWatcher
+from typo_index import TermIndex, correct_query, frequent_terms, lazy_pinyin
+from shared_cache import SharedMatchCache, create_cache_backend
+
+try:
+    from opencc import OpenCC  # 可选依赖：完整的繁简转换
+except ImportError:
+    OpenCC = None
 
 try:
     # 尝试使用系统中可能有的中文字体
@@ -48,7 +81,21 @@ if 'all_conversations' not in st.session_state:
 if 'knowledge_df' not in st.session_state:
     st.session_state.knowledge_df = None  # 统一知识库DataFrame
 if 'rule_base' not in st.session_state:
-    st.session_state.rule_base = None  # 规则库（仅用于意图识别）
+    st.session_state.rule_base = None  # 加载知识库时的意图关键词（提取型号用于规范化索引；意图识别使用 get_routing_rules）
+if 'speculation_config' not in st.session_state:
+    st.session_state.speculation_config = None  # 推测执行配置，None表示使用默认值
+if 'prompt_budget' not in st.session_state:
+    st.session_state.prompt_budget = None  # Prompt token预算，None表示使用默认值
+
+# 推测执行默认配置：对大概率无法命中知识库的问题，在知识库匹配的同时提前发起AI请求
+SPECULATION_DEFAULTS = {
+    "enabled": True,
+    "miss_threshold": 0.7,  # 预测未命中概率达到该值才推测执行
+    "long_query_chars": 40,  # 超过该长度视为长文本自由提问
+    "confident_score": 100,  # 知识库结果分数达到该值视为可信命中，取消AI请求
+    "wasted_budget": 30,  # 时间窗口内允许浪费的AI调用次数
+    "budget_window": 3600,  # 浪费预算的统计窗口（秒）
+}
 
 
 def desensitize(text):
@@ -103,522 +150,3245 @@ def desensitize(text):
     return text
 
 
-@st.cache_data
-def load_knowledge_base(uploaded_file):
+# 批量脱敏时拼接文本用的分隔符：以句号开头和结尾，任何脱敏规则都不会跨越它
+DESENSITIZE_BATCH_SEPARATOR = "。\x00。"
+
+
+def desensitize_batch(texts):
+    """批量脱敏：一批文本拼接后整体替换一次，省去逐条调用的开销，结果与逐条 desensitize 相同"""
+    strings = [text for text in texts if isinstance(text, str)]
+    if not strings:
+        return list(texts)
+    if any("\x00" in text for text in strings):
+        return [desensitize(text) for text in texts]
+    masked = iter(desensitize(DESENSITIZE_BATCH_SEPARATOR.join(strings)).split(DESENSITIZE_BATCH_SEPARATOR))
+    return [next(masked) if isinstance(text, str) else text for text in texts]
+
+
+def compute_kb_version(df):
+    """根据知识库内容计算版本号（内容哈希）"""
+    row_hashes = pd.util.hash_pandas_object(df[['问题', '问题类型', '标准回答']], index=False)
+    return hashlib.sha1(row_hashes.values.tobytes()).hexdigest()[:16]
+
+
+def get_kb_version(knowledge_df):
+    """读取知识库版本号，旧数据没有版本号时现场计算"""
+    if 'kb_version' not in knowledge_df.attrs:
+        knowledge_df.attrs['kb_version'] = compute_kb_version(knowledge_df)
+    return knowledge_df.attrs['kb_version']
+
+
+def parse_knowledge_base(source, name=None):
     """
-    加载统一知识库Excel文件,知识库应包含`问题`、`问题类型`、`标准回答`三列
+    解析知识库文件（Excel/CSV/Parquet）,知识库应包含`问题`、`问题类型`、`标准回答`三列
+
+    Excel流式读取，多个工作表（如每个产品线一个）并行解析后合并；导入报告保存在 df.attrs['ingest_report']。
+    格式错误时抛出 KnowledgeBaseFormatError
     """
-    try:
-        df = pd.read_excel(uploaded_file)
-        required_columns = ['问题', '问题类型', '标准回答']
-        for col in required_columns:
-            if col not in df.columns:
-                st.error(f"知识库文件必须包含'{col}'列")
-                return None, None
-
-        df = df.dropna(subset=['问题', '标准回答']).reset_index(drop=True)
-
-        # 扩展后的规则库 - 意图路由器，引导系统去知识库中查找答案
-        rule_base = {
-            # 原有类别
-            "发票咨询": {
-                "patterns": ["发票", "开票", "专票", "普票", "税点", "开发票", "增值税", "抬头", "发票抬头"],
-            },
-            "物流查询": {
-                "patterns": ["发货", "快递", "物流", "顺丰", "送达", "配送", "运输", "几天到", "发货时间", "快递单号",
-                             "运费", "快递公司"],
-            },
-            "退货政策": {
-                "patterns": ["退货", "退款", "退换货", "退货流程", "退货政策", "退货条件", "退货运费", "退货申请",
-                             "退货怎么退"],
-            },
-            "售后政策": {
-                "patterns": ["保修", "质保", "维修", "售后", "坏了", "保修期", "质保期", "维修服务", "售后支持",
-                             "报修"],
-            },
-
-            # 新增类别
-            "价格咨询": {
-                "patterns": ["价格", "多少钱", "价", "优惠", "折扣", "便宜", "价位", "报价", "价格多少", "有优惠吗",
-                             "价格优惠", "打折"],
-            },
-            "电机技术咨询": {
-                "patterns": ["电机", "M0601", "M0602", "M1502", "M0603", "M0701", "M1505", "P1010",
-                             "编码器", "减速器", "波特率", "CAN", "上位机", "电压", "扭矩", "转矩",
-                             "电流", "转速", "PID", "位置环", "速度环", "电流环", "CANopen", "通信协议",
-                             "例程", "代码", "固件", "驱动程序", "安装", "接线", "参数", "规格", "参数配置",
-                             "电池", "电源", "电压范围", "供电", "功率", "力矩", "负载", "承重", "重量"],
-            },
-            "通用问答": {
-                "patterns": ["你好", "您好", "hello", "hi", "早上好", "下午好", "晚上好", "在吗", "有人吗", "客服"],
-            },
-            "感谢与告别": {
-                "patterns": ["谢谢", "感谢", "辛苦了", "再见", "拜拜", "下次见", "结束了", "好了", "没问题了"],
-            }
-        }
+    df, ingest_report = ingest_knowledge_base(source, name)
+    print(f"DEBUG: 知识库导入 {ingest_report['rows_kept']}/{ingest_report['rows_read']} 行, "
+          f"{ingest_report['rows_per_sec']:.0f} 行/秒")
+    df.attrs['ingest_report'] = ingest_report
+    # 知识库内容版本号，用于缓存和索引的失效判断
+    df.attrs['kb_version'] = compute_kb_version(df)
+    return df
 
-        return df, rule_base
 
-    except Exception as e:
-        st.error(f"知识库加载失败: {str(e)}")
-        return None, None
+# ====== 路由规则：意图关键词和判断词表来自 rules.json，编译为多关键词自动机，修改后热加载 ======
+# 租户可以有自己的规则文件 rules/<租户ID>.json，没有时使用全局 rules.json；每个租户各自编译、各自热加载
+RULES_CONFIG = {
+    "path": os.getenv("RULES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.json")),
+    "tenant_dir": os.getenv("RULES_TENANT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules")),
+    "check_interval": float(os.getenv("RULES_CHECK_INTERVAL", "2")),  # 检查文件修改时间的最短间隔（秒），0 表示每次都检查
+    "watch": os.getenv("RULES_WATCH", "1") != "0",  # 关闭后只能在侧边栏手动重新加载
+}
 
 
-def find_in_knowledge_base(user_query, knowledge_df):
+def on_rules_reload(tenant_id, rules, previous):
     """
-    系统核心查询函数 - 智能匹配版：平衡准确性和召回率
+    规则变化会改变知识库匹配结果（外观/技术词表）、Prompt分支和规范化用的型号列表：
+    清除该租户的匹配缓存、未命中缓存和AI回复缓存，并丢弃规范化索引（下次匹配时按新规则重建）；知识库本身不需要重新加载。
+    缓存键包含租户，其他租户的缓存不受影响；规范化索引按知识库版本共享，全部丢弃
     """
-    print(f"\n=== DEBUG find_in_knowledge_base 开始 ===")
-    print(f"用户查询: {user_query}")
-    
-    if knowledge_df is None or knowledge_df.empty:
-        print(f"DEBUG: 知识库为空")
+    cleared = (get_negative_cache().invalidate(tenant_id=tenant_id) + get_match_cache().invalidate(tenant_id=tenant_id)
+               + get_response_cache().invalidate(tenant_id=tenant_id))
+    registry = get_kb_store_registry()
+    with registry["lock"]:
+        stores = list(registry["stores"].values())
+    for store in stores:
+        store.reset_canonical_index()
+    print(f"DEBUG: 租户 {tenant_id} 规则版本 {previous.version} -> {rules.version}，"
+          f"清除缓存 {cleared} 条，重建 {len(stores)} 个规范化索引")
+
+
+@st.cache_resource
+def get_rule_watcher(tenant_id):
+    """进程内共享的租户路由规则，每个租户一个（首次加载失败时抛出 RuleConfigError）"""
+    config = RULES_CONFIG
+    return RuleConfigWatcher(os.path.join(config["tenant_dir"], f"{tenant_id}.json"),
+                             config["check_interval"] if config["watch"] else None,
+                             on_reload=functools.partial(on_rules_reload, tenant_id), fallback_path=config["path"])
+
+
+def get_routing_rules(tenant_id=None):
+    """租户当前生效的编译后路由规则，文件已修改时先重新加载；tenant_id 为None时取本会话的租户，后台线程中调用时需要指定"""
+    return get_rule_watcher(tenant_id or get_tenant_id()).current()
+
+
+def build_rule_base(tenant_id=None):
+    """租户当前规则配置的意图关键词（原规则库格式），随知识库一起保存，用于提取型号构建规范化索引"""
+    return get_routing_rules(tenant_id).rule_base()
+
+
+def load_knowledge_base(uploaded_file, tenant_id=None):
+    """
+    加载知识库文件并生成规则库，返回 (DataFrame, 规则库)，失败时在界面提示并返回 (None, None)
+
+    不使用 st.cache_data：规则库取自租户当前（可热加载）的规则，按文件缓存会把首个租户、旧版本的规则库返回给后续调用。
+    界面上传走 KnowledgeBaseLoadJob，这里只供命令行工具使用
+    """
+    try:
+        return parse_knowledge_base(uploaded_file), build_rule_base(tenant_id)
+
+    except KnowledgeBaseFormatError as e:
+        st.error(str(e))
         return None, None
-    
-    # ====== 第一步：强力拦截外观问题 ======
-    # 只要包含这些关键词，就跳过知识库匹配
-    appearance_keywords = [
-        "颜色", "红色", "蓝色", "绿色", "黄色", "白色", "黑色", "灰色", 
-        "外观", "样子", "外形", "形状", "长得", 
-        "尺寸", "大小", "长", "宽", "高", 
-        "材质", "材料", "塑料", "金属", 
-        "重量", "重", "轻", "多重"
-    ]
-    
-    # 检查是否包含外观关键词
-    for keyword in appearance_keywords:
-        if keyword in user_query:
-            print(f"DEBUG: 发现外观关键词 '{keyword}'，跳过知识库匹配")
-            return None, None
-    
-    # ====== 第二步：精确匹配 ======
-    exact_match = knowledge_df[knowledge_df['问题'].str.strip().str.lower() == user_query.strip().lower()]
-    if not exact_match.empty:
-        answer = exact_match.iloc[0]['标准回答']
-        print(f"DEBUG: 精确匹配成功，问题: {exact_match.iloc[0]['问题']}")
-        return answer, exact_match.iloc[0].get('问题类型', '通用咨询')
-    
-    print(f"DEBUG: 精确匹配失败")
-    
-    # ====== 第三步：合并问题处理 ======
-    # 检查是否是合并问题（包含"和"、"及"、"还有"等连接词）
-    connectors = ["和", "及", "还有", "以及", "并且", "同时", "、"]
-    has_connector = any(connector in user_query for connector in connectors)
-    
-    if has_connector:
-        print(f"DEBUG: 检测到合并问题，尝试拆分处理")
-        
-        # 尝试根据连接词拆分问题
-        found_answers = []
-        
-        # 检查各种连接词
-        for connector in connectors:
-            if connector in user_query:
-                parts = [part.strip() for part in user_query.split(connector) if part.strip()]
-                
-                # 如果拆分成至少2部分，尝试分别匹配
-                if len(parts) >= 2:
-                    print(f"DEBUG: 按'{connector}'拆分为: {parts}")
-                    
-                    for part in parts:
-                        # 为每个部分查找最佳匹配
-                        part_matches = []
-                        
-                        # 1. 子串匹配
-                        for idx, row in knowledge_df.iterrows():
-                            question = row['问题'].strip().lower()
-                            if part.lower() in question or question in part.lower():
-                                part_matches.append((row['标准回答'], row.get('问题类型', '通用咨询'), 100))
-                                break
-                        
-                        # 2. 模糊匹配
-                        if not part_matches:
-                            result = process.extractOne(
-                                part,
-                                knowledge_df['问题'].tolist(),
-                                scorer=fuzz.token_set_ratio
-                            )
-                            
-                            if result:
-                                best_match, score, index = result
-                                if score >= 50:  # 合并问题的部分匹配可以降低阈值
-                                    matched_row = knowledge_df.iloc[index]
-                                    part_matches.append((matched_row['标准回答'], matched_row.get('问题类型', '通用咨询'), score))
-                        
-                        if part_matches:
-                            # 选择分数最高的
-                            part_matches.sort(key=lambda x: x[2], reverse=True)
-                            found_answers.append(part_matches[0][0])
-                            print(f"DEBUG: 部分'{part}'匹配到答案")
-        
-        # 如果有找到多个答案，合并它们
-        if len(found_answers) >= 2:
-            print(f"DEBUG: 合并问题找到{len(found_answers)}个答案，进行合并")
-            
-            # 去重
-            unique_answers = []
-            for ans in found_answers:
-                if ans not in unique_answers:
-                    unique_answers.append(ans)
-            
-            if len(unique_answers) == 1:
-                return unique_answers[0], "组合问题"
-            else:
-                # 组合多个答案
-                combined_reply = "关于您的问题，分别回答如下：\n\n"
-                for i, ans in enumerate(unique_answers, 1):
-                    # 清理答案格式
-                    clean_ans = ans.strip()
-                    if not clean_ans.endswith(('。', '!', '?', '！', '？')):
-                        clean_ans += '。'
-                    combined_reply += f"{i}. {clean_ans}\n"
-                
-                return combined_reply, "组合问题"
-        elif found_answers:
-            # 只找到一个答案，直接返回
-            return found_answers[0], "组合问题"
-    
-    # ====== 第四步：子串匹配（双向） ======
-    # 只有当用户问题在知识库问题中是子串时才匹配，或者反过来
-    for idx, row in knowledge_df.iterrows():
-        question = row['问题'].strip().lower()
-        user_q_lower = user_query.strip().lower()
-        
-        # 双向子串匹配
-        if user_q_lower in question or question in user_q_lower:
-            print(f"DEBUG: 子串匹配成功: {user_query} -> {question}")
-            return row['标准回答'], row.get('问题类型', '通用咨询')
-    
-    print(f"DEBUG: 子串匹配失败")
-    
-    # ====== 第五步：智能模糊匹配（针对技术问题） ======
-    # 检查是否是技术问题
-    technical_keywords = ["电机", "M0601", "M0602", "M1502", "M0603", "M0701", "M1505", "P1010",
-                         "编码器", "减速器", "波特率", "CAN", "上位机", "电压", "扭矩", "转矩",
-                         "电流", "转速", "PID", "位置环", "速度环", "电流环", "CANopen", "通信协议",
-                         "例程", "代码", "固件", "驱动程序", "安装", "接线", "参数", "规格"]
-    
-    is_technical_question = any(keyword in user_query for keyword in technical_keywords)
-    
-    if is_technical_question:
-        print(f"DEBUG: 检测到技术问题，尝试模糊匹配")
-        
-        # 只对技术问题进行模糊匹配
-        # rapidfuzz 返回三个值：(最佳匹配, 分数, 索引)
-        result = process.extractOne(
-            user_query,
-            knowledge_df['问题'].tolist(),
-            scorer=fuzz.token_set_ratio  # 使用token_set_ratio，对词序不敏感
-        )
-        
-        if result:
-            best_match, score, index = result
-            print(f"DEBUG: 模糊匹配结果: {best_match}")
-            print(f"DEBUG: 匹配分数: {score}")
-            print(f"DEBUG: 匹配索引: {index}")
-            
-            # 对于技术问题，降低阈值到50
-            if score >= 50:  # 降低阈值到50，提高召回率
-                matched_row = knowledge_df.iloc[index]  # 直接使用索引获取行
-                
-                # 验证匹配的相关性
-                # 检查匹配到的问题是否也是技术问题
-                matched_is_technical = any(keyword in best_match for keyword in technical_keywords)
-                
-                if matched_is_technical:
-                    print(f"DEBUG: 模糊匹配成功，返回知识库答案")
-                    return matched_row['标准回答'], matched_row.get('问题类型', '通用咨询')
-                else:
-                    print(f"DEBUG: 匹配到非技术问题，拒绝返回")
-            else:
-                print(f"DEBUG: 模糊匹配分数不足 {score} < 50")
-        else:
-            print(f"DEBUG: 模糊匹配未找到结果")
-    
-    # 没有找到匹配
-    print(f"DEBUG: 所有匹配方法都失败")
-    return None, None
+    except Exception as e:
+        st.error(f"知识库加载失败: {str(e)}")
+        return None, None
+
+
+# ====== 问题规范化：知识库问题和用户问题使用同一套规则，提高精确匹配命中率 ======
+
+CANONICALIZE_CONFIG = {
+    "enabled": True,
+}
 
-def rule_engine(user_query, knowledge_df):
+# 常见繁体字 -> 简体字（未安装 opencc 时使用；安装后由 opencc 做完整转换）
+TRADITIONAL_CHARS = "電機發貨請問嗎運費價優換編碼減轉壓數參線裝驅動開遞時間麼們個這號買賣應該說書寶險維護質長達協議訊韌體軟載區別與為還沒讓給會對從幾種顏規係統設調試錯誤燈閃爍紅綠藍黃輸關於並後單訂帳戶郵邊內網絡圖話謝見實際煩擾詢諮處認證確額鐘頭殼"
+SIMPLIFIED_CHARS = "电机发货请问吗运费价优换编码减转压数参线装驱动开递时间么们个这号买卖应该说书宝险维护质长达协议讯韧体软载区别与为还没让给会对从几种颜规系统设调试错误灯闪烁红绿蓝黄输关于并后单订账户邮边内网络图话谢见实际烦扰询咨处认证确额钟头壳"
+
+# 问题开头的客套语（可连续出现，如“你好，请问”）
+FILLER_PREFIXES = ["你好", "您好", "请问一下", "请问下", "请问", "麻烦问一下", "麻烦问下", "我想问一下", "我想问下", "想问一下",
+                   "想问下", "我想问", "问一下", "打扰一下", "打扰了"]
+
+
+class QueryCanonicalizer:
     """
-    识别意图,并尝试从对应类型的知识库中获取答案
+    问题规范化流水线（正则和转换表在构造时预编译）
+
+    1. NFKC：全角字母数字和标点转半角（“？”->“?”），然后转小写
+    2. 繁体转简体
+    3. 去掉开头的客套语（“请问”、“你好，”等）
+    4. 型号归一：根据规则库中的电机型号（如 M0601）生成规则，“m 0601”、“M-0601” 统一为 “m0601”
+    5. 合并连续空白，去掉结尾的问号、感叹号、句号等
+
+    规范化结果为空时（问题只有客套语）返回 strip+lower 的结果
     """
-    start_time = time.time()
-    print(f"\n=== DEBUG rule_engine 开始 ===")
-    print(f"用户查询: {user_query}")
-    
-    user_query_lower = user_query.lower()
-    rule_base = st.session_state.rule_base
-    
-    # ==== 新增：特殊处理外观属性问题 ====
-    # 定义外观属性关键词（更全面）
-    appearance_keywords = [
-        # 颜色相关
-        "颜色", "红色", "蓝色", "绿色", "黄色", "白色", "黑色", "灰色", "银色", "金色",
-        "什么颜色", "颜色是", "啥颜色", "颜色的", "色",
-        # 外观相关
-        "外观", "样子", "外形", "形状", "长得", "长什么样", "好看", "漂亮", "颜值",
-        "外观设计", "外观是", "外观怎么样",
-        # 尺寸相关
-        "尺寸", "大小", "长", "宽", "高", "厚度", "直径", "体积", "尺寸多大",
-        "多长", "多宽", "多高", "多大尺寸", "大小是",
-        # 材质相关
-        "材质", "材料", "塑料", "金属", "铝合金", "不锈钢", "铁", "钢",
-        "什么材质", "什么材料", "用的什么",
-        # 重量相关
-        "重量", "重", "轻", "多重", "几公斤", "多少克", "重量多少"
-    ]
-    
-    # 检查是否包含外观属性关键词
-    has_appearance_keyword = False
-    matched_keywords = []
-    for keyword in appearance_keywords:
-        if keyword in user_query:
-            has_appearance_keyword = True
-            matched_keywords.append(keyword)
-    
-    print(f"是否包含外观关键词: {has_appearance_keyword}")
-    if has_appearance_keyword:
-        print(f"匹配到的外观关键词: {matched_keywords}")
-    
-    # 关键修改：只要包含外观关键词，就强制使用AI处理
-    if has_appearance_keyword:
-        # 但需要排除技术上下文（比如"红色指示灯"）
-        technical_contexts = ["指示灯", "LED", "灯", "报警", "故障", "状态", "显示", "信号", 
-                             "电压", "电流", "转速", "扭矩", "编码器", "减速器", "通信"]
-        has_technical_context = any(context in user_query for context in technical_contexts)
-        
-        print(f"是否包含技术上下文: {has_technical_context}")
-        
-        # 如果没有技术上下文，直接强制使用AI
-        if not has_technical_context:
-            end_time = time.time()
-            print(f"DEBUG: 外观问题，强制使用AI处理")
-            return {
-                "source": "规则引擎",
-                "intent": "外观属性咨询",
-                "reply": None,  # 返回None，让AI处理
-                "latency": end_time - start_time,
-                "score": 0,
-                "status": "failed"  # 标记为失败，让后续流程处理
-            }
-    
-    # ==== 原有意图识别逻辑 ====
-    detected_intent = None
-    for intent, config in rule_base.items():
-        if any(word in user_query_lower for word in config["patterns"]):
-            detected_intent = intent
-            print(f"规则引擎识别到意图: {intent}")
-            break
 
-    # 特殊处理：通用问答和感谢告别
-    if detected_intent == "通用问答":
-        end_time = time.time()
-        print(f"DEBUG: 通用问答，使用预设回复")
-        return {
-            "source": "系统预设",
-            "intent": "通用问答",
-            "reply": "您好！我是本末科技的智能客服，很高兴为您服务。有什么可以帮助您的吗？",
-            "latency": end_time - start_time,
-            "score": 100,
-            "status": "success"
-        }
-    elif detected_intent == "感谢与告别":
-        end_time = time.time()
-        print(f"DEBUG: 感谢告别，使用预设回复")
-        return {
-            "source": "系统预设",
-            "intent": "感谢与告别",
-            "reply": "不客气，这是我应该做的！如有其他问题随时联系我，祝您生活愉快！",
-            "latency": end_time - start_time,
-            "score": 100,
-            "status": "success"
-        }
+    def __init__(self, model_codes=()):
+        self.model_codes = tuple(sorted(set(model_codes)))
+        self.opencc = OpenCC('t2s') if OpenCC is not None else None
+        self.char_map = str.maketrans(TRADITIONAL_CHARS, SIMPLIFIED_CHARS)
+        fillers = "|".join(re.escape(filler) for filler in sorted(FILLER_PREFIXES, key=len, reverse=True))
+        self.filler_pattern = re.compile(rf'^(?:(?:{fillers})[\s,.!、~]*)+')
+        self.space_pattern = re.compile(r'\s+')
+        self.trailing_pattern = re.compile(r'[\s?!.。~…]+$')
 
-    # 无论是否识别出具体意图，都先在知识库中全局查找
-    print(f"调用 find_in_knowledge_base...")
-    reply, detected_type = find_in_knowledge_base(user_query, knowledge_df)
+        # 型号：字母前缀 + 固定位数数字，前缀和数字之间允许空白、连字符、下划线
+        model_parts = set()
+        for code in self.model_codes:
+            match = re.fullmatch(r'([a-z]+)(\d+)', code.lower())
+            if match:
+                model_parts.add((match.group(1), len(match.group(2))))
+        self.model_pattern = None
+        if model_parts:
+            alternatives = "|".join(f"(?:{prefix})[\\s\\-_]*\\d{{{digits}}}"
+                                    for prefix, digits in sorted(model_parts))
+            self.model_pattern = re.compile(rf'(?<![a-z0-9])(?:{alternatives})(?![0-9])')
+        self.signature = ("v1", self.model_codes, self.opencc is not None)
 
-    end_time = time.time()
+    def _join_model(self, match):
+        return re.sub(r'[\s\-_]', '', match.group(0))
+
+    def __call__(self, text):
+        fallback = text.strip().lower()
+        text = unicodedata.normalize("NFKC", text)
+        if self.opencc is not None:
+            text = self.opencc.convert(text)
+        text = text.translate(self.char_map).lower()
+        text = self.space_pattern.sub(" ", text).strip()
+        text = self.filler_pattern.sub("", text)
+        if self.model_pattern is not None:
+            text = self.model_pattern.sub(self._join_model, text)
+        text = self.trailing_pattern.sub("", text).strip()
+        return text or fallback
+
+
+def extract_model_codes(rule_base):
+    """从规则库的关键词中提取产品型号（字母前缀+数字，如 M0601、P1010）"""
+    if not rule_base:
+        return ()
+    codes = set()
+    for rule in rule_base.values():
+        for pattern in rule.get("patterns", []):
+            if re.fullmatch(r'[A-Za-z]+\d{3,}', pattern):
+                codes.add(pattern)
+    return tuple(sorted(codes))
+
+
+@st.cache_resource
+def build_query_canonicalizer(model_codes):
+    """按型号列表缓存规范化器"""
+    return QueryCanonicalizer(model_codes)
 
-    if reply:
-        # 成功从知识库中找到答案
-        # 使用检测到的问题类型作为意图，如果未指定则使用规则引擎检测的意图
-        intent_used = detected_type if detected_type else (detected_intent if detected_intent else "知识库匹配")
-        print(f"DEBUG: 知识库匹配成功，返回答案")
-        print(f"匹配到的问题类型: {detected_type}")
-        print(f"使用的意图: {intent_used}")
-        return {
-            "source": f"知识库 ({intent_used})",
-            "intent": intent_used,
-            "reply": reply,
-            "latency": end_time - start_time,
-            "score": 100,
-            "status": "success"
-        }
-    else:
-        # 知识库中未找到答案
-        print(f"DEBUG: 知识库未找到答案")
-        return {
-            "source": "规则引擎",
-            "intent": detected_intent if detected_intent else "未识别",
-            "reply": None,
-            "latency": end_time - start_time,
-            "score": 0,
-            "status": "failed"
-        }
 
-def ai_enhancement_with_knowledge(user_query, history_window, knowledge_df):
+def get_query_canonicalizer(rule_base=None):
+    """当前规则库对应的规范化器；未指定 rule_base 时读取 session_state"""
+    if rule_base is None:
+        rule_base = st.session_state.get('rule_base')
+    return build_query_canonicalizer(extract_model_codes(rule_base))
+
+
+@st.cache_resource
+def get_canonical_stats():
+    """进程内共享的精确匹配统计：canonical_hits 为原本会落到子串/模糊匹配或AI、经规范化后精确命中的次数"""
+    return {"lock": threading.Lock(), "lookups": 0, "exact_hits": 0, "canonical_hits": 0}
+
+
+# ====== 紧凑知识库：查询路径使用的数组化存储 ======
+class CompactKnowledgeBase:
     """
-    增强版AI生成回复：结合知识库中的相关信息，生成简洁回答
+    面向查询路径的紧凑知识库存储，pandas DataFrame 只用于界面展示
+
+    - 问题类型：去重后的类型表 + 每行一个整数编码
+    - 标准回答：去重后的回答表 + 每行一个回答ID
+    - 问题：原始问题和归一化问题（strip+lower）各自拼接为一个连续字符串，按偏移量切片
+    - 精确匹配索引：归一化问题的哈希排序数组，二分查找
+    - 规范化精确匹配索引：规范化（QueryCanonicalizer）后问题的哈希排序数组，由 build_canonical_index 构建
     """
-    start_time = time.time()
-    
-    # 1. 检查是否是外观属性问题
-    is_appearance_question = False
-    appearance_keywords = [
-        "颜色", "红色", "蓝色", "绿色", "黄色", "白色", "黑色", "外观", "样子", 
-        "外形", "形状", "长得", "尺寸", "大小", "长", "宽", "高", "材质", "材料",
-        "重量", "多重", "重"
-    ]
-    
-    if any(keyword in user_query for keyword in appearance_keywords):
-        is_appearance_question = True
-    
-    # 2. 从知识库中检索相关上下文
-    relevant_knowledge = ""
-    if knowledge_df is not None and not knowledge_df.empty:
-        # 尝试查找最相关的问题
-        best_answer, _ = find_in_knowledge_base(user_query, knowledge_df)
-        if best_answer:
-            relevant_knowledge = f"知识库标准答案：{best_answer}\n\n"
-    
-    # 3. 构建Prompt - 特别要求简洁回答
-    history_text = "\n".join([f"用户：{q}\n客服:{a}" for q, a in history_window])
-    
-    # 根据问题类型调整Prompt
-    technical_keywords = ["电机", "M0601", "M0602", "M1502", "编码器", "减速器", "CAN", 
-                         "上位机", "电压", "代码", "例程", "通信", "波特率"]
-    
-    is_technical = any(keyword in user_query for keyword in technical_keywords)
-    
-    if is_technical and relevant_knowledge:
-        # 技术问题且有知识库答案时，生成简洁回答
-        full_prompt = f"""你是一个专业的机器人产品淘宝客服AI助手。
 
-**重要指令**：
-1. 下面提供了知识库中的标准答案
-2. 如果知道确切答案，请准确、简洁地回答
-3. 如果不知道确切答案，请说"抱歉，我暂时无法回答这个问题，建议您联系客服或查看产品说明书"
-4. 绝对不要编造参数、规格、公司地址等具体信息，尤其是知识库没有提到的信息。不要猜测
-5. 如果用户问的是技术参数，直接回答参数
+    SEPARATOR = "\x00"
+    # 用户问题不超过该长度时，通过枚举其子串查找“知识库问题是用户问题子串”的行，否则逐行扫描
+    MAX_ENUMERATED_QUERY = 64
+
+    def __init__(self, knowledge_df):
+        self.size = len(knowledge_df)
+
+        # 问题类型：类别编码
+        self.type_names = []
+        type_lookup = {}
+        type_codes = []
+        for qtype in knowledge_df['问题类型'].tolist():
+            if isinstance(qtype, float) and qtype != qtype:
+                qtype = None
+            code = type_lookup.get(qtype)
+            if code is None:
+                code = type_lookup[qtype] = len(self.type_names)
+                self.type_names.append(qtype)
+            type_codes.append(code)
+        self.type_codes = array('H' if len(self.type_names) < 65536 else 'I', type_codes)
+
+        # 标准回答：去重后按ID引用
+        self.answers = []
+        answer_lookup = {}
+        answer_ids = []
+        for answer in knowledge_df['标准回答'].tolist():
+            answer_id = answer_lookup.get(answer)
+            if answer_id is None:
+                answer_id = answer_lookup[answer] = len(self.answers)
+                self.answers.append(answer)
+            answer_ids.append(answer_id)
+        self.answer_ids = array('I', answer_ids)
+
+        # 问题：连续缓冲区 + 偏移量
+        raw_questions = [str(question) for question in knowledge_df['问题'].tolist()]
+        normalized = [question.strip().lower().replace(self.SEPARATOR, " ") for question in raw_questions]
+        self.raw_buffer, self.raw_offsets = self._pack(raw_questions)
+        self.norm_buffer, self.norm_offsets = self._pack(normalized)
+        self.min_question_len = min((len(q) for q in normalized), default=0)
+        self.max_question_len = max((len(q) for q in normalized), default=0)
+
+        # 精确匹配索引：按 (哈希, 行号) 排序，同一问题重复出现时取行号最小者
+        order = sorted(range(self.size), key=lambda i: (hash(normalized[i]), i))
+        self.exact_hashes = array('q', [hash(normalized[i]) for i in order])
+        self.exact_rows = array('I', order)
+
+        self._choices = None
+        self.bm25 = None  # 大知识库的二元组预筛选索引，由 get_kb_store 按配置构建
+        self.typo_index = None  # 拼音/错字纠错词条索引，由 get_kb_typo_index 在首次需要时构建
+        self.canonicalizer = None
+        self.canonical_hashes = None
+        self.canonical_rows = None
+
+    @classmethod
+    def _pack(cls, texts):
+        """拼接为单个字符串，offsets[i]:offsets[i+1]-1 为第i条（末尾为分隔符）"""
+        offsets = array('I', [0])
+        position = 0
+        for text in texts:
+            position += len(text) + 1
+            offsets.append(position)
+        return cls.SEPARATOR.join(texts) + cls.SEPARATOR, offsets
+
+    def question(self, index):
+        """原始问题文本"""
+        return self.raw_buffer[self.raw_offsets[index]:self.raw_offsets[index + 1] - 1]
+
+    def normalized_question(self, index):
+        """归一化后的问题文本"""
+        return self.norm_buffer[self.norm_offsets[index]:self.norm_offsets[index + 1] - 1]
+
+    def answer(self, index):
+        return self.answers[self.answer_ids[index]]
+
+    def question_type(self, index):
+        return self.type_names[self.type_codes[index]]
+
+    def choices(self):
+        """模糊匹配使用的原始问题列表（首次使用时生成并复用）"""
+        if self._choices is None:
+            self._choices = [self.question(i) for i in range(self.size)]
+        return self._choices
+
+    def exact_lookup(self, normalized_query):
+        """查找归一化问题完全相同的第一行，未找到返回None"""
+        query_hash = hash(normalized_query)
+        position = bisect_left(self.exact_hashes, query_hash)
+        while position < self.size and self.exact_hashes[position] == query_hash:
+            row = self.exact_rows[position]
+            if self.normalized_question(row) == normalized_query:
+                return row
+            position += 1
+        return None
+
+    def build_canonical_index(self, canonicalizer):
+        """用规范化器处理全部问题并建立哈希索引；同一规范化器重复调用时直接返回"""
+        if self.canonicalizer is not None and self.canonicalizer.signature == canonicalizer.signature:
+            return
+        canonical_hashes = [hash(canonicalizer(self.normalized_question(i))) for i in range(self.size)]
+        order = sorted(range(self.size), key=lambda i: (canonical_hashes[i], i))
+        self.canonical_hashes = array('q', [canonical_hashes[i] for i in order])
+        self.canonical_rows = array('I', order)
+        self.canonicalizer = canonicalizer
+
+    def reset_canonical_index(self):
+        """丢弃规范化索引（规则变化后型号列表可能不同），下次 build_canonical_index 时重建"""
+        self.canonicalizer = None
+        self.canonical_hashes = None
+        self.canonical_rows = None
+
+    def canonical_lookup(self, canonical_query):
+        """查找规范化后与 canonical_query 相同的第一行，未找到返回None"""
+        # 读取一次引用：其他线程可能同时重置或重建索引
+        canonicalizer, hashes, rows = self.canonicalizer, self.canonical_hashes, self.canonical_rows
+        if canonicalizer is None or hashes is None or rows is None:
+            return None
+        query_hash = hash(canonical_query)
+        position = bisect_left(hashes, query_hash)
+        while position < self.size and hashes[position] == query_hash:
+            row = rows[position]
+            if canonicalizer(self.normalized_question(row)) == canonical_query:
+                return row
+            position += 1
+        return None
+
+    def _row_at(self, buffer_position):
+        """缓冲区位置所在的行号"""
+        return bisect_left(self.norm_offsets, buffer_position + 1) - 1
+
+    def first_substring_match(self, normalized_query):
+        """
+        双向子串匹配：返回第一个满足“用户问题是知识库问题的子串”或“知识库问题是用户问题的子串”的行号
+
+        与逐行扫描的结果一致（取行号最小者）
+        """
+        query = normalized_query.replace(self.SEPARATOR, " ")
+        best = None
+
+        # 用户问题是知识库问题的子串：在连续缓冲区中查找第一次出现的位置
+        position = self.norm_buffer.find(query)
+        if position >= 0:
+            best = self._row_at(position)
+
+        # 知识库问题是用户问题的子串
+        if len(query) <= self.MAX_ENUMERATED_QUERY:
+            seen = set()
+            upper = min(len(query), self.max_question_len)
+            for length in range(self.min_question_len, upper + 1):
+                for start in range(len(query) - length + 1):
+                    piece = query[start:start + length]
+                    if piece in seen:
+                        continue
+                    seen.add(piece)
+                    row = self.exact_lookup(piece)
+                    if row is not None and (best is None or row < best):
+                        best = row
+        else:
+            limit = self.size if best is None else best
+            for row in range(limit):
+                if self.normalized_question(row) in query:
+                    best = row
+                    break
+        return best
+
+    def nbytes(self):
+        """查询路径占用的内存（字节），不含按需生成的模糊匹配列表"""
+        total = sum(sys.getsizeof(part) for part in (
+            self.type_codes, self.answer_ids, self.raw_buffer, self.raw_offsets,
+            self.norm_buffer, self.norm_offsets, self.exact_hashes, self.exact_rows,
+            self.answers, self.type_names))
+        if self.canonical_hashes is not None:
+            total += sys.getsizeof(self.canonical_hashes) + sys.getsizeof(self.canonical_rows)
+        total += sum(sys.getsizeof(answer) for answer in self.answers)
+        total += sum(sys.getsizeof(name) for name in self.type_names)
+        return total
+
+
+class BigramBM25Index:
+    """
+    字符二元组倒排索引 + BM25打分，用于在模糊匹配前筛选候选问题
+
+    中文问题没有空格，token_set_ratio 的“词”就是整句，逐条全量比较既慢又缺乏区分度；
+    先用二元组倒排表找出共享字符片段最多的几百条问题，再交给 rapidfuzz 精确打分。
+    倒排表以CSR数组存储（indptr/文档号/预先算好的BM25权重），查询只访问命中的倒排链。
+    """
+
+    def __init__(self, normalized_questions, k1=1.2, b=0.75):
+        self.size = len(normalized_questions)
+        self.vocabulary = {}
+        bigram_ids = []
+        doc_ids = []
+        term_freqs = []
+        doc_lengths = np.zeros(self.size, dtype=np.float32)
+        for doc, question in enumerate(normalized_questions):
+            grams = self.bigrams(question)
+            doc_lengths[doc] = len(grams)
+            for gram, tf in Counter(grams).items():
+                gram_id = self.vocabulary.setdefault(gram, len(self.vocabulary))
+                bigram_ids.append(gram_id)
+                doc_ids.append(doc)
+                term_freqs.append(tf)
+
+        bigram_ids = np.asarray(bigram_ids, dtype=np.int32)
+        order = np.argsort(bigram_ids, kind="stable")  # 同一二元组内按文档号升序
+        self.doc_ids = np.asarray(doc_ids, dtype=np.int32)[order]
+        term_freqs = np.asarray(term_freqs, dtype=np.float32)[order]
+        doc_freqs = np.bincount(bigram_ids, minlength=len(self.vocabulary))
+        self.indptr = np.concatenate(([0], np.cumsum(doc_freqs))).astype(np.int64)
+        self.doc_freqs = doc_freqs
+
+        # 预先计算每条倒排记录的BM25权重：idf * tf*(k1+1) / (tf + k1*(1-b+b*dl/avgdl))
+        avg_length = float(doc_lengths.mean()) if self.size else 1.0
+        idf = np.log(1 + (self.size - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+        norm = k1 * (1 - b + b * doc_lengths[self.doc_ids] / max(avg_length, 1e-6))
+        posting_idf = np.repeat(idf, doc_freqs)
+        self.weights = (posting_idf * term_freqs * (k1 + 1) / (term_freqs + norm)).astype(np.float32)
+
+    @staticmethod
+    def bigrams(text):
+        """去空白后的字符二元组列表（单字文本返回自身）"""
+        text = re.sub(r'\s+', '', text)
+        if len(text) < 2:
+            return [text] if text else []
+        return [text[i:i + 2] for i in range(len(text) - 1)]
+
+    def top_candidates(self, normalized_query, top_k, max_df_ratio=1.0):
+        """
+        返回BM25得分最高的至多 top_k 个候选行号（升序）
+
+        出现在超过 max_df_ratio 比例问题中的二元组区分度低且倒排链长，跳过以保持查询代价与知识库规模无关
+        """
+        query_grams = [(self.vocabulary[gram], query_tf)
+                       for gram, query_tf in Counter(self.bigrams(normalized_query)).items()
+                       if gram in self.vocabulary]
+        max_df = max_df_ratio * self.size
+        selective = [(gram_id, query_tf) for gram_id, query_tf in query_grams if self.doc_freqs[gram_id] <= max_df]
+        if not selective and query_grams:
+            # 全部是高频二元组时只用其中最少见的一个
+            selective = [min(query_grams, key=lambda item: self.doc_freqs[item[0]])]
+
+        scores = None
+        for gram_id, query_tf in selective:
+            if scores is None:
+                scores = np.zeros(self.size, dtype=np.float32)
+            start, end = self.indptr[gram_id], self.indptr[gram_id + 1]
+            scores[self.doc_ids[start:end]] += self.weights[start:end] * query_tf
+        if scores is None:
+            return []
+
+        matched = np.flatnonzero(scores)
+        if len(matched) > top_k:
+            # 取前 top_k，分数相同时优先行号小的，保证结果确定
+            matched_scores = scores[matched]
+            ranking = np.lexsort((matched, -matched_scores))[:top_k]
+            matched = matched[ranking]
+        return sorted(matched.tolist())
+
+    def nbytes(self):
+        return (self.doc_ids.nbytes + self.weights.nbytes + self.indptr.nbytes + self.doc_freqs.nbytes
+                + sys.getsizeof(self.vocabulary))
+
+
+# 模糊匹配候选预筛选配置
+FUZZY_PREFILTER_CONFIG = {
+    "enabled": True,
+    "min_kb_size": 5000,  # 知识库问题数达到该值才建立二元组索引并预筛选
+    "top_k": 300,  # 交给 rapidfuzz 精确打分的候选数
+    "max_df_ratio": 0.3,  # 跳过出现在超过该比例问题中的二元组
+    "min_query_chars": 4,  # 短于该长度的问题二元组太少，直接全量打分
+    "exhaustive_fallback": False,  # 与任何问题都没有共同二元组时是否仍全量打分
+}
+
+
+@st.cache_resource
+def get_kb_store_registry():
+    """知识库版本 -> 紧凑存储（进程内共享）；多租户时由租户注册表按内存预算卸载，版本数上限只作兜底"""
+    return {"lock": threading.Lock(), "stores": OrderedDict(), "max_versions": 64}
+
+
+def lookup_kb_store(kb_version):
+    """已构建的紧凑存储，尚未构建时返回None"""
+    registry = get_kb_store_registry()
+    with registry["lock"]:
+        store = registry["stores"].get(kb_version)
+        if store is not None:
+            registry["stores"].move_to_end(kb_version)
+        return store
+
+
+def register_kb_store(kb_version, store):
+    """登记构建完成的紧凑存储，超过版本数上限时丢弃最久未使用的版本"""
+    registry = get_kb_store_registry()
+    with registry["lock"]:
+        registry["stores"][kb_version] = store
+        while len(registry["stores"]) > registry["max_versions"]:
+            registry["stores"].popitem(last=False)
+    print(f"DEBUG: 已构建知识库 {kb_version} 的紧凑存储，{store.nbytes() / 1024:.0f}KB")
+
+
+def build_kb_canonical_index(store, rule_base=None):
+    """按配置构建规范化精确匹配索引，未启用时返回False"""
+    if not CANONICALIZE_CONFIG["enabled"]:
+        return False
+    store.build_canonical_index(get_query_canonicalizer(rule_base))
+
+
+def build_kb_bm25_index(store):
+    """大知识库按配置构建二元组预筛选索引，不需要时返回False"""
+    if not FUZZY_PREFILTER_CONFIG["enabled"] or store.size < FUZZY_PREFILTER_CONFIG["min_kb_size"]:
+        return False
+    if store.bm25 is None:
+        store.bm25 = BigramBM25Index([store.normalized_question(i) for i in range(store.size)])
+
+
+def get_kb_store(knowledge_df, rule_base=None):
+    """获取知识库对应的紧凑存储，首次访问时构建；rule_base 用于规范化索引，未指定时读取 session_state"""
+    kb_version = get_kb_version(knowledge_df)
+    store = lookup_kb_store(kb_version)
+    if store is not None:
+        return store
+    # 构建在锁外进行，避免大知识库阻塞其他会话
+    store = CompactKnowledgeBase(knowledge_df)
+    build_kb_canonical_index(store, rule_base)
+    build_kb_bm25_index(store)
+    register_kb_store(kb_version, store)
+    return store
+
+
+# ====== 请求截止时间：单次请求的总时间预算，各阶段按剩余时间跳过可选步骤或返回部分结果 ======
+DEADLINE_CONFIG = {
+    "enabled": True,
+    "total_seconds": float(os.getenv("REQUEST_DEADLINE", "15")),  # 单次请求（知识库匹配+AI调用）的总预算
+    "llm_reserve": 3.0,  # 知识库阶段需要为AI调用预留的时间
+    "min_llm_seconds": 1.0,  # 剩余时间不足该值时不再发起或切换模型调用
+    "fuzzy_chunk_rows": 5000,  # 全量模糊打分时每块的行数，块之间检查截止时间
+    "suggestions": 3,  # 降级回复中给出的相关问题数
+    "relaxed_score": 75,  # 降级时放宽匹配（不限技术问题）：最相关问题不低于该分数时直接给出其答案
+}
+
+
+class Deadline:
+    """
+    单次请求的截止时间
+
+    各阶段用 expired()/allows(秒) 检查剩余时间，不足时跳过可选步骤或返回已有的部分结果，并调用 hit(阶段) 计数；
+    reserve(秒) 返回提前结束的子截止时间（如知识库阶段为AI调用预留时间），与父对象共用命中记录
+    """
+
+    def __init__(self, seconds, stats=None, hits=None):
+        self.expires_at = time.perf_counter() + seconds
+        self.stats = stats
+        self.hits = hits if hits is not None else []  # 本次请求中超时的阶段
+
+    @classmethod
+    def unlimited(cls):
+        return cls(math.inf)
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.perf_counter())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def allows(self, seconds):
+        return self.remaining() >= seconds
+
+    def reserve(self, seconds):
+        return Deadline(self.expires_at - seconds - time.perf_counter(), self.stats, self.hits)
+
+    def hit(self, stage):
+        """记录某阶段因时间不足被跳过或截断（每次请求每个阶段只计一次）"""
+        if stage in self.hits:
+            return
+        self.hits.append(stage)
+        print(f"DEBUG: 阶段 {stage} 超出请求时间预算")
+        if self.stats is not None:
+            with self.stats["lock"]:
+                self.stats["hits"][stage] += 1
+
+
+@st.cache_resource
+def get_deadline_stats():
+    """各阶段截止时间命中次数（进程内共享）"""
+    return {"lock": threading.Lock(), "requests": 0, "requests_hit": 0, "hits": Counter()}
+
+
+def new_request_deadline():
+    """为一次请求创建截止时间，未启用时不限时"""
+    stats = get_deadline_stats()
+    with stats["lock"]:
+        stats["requests"] += 1
+    seconds = DEADLINE_CONFIG["total_seconds"] if DEADLINE_CONFIG["enabled"] else math.inf
+    return Deadline(seconds, stats)
+
+
+# ====== 模糊匹配：大知识库分片到常驻进程池并行打分 ======
+# 与预筛选的关系：建有二元组索引（FUZZY_PREFILTER_CONFIG["min_kb_size"] 以上）的知识库只对候选打分，
+# 分片只用于预筛选不适用的查询——短于 min_query_chars 的问题，以及开启 exhaustive_fallback 后没有共同二元组的问题；
+# 关闭预筛选时，达到 min_kb_size 的知识库的所有模糊匹配都走分片
+FUZZY_SHARD_CONFIG = {
+    "enabled": True,
+    "min_kb_size": 20000,  # 知识库问题数达到该值才启用分片，小知识库进程间通信开销大于收益
+    "num_shards": os.cpu_count() or 1,
+    "max_services": 2,  # 同时保留进程池的知识库版本数（多个租户的大知识库轮流访问时避免反复重建）
+}
+
+
+@st.cache_resource
+def get_fuzzy_shard_registry():
+    """知识库版本 -> 分片服务（进程内共享，超过数量上限时关闭最久未使用的进程池）"""
+    return {"lock": threading.Lock(), "services": OrderedDict()}
+
+
+def get_fuzzy_shard_service(knowledge_df):
+    """获取知识库对应的分片服务，首次访问时启动进程池"""
+    registry = get_fuzzy_shard_registry()
+    kb_version = get_kb_version(knowledge_df)
+    with registry["lock"]:
+        service = registry["services"].get(kb_version)
+        if service is not None:
+            registry["services"].move_to_end(kb_version)
+            return service
+        print(f"DEBUG: 为知识库 {kb_version} 启动 {FUZZY_SHARD_CONFIG['num_shards']} 个模糊匹配分片")
+        service = FuzzyShardService(get_kb_store(knowledge_df).choices(), FUZZY_SHARD_CONFIG["num_shards"])
+        registry["services"][kb_version] = service
+        evicted = []
+        while len(registry["services"]) > FUZZY_SHARD_CONFIG["max_services"]:
+            evicted.append(registry["services"].popitem(last=False)[1])
+    # 关闭时等待工作进程退出，在锁外进行，不阻塞其他知识库的查询
+    for old_service in evicted:
+        old_service.shutdown()
+    return service
+
+
+def release_kb_indexes(kb_version):
+    """释放某个知识库版本的紧凑存储和模糊匹配进程池（租户卸载或更换知识库后调用）"""
+    registry = get_kb_store_registry()
+    with registry["lock"]:
+        registry["stores"].pop(kb_version, None)
+    shard_registry = get_fuzzy_shard_registry()
+    with shard_registry["lock"]:
+        service = shard_registry["services"].pop(kb_version, None)
+    if service is not None:
+        service.shutdown()
+
+
+def fuzzy_extract_one(query, knowledge_df, score_cutoff=0, deadline=None):
+    """
+    在知识库问题中查找最佳模糊匹配，返回 (匹配问题, 分数, 索引)，低于 score_cutoff 时返回 None
+
+    大知识库优先用二元组BM25索引预筛选候选，只对候选打分；未建索引时使用分片进程池，
+    结果与单线程 process.extractOne 一致。
+    指定 deadline 时全量打分分块进行（分片进程池最多等待剩余时间），时间用完后返回已扫描部分中的最佳候选
+    """
+    if deadline is not None and deadline.expired():
+        deadline.hit("fuzzy")
+        return None
+    store = get_kb_store(knowledge_df)
+    if (store.bm25 is not None and FUZZY_PREFILTER_CONFIG["enabled"]
+            and len(query.strip()) >= FUZZY_PREFILTER_CONFIG["min_query_chars"]):
+        candidates = store.bm25.top_candidates(query.strip().lower(), FUZZY_PREFILTER_CONFIG["top_k"],
+                                               FUZZY_PREFILTER_CONFIG["max_df_ratio"])
+        if not candidates and not FUZZY_PREFILTER_CONFIG["exhaustive_fallback"]:
+            return None
+        if candidates:
+            choices = store.choices()
+            # 候选按行号升序，分数相同时 extractOne 取第一个，即行号最小者
+            result = process.extractOne(
+                query,
+                [choices[i] for i in candidates],
+                scorer=fuzz.token_set_ratio,
+                score_cutoff=score_cutoff
+            )
+            if result is None:
+                return None
+            best_match, score, position = result
+            return best_match, score, candidates[position]
+
+    if (FUZZY_SHARD_CONFIG["enabled"] and FUZZY_SHARD_CONFIG["num_shards"] > 1
+            and len(knowledge_df) >= FUZZY_SHARD_CONFIG["min_kb_size"]):
+        service = get_fuzzy_shard_service(knowledge_df)
+        if deadline is None:
+            return service.extract_one(query, score_cutoff)
+        remaining = deadline.remaining()
+        result, complete = service.extract_one_partial(query, score_cutoff,
+                                                       remaining if math.isfinite(remaining) else None)
+        if not complete:
+            deadline.hit("fuzzy")
+            print(f"DEBUG: 模糊匹配分片超时，使用已完成分片中的最佳候选")
+        return result
+
+    choices = store.choices()
+    chunk_rows = DEADLINE_CONFIG["fuzzy_chunk_rows"]
+    if deadline is None or len(choices) <= chunk_rows:
+        return process.extractOne(
+            query,
+            choices,
+            scorer=fuzz.token_set_ratio,  # 使用token_set_ratio，对词序不敏感
+            score_cutoff=score_cutoff
+        )
+
+    # 分块打分，块之间检查截止时间；分数相同时保留行号最小者，完整扫描的结果与一次性打分一致
+    best = None
+    for start in range(0, len(choices), chunk_rows):
+        if deadline.expired():
+            deadline.hit("fuzzy")
+            print(f"DEBUG: 模糊匹配扫描 {start}/{len(choices)} 行后超时，使用已有最佳候选")
+            break
+        result = process.extractOne(query, choices[start:start + chunk_rows], scorer=fuzz.token_set_ratio,
+                                    score_cutoff=score_cutoff)
+        if result is not None and (best is None or result[1] > best[1]):
+            best = (result[0], result[1], start + result[2])
+    return best
+
+
+# ====== 拼音/错字纠错：知识库未命中时纠正同音错字、拼音和个别错字后再查一次，避免为错别字调用模型 ======
+TYPO_CONFIG = {
+    "enabled": os.getenv("TYPO_CORRECTION", "1") != "0",
+    "max_term_chars": 4,  # 词条和纠正片段的最大字数
+    "kb_sample_rows": 20000,  # 统计知识库词条时最多读取的问题数（均匀抽样）
+    "kb_min_count": 2,  # 至少出现在这么多条问题中的片段才作为词条
+    "kb_max_terms": 10000,
+}
+
+
+@st.cache_resource
+def get_typo_stats():
+    """纠错阶段统计（进程内共享）：attempts 为进入纠错的知识库未命中数，kb_hits 为纠正后命中、省去的模型调用数"""
+    return {"lock": threading.Lock(), "attempts": 0, "corrected": 0, "kb_hits": 0, "preset_hits": 0,
+            "seconds": 0.0, "kinds": Counter()}
+
+
+def build_kb_typo_index(store):
+    """统计知识库问题中的高频片段作为纠错词条（大知识库均匀抽样），未启用时返回False"""
+    if not TYPO_CONFIG["enabled"]:
+        return False
+    if store.typo_index is None:
+        start = time.perf_counter()
+        step = max(1, store.size // TYPO_CONFIG["kb_sample_rows"])
+        terms = frequent_terms((store.normalized_question(i) for i in range(0, store.size, step)),
+                               max_chars=TYPO_CONFIG["max_term_chars"], min_count=TYPO_CONFIG["kb_min_count"],
+                               max_terms=TYPO_CONFIG["kb_max_terms"])
+        store.typo_index = TermIndex(terms)
+        print(f"DEBUG: 纠错词条索引 {len(terms)} 个词条，构建 {time.perf_counter() - start:.2f}秒")
+
+
+def get_kb_typo_index(store):
+    """知识库的纠错词条索引；后台加载时已构建，否则在首次纠错时构建"""
+    if store.typo_index is None:
+        build_kb_typo_index(store)
+    return store.typo_index
+
+
+@st.cache_resource
+def get_rules_typo_registry(tenant_id):
+    """租户路由规则的意图关键词索引，规则重新加载后重建"""
+    return {"lock": threading.Lock(), "rules": None, "indexes": []}
+
+
+def get_rules_typo_indexes(tenant_id):
+    """
+    意图关键词的纠错索引：业务意图的关键词（退货、发票）允许错字纠正；
+    有预设回复的意图多为问候等短词，只差一个字时常是另一个正常用词（在哪/在吗），只做同音和拼音纠正
+    """
+    rules = get_routing_rules(tenant_id)
+    registry = get_rules_typo_registry(tenant_id)
+    with registry["lock"]:
+        if registry["rules"] is not rules:
+            max_chars = TYPO_CONFIG["max_term_chars"]
+            business, preset = {}, {}
+            for intent, patterns in rules.patterns.items():
+                terms = preset if intent in rules.replies else business
+                terms.update((pattern, 1) for pattern in patterns if 2 <= len(pattern) <= max_chars
+                             and all('\u4e00' <= char <= '\u9fff' for char in pattern))
+            registry.update(rules=rules, indexes=[TermIndex(business),
+                                                  TermIndex(preset, substitution_min_chars=max_chars + 1)])
+        return registry["indexes"]
+
+
+def find_with_typo_correction(user_query, knowledge_df, deadline=None, tenant_id=None):
+    """
+    纠正问题后重新查找知识库，返回 (纠正后的问题, 回答, 问题类型)；没有可纠正之处时返回None，回答为None表示仍未命中
+
+    纠正后的问题走与原问题相同的完整知识库匹配（包括外观拦截和只对技术问题的模糊匹配），不另放宽条件
+    """
+    if not TYPO_CONFIG["enabled"] or knowledge_df is None or knowledge_df.empty:
+        return None
+    if deadline is not None and deadline.expired():
+        deadline.hit("typo")
+        return None
+    start = time.perf_counter()
+    store = get_kb_store(knowledge_df)
+    corrected, corrections = correct_query(user_query, [get_kb_typo_index(store)] + get_rules_typo_indexes(tenant_id),
+                                           TYPO_CONFIG["max_term_chars"])
+    reply, detected_type = None, None
+    if corrections:
+        print(f"DEBUG: 纠错 {user_query} -> {corrected}: {corrections}")
+        reply, detected_type = find_in_knowledge_base(corrected, knowledge_df, deadline, tenant_id)
+    stats = get_typo_stats()
+    with stats["lock"]:
+        stats["attempts"] += 1
+        stats["seconds"] += time.perf_counter() - start
+        if corrections:
+            stats["corrected"] += 1
+            stats["kinds"].update(kind for _, _, kind in corrections)
+        stats["kb_hits"] += reply is not None
+    return (corrected, reply, detected_type) if corrections else None
+
+
+# ====== 未命中缓存：已知无法从知识库回答的问题直接走AI ======
+NEGATIVE_CACHE_CONFIG = {
+    "enabled": True,
+    "max_entries": 10000,  # 最多缓存的未命中问题数，超出时淘汰最久未使用的
+}
+
+
+def normalize_query(user_query):
+    """缓存键使用的问题归一化：去首尾空白、小写、合并连续空白"""
+    return re.sub(r'\s+', ' ', user_query.strip().lower())
+
+
+class NegativeMatchCache:
+    """
+    有界LRU未命中缓存，键为 (知识库版本, 租户, 归一化问题)
+
+    匹配结果还取决于租户的路由规则，相同知识库的不同租户分别缓存。
+    记录每个问题完整匹配流程的耗时，命中时累计为节省的时间
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (kb_version, tenant_id, query) -> 完整匹配耗时（秒）
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.lookups = 0
+        self.evictions = 0
+        self.saved_seconds = 0.0
+
+    def contains(self, kb_version, tenant_id, query):
+        """查询是否为已知未命中，命中时更新LRU顺序和统计"""
+        key = (kb_version, tenant_id, normalize_query(query))
+        with self.lock:
+            self.lookups += 1
+            cost = self.entries.get(key)
+            if cost is None:
+                return False
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += cost
+            return True
+
+    def add(self, kb_version, tenant_id, query, cost):
+        """记录一次完整匹配流程后的未命中"""
+        key = (kb_version, tenant_id, normalize_query(query))
+        with self.lock:
+            self.entries[key] = cost
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keep_version=None, versions=None, tenant_id=None):
+        """
+        清除其他知识库版本的条目（keep_version为None时全部清除）；指定 versions 时只清除这些版本。
+        指定 tenant_id 时只清除该租户的条目
+        """
+        with self.lock:
+            if versions is not None:
+                stale = [key for key in self.entries if key[0] in versions]
+            else:
+                stale = [key for key in self.entries if key[0] != keep_version]
+            if tenant_id is not None:
+                stale = [key for key in stale if key[1] == tenant_id]
+            for key in stale:
+                del self.entries[key]
+            return len(stale)
+
+    def stats(self):
+        """返回统计信息，用于界面展示"""
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "lookups": self.lookups,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "evictions": self.evictions,
+                "saved_seconds": self.saved_seconds,
+            }
+
+
+@st.cache_resource
+def get_negative_cache():
+    """进程内共享的未命中缓存"""
+    return NegativeMatchCache(NEGATIVE_CACHE_CONFIG["max_entries"])
+
+
+# ====== 命中缓存与AI回复缓存：热门问题直接返回上次的匹配结果或AI回复，由缓存预热提前填充 ======
+MATCH_CACHE_CONFIG = {
+    "enabled": True,
+    "max_entries": 20000,  # 只缓存需要合并拆分、子串或模糊匹配才命中的问题，精确匹配本身已是O(1)
+}
+
+RESPONSE_CACHE_CONFIG = {
+    "enabled": True,
+    "max_entries": 2000,
+    "ttl": 6 * 3600,  # AI回复的有效期（秒）
+}
+
+
+class MatchResultCache(NegativeMatchCache):
+    """
+    有界LRU命中缓存，键与未命中缓存相同，值为 (完整匹配耗时, (回答, 类型))
+
+    超时得到的部分结果不写入缓存
+    """
+
+    def get(self, kb_version, tenant_id, query):
+        """返回缓存的 (回答, 类型)，未命中返回None"""
+        key = (kb_version, tenant_id, normalize_query(query))
+        with self.lock:
+            self.lookups += 1
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += entry[0]
+            return entry[1]
+
+    def put(self, kb_version, tenant_id, query, result, cost):
+        self.add(kb_version, tenant_id, query, (cost, result))
+
+
+class ResponseCache:
+    """
+    AI回复缓存，键为 (知识库版本, 租户, Prompt分支, Prompt摘要)
+
+    Prompt 中包含知识库片段和对话历史，键相同即请求内容完全相同；命中时不再调用模型，也不计入用量
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # 键 -> (写入时间, 响应)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.lookups = 0
+        self.saved_seconds = 0.0
+        self.saved_tokens = 0
+
+    @staticmethod
+    def key(kb_version, tenant_id, branch, prompt):
+        return kb_version, tenant_id, branch, hashlib.sha1(prompt.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            self.lookups += 1
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            stored_at, response = entry
+            if time.time() - stored_at > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += response.get("latency", 0.0)
+            self.saved_tokens += (response.get("input_tokens") or 0) + (response.get("output_tokens") or 0)
+            return dict(response)
+
+    def put(self, key, response):
+        with self.lock:
+            self.entries[key] = (time.time(), dict(response))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, keep_version=None, versions=None, tenant_id=None):
+        """参数同 NegativeMatchCache.invalidate"""
+        with self.lock:
+            if versions is not None:
+                stale = [key for key in self.entries if key[0] in versions]
+            else:
+                stale = [key for key in self.entries if key[0] != keep_version]
+            if tenant_id is not None:
+                stale = [key for key in stale if key[1] == tenant_id]
+            for key in stale:
+                del self.entries[key]
+            return len(stale)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "lookups": self.lookups,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "saved_seconds": self.saved_seconds,
+                "saved_tokens": self.saved_tokens,
+            }
+
+
+@st.cache_resource
+def get_match_cache():
+    """进程内共享的命中缓存"""
+    return MatchResultCache(MATCH_CACHE_CONFIG["max_entries"])
+
+
+@st.cache_resource
+def get_response_cache():
+    """进程内共享的AI回复缓存"""
+    return ResponseCache(RESPONSE_CACHE_CONFIG["max_entries"], RESPONSE_CACHE_CONFIG["ttl"])
+
+
+# ====== 共享匹配缓存（二级）：多个实例共用匹配结果，进程内的命中/未命中缓存作为一级 ======
+SHARED_CACHE_CONFIG = {
+    "backend": os.getenv("SHARED_CACHE_BACKEND", "none"),  # none / sqlite / tcp
+    "address": os.getenv("SHARED_CACHE_ADDRESS", "127.0.0.1:8901"),  # tcp：python shared_cache.py 启动的缓存服务
+    "path": os.getenv("SHARED_CACHE_PATH", "shared_cache.db"),  # sqlite：各实例共用的数据库文件
+    "timeout": 0.2,  # tcp 读写超时（秒），超时视为未命中
+}
+
+
+@st.cache_resource
+def get_shared_match_cache():
+    """进程内共享的二级缓存客户端，未配置后端时返回None"""
+    config = SHARED_CACHE_CONFIG
+    if config["backend"] == "tcp":
+        backend = create_cache_backend("tcp", config["address"], timeout=config["timeout"])
+    else:
+        backend = create_cache_backend(config["backend"], path=config["path"])
+    if backend is None:
+        return None
+    print(f"DEBUG: 共享匹配缓存后端: {backend.backend}")
+    return SharedMatchCache(backend)
+
+
+def shared_cache_version(kb_version, tenant_id=None):
+    """
+    二级缓存键的版本：知识库内容哈希 + 租户 + 租户路由规则的内容哈希
+
+    不用规则文件里人工维护的 version：改了规则没改版本号、或各租户的规则文件版本号相同时，
+    各实例会继续读到旧规则或其他租户规则下的匹配结果
+    """
+    tenant_id = tenant_id or get_tenant_id()
+    return f"{kb_version}:{tenant_id}:{get_routing_rules(tenant_id).digest}"
+
+
+# ====== AI回答沉淀：高频且获得好评的AI回答升级为生成知识层 ======
+
+GENERATED_TIER_CONFIG = {
+    "enabled": True,
+    "min_occurrences": 3,  # 同一类问题至少由AI回答过的次数
+    "min_positive": 1,  # 至少获得的好评数（且好评多于差评）
+    "cluster_similarity": 90,  # 规范化问题的相似度（fuzz.ratio）达到该值归为同一类
+    "interval": 600,  # 后台沉淀任务的运行间隔（秒）
+    "refresh_interval": 5,  # 从会话存储重新加载生成知识层的最短间隔（秒）
+    "history_hours": 48,  # AI调用量统计保留的小时数
+}
+GENERATED_TIER_TYPE = "AI沉淀"
+GENERATED_TIER_DOCUMENT = "generated_kb"
+
+
+class GeneratedKnowledgeTier:
+    """
+    生成知识层：由后台任务从AI回答中沉淀，按规范化问题精确查找
+
+    条目保存在会话存储的共享文档中（多实例共用），每次升级、更新或降级版本号加一；
+    降级的条目保留记录，后台任务不会再次升级它
+    """
+
+    def __init__(self, session_store, refresh_interval=5, document=GENERATED_TIER_DOCUMENT):
+        self.session_store = session_store
+        self.document = document
+        self.refresh_interval = refresh_interval
+        self.lock = threading.RLock()
+        self.version = 0
+        self.entries = {}  # 条目ID -> 条目
+        self.index = {}  # 规范化问题 -> 生效条目ID
+        self.last_refresh = 0.0
+        self.refresh(force=True)
+
+    def _reindex(self):
+        self.index = {key: entry["id"] for entry in self.entries.values() if entry["status"] == "active"
+                      for key in entry["keys"]}
+
+    def refresh(self, force=False):
+        """其他实例更新了生成知识层时重新加载"""
+        now = time.monotonic()
+        if not force and now - self.last_refresh < self.refresh_interval:
+            return
+        self.last_refresh = now
+        document = self.session_store.load_document(self.document)
+        with self.lock:
+            if document and document["version"] > self.version:
+                hits = {entry_id: entry.get("hits", 0) for entry_id, entry in self.entries.items()}
+                self.version = document["version"]
+                self.entries = {entry["id"]: entry for entry in document["entries"]}
+                for entry_id, entry in self.entries.items():
+                    entry["hits"] = hits.get(entry_id, 0)
+                self._reindex()
+
+    def _save(self):
+        """版本号加一并写入会话存储（调用方持有锁）"""
+        self.version += 1
+        entries = [{key: value for key, value in entry.items() if key != "hits"} for entry in self.entries.values()]
+        self.session_store.save_document(self.document, {"version": self.version, "entries": entries})
+        self._reindex()
+
+    def lookup(self, canonical_query):
+        """按规范化问题查找生效条目，未找到返回None"""
+        self.refresh()
+        entry_id = self.index.get(canonical_query)
+        if entry_id is None:
+            return None
+        entry = self.entries[entry_id]
+        entry["hits"] = entry.get("hits", 0) + 1
+        return entry
+
+    def apply_clusters(self, clusters, config):
+        """根据聚类结果升级新条目、更新已有条目，返回 (升级数, 更新数)"""
+        promoted = updated = 0
+        with self.lock:
+            self.refresh(force=True)
+            key_owner = {key: entry["id"] for entry in self.entries.values() for key in entry["keys"]}
+            for cluster in clusters:
+                if not cluster["answer"]:
+                    continue
+                qualified = (cluster["count"] >= config["min_occurrences"]
+                             and cluster["positive"] >= config["min_positive"]
+                             and cluster["positive"] > cluster["negative"])
+                owner = next((key_owner[key] for key in cluster["keys"] if key in key_owner), None)
+                if owner is not None:
+                    entry = self.entries[owner]
+                    if entry["status"] != "active":
+                        continue
+                    if not qualified:
+                        # 差评增多，自动降级
+                        entry["status"] = "demoted"
+                        entry["demoted_at"] = time.time()
+                        updated += 1
+                        continue
+                    new_keys = sorted(set(entry["keys"]) | set(cluster["keys"]))
+                    if (new_keys, cluster["answer"], cluster["count"]) != (entry["keys"], entry["answer"], entry["count"]):
+                        entry.update(keys=new_keys, answer=cluster["answer"], count=cluster["count"],
+                                     positive=cluster["positive"], negative=cluster["negative"],
+                                     avg_latency=cluster["avg_latency"])
+                        updated += 1
+                elif qualified:
+                    entry_id = uuid.uuid4().hex[:12]
+                    self.entries[entry_id] = {
+                        "id": entry_id,
+                        "question": cluster["question"],
+                        "answer": cluster["answer"],
+                        "keys": sorted(cluster["keys"]),
+                        "count": cluster["count"],
+                        "positive": cluster["positive"],
+                        "negative": cluster["negative"],
+                        "avg_latency": cluster["avg_latency"],
+                        "status": "active",
+                        "promoted_at": time.time(),
+                        "promoted_version": self.version + 1,
+                        "hits": 0,
+                    }
+                    promoted += 1
+            if promoted or updated:
+                self._save()
+        return promoted, updated
+
+    def demote(self, entry_id):
+        """降级条目：不再用于回答，后台任务也不会再次升级"""
+        with self.lock:
+            self.refresh(force=True)
+            entry = self.entries.get(entry_id)
+            if entry is None or entry["status"] != "active":
+                return False
+            entry["status"] = "demoted"
+            entry["demoted_at"] = time.time()
+            self._save()
+        return True
+
+    def active_entries(self):
+        with self.lock:
+            return [entry for entry in self.entries.values() if entry["status"] == "active"]
+
+
+def cluster_ai_answers(conversation_chunks, canonicalizer, similarity):
+    """
+    将AI回答过的问题按规范化结果分组，再把相似的组合并为一类
+
+    每类的候选答案为好评回答中出现最多的一条；外观类问题（知识库阶段会被拦截）不参与
+    """
+    groups = {}
+    for chunk in conversation_chunks:
+        for _, _, record in chunk:
+            source = record.get("source") or ""
+            if not source.startswith("AI模型（") or "外观" in source:
+                continue
+            key = canonicalizer(record["query"])
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = {"question": record["query"], "count": 0, "positive": 0, "negative": 0,
+                                       "latency_sum": 0.0, "replies": Counter()}
+            group["count"] += 1
+            group["latency_sum"] += record.get("latency") or 0.0
+            feedback = record.get("feedback")
+            if feedback == "positive":
+                group["positive"] += 1
+                group["replies"][record["reply"]] += 1
+            elif feedback == "negative":
+                group["negative"] += 1
+
+    # 出现次数多的问题作为类的代表，其余问题并入相似度达标的类
+    clusters = []
+    leaders = []
+    for key, group in sorted(groups.items(), key=lambda item: -item[1]["count"]):
+        match = process.extractOne(key, leaders, scorer=fuzz.ratio, score_cutoff=similarity) if leaders else None
+        if match is None:
+            leaders.append(key)
+            clusters.append({"keys": [key], "question": group["question"], "count": 0, "positive": 0,
+                             "negative": 0, "latency_sum": 0.0, "replies": Counter()})
+            cluster = clusters[-1]
+        else:
+            cluster = clusters[match[2]]
+            cluster["keys"].append(key)
+        for field in ("count", "positive", "negative", "latency_sum"):
+            cluster[field] += group[field]
+        cluster["replies"].update(group["replies"])
+
+    for cluster in clusters:
+        cluster["answer"] = cluster["replies"].most_common(1)[0][0] if cluster["replies"] else None
+        cluster["avg_latency"] = cluster["latency_sum"] / cluster["count"] if cluster["count"] else 0.0
+        del cluster["replies"], cluster["latency_sum"]
+    return clusters
+
+
+@st.cache_resource
+def get_generated_tier(tenant_id):
+    """进程内共享的生成知识层，每个租户一个"""
+    return GeneratedKnowledgeTier(get_session_store(), GENERATED_TIER_CONFIG["refresh_interval"],
+                                  tenant_document(GENERATED_TIER_DOCUMENT, tenant_id))
+
+
+def run_generated_promotion(model_codes, tenant_id):
+    """执行一次沉淀：扫描租户的对话记录（只读取该租户的记录）、聚类并更新该租户的生成知识层，返回结果摘要"""
+    start = time.perf_counter()
+    canonicalizer = build_query_canonicalizer(model_codes)
+    clusters = cluster_ai_answers(iter_tenant_conversations(get_session_store(), tenant_id), canonicalizer,
+                                  GENERATED_TIER_CONFIG["cluster_similarity"])
+    promoted, updated = get_generated_tier(tenant_id).apply_clusters(clusters, GENERATED_TIER_CONFIG)
+    result = {"time": time.strftime("%H:%M:%S"), "clusters": len(clusters), "promoted": promoted,
+              "updated": updated, "seconds": time.perf_counter() - start}
+    print(f"DEBUG: 租户 {tenant_id} AI回答沉淀完成: {result}")
+    return result
+
+
+@st.cache_resource
+def get_promotion_jobs():
+    """租户 -> 后台沉淀任务（进程内共享）"""
+    return {"lock": threading.Lock(), "jobs": {}}
+
+
+def get_promotion_job(tenant_id, model_codes):
+    """
+    确保租户的后台沉淀任务在运行（每个进程每个租户一个），按固定间隔运行
+
+    任务按租户登记；知识库更新导致型号列表变化时停止旧任务，用新的型号列表重新启动
+    """
+    model_codes = tuple(model_codes)
+    registry = get_promotion_jobs()
+    with registry["lock"]:
+        job = registry["jobs"].get(tenant_id)
+        if job is not None and job["model_codes"] == model_codes:
+            return job
+        if job is not None:
+            job["stop"].set()
+        job = {"runs": 0, "last_result": None, "model_codes": model_codes, "stop": threading.Event()}
+        registry["jobs"][tenant_id] = job
+
+    def loop():
+        while not job["stop"].wait(GENERATED_TIER_CONFIG["interval"]):
+            try:
+                job["last_result"] = run_generated_promotion(model_codes, tenant_id)
+                job["runs"] += 1
+            except Exception as e:
+                print(f"DEBUG: AI回答沉淀失败: {str(e)}")
+
+    threading.Thread(target=loop, name=f"generated-tier-promotion-{tenant_id}", daemon=True).start()
+    return job
+
+
+@st.cache_resource
+def get_llm_volume_stats():
+    """按小时统计AI调用量和生成知识层命中量，用于观察沉淀带来的AI调用下降"""
+    return {"lock": threading.Lock(), "hours": OrderedDict()}
+
+
+def record_llm_volume(kind, latency):
+    """kind 为 llm（实际调用AI）或 generated（生成知识层命中，latency 为估计节省的AI耗时）"""
+    stats = get_llm_volume_stats()
+    hour = time.strftime("%m-%d %H:00")
+    with stats["lock"]:
+        bucket = stats["hours"].get(hour)
+        if bucket is None:
+            bucket = stats["hours"][hour] = {"llm_calls": 0, "llm_seconds": 0.0,
+                                             "generated_hits": 0, "saved_seconds": 0.0}
+            while len(stats["hours"]) > GENERATED_TIER_CONFIG["history_hours"]:
+                stats["hours"].popitem(last=False)
+        if kind == "llm":
+            bucket["llm_calls"] += 1
+            bucket["llm_seconds"] += latency
+        else:
+            bucket["generated_hits"] += 1
+            bucket["saved_seconds"] += latency
+
+
+def lookup_generated_answer(user_query, canonicalizer=None, tenant_id=None):
+    """知识库各阶段都未命中时查找租户的生成知识层，返回 (回答, 类型) 或 None"""
+    if not GENERATED_TIER_CONFIG["enabled"]:
+        return None
+    entry = get_generated_tier(tenant_id or get_tenant_id()).lookup((canonicalizer or get_query_canonicalizer())(user_query))
+    if entry is None:
+        return None
+    print(f"DEBUG: 命中AI沉淀知识: {entry['question']}")
+    record_llm_volume("generated", entry["avg_latency"])
+    return entry["answer"], GENERATED_TIER_TYPE
+
+
+def find_in_knowledge_base(user_query, knowledge_df, deadline=None, tenant_id=None):
+    """
+    系统核心查询函数 - 智能匹配版：平衡准确性和召回率
+
+    deadline 用完时跳过剩余的合并问题拆分和模糊匹配，返回已找到的部分结果；
+    tenant_id 用于查找该租户的生成知识层，后台线程中调用时需要指定
+    """
+    if deadline is None:
+        deadline = Deadline.unlimited()
+    print(f"\n=== DEBUG find_in_knowledge_base 开始 ===")
+    print(f"用户查询: {user_query}")
+    
+    if knowledge_df is None or knowledge_df.empty:
+        print(f"DEBUG: 知识库为空")
+        return None, None
+    
+    # ====== 第一步：强力拦截外观问题 ======
+    # 只要包含外观词表（rules.json 的 kb_appearance）中的关键词，就跳过知识库匹配
+    tenant_id = tenant_id or get_tenant_id()
+    rules = get_routing_rules(tenant_id)
+    keyword = rules.first("kb_appearance", user_query)
+    if keyword is not None:
+        print(f"DEBUG: 发现外观关键词 '{keyword}'，跳过知识库匹配")
+        return None, None
+    
+    # ====== 未命中缓存：已知未命中的问题跳过后续所有匹配 ======
+    match_start = time.perf_counter()
+    kb_version = get_kb_version(knowledge_df)
+    store = get_kb_store(knowledge_df)
+    # 规范化器随知识库确定；优先使用建索引时的规范化器，后台线程中读不到session_state也能得到同一个。
+    # 规则重新加载后规范化索引被丢弃，按租户当前规则的型号列表重建
+    canonicalizer = store.canonicalizer or get_query_canonicalizer(rules.rule_base())
+    negative_cache = get_negative_cache() if NEGATIVE_CACHE_CONFIG["enabled"] else None
+    if negative_cache is not None and negative_cache.contains(kb_version, tenant_id, user_query):
+        print(f"DEBUG: 命中未命中缓存，直接返回")
+        return lookup_generated_answer(user_query, canonicalizer, tenant_id) or (None, None)
+
+    # ====== 命中缓存：需要拆分/子串/模糊匹配才命中的问题直接返回上次的结果 ======
+    match_cache = get_match_cache() if MATCH_CACHE_CONFIG["enabled"] else None
+    if match_cache is not None:
+        cached = match_cache.get(kb_version, tenant_id, user_query)
+        if cached is not None:
+            print(f"DEBUG: 命中匹配缓存，直接返回")
+            return cached
+
+    deadline_hits = len(deadline.hits)
+
+    shared_cache = get_shared_match_cache()
+
+    def remember(result):
+        """写入命中缓存和共享缓存（超时得到的部分结果除外）"""
+        if len(deadline.hits) == deadline_hits:
+            cost = time.perf_counter() - match_start
+            if match_cache is not None:
+                match_cache.put(kb_version, tenant_id, user_query, result, cost)
+            if shared_cache is not None:
+                shared_cache.put(shared_cache_version(kb_version, tenant_id), normalize_query(user_query), result, cost)
+        return result
+
+    # ====== 第二步：精确匹配 ======
+    canonical_stats = get_canonical_stats()
+    exact_row = store.exact_lookup(user_query.strip().lower())
+    with canonical_stats["lock"]:
+        canonical_stats["lookups"] += 1
+        if exact_row is not None:
+            canonical_stats["exact_hits"] += 1
+    if exact_row is not None:
+        print(f"DEBUG: 精确匹配成功，问题: {store.question(exact_row)}")
+        return store.answer(exact_row), store.question_type(exact_row)
+
+    # 规范化后再精确匹配一次（全半角、繁简、客套语、型号写法、结尾标点）
+    if CANONICALIZE_CONFIG["enabled"]:
+        store.build_canonical_index(canonicalizer)
+        canonical_row = store.canonical_lookup(canonicalizer(user_query))
+        if canonical_row is not None:
+            with canonical_stats["lock"]:
+                canonical_stats["canonical_hits"] += 1
+            print(f"DEBUG: 规范化后精确匹配成功，问题: {store.question(canonical_row)}")
+            return store.answer(canonical_row), store.question_type(canonical_row)
+    
+    print(f"DEBUG: 精确匹配失败")
+
+    # ====== 共享缓存：其他实例已完整匹配过的问题直接使用其结果，并写入本进程的一级缓存 ======
+    # 精确匹配本身是O(1)，放在其后查询，避免为可精确命中的问题多一次网络往返
+    if shared_cache is not None:
+        shared = shared_cache.get(shared_cache_version(kb_version, tenant_id), normalize_query(user_query))
+        if shared is not None:
+            reply, question_type, cost = shared
+            if reply is None:
+                print(f"DEBUG: 命中共享缓存（已知未命中），直接返回")
+                if negative_cache is not None:
+                    negative_cache.add(kb_version, tenant_id, user_query, cost)
+                return lookup_generated_answer(user_query, canonicalizer, tenant_id) or (None, None)
+            print(f"DEBUG: 命中共享缓存，直接返回")
+            if match_cache is not None:
+                match_cache.put(kb_version, tenant_id, user_query, (reply, question_type), cost)
+            return reply, question_type
+    
+    # ====== 第三步：合并问题处理 ======
+    # 检查是否是合并问题（包含"和"、"及"、"还有"等连接词）
+    connectors = ["和", "及", "还有", "以及", "并且", "同时", "、"]
+    has_connector = any(connector in user_query for connector in connectors)
+    
+    if has_connector:
+        print(f"DEBUG: 检测到合并问题，尝试拆分处理")
+        
+        # 尝试根据连接词拆分问题
+        found_answers = []
+        
+        # 检查各种连接词
+        for connector in connectors:
+            if connector in user_query:
+                parts = [part.strip() for part in user_query.split(connector) if part.strip()]
+                
+                # 如果拆分成至少2部分，尝试分别匹配
+                if len(parts) >= 2:
+                    print(f"DEBUG: 按'{connector}'拆分为: {parts}")
+                    
+                    for part in parts:
+                        if deadline.expired():
+                            # 时间用完，使用已匹配到的部分答案
+                            deadline.hit("compound")
+                            break
+                        # 为每个部分查找最佳匹配
+                        part_matches = []
+                        
+                        # 1. 子串匹配
+                        row = store.first_substring_match(part.lower())
+                        if row is not None:
+                            part_matches.append((store.answer(row), store.question_type(row), 100))
+                        
+                        # 2. 模糊匹配
+                        if not part_matches:
+                            result = fuzzy_extract_one(part, knowledge_df, score_cutoff=50, deadline=deadline)
+                            
+                            if result:
+                                best_match, score, index = result
+                                if score >= 50:  # 合并问题的部分匹配可以降低阈值
+                                    part_matches.append((store.answer(index), store.question_type(index), score))
+                        
+                        if part_matches:
+                            # 选择分数最高的
+                            part_matches.sort(key=lambda x: x[2], reverse=True)
+                            found_answers.append(part_matches[0][0])
+                            print(f"DEBUG: 部分'{part}'匹配到答案")
+        
+        # 如果有找到多个答案，合并它们
+        if len(found_answers) >= 2:
+            print(f"DEBUG: 合并问题找到{len(found_answers)}个答案，进行合并")
+            
+            # 去重
+            unique_answers = []
+            for ans in found_answers:
+                if ans not in unique_answers:
+                    unique_answers.append(ans)
+            
+            if len(unique_answers) == 1:
+                return remember((unique_answers[0], "组合问题"))
+            else:
+                # 组合多个答案
+                combined_reply = "关于您的问题，分别回答如下：\n\n"
+                for i, ans in enumerate(unique_answers, 1):
+                    # 清理答案格式
+                    clean_ans = ans.strip()
+                    if not clean_ans.endswith(('。', '!', '?', '！', '？')):
+                        clean_ans += '。'
+                    combined_reply += f"{i}. {clean_ans}\n"
+                
+                return remember((combined_reply, "组合问题"))
+        elif found_answers:
+            # 只找到一个答案，直接返回
+            return remember((found_answers[0], "组合问题"))
+    
+    # ====== 第四步：子串匹配（双向） ======
+    # 只有当用户问题在知识库问题中是子串时才匹配，或者反过来
+    # 双向子串匹配
+    substring_row = store.first_substring_match(user_query.strip().lower())
+    if substring_row is not None:
+        print(f"DEBUG: 子串匹配成功: {user_query} -> {store.normalized_question(substring_row)}")
+        return remember((store.answer(substring_row), store.question_type(substring_row)))
+    
+    print(f"DEBUG: 子串匹配失败")
+    
+    # ====== 第五步：智能模糊匹配（针对技术问题） ======
+    # 检查是否是技术问题（rules.json 的 technical 词表）
+    is_technical_question = rules.contains("technical", user_query)
+    
+    if is_technical_question:
+        print(f"DEBUG: 检测到技术问题，尝试模糊匹配")
+        
+        # 只对技术问题进行模糊匹配
+        # rapidfuzz 返回三个值：(最佳匹配, 分数, 索引)
+        result = fuzzy_extract_one(user_query, knowledge_df, score_cutoff=50, deadline=deadline)
+        
+        if result:
+            best_match, score, index = result
+            print(f"DEBUG: 模糊匹配结果: {best_match}")
+            print(f"DEBUG: 匹配分数: {score}")
+            print(f"DEBUG: 匹配索引: {index}")
+            
+            # 对于技术问题，降低阈值到50
+            if score >= 50:  # 降低阈值到50，提高召回率
+                # 验证匹配的相关性
+                # 检查匹配到的问题是否也是技术问题
+                matched_is_technical = rules.contains("technical", best_match)
+                
+                if matched_is_technical:
+                    print(f"DEBUG: 模糊匹配成功，返回知识库答案")
+                    return remember((store.answer(index), store.question_type(index)))
+                else:
+                    print(f"DEBUG: 匹配到非技术问题，拒绝返回")
+            else:
+                print(f"DEBUG: 模糊匹配分数不足 {score} < 50")
+        else:
+            print(f"DEBUG: 模糊匹配未找到分数不低于50的结果")
+    
+    # 没有找到匹配
+    print(f"DEBUG: 所有匹配方法都失败")
+    # 因超时未完整匹配的问题不能记为已知未命中
+    if len(deadline.hits) == deadline_hits:
+        cost = time.perf_counter() - match_start
+        if negative_cache is not None:
+            negative_cache.add(kb_version, tenant_id, user_query, cost)
+        if shared_cache is not None:
+            shared_cache.put(shared_cache_version(kb_version, tenant_id), normalize_query(user_query), None, cost)
+
+    # ====== 第六步：AI沉淀知识（高频且获得好评的AI回答） ======
+    return lookup_generated_answer(user_query, canonicalizer, tenant_id) or (None, None)
+
+def rule_engine(user_query, knowledge_df, deadline=None):
+    """
+    识别意图,并尝试从对应类型的知识库中获取答案
+    """
+    start_time = time.time()
+    print(f"\n=== DEBUG rule_engine 开始 ===")
+    print(f"用户查询: {user_query}")
+    
+    user_query_lower = user_query.lower()
+    rules = get_routing_rules()
+
+    # ==== 新增：特殊处理外观属性问题 ====
+    # 外观属性关键词见 rules.json 的 appearance 词表
+    matched_keywords = rules.find("appearance", user_query)
+    has_appearance_keyword = bool(matched_keywords)
+
+    print(f"是否包含外观关键词: {has_appearance_keyword}")
+    if has_appearance_keyword:
+        print(f"匹配到的外观关键词: {matched_keywords}")
+
+    # 关键修改：只要包含外观关键词，就强制使用AI处理
+    if has_appearance_keyword:
+        # 但需要排除技术上下文（比如"红色指示灯"，见 appearance_technical_context 词表）
+        has_technical_context = rules.contains("appearance_technical_context", user_query)
+
+        print(f"是否包含技术上下文: {has_technical_context}")
+
+        # 如果没有技术上下文，直接强制使用AI
+        if not has_technical_context:
+            end_time = time.time()
+            print(f"DEBUG: 外观问题，强制使用AI处理")
+            return {
+                "source": "规则引擎",
+                "intent": "外观属性咨询",
+                "reply": None,  # 返回None，让AI处理
+                "latency": end_time - start_time,
+                "score": 0,
+                "status": "failed"  # 标记为失败，让后续流程处理
+            }
+
+    # ==== 原有意图识别逻辑：按 rules.json 中意图的顺序，第一个有关键词命中的意图 ====
+    detected_intent = rules.detect_intent(user_query_lower)
+    if detected_intent:
+        print(f"规则引擎识别到意图: {detected_intent}")
+
+    # 特殊处理：配置了预设回复的意图（通用问答、感谢告别）
+    if detected_intent in rules.replies:
+        end_time = time.time()
+        print(f"DEBUG: {detected_intent}，使用预设回复")
+        return {
+            "source": "系统预设",
+            "intent": detected_intent,
+            "reply": rules.replies[detected_intent],
+            "latency": end_time - start_time,
+            "score": 100,
+            "status": "success"
+        }
+
+    # 无论是否识别出具体意图，都先在知识库中全局查找
+    print(f"调用 find_in_knowledge_base...")
+    reply, detected_type = find_in_knowledge_base(user_query, knowledge_df, deadline)
+
+    end_time = time.time()
+
+    if reply:
+        # 成功从知识库中找到答案
+        # 使用检测到的问题类型作为意图，如果未指定则使用规则引擎检测的意图
+        intent_used = detected_type if detected_type else (detected_intent if detected_intent else "知识库匹配")
+        print(f"DEBUG: 知识库匹配成功，返回答案")
+        print(f"匹配到的问题类型: {detected_type}")
+        print(f"使用的意图: {intent_used}")
+        return {
+            "source": f"知识库 ({intent_used})",
+            "intent": intent_used,
+            "reply": reply,
+            "latency": end_time - start_time,
+            "score": 100,
+            "status": "success"
+        }
+
+    # 知识库未命中：纠正拼音/同音错字/错字后再查一次，纠正后是问候或告别时使用预设回复
+    typo = find_with_typo_correction(user_query, knowledge_df, deadline)
+    if typo is not None:
+        corrected, reply, detected_type = typo
+        corrected_intent = rules.detect_intent(corrected.lower())
+        end_time = time.time()
+        if reply:
+            intent_used = detected_type or corrected_intent or detected_intent or "知识库匹配"
+            return {
+                "source": f"知识库 ({intent_used})",
+                "intent": intent_used,
+                "reply": reply,
+                "latency": end_time - start_time,
+                "score": 100,
+                "status": "success",
+                "corrected_query": corrected,
+            }
+        if corrected_intent in rules.replies:
+            stats = get_typo_stats()
+            with stats["lock"]:
+                stats["preset_hits"] += 1
+            return {
+                "source": "系统预设",
+                "intent": corrected_intent,
+                "reply": rules.replies[corrected_intent],
+                "latency": end_time - start_time,
+                "score": 100,
+                "status": "success",
+                "corrected_query": corrected,
+            }
+
+    # 知识库中未找到答案
+    print(f"DEBUG: 知识库未找到答案")
+    return {
+        "source": "规则引擎",
+        "intent": detected_intent if detected_intent else "未识别",
+        "reply": None,
+        "latency": end_time - start_time,
+        "score": 0,
+        "status": "failed"
+    }
+
+def get_api_key():
+    """获取API密钥：优先使用侧边栏配置，其次使用环境变量"""
+    api_key = st.session_state.get('api_key', '')
+    if not api_key:
+        api_key = os.getenv('DASHSCOPE_API_KEY', '')
+    return api_key
+
+
+# ====== 多模型路由：按分支、Prompt长度和实时延迟/错误率选择模型 ======
+# 模型档位配置：endpoint为空时调用DashScope，否则调用兼容DashScope响应格式的HTTP接口（用于本地测试）
+# 可通过环境变量 MODEL_ROUTER_CONFIG 指定JSON文件覆盖，格式同下
+MODEL_ROUTER_DEFAULTS = {
+    "models": {
+        "qwen-turbo": {"endpoint": None, "timeout": 8, "expected_latency": 0.8, "max_prompt_chars": 2000,
+                       "input_price": 0.0003, "output_price": 0.0006},
+        "qwen-plus": {"endpoint": None, "timeout": 20, "expected_latency": 2.0, "max_prompt_chars": 8000,
+                      "input_price": 0.0008, "output_price": 0.002},
+    },
+    # input_price / output_price: 元/千tokens，用于用量账本估算费用
+    # 各Prompt分支的模型偏好顺序
+    "branches": {
+        "技术问题": ["qwen-plus", "qwen-turbo"],
+        "外观问题": ["qwen-turbo", "qwen-plus"],
+        "通用问题": ["qwen-turbo", "qwen-plus"],
+    },
+    "ewma_alpha": 0.3,  # 延迟/错误率EWMA平滑系数
+    "preference_penalty": 1.0,  # 偏好顺序每靠后一位增加的代价（秒）
+    "error_penalty": 10.0,  # 错误率为100%时增加的代价（秒）
+    "error_half_life": 60,  # 模型空闲时错误率惩罚的半衰期（秒），让故障模型恢复后能重新被选中
+}
+
+
+def load_model_router_config():
+    """
+    读取模型路由配置，环境变量 MODEL_ROUTER_CONFIG 指向的JSON文件优先
+
+    models 按模型逐项合并（只写 {"qwen-plus": {"timeout": 5}} 时保留该模型的其他默认配置），
+    branches 按分支覆盖，其余键直接覆盖
+    """
+    config = json.loads(json.dumps(MODEL_ROUTER_DEFAULTS))
+    config_path = os.getenv('MODEL_ROUTER_CONFIG', '')
+    if config_path:
+        with open(config_path, encoding='utf-8') as f:
+            overrides = json.load(f)
+        for model, model_config in overrides.pop("models", {}).items():
+            config["models"].setdefault(model, {}).update(model_config)
+        config["branches"].update(overrides.pop("branches", {}))
+        config.update(overrides)
+    return config
+
+
+def call_llm(model, model_config, prompt, api_key, temperature=0.3, timeout=None):
+    """
+    调用单个模型，返回统一格式的结果字典
+
+    timeout 传给底层HTTP请求（默认为模型配置的 timeout）：路由器等待超时后，
+    挂起的请求也会在同一时间结束，不会一直占用线程池的工作线程
+    返回: {"ok", "status_code", "text", "input_tokens", "output_tokens", "error"}
+    """
+    if timeout is None:
+        timeout = model_config.get("timeout", 20)
+    endpoint = model_config.get("endpoint")
+    if endpoint:
+        # 本地/自建接口：请求与响应均使用DashScope的JSON结构
+        payload = json.dumps({"model": model, "prompt": prompt, "temperature": temperature}).encode('utf-8')
+        request = urllib.request.Request(endpoint, data=payload, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=timeout) as resp:
+            body = json.loads(resp.read().decode('utf-8'))
+        usage = body.get("usage") or {}
+        return {
+            "ok": body.get("status_code", 200) == 200,
+            "status_code": body.get("status_code", 200),
+            "text": (body.get("output") or {}).get("text", ""),
+            "input_tokens": usage.get("input_tokens", 0),
+            "output_tokens": usage.get("output_tokens", 0),
+            "error": body.get("message", ""),
+        }
+
+    response = Generation.call(
+        model=model,
+        prompt=prompt,
+        temperature=temperature,
+        api_key=api_key,
+        request_timeout=max(1, math.ceil(timeout))
+    )
+    usage = getattr(response, "usage", None) or {}
+    ok = response.status_code == 200
+    return {
+        "ok": ok,
+        "status_code": response.status_code,
+        "text": response.output.text if ok else "",
+        "input_tokens": usage.get("input_tokens", 0) if ok else 0,
+        "output_tokens": usage.get("output_tokens", 0) if ok else 0,
+        "error": getattr(response, "message", ""),
+    }
+
+
+class ModelRouter:
+    """
+    多模型路由器：为每次请求排列候选模型，超时或失败时切换到下一个档位
+
+    每个模型维护延迟和错误率的EWMA，以及调用次数、token用量等统计
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="model-router")
+        self.stats = {}
+        for model, model_config in config["models"].items():
+            self.stats[model] = {
+                "latency_ewma": model_config.get("expected_latency", 1.0),
+                "error_ewma": 0.0,
+                "calls": 0,
+                "failures": 0,
+                "timeouts": 0,
+                "total_latency": 0.0,
+                "input_tokens": 0,
+                "output_tokens": 0,
+                "last_call": 0.0,
+            }
+
+    def rank(self, branch, prompt, api_key):
+        """按预估代价排列候选模型：偏好顺序 + EWMA延迟 + 错误率惩罚，超长Prompt的模型排最后"""
+        preference = self.config["branches"].get(branch) or list(self.config["models"])
+        candidates = []
+        now = time.time()
+        for position, model in enumerate(preference):
+            model_config = self.config["models"].get(model)
+            if model_config is None:
+                continue
+            # DashScope模型需要API密钥，没有密钥时跳过
+            if not model_config.get("endpoint") and not api_key:
+                continue
+            with self.lock:
+                stats = self.stats[model]
+                idle = now - stats["last_call"]
+                error_rate = stats["error_ewma"] * 0.5 ** (idle / self.config["error_half_life"])
+                cost = (stats["latency_ewma"]
+                        + error_rate * self.config["error_penalty"]
+                        + position * self.config["preference_penalty"])
+            too_long = len(prompt) > model_config.get("max_prompt_chars", float("inf"))
+            candidates.append((too_long, cost, position, model))
+        candidates.sort()
+        return [model for _, _, _, model in candidates]
+
+    def record(self, model, latency, ok, timed_out=False, input_tokens=0, output_tokens=0):
+        """记录一次调用结果并更新EWMA"""
+        alpha = self.config["ewma_alpha"]
+        with self.lock:
+            stats = self.stats[model]
+            stats["calls"] += 1
+            stats["last_call"] = time.time()
+            stats["total_latency"] += latency
+            stats["latency_ewma"] = alpha * latency + (1 - alpha) * stats["latency_ewma"]
+            stats["error_ewma"] = alpha * (0.0 if ok else 1.0) + (1 - alpha) * stats["error_ewma"]
+            if not ok:
+                stats["failures"] += 1
+            if timed_out:
+                stats["timeouts"] += 1
+            stats["input_tokens"] += input_tokens
+            stats["output_tokens"] += output_tokens
+
+    def call(self, branch, prompt, api_key, temperature=0.3, deadline=None):
+        """
+        按路由顺序调用模型，超时或失败时切换到下一个档位
+
+        返回 call_llm 的结果字典，附加 "model" 和 "attempts"；没有可用模型时 ok=False。
+        指定 deadline 时每次调用的超时不超过剩余时间，剩余时间不足时不再切换模型，返回 error="deadline"
+        """
+        candidates = self.rank(branch, prompt, api_key)
+        if not candidates:
+            return {"ok": False, "status_code": None, "text": "", "error": "no_model",
+                    "model": None, "attempts": []}
+
+        attempts = []
+        result = None
+        for model in candidates:
+            model_config = self.config["models"][model]
+            timeout = model_config.get("timeout", 20)
+            capped = False
+            if deadline is not None:
+                if not deadline.allows(DEADLINE_CONFIG["min_llm_seconds"]):
+                    deadline.hit("llm")
+                    result = {"ok": False, "status_code": None, "text": "", "error": "deadline"}
+                    break
+                capped = deadline.remaining() < timeout
+                timeout = min(timeout, deadline.remaining())
+            start_time = time.time()
+            future = self.executor.submit(call_llm, model, model_config, prompt, api_key, temperature, timeout)
+            try:
+                result = future.result(timeout=timeout)
+                timed_out = False
+            except FutureTimeoutError:
+                result = {"ok": False, "status_code": None, "text": "", "error": "timeout"}
+                timed_out = True
+            except Exception as e:
+                result = {"ok": False, "status_code": None, "text": "", "error": str(e)}
+                timed_out = "timed out" in str(e)
+            latency = time.time() - start_time
+            attempts.append(model)
+            print(f"DEBUG: 模型 {model} 耗时 {latency:.2f}秒, 成功: {result['ok']}")
+            if timed_out and capped:
+                # 因请求截止时间提前放弃，不计入模型的错误率
+                deadline.hit("llm")
+                result["error"] = "deadline"
+                break
+            self.record(model, latency, result["ok"], timed_out,
+                        result.get("input_tokens", 0), result.get("output_tokens", 0))
+            if result["ok"]:
+                break
+
+        result["model"] = attempts[-1] if attempts else None
+        result["attempts"] = attempts
+        return result
+
+    def snapshot(self):
+        """返回各模型统计的副本，用于界面展示"""
+        with self.lock:
+            return {model: dict(stats) for model, stats in self.stats.items()}
+
+
+@st.cache_resource
+def get_model_router():
+    """进程内共享的模型路由器"""
+    return ModelRouter(load_model_router_config())
+
+
+# ====== 模型用量账本：按模型、意图、Prompt分支和会话统计token与费用，超出每日预算时降级 ======
+# 每日token预算，0表示不限制；超出后新问题只使用知识库回答
+USAGE_BUDGET_CONFIG = {
+    "daily_tokens": int(os.getenv("LLM_DAILY_TOKEN_BUDGET", "0")),
+    "session_daily_tokens": int(os.getenv("LLM_SESSION_TOKEN_BUDGET", "0")),
+    "flush_interval": 5,  # 本地增量合并到共享账本的间隔（秒）
+    "keep_days": 7,
+}
+
+BUDGET_EXHAUSTED_REPLY = "当前咨询量较大，智能助手暂时无法回答这个问题，请稍后再试或联系人工客服。"
+
+
+@st.cache_resource
+def get_usage_ledger():
+    """进程内共享的用量账本，保存在会话存储中，多个实例共享当日用量"""
+    prices = {model: (model_config.get("input_price", 0.0), model_config.get("output_price", 0.0))
+              for model, model_config in get_model_router().config["models"].items()}
+    config = USAGE_BUDGET_CONFIG
+    ledger = UsageLedger(get_session_store(), prices=prices, daily_tokens=config["daily_tokens"],
+                         session_daily_tokens=config["session_daily_tokens"],
+                         flush_interval=config["flush_interval"], keep_days=config["keep_days"])
+    atexit.register(ledger.flush)
+    return ledger
+
+
+def detect_query_intent(user_query, tenant_id=None):
+    """按外观词表和意图关键词粗略判断意图，用于用量归类（不做知识库匹配）"""
+    rules = get_routing_rules(tenant_id)
+    if rules.contains("kb_appearance", user_query):
+        return "外观属性咨询"
+    return rules.detect_intent(user_query.lower()) or "未识别"
+
+
+def get_usage_context(user_query, kind="query"):
+    """在主线程中收集用量归类信息和所属租户（后台线程无法访问session_state）"""
+    return {"intent": detect_query_intent(user_query),
+            "session_id": get_session_id(), "kind": kind, "tenant": get_tenant_id()}
+
+
+def record_llm_usage(response, latency, branch, prompt, usage_context):
+    """把一次模型调用记入用量账本；接口未返回用量时按字符数估算"""
+    input_tokens = response.get("input_tokens") or 0
+    output_tokens = response.get("output_tokens") or 0
+    if response["ok"] and not input_tokens and not output_tokens:
+        input_tokens, output_tokens = estimate_tokens(prompt), estimate_tokens(response.get("text") or "")
+    get_usage_ledger().record(response.get("model"), input_tokens, output_tokens, latency, ok=response["ok"],
+                              intent=usage_context.get("intent"), branch=branch,
+                              session_id=usage_context.get("session_id"), kind=usage_context.get("kind", "query"))
+
+
+# ====== Prompt构建：按token预算压缩知识库片段和对话历史 ======
+PROMPT_BUDGET_DEFAULTS = {
+    "total_tokens": 1200,  # 整个Prompt的token预算
+    "knowledge_tokens": 400,  # 知识库片段的token上限
+    "history_tokens": 300,  # 对话历史的token上限
+    "keep_recent_turns": 1,  # 原样保留的最近对话轮数，更早的轮次压缩为摘要
+    "summary_chars": 20,  # 压缩后每轮问题/回答保留的字数
+}
+
+CJK_PATTERN = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]')
+ALNUM_RUN_PATTERN = re.compile(r'[A-Za-z0-9]+')
+SENTENCE_SPLIT_PATTERN = re.compile(r'(?<=[。！？!?；;\n])')
+
+
+def estimate_tokens(text):
+    """
+    近似估算token数（面向中文）：汉字每字约1个token，连续字母数字约每4个字符1个token，
+    其他标点符号每个1个token，空白不计
+    """
+    if not text:
+        return 0
+    cjk_count = len(CJK_PATTERN.findall(text))
+    alnum_runs = ALNUM_RUN_PATTERN.findall(text)
+    alnum_tokens = sum((len(run) + 3) // 4 for run in alnum_runs)
+    alnum_chars = sum(len(run) for run in alnum_runs)
+    other_count = len(text) - cjk_count - alnum_chars - sum(1 for c in text if c.isspace())
+    return cjk_count + alnum_tokens + max(0, other_count)
+
+
+def char_bigrams(text):
+    """字符二元组集合，用于无分词的中文相关度估计"""
+    text = re.sub(r'\s+', '', text.lower())
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def truncate_to_tokens(text, token_budget):
+    """按token预算截断文本，截断时添加省略号"""
+    if estimate_tokens(text) <= token_budget:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) + 1 <= token_budget:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + "…" if low > 0 else ""
+
+
+def compress_knowledge(answer, user_query, token_budget):
+    """
+    抽取式压缩知识库答案：按与问题的字符二元组重合度挑选句子，保持原有顺序，控制在预算内
+    """
+    answer = answer.strip()
+    if estimate_tokens(answer) <= token_budget:
+        return answer
+
+    sentences = []
+    for sentence in SENTENCE_SPLIT_PATTERN.split(answer):
+        # 去掉空句和重复句
+        if sentence.strip() and sentence.strip() not in (s.strip() for s in sentences):
+            sentences.append(sentence)
+    query_bigrams = char_bigrams(user_query)
+    scored = []
+    for position, sentence in enumerate(sentences):
+        overlap = len(char_bigrams(sentence) & query_bigrams)
+        # 首句通常是结论，给少量加分
+        scored.append((overlap + (0.5 if position == 0 else 0), -position, sentence))
+    scored.sort(reverse=True)
+
+    selected = []
+    used = 0
+    for _, neg_position, sentence in scored:
+        cost = estimate_tokens(sentence)
+        if used + cost <= token_budget:
+            selected.append((-neg_position, sentence))
+            used += cost
+
+    if not selected:
+        # 单句就超出预算，截断最相关的一句
+        return truncate_to_tokens(scored[0][2].strip(), token_budget)
+    selected.sort()
+    return "".join(sentence.strip() for _, sentence in selected)
+
+
+def compact_history(history_window, token_budget, keep_recent_turns=1, summary_chars=20):
+    """
+    压缩对话历史：最近的轮次原样保留，更早的轮次只保留问题和回答的开头作为摘要，超出预算时丢弃最早的轮次
+
+    history_window 中第0项为最近一轮，返回文本保持同样顺序
+    """
+    lines = []
+    for i, (q, a) in enumerate(history_window):
+        if i < keep_recent_turns:
+            lines.append(f"用户：{q}\n客服:{a}")
+        else:
+            q_short = q if len(q) <= summary_chars else q[:summary_chars] + "…"
+            a_text = a or ""
+            a_short = a_text if len(a_text) <= summary_chars else a_text[:summary_chars] + "…"
+            lines.append(f"（较早）用户问：{q_short} 客服答：{a_short}")
+
+    while lines and estimate_tokens("\n".join(lines)) > token_budget:
+        if len(lines) == 1:
+            lines[0] = truncate_to_tokens(lines[0], token_budget)
+            break
+        lines.pop()
+    return "\n".join(line for line in lines if line)
+
+
+# 各分支的Prompt模板，{relevant_knowledge}、{history_text}、{user_query} 在构建时填充
+PROMPT_TEMPLATES = {
+    # 技术问题且有知识库答案时，生成简洁回答
+    "技术问题": """你是一个专业的机器人产品淘宝客服AI助手。
+
+**重要指令**：
+1. 下面提供了知识库中的标准答案
+2. 如果知道确切答案，请准确、简洁地回答
+3. 如果不知道确切答案，请说"抱歉，我暂时无法回答这个问题，建议您联系客服或查看产品说明书"
+4. 绝对不要编造参数、规格、公司地址等具体信息，尤其是知识库没有提到的信息。不要猜测
+5. 如果用户问的是技术参数，直接回答参数
+
+**知识库标准答案**：
+{relevant_knowledge}
+
+**当前用户问题**：
+{user_query}
+
+请生成简洁、专业的客服回复（最好在50字以内）：""",
+    # 外观问题
+    "外观问题": """你是一个专业的机器人产品淘宝客服AI助手。
+
+用户问了一个关于产品外观/颜色/尺寸的问题，但知识库中没有相关信息。
+
+**当前用户问题**：
+{user_query}
+
+请根据常识生成简短回复（30字以内），如果不知道确切信息，可以说明情况并提供帮助方式。""",
+    # 其他问题
+    "通用问题": """你是一个专业的机器人产品淘宝客服AI助手。
+
+**重要指令**：
+1. 请优先参考下面的知识库信息
+2. 如果知识库信息能回答用户问题，请基于知识库信息生成简洁回复
+3. 如果知识库信息不完整，可以补充你的专业知识。
+4. 但是涉及到你不确定且知识库完全没出现的内容时，请说抱歉我不知道，建议您联系客服或查看公司官网或产品说明书。
+5. 注意不要泄露任何隐私信息
+6. 保持回答简洁明了
+
+**知识库参考信息**：
+{relevant_knowledge}
+
+**对话历史(最近3轮)**：
+{history_text}
+
+**当前用户问题**：
+{user_query}
+
+请生成简洁、友好的客服回复：""",
+}
+PROMPT_TEMPLATE_TOKENS = {
+    branch: estimate_tokens(template.format(relevant_knowledge="", history_text="", user_query=""))
+    for branch, template in PROMPT_TEMPLATES.items()
+}
+
+
+def get_prompt_budget():
+    """读取Prompt预算配置（会话内可在侧边栏调整）"""
+    budget = dict(PROMPT_BUDGET_DEFAULTS)
+    try:
+        if st.session_state.get('prompt_budget'):
+            budget.update(st.session_state.prompt_budget)
+    except Exception:
+        # 后台线程中无法访问session_state时使用默认预算
+        pass
+    return budget
+
+
+def build_prompt(user_query, history_window, knowledge_df, budget=None, deadline=None, tenant_id=None):
+    """
+    构建AI请求的Prompt：判断问题分支（技术/外观/通用），在token预算内组装知识库片段和对话历史
+    tenant_id 为所属租户，用于查找该租户的生成知识层
+
+    返回: {"branch", "prompt", "is_appearance", "prompt_tokens", "budget_tokens",
+           "knowledge_tokens", "history_tokens", "compressed", "knowledge_answer"}
+    """
+    if budget is None:
+        budget = get_prompt_budget()
+
+    # 1. 检查是否是外观属性问题（rules.json 的 prompt_appearance 词表）
+    rules = get_routing_rules(tenant_id)
+    is_appearance_question = rules.contains("prompt_appearance", user_query)
+    
+    # 2. 从知识库中检索相关上下文
+    best_answer = None
+    if knowledge_df is not None and not knowledge_df.empty:
+        # 尝试查找最相关的问题（可选步骤，需为AI调用留出时间）
+        if deadline is None:
+            best_answer, _ = find_in_knowledge_base(user_query, knowledge_df, tenant_id=tenant_id)
+        elif deadline.allows(DEADLINE_CONFIG["min_llm_seconds"]):
+            best_answer, _ = find_in_knowledge_base(user_query, knowledge_df,
+                                                    deadline.reserve(DEADLINE_CONFIG["min_llm_seconds"]), tenant_id)
+        else:
+            deadline.hit("prompt_context")
+
+    # 根据问题类型调整Prompt（prompt_technical 词表）
+    is_technical = rules.contains("prompt_technical", user_query)
+    
+    if is_technical and best_answer:
+        prompt_branch = "技术问题"
+    elif is_appearance_question:
+        prompt_branch = "外观问题"
+    else:
+        prompt_branch = "通用问题"
+
+    # 3. 按预算分配知识库片段和对话历史：模板和用户问题本身不压缩
+    query_tokens = estimate_tokens(user_query)
+    remaining = max(0, budget["total_tokens"] - PROMPT_TEMPLATE_TOKENS[prompt_branch] - query_tokens)
+
+    relevant_knowledge = ""
+    compressed = False
+    if best_answer and prompt_branch != "外观问题":
+        knowledge_budget = min(budget["knowledge_tokens"], remaining)
+        snippet = compress_knowledge(str(best_answer), user_query, knowledge_budget)
+        compressed = snippet != str(best_answer).strip()
+        if snippet:
+            relevant_knowledge = f"知识库标准答案：{snippet}\n\n"
+    knowledge_tokens = estimate_tokens(relevant_knowledge)
+
+    history_text = ""
+    if prompt_branch == "通用问题":
+        history_budget = min(budget["history_tokens"], max(0, remaining - knowledge_tokens))
+        history_text = compact_history(history_window, history_budget,
+                                       budget["keep_recent_turns"], budget["summary_chars"])
+    history_tokens = estimate_tokens(history_text)
+
+    full_prompt = PROMPT_TEMPLATES[prompt_branch].format(
+        relevant_knowledge=relevant_knowledge if relevant_knowledge else "（暂无相关参考信息）",
+        history_text=history_text if history_text else "（暂无历史对话）",
+        user_query=user_query
+    )
+
+    return {
+        "branch": prompt_branch,
+        "prompt": full_prompt,
+        "is_appearance": is_appearance_question,
+        "prompt_tokens": estimate_tokens(full_prompt),
+        "budget_tokens": budget["total_tokens"],
+        "knowledge_tokens": knowledge_tokens,
+        "history_tokens": history_tokens,
+        "compressed": compressed,
+        "knowledge_answer": best_answer,
+    }
+
+
+# 替换真实模型调用的替身：callable(user_query, branch, prompt) -> 与 ModelRouter.call 相同格式的响应
+# 为None时正常路由到模型；replay.py 用它返回录制的响应
+LLM_RESPONDER = None
+
+
+# 降级原因 -> 使用知识库相近答案时的来源
+DEGRADED_SOURCES = {"daily": "知识库（AI额度降级）", "session": "知识库（AI额度降级）", "deadline": "知识库（超时降级）"}
+DEADLINE_EXCEEDED_REPLY = "抱歉，系统当前响应较慢，暂时无法生成回答，请稍后再试或联系人工客服。"
+
+
+def suggest_related_questions(user_query, knowledge_df, limit):
+    """
+    给出知识库中的相关问题（用于降级回复）；大知识库只在二元组索引预筛选出的候选中打分
+
+    返回 [(问题, 分数, 行号), ...]，按分数从高到低
+    """
+    if knowledge_df is None or knowledge_df.empty or limit <= 0:
+        return []
+    store = get_kb_store(knowledge_df)
+    choices = store.choices()
+    rows = None
+    if store.bm25 is not None:
+        rows = store.bm25.top_candidates(user_query.strip().lower(), limit * 10,
+                                         FUZZY_PREFILTER_CONFIG["max_df_ratio"])
+        choices = [choices[i] for i in rows]
+    elif len(choices) > DEADLINE_CONFIG["fuzzy_chunk_rows"]:
+        return []
+    matches = process.extract(user_query, choices, scorer=fuzz.token_set_ratio, limit=limit, score_cutoff=30)
+    return [(question, score, rows[index] if rows is not None else index) for question, score, index in matches]
+
+
+def degraded_reply(user_query, knowledge_df, prompt_info, reason, start_time):
+    """
+    无法调用AI时（用量预算耗尽或超出请求时间）的降级回复
+
+    依次尝试：放宽条件的知识库匹配（最相关问题分数足够高时直接给出其答案）、知识库相关问题推荐、固定提示
+    （构建Prompt时的知识库匹配与规则引擎相同，走到这里时已确定未命中，不再使用）
+    """
+    if reason == "deadline":
+        print(f"DEBUG: 请求时间预算不足，降级为知识库回答")
+    else:
+        print(f"DEBUG: 模型用量预算耗尽 ({reason})，降级为知识库回答")
+        get_usage_ledger().record_degraded()
+    fallback_reply = DEADLINE_EXCEEDED_REPLY if reason == "deadline" else BUDGET_EXHAUSTED_REPLY
+    if not prompt_info["is_appearance"]:
+        suggestions = suggest_related_questions(user_query, knowledge_df, DEADLINE_CONFIG["suggestions"])
+        if suggestions and suggestions[0][1] >= DEADLINE_CONFIG["relaxed_score"]:
+            question, score, row = suggestions[0]
+            print(f"DEBUG: 降级放宽匹配: {question} ({score:.0f})")
+            return {
+                "source": DEGRADED_SOURCES[reason],
+                "intent": "未识别",
+                "reply": str(get_kb_store(knowledge_df).answer(row)),
+                "latency": time.time() - start_time,
+                "degraded": reason,
+                "status": "success"
+            }
+        if suggestions:
+            lines = "\n".join(f"{i}. {question}" for i, (question, _, _) in enumerate(suggestions, 1))
+            return {
+                "source": "知识库（相关问题）",
+                "intent": "未识别",
+                "reply": f"{fallback_reply}\n\n您可以参考以下相关问题：\n{lines}",
+                "latency": time.time() - start_time,
+                "degraded": reason,
+                "status": "success"
+            }
+    return {
+        "source": "AI模型",
+        "intent": "未识别",
+        "reply": fallback_reply,
+        "latency": time.time() - start_time,
+        "degraded": reason,
+        "status": "failed"
+    }
+
+
+def ai_enhancement_with_knowledge(user_query, history_window, knowledge_df, api_key=None, usage_context=None,
+                                  deadline=None):
+    """
+    增强版AI生成回复：结合知识库中的相关信息，生成简洁回答
+
+    api_key 为None时从session_state读取；在后台线程中调用时必须显式传入，
+    usage_context（意图、会话ID、调用类型）同理，由 get_usage_context 生成。
+    deadline 剩余时间不足以调用模型时返回知识库降级回复
+    """
+    start_time = time.time()
+    if usage_context is None:
+        usage_context = get_usage_context(user_query)
+    tenant_id = usage_context.get("tenant") or get_tenant_id()
+
+    prompt_info = build_prompt(user_query, history_window, knowledge_df, deadline=deadline, tenant_id=tenant_id)
+    prompt_branch = prompt_info["branch"]
+    full_prompt = prompt_info["prompt"]
+    is_appearance_question = prompt_info["is_appearance"]
+    print(f"DEBUG: Prompt分支 {prompt_branch}, 约 {prompt_info['prompt_tokens']}/{prompt_info['budget_tokens']} tokens")
+
+    # 相同Prompt的AI回复缓存：命中时不调用模型，也不受用量预算和截止时间限制。
+    # 预算耗尽的会话仍可命中缓存：缓存回复不消耗token（不计入账本），返回它比降级回复更好，也不会超时
+    response_cache = None
+    cache_key = None
+    if RESPONSE_CACHE_CONFIG["enabled"] and LLM_RESPONDER is None:
+        response_cache = get_response_cache()
+        cache_key = ResponseCache.key(get_kb_version(knowledge_df) if knowledge_df is not None else None,
+                                      tenant_id, prompt_branch, full_prompt)
+        cached_response = response_cache.get(cache_key)
+        if cached_response is not None:
+            print(f"DEBUG: 命中AI回复缓存")
+            return {
+                "source": "AI模型" + ("（外观咨询）" if is_appearance_question else "（增强版）"),
+                "intent": "外观属性咨询" if is_appearance_question else "未识别",
+                "reply": desensitize(cached_response["text"]),
+                "latency": time.time() - start_time,
+                "model": cached_response["model"],
+                "prompt_tokens": prompt_info["prompt_tokens"],
+                "prompt_budget": prompt_info["budget_tokens"],
+                "llm_response": cached_response,
+                "cached": True,
+                "status": "success"
+            }
+
+    budget_exceeded = get_usage_ledger().check_budget(usage_context.get("session_id"))
+    if budget_exceeded:
+        return degraded_reply(user_query, knowledge_df, prompt_info, budget_exceeded, start_time)
+    if deadline is not None and not deadline.allows(DEADLINE_CONFIG["min_llm_seconds"]):
+        deadline.hit("llm")
+        return degraded_reply(user_query, knowledge_df, prompt_info, "deadline", start_time)
+
+    try:
+        # 获取API密钥
+        if api_key is None:
+            api_key = get_api_key()
+
+        router = get_model_router()
+        if LLM_RESPONDER is not None:
+            # 重放等离线场景：由替身返回响应，不访问网络
+            response = LLM_RESPONDER(user_query, prompt_branch, full_prompt)
+        elif not router.rank(prompt_branch, full_prompt, api_key):
+            return {
+                "source": "AI模型",
+                "intent": "未识别",
+                "reply": "⚠️ 未配置API密钥，请在侧边栏设置",
+                "latency": time.time() - start_time,
+                "status": "failed"
+            }
+        else:
+            response = router.call(prompt_branch, full_prompt, api_key, temperature=0.3, deadline=deadline)
+        
+        end_time = time.time()
+        if response["error"] == "deadline":
+            return degraded_reply(user_query, knowledge_df, prompt_info, "deadline", start_time)
+        record_llm_usage(response, end_time - start_time, prompt_branch, full_prompt, usage_context)
+        if response_cache is not None and response["ok"]:
+            response_cache.put(cache_key, dict(response, latency=end_time - start_time))
+        
+        if response["ok"]:
+            reply = response["text"]
+            reply = desensitize(reply)
+                        
+            return {
+                "source": "AI模型" + ("（外观咨询）" if is_appearance_question else "（增强版）"),
+                "intent": "外观属性咨询" if is_appearance_question else "未识别",
+                "reply": reply,
+                "latency": end_time - start_time,
+                "model": response["model"],
+                "prompt_tokens": prompt_info["prompt_tokens"],
+                "prompt_budget": prompt_info["budget_tokens"],
+                "llm_response": response,
+                "status": "success"
+            }
+        else:
+            error_code = response["status_code"] or response["error"]
+            return {
+                "source": "AI模型",
+                "intent": "未识别",
+                "reply": f"请求失败，请稍后再试 (错误码: {error_code})",
+                "latency": end_time - start_time,
+                "model": response["model"],
+                "prompt_tokens": prompt_info["prompt_tokens"],
+                "prompt_budget": prompt_info["budget_tokens"],
+                "llm_response": response,
+                "status": "failed"
+            }
+    except Exception as e:
+        end_time = time.time()
+        return {
+            "source": "AI模型",
+            "intent": "未识别",
+            "reply": f"API调用异常: {str(e)[:50]}...",
+            "latency": end_time - start_time,
+            "status": "failed"
+        }
+
+# ====== 推测执行：知识库匹配与AI请求并行 ======
+# 各类问题的未命中先验概率，运行中根据实际结果在线校准
+SPECULATION_PRIORS = {
+    "外观问题": 0.95,  # 包含外观关键词，知识库阶段必然跳过
+    "长文本": 0.75,  # 长篇自由提问，通常无法精确/子串命中
+    "组合问题": 0.3,
+    "普通问题": 0.3,
+}
+
+
+@st.cache_resource
+def get_speculation_executor():
+    """推测执行使用的线程池（进程内共享）"""
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculative-llm")
+
+
+@st.cache_resource
+def get_speculation_stats():
+    """推测执行统计（进程内共享）"""
+    return {
+        "lock": threading.Lock(),
+        "launched": 0,  # 发起的推测请求数
+        "used": 0,  # 知识库未命中、推测结果被采用
+        "wasted": 0,  # 知识库命中但AI请求已发出
+        "cancelled": 0,  # 知识库命中且AI请求尚未发出，成功取消
+        "budget_skipped": 0,  # 因浪费预算耗尽而放弃推测
+        "latency_saved": 0.0,  # 累计节省的时间（秒）
+        "wasted_times": deque(),  # 浪费调用的时间戳，用于滑动窗口预算
+        "outcomes": {bucket: [0, 0] for bucket in SPECULATION_PRIORS},  # 类别 -> [未命中数, 总数]
+    }
+
+
+def get_speculation_config():
+    """读取推测执行配置（会话内可在侧边栏调整）"""
+    config = dict(SPECULATION_DEFAULTS)
+    if st.session_state.get('speculation_config'):
+        config.update(st.session_state.speculation_config)
+    return config
+
+
+def classify_for_speculation(user_query, config):
+    """按问题特征划分类别，作为未命中预测的依据"""
+    rules = get_routing_rules()
+    if rules.contains("kb_appearance", user_query):
+        return "外观问题"
+    if len(user_query.strip()) >= config["long_query_chars"]:
+        return "长文本"
+    if rules.contains("combination_connectors", user_query):
+        return "组合问题"
+    return "普通问题"
+
+
+def predict_kb_miss(user_query, config):
+    """
+    预测知识库未命中的概率，返回 (概率, 类别)
+
+    识别为有预设回复的意图（通用问答/感谢告别）的问题走预设回复，概率为0；
+    其他问题使用类别先验与历史命中情况做平滑估计
+    """
+    rules = get_routing_rules()
+    if rules.detect_intent(user_query.lower()) in rules.replies:
+        return 0.0, "系统预设"
+
+    bucket = classify_for_speculation(user_query, config)
+    stats = get_speculation_stats()
+    with stats["lock"]:
+        misses, total = stats["outcomes"][bucket]
+    # 以先验作为10次虚拟观测做平滑
+    prior_weight = 10
+    probability = (misses + SPECULATION_PRIORS[bucket] * prior_weight) / (total + prior_weight)
+    return probability, bucket
+
+
+def record_speculation_outcome(bucket, kb_missed):
+    """记录实际匹配结果，用于校准未命中预测"""
+    stats = get_speculation_stats()
+    with stats["lock"]:
+        if bucket in stats["outcomes"]:
+            stats["outcomes"][bucket][1] += 1
+            if kb_missed:
+                stats["outcomes"][bucket][0] += 1
+
+
+def try_reserve_speculation(config):
+    """检查浪费预算，预算耗尽时不再推测执行"""
+    stats = get_speculation_stats()
+    now = time.time()
+    with stats["lock"]:
+        wasted_times = stats["wasted_times"]
+        while wasted_times and now - wasted_times[0] > config["budget_window"]:
+            wasted_times.popleft()
+        if len(wasted_times) >= config["wasted_budget"]:
+            stats["budget_skipped"] += 1
+            return False
+        stats["launched"] += 1
+        return True
+
+
+def start_speculative_ai(user_query, knowledge_df, deadline=None):
+    """
+    按预测结果决定是否提前发起AI请求，返回 (future或None, 类别)
+    """
+    config = get_speculation_config()
+    probability, bucket = predict_kb_miss(user_query, config)
+    print(f"DEBUG: 未命中预测 {probability:.2f} (类别: {bucket})")
+
+    if not config["enabled"] or probability < config["miss_threshold"]:
+        return None, bucket
+    if get_usage_ledger().check_budget(get_session_id()):
+        return None, bucket
+    if not try_reserve_speculation(config):
+        print(f"DEBUG: 推测执行浪费预算已耗尽，跳过")
+        return None, bucket
+
+    print(f"DEBUG: 推测执行，提前发起AI请求")
+    # 后台线程无法访问session_state，需要传入历史快照和API密钥
+    future = get_speculation_executor().submit(
+        ai_enhancement_with_knowledge,
+        user_query,
+        list(st.session_state.history),
+        knowledge_df,
+        get_api_key(),
+        get_usage_context(user_query, kind="speculation"),
+        deadline
+    )
+    return future, bucket
+
+
+def settle_speculation(future, rule_result, query_start):
+    """
+    知识库匹配结束后处理推测请求
+
+    知识库可信命中时取消（或丢弃）AI请求并返回None；否则等待并返回AI结果
+    """
+    config = get_speculation_config()
+    stats = get_speculation_stats()
+
+    if rule_result["status"] == "success" and rule_result.get("score", 0) >= config["confident_score"]:
+        cancelled = future.cancel()
+        with stats["lock"]:
+            if cancelled:
+                stats["cancelled"] += 1
+            else:
+                stats["wasted"] += 1
+                stats["wasted_times"].append(time.time())
+        print(f"DEBUG: 知识库可信命中，{'取消' if cancelled else '丢弃'}推测请求")
+        return None
+
+    ai_result = future.result()
+    # 串行执行需要 规则引擎耗时 + AI耗时，并行后只需等待较慢的一方
+    serial_latency = rule_result["latency"] + ai_result["latency"]
+    saved = max(0.0, serial_latency - (time.time() - query_start))
+    with stats["lock"]:
+        stats["used"] += 1
+        stats["latency_saved"] += saved
+    print(f"DEBUG: 采用推测结果，节省 {saved:.3f}秒")
+    return ai_result
+
+
+# ====== 会话状态外置：多实例部署时任一实例都能接管任一会话 ======
+
+# 会话存储配置：memory 为进程内存储（默认）；sqlite 可供多个实例共享同一个数据库文件
+SESSION_STORE_CONFIG = {
+    "backend": os.getenv("SESSION_BACKEND", "memory"),
+    "path": os.getenv("SESSION_DB_PATH", "session_state.db"),
+    "snapshot_dir": os.getenv("KB_SNAPSHOT_DIR", "kb_snapshots"),
+    # 默认不保存API密钥：会话ID就在URL的 sid 参数里，分享链接的人会恢复出同一会话，连同密钥；
+    # 只在会话存储和链接都不会外泄的内部部署中开启，否则换实例或刷新后需要重新输入密钥
+    "persist_api_key": os.getenv("SESSION_PERSIST_API_KEY", "0") == "1",
+}
+
+
+@st.cache_resource
+def get_session_store():
+    """进程内共享的会话存储"""
+    config = SESSION_STORE_CONFIG
+    store = create_session_store(config["backend"], config["path"], config["snapshot_dir"])
+    print(f"DEBUG: 会话存储后端: {store.backend}")
+    return store
+
+
+def kb_snapshot_document(knowledge_df, rule_base):
+    """知识库快照文档：按列保存的数据、DataFrame.attrs（版本号、导入报告）和规则库，均为JSON类型"""
+    return {"columns": list(knowledge_df.columns),
+            "data": {column: knowledge_df[column].tolist() for column in knowledge_df.columns},
+            "attrs": dict(knowledge_df.attrs), "rule_base": rule_base}
+
+
+def knowledge_base_from_snapshot(document):
+    """kb_snapshot_document 的逆操作，返回 (knowledge_df, rule_base)"""
+    knowledge_df = pd.DataFrame(document["data"], columns=document["columns"])
+    knowledge_df.attrs.update(document["attrs"])
+    return knowledge_df, document["rule_base"]
+
+
+def get_session_id():
+    """会话ID保存在URL参数 sid 中，刷新页面或被负载均衡到其他实例后仍能找回同一会话"""
+    session_id = st.session_state.get('session_id')
+    if session_id:
+        return session_id
+    session_id = st.query_params.get("sid")
+    if not session_id:
+        session_id = uuid.uuid4().hex
+        st.query_params["sid"] = session_id
+    st.session_state.session_id = session_id
+    return session_id
+
+
+def persist_session_state(record=None):
+    """保存当前会话的对话窗口、API密钥和知识库版本；record 不为None时同时追加一条对话记录
+
+    只做序列化并放入写入队列，不等待落盘
+    """
+    knowledge_df = st.session_state.knowledge_df
+    api_key = st.session_state.get('api_key', '') if SESSION_STORE_CONFIG["persist_api_key"] else ""
+    store = get_session_store()
+    session_id = get_session_id()
+    store.save_state(session_id, st.session_state.history, api_key,
+                     get_kb_version(knowledge_df) if knowledge_df is not None else None)
+    if record is not None:
+        store.append_conversation(session_id, record)
+
+
+def persist_conversations():
+    """删除或清空对话记录后，整体覆盖会话存储中的记录"""
+    get_session_store().replace_conversations(get_session_id(), st.session_state.all_conversations)
+    persist_session_state()
+
+
+# 反馈类型 -> 显示文本，以及提交后的提示
+FEEDBACK_LABELS = {"positive": "👍 准确", "negative": "👎 不准确", "unsure": "🤔 不确定"}
+FEEDBACK_NOTICES = {
+    "positive": "感谢您的反馈！",
+    "negative": "抱歉回答有误，我们会改进！",
+    "unsure": "感谢反馈，我们会检查这个问题。",
+}
+
+
+def record_feedback(conversation_id, rating):
+    """反馈按钮回调：把反馈写入对应的对话记录并持久化"""
+    conversations = st.session_state.all_conversations
+    for index in range(len(conversations) - 1, -1, -1):
+        if conversations[index].get("id") == conversation_id:
+            conversations[index]["feedback"] = rating
+            # 只改写这一条记录，不整体覆盖会话的全部记录（也不会重置其创建时间）
+            get_session_store().update_conversation(get_session_id(), index, {"feedback": rating})
+            break
+    st.session_state.feedback_notice = FEEDBACK_NOTICES[rating]
+
+
+def delete_conversation(index):
+    """删除按钮回调：从对话记录中删除一条并持久化"""
+    if 0 <= index < len(st.session_state.all_conversations):
+        del st.session_state.all_conversations[index]
+        persist_conversations()
+
+
+def restore_session_state():
+    """会话在本进程中首次运行时，从会话存储恢复对话窗口、对话记录、API密钥和知识库"""
+    if st.session_state.get('session_restored'):
+        return
+    st.session_state.session_restored = True
+
+    store = get_session_store()
+    session_id = get_session_id()
+    state = store.load_state(session_id)
+    if state is None:
+        return
+
+    st.session_state.history = deque(state["history"], maxlen=st.session_state.history.maxlen)
+    st.session_state.all_conversations = store.load_conversations(session_id)
+    if state["api_key"] and not st.session_state.get('api_key'):
+        st.session_state['api_key'] = state["api_key"]
+
+    kb_version = state["kb_version"]
+    current_df = st.session_state.knowledge_df
+    # 所属租户已有知识库时由 bind_tenant_kb 加载租户的当前版本，不再按会话恢复
+    if (kb_version and get_tenant_registry().kb_version(get_tenant_id()) is None
+            and (current_df is None or get_kb_version(current_df) != kb_version)):
+        snapshot = store.load_kb_snapshot(kb_version)
+        if snapshot is None:
+            print(f"DEBUG: 未找到知识库快照 {kb_version}，需要重新上传")
+        else:
+            knowledge_df, rule_base = knowledge_base_from_snapshot(snapshot)
+            st.session_state.knowledge_df = knowledge_df
+            st.session_state.rule_base = rule_base
+            get_kb_store(knowledge_df)
+    print(f"DEBUG: 已恢复会话 {session_id}: {len(st.session_state.all_conversations)} 条对话记录")
+
+
+# ====== 多租户：每个店铺/产品线使用独立的知识库、规则库、查询索引和生成知识层 ======
+TENANT_CONFIG = {
+    "param": "tenant",  # URL参数名，如 ?tenant=shop-a
+    "default": os.getenv("DEFAULT_TENANT", "default"),
+    "memory_budget_mb": float(os.getenv("TENANT_MEMORY_BUDGET_MB", "1024")),  # 常驻租户知识库和索引的内存上限
+    "max_share": 0.5,  # 单个租户占用超过预算的该比例时优先卸载
+    "refresh_interval": 5,  # 重新读取租户 -> 知识库版本对应关系的最短间隔（秒）
+}
+TENANT_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+
+def get_tenant_id():
+    """租户ID来自URL参数 tenant（未指定或不合法时使用默认租户），会话内保持不变"""
+    tenant_id = st.session_state.get('tenant_id')
+    if tenant_id:
+        return tenant_id
+    tenant_id = st.query_params.get(TENANT_CONFIG["param"])
+    if not tenant_id or not TENANT_ID_PATTERN.fullmatch(tenant_id):
+        tenant_id = TENANT_CONFIG["default"]
+    st.session_state.tenant_id = tenant_id
+    return tenant_id
+
+
+def iter_tenant_conversations(store, tenant_id, session_id=None, chunk_size=1000):
+    """按块读取租户的对话记录（由会话存储按租户过滤）；启用多租户之前的记录没有租户字段，属于默认租户"""
+    return store.iter_conversations(session_id, chunk_size=chunk_size, tenant_id=tenant_id,
+                                    default_tenant=TENANT_CONFIG["default"])
+
+
+def tenant_document(name, tenant_id):
+    """租户专属的共享文档名；默认租户沿用原文档名，已有数据无需迁移"""
+    return name if tenant_id == TENANT_CONFIG["default"] else f"{name}:{tenant_id}"
+
+
+def tenant_kb_nbytes(knowledge_df, store):
+    """租户常驻内存估算：DataFrame + 紧凑存储 + BM25索引 + 纠错词条索引"""
+    total = int(knowledge_df.memory_usage(deep=True).sum()) + store.nbytes()
+    if store.bm25 is not None:
+        total += store.bm25.nbytes()
+    if store.typo_index is not None:
+        total += store.typo_index.nbytes()
+    return total
+
+
+def load_tenant_kb(tenant_id, kb_version):
+    """从知识库快照加载租户的知识库并构建索引，返回 (常驻对象, 字节数)；快照缺失时返回None"""
+    snapshot = get_session_store().load_kb_snapshot(kb_version)
+    if snapshot is None:
+        print(f"DEBUG: 租户 {tenant_id} 的知识库快照 {kb_version} 不存在，需要重新上传")
+        return None
+    knowledge_df, rule_base = knowledge_base_from_snapshot(snapshot)
+    store = get_kb_store(knowledge_df, rule_base)
+    print(f"DEBUG: 已加载租户 {tenant_id} 的知识库 {kb_version}")
+    return {"knowledge_df": knowledge_df, "rule_base": rule_base}, tenant_kb_nbytes(knowledge_df, store)
+
+
+def unload_tenant_kb(tenant_id, kb_version, still_used):
+    """租户卸载或更换知识库后释放索引；其他常驻租户仍在使用同一版本时保留"""
+    if not still_used:
+        release_kb_indexes(kb_version)
+
+
+@st.cache_resource
+def get_tenant_registry():
+    """进程内共享的租户注册表"""
+    store = get_session_store()
+    return TenantRegistry(store, load_tenant_kb, can_reload=store.has_kb_snapshot, on_unload=unload_tenant_kb,
+                          memory_budget=int(TENANT_CONFIG["memory_budget_mb"] * 1024 * 1024),
+                          max_share=TENANT_CONFIG["max_share"], refresh_interval=TENANT_CONFIG["refresh_interval"])
+
+
+def assign_tenant_kb(tenant_id, knowledge_df, rule_base):
+    """把知识库设为租户的当前知识库；被替换的旧版本不再有租户使用时清除它的匹配缓存和AI回复缓存"""
+    registry = get_tenant_registry()
+    previous = registry.kb_version(tenant_id)
+    kb_version = get_kb_version(knowledge_df)
+    store = get_kb_store(knowledge_df, rule_base)
+    registry.assign(tenant_id, kb_version, {"knowledge_df": knowledge_df, "rule_base": rule_base},
+                    tenant_kb_nbytes(knowledge_df, store))
+    if previous and previous != kb_version and not registry.tenants_using(previous):
+        for cache in (get_negative_cache(), get_match_cache(), get_response_cache()):
+            cache.invalidate(versions={previous})
+
+
+def bind_tenant_kb():
+    """每次运行开始时把会话的知识库和规则库切换为所属租户的当前版本（按需从快照加载）"""
+    tenant_id = get_tenant_id()
+    registry = get_tenant_registry()
+    resident = registry.acquire(tenant_id)
+    if resident is not None:
+        st.session_state.knowledge_df = resident["knowledge_df"]
+        st.session_state.rule_base = resident["rule_base"]
+    elif registry.kb_version(tenant_id) is None and st.session_state.knowledge_df is not None:
+        # 启用多租户之前按会话恢复的知识库，登记为所属租户的知识库
+        assign_tenant_kb(tenant_id, st.session_state.knowledge_df, st.session_state.rule_base)
+
+
+# ====== 缓存预热：启动和知识库更新后，按对话日志中的热门问题预先填充匹配缓存和AI回复缓存 ======
+WARMUP_CONFIG = {
+    "enabled": os.getenv("CACHE_WARMUP", "1") != "0",
+    "top_n": 200,  # 预热匹配结果的热门问题数
+    "scan_limit": 50000,  # 最多读取的对话记录数
+    "workers": 2,
+    "match_rate": 50,  # 每秒最多预热的知识库匹配数
+    "llm": os.getenv("CACHE_WARMUP_LLM", "0") == "1",  # 是否为知识库未命中的热门问题预生成AI回复（消耗token）
+    "llm_top_n": 30,
+    "llm_rate": 0.5,  # 每秒最多发起的预生成AI请求数
+}
+
+
+class RateLimiter:
+    """按固定间隔放行的限速器（线程安全），rate 为每秒放行次数"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+@st.cache_resource
+def get_warmup_state(tenant_id):
+    """
+    租户的预热进度（进程内共享）；ready 为True表示该租户当前知识库的预热已完成
+
+    ready 只在侧边栏展示，不拦截请求：预热只填充缓存，未完成时请求照常走知识库匹配和模型，结果相同只是更慢；
+    streamlit 也没有可供负载均衡探测的就绪接口（/_stcore/health 只反映服务是否启动）
+    """
+    return {"lock": threading.Lock(), "generation": 0, "kb_version": None, "status": "idle", "ready": False,
+            "queries": 0, "matched": 0, "kb_hits": 0, "llm_total": 0, "llm_done": 0, "llm_cached": 0,
+            "started": None, "finished": None, "error": None}
+
+
+def top_logged_queries(store, limit, scan_limit, tenant_id=None):
+    """从对话日志统计出现次数最多的问题，返回 [(问题, 次数), ...]（按归一化问题合并）；指定 tenant_id 时只统计该租户"""
+    counts = Counter()
+    examples = {}
+    scanned = 0
+    chunks = (iter_tenant_conversations(store, tenant_id) if tenant_id is not None
+              else store.iter_conversations(chunk_size=1000))
+    for chunk in chunks:
+        for _, _, record in chunk:
+            key = normalize_query(record["query"])
+            counts[key] += 1
+            examples.setdefault(key, record["query"])
+        scanned += len(chunk)
+        if scanned >= scan_limit:
+            break
+    return [(examples[key], count) for key, count in counts.most_common(limit)]
+
+
+def run_cache_warmup(knowledge_df, rule_base, api_key, generation, tenant_id):
+    """后台执行一次租户的预热：先匹配热门问题填充命中/未命中缓存，再按配置为未命中的问题预生成AI回复"""
+    state = get_warmup_state(tenant_id)
+    config = WARMUP_CONFIG
+
+    def superseded():
+        return state["generation"] != generation
+
+    try:
+        queries = top_logged_queries(get_session_store(), config["top_n"], config["scan_limit"], tenant_id)
+        with state["lock"]:
+            state["queries"] = len(queries)
+        print(f"DEBUG: 缓存预热开始，热门问题 {len(queries)} 个")
+
+        limiter = RateLimiter(config["match_rate"])
+
+        def warm_match(query):
+            if superseded():
+                return None
+            limiter.wait()
+            answer, _ = find_in_knowledge_base(query, knowledge_df, tenant_id=tenant_id)
+            with state["lock"]:
+                state["matched"] += 1
+                state["kb_hits"] += answer is not None
+            return answer
+
+        with ThreadPoolExecutor(max_workers=config["workers"], thread_name_prefix="cache-warmup") as executor:
+            answers = list(executor.map(warm_match, [query for query, _ in queries]))
+
+        if config["llm"] and not superseded():
+            # 只为知识库无法回答（需要走AI）的热门问题预生成，使用空对话历史，与新会话的首个问题的Prompt一致
+            misses = [query for (query, _), answer in zip(queries, answers)
+                      if answer is None and not get_routing_rules(tenant_id).contains("kb_appearance", query)]
+            misses = misses[:config["llm_top_n"]]
+            with state["lock"]:
+                state["llm_total"] = len(misses)
+            llm_limiter = RateLimiter(config["llm_rate"])
+
+            def warm_llm(query):
+                if superseded():
+                    return
+                llm_limiter.wait()
+                usage_context = {"intent": detect_query_intent(query, tenant_id), "session_id": "warmup",
+                                 "kind": "warmup", "tenant": tenant_id}
+                result = ai_enhancement_with_knowledge(query, [], knowledge_df, api_key, usage_context)
+                with state["lock"]:
+                    state["llm_done"] += 1
+                    state["llm_cached"] += result["status"] == "success" and "model" in result
+
+            with ThreadPoolExecutor(max_workers=config["workers"], thread_name_prefix="cache-warmup-llm") as executor:
+                list(executor.map(warm_llm, misses))
+    except Exception as e:
+        print(f"DEBUG: 缓存预热失败: {str(e)}")
+        with state["lock"]:
+            state["error"] = str(e)[:200]
+    finally:
+        with state["lock"]:
+            if not superseded():
+                # 预热失败也标记为就绪，只是缓存未填充，不影响正常处理请求
+                state["status"] = "ready"
+                state["ready"] = True
+                state["finished"] = time.time()
+        print(f"DEBUG: 缓存预热结束: 匹配 {state['matched']} 个 (知识库命中 {state['kb_hits']}), "
+              f"预生成AI回复 {state['llm_cached']}/{state['llm_total']}")
+
+
+def start_cache_warmup(knowledge_df, rule_base, api_key, force=False, tenant_id=None):
+    """租户的当前知识库尚未预热时在后台启动预热；知识库版本变化后重新预热，旧的预热任务自行退出"""
+    tenant_id = tenant_id or get_tenant_id()
+    state = get_warmup_state(tenant_id)
+    kb_version = get_kb_version(knowledge_df) if knowledge_df is not None else None
+    with state["lock"]:
+        if state["kb_version"] == kb_version and state["status"] != "idle" and not force:
+            return
+        state["generation"] += 1
+        state.update(kb_version=kb_version, queries=0, matched=0, kb_hits=0, llm_total=0, llm_done=0,
+                     llm_cached=0, started=time.time(), finished=None, error=None)
+        if knowledge_df is None or not WARMUP_CONFIG["enabled"]:
+            state.update(status="ready", ready=True, finished=time.time())
+            return
+        state.update(status="running", ready=False)
+        generation = state["generation"]
+    threading.Thread(target=run_cache_warmup, args=(knowledge_df, rule_base, api_key, generation, tenant_id),
+                     name="cache-warmup", daemon=True).start()
+
+
+# ====== 知识库后台加载：解析和索引构建在后台分阶段执行，构建完成后原子切换，期间继续使用旧版本 ======
+KB_LOAD_CONFIG = {
+    "background": os.getenv("KB_BACKGROUND_LOAD", "1") != "0",  # 关闭后上传请求等待加载完成（仍按阶段并发构建）
+    "workers": 4,  # 同组阶段（各项索引和快照保存）的并发线程数
+    "poll_seconds": 1.0,  # 加载进行中时界面刷新进度的间隔
+}
+KB_LOAD_STAGE_LABELS = {"parse": "解析文件", "store": "紧凑存储", "canonical": "规范化索引", "bm25": "BM25预筛选索引",
+                        "choices": "模糊匹配候选", "snapshot": "保存快照", "register": "登记索引",
+                        "typo": "纠错词条索引", "shards": "模糊匹配分片", "swap": "切换版本", "warmup": "缓存预热"}
+
+
+def kb_load_parse(context):
+    context["knowledge_df"] = parse_knowledge_base(context.pop("source"), context["name"])
+    context["rule_base"] = build_rule_base(context["tenant_id"])
+    context["kb_version"] = get_kb_version(context["knowledge_df"])
+
+
+def kb_load_store(context):
+    """同一内容的知识库已构建过时复用已有的紧凑存储，之后各阶段直接跳过"""
+    store = lookup_kb_store(context["kb_version"])
+    context["registered"] = store is not None
+    context["store"] = store if store is not None else CompactKnowledgeBase(context["knowledge_df"])
+
+
+def kb_load_canonical(context):
+    return build_kb_canonical_index(context["store"], context["rule_base"])
+
+
+def kb_load_bm25(context):
+    return build_kb_bm25_index(context["store"])
+
+
+def kb_load_typo(context):
+    return build_kb_typo_index(context["store"])
+
+
+def kb_load_choices(context):
+    context["store"].choices()
+
+
+def kb_load_snapshot(context):
+    store = get_session_store()
+    if store.has_kb_snapshot(context["kb_version"]):
+        return False
+    store.save_kb_snapshot(context["kb_version"], kb_snapshot_document(context["knowledge_df"], context["rule_base"]))
+
+
+def kb_load_register(context):
+    if context["registered"]:
+        return False
+    register_kb_store(context["kb_version"], context["store"])
+
+
+def kb_load_shards(context):
+    """没有预筛选索引的大知识库在切换前启动模糊匹配进程池，切换后的首个请求不必等待"""
+    knowledge_df = context["knowledge_df"]
+    if (context["store"].bm25 is not None or not FUZZY_SHARD_CONFIG["enabled"]
+            or FUZZY_SHARD_CONFIG["num_shards"] <= 1 or len(knowledge_df) < FUZZY_SHARD_CONFIG["min_kb_size"]):
+        return False
+    get_fuzzy_shard_service(knowledge_df)
+
+
+def kb_load_swap(context):
+    """索引全部就绪后设为租户的当前知识库，该租户的会话下次运行时切换到新版本"""
+    knowledge_df = context["knowledge_df"]
+    assign_tenant_kb(context["tenant_id"], knowledge_df, context["rule_base"])
+    context["summary"] = {"kb_version": context["kb_version"], "rows": len(knowledge_df),
+                          "ingest_report": knowledge_df.attrs.get('ingest_report'),
+                          "type_counts": knowledge_df['问题类型'].value_counts().to_dict(),
+                          "rule_categories": len(context["rule_base"])}
+
+
+def kb_load_warmup(context):
+    start_cache_warmup(context["knowledge_df"], context["rule_base"], context["api_key"],
+                       tenant_id=context["tenant_id"])
+
+
+# 外层按顺序执行，同一组内的阶段并发执行
+KB_LOAD_STAGES = [
+    [("parse", kb_load_parse)],
+    [("store", kb_load_store)],
+    [("canonical", kb_load_canonical), ("bm25", kb_load_bm25), ("choices", kb_load_choices),
+     ("typo", kb_load_typo), ("snapshot", kb_load_snapshot)],
+    [("register", kb_load_register)],
+    [("shards", kb_load_shards)],
+    [("swap", kb_load_swap)],
+    [("warmup", kb_load_warmup)],
+]
+
+
+@st.cache_resource
+def get_kb_load_jobs():
+    """租户 -> (任务ID, 最近一次知识库加载任务)（进程内共享，同一租户的其他会话也能看到进度）"""
+    return {"lock": threading.Lock(), "jobs": {}}
+
+
+def start_kb_load(tenant_id, uploaded_file, api_key):
+    """在后台加载上传的知识库并返回任务ID；同一租户尚未完成的上一次加载被取代，不再切换版本"""
+    # 上传内容在当前请求中读出，后台线程不访问 UploadedFile
+    context = {"source": uploaded_file.getvalue(), "name": uploaded_file.name, "tenant_id": tenant_id,
+               "api_key": api_key}
+    job = KnowledgeBaseLoadJob(KB_LOAD_STAGES, context, KB_LOAD_CONFIG["workers"], name="kb-load",
+                               keep=("summary",))
+    job_id = uuid.uuid4().hex[:12]
+    registry = get_kb_load_jobs()
+    with registry["lock"]:
+        previous = registry["jobs"].get(tenant_id)
+        registry["jobs"][tenant_id] = (job_id, job)
+    if previous is not None:
+        previous[1].cancel()
+    job.start()
+    print(f"DEBUG: 租户 {tenant_id} 开始后台加载知识库 {uploaded_file.name}")
+    return job_id
+
+
+def get_kb_load_job(tenant_id):
+    """租户最近一次的加载任务 (任务ID, 任务)，没有时返回None"""
+    registry = get_kb_load_jobs()
+    with registry["lock"]:
+        return registry["jobs"].get(tenant_id)
+
+
+# ====== 对话记录导出：后台按块读取会话存储，批量脱敏后写入文件 ======
+EXPORT_CONFIG = {
+    "dir": os.getenv("EXPORT_DIR", "exports"),
+    "chunk_size": 1000,
+    "max_download_mb": 50,  # 超过该大小的导出文件不提供浏览器下载，只显示文件路径
+    "max_jobs": 20,  # 保留的导出任务记录数
+}
+
+
+@st.cache_resource
+def get_export_jobs():
+    """导出任务ID -> 任务（进程内共享，会话刷新后仍能查看进度）"""
+    return {"lock": threading.Lock(), "jobs": OrderedDict()}
+
+
+def start_conversation_export(fmt, tenant_id, session_id=None):
+    """启动后台导出任务并返回任务ID；只导出 tenant_id 租户的记录，session_id 为None时导出该租户的全部会话"""
+    scope = session_id[:8] if session_id else "all"
+    path = os.path.join(EXPORT_CONFIG["dir"],
+                        f"conversations-{tenant_id}-{scope}-{time.strftime('%Y%m%d-%H%M%S')}{EXPORT_FORMATS[fmt]}")
+    job = ConversationExportJob(get_session_store(), path, fmt, desensitize_batch, session_id,
+                                EXPORT_CONFIG["chunk_size"], tenant_id, TENANT_CONFIG["default"])
+    job_id = uuid.uuid4().hex[:12]
+    registry = get_export_jobs()
+    with registry["lock"]:
+        registry["jobs"][job_id] = job
+        while len(registry["jobs"]) > EXPORT_CONFIG["max_jobs"]:
+            registry["jobs"].popitem(last=False)
+    job.start()
+    print(f"DEBUG: 开始导出对话记录 {path}")
+    return job_id
+
+
+def get_export_job(job_id):
+    registry = get_export_jobs()
+    with registry["lock"]:
+        return registry["jobs"].get(job_id)
+
+
+# ====== 流量录制：供 replay.py 重放线上流量、对比路由和延迟 ======
 
-**知识库标准答案**：
-{relevant_knowledge}
+# 录制配置：设置环境变量 TRAFFIC_RECORD=1 开启，也可在侧边栏开关
+TRAFFIC_RECORDER_CONFIG = {
+    "enabled": os.getenv("TRAFFIC_RECORD", "") == "1",
+    "path_pattern": os.getenv("TRAFFIC_RECORD_PATH", DEFAULT_TRAFFIC_PATH),
+    "batch_size": 100,
+    "flush_interval": 5.0,
+}
 
-**当前用户问题**：
-{user_query}
 
-请生成简洁、专业的客服回复（最好在50字以内）："""
-    elif is_appearance_question:
-        # 外观问题
-        full_prompt = f"""你是一个专业的机器人产品淘宝客服AI助手。
+@st.cache_resource
+def get_traffic_recorder():
+    """进程内共享的流量录制器，退出时写入剩余的缓冲记录"""
+    config = TRAFFIC_RECORDER_CONFIG
+    recorder = TrafficRecorder(config["path_pattern"], config["batch_size"], config["flush_interval"],
+                               enabled=config["enabled"])
+    atexit.register(recorder.flush)
+    return recorder
 
-用户问了一个关于产品外观/颜色/尺寸的问题，但知识库中没有相关信息。
 
-**当前用户问题**：
-{user_query}
+def record_traffic(user_query, result, rule_result, stage_timings, query_start):
+    """
+    录制一次查询：脱敏后的问题和回复、路由结果、各阶段耗时（毫秒）以及AI原始响应
 
-请根据常识生成简短回复（30字以内），如果不知道确切信息，可以说明情况并提供帮助方式。"""
-    else:
-        # 其他问题
-        full_prompt = f"""你是一个专业的机器人产品淘宝客服AI助手。
+    rule_result 为走AI时规则引擎的结果，用于记录知识库未命中的原因
+    """
+    recorder = get_traffic_recorder()
+    if not recorder.enabled:
+        return
+    knowledge_df = st.session_state.knowledge_df
+    stage_ms = {stage: round(seconds * 1000, 3) for stage, seconds in stage_timings.items()}
+    stage_ms["total"] = round((time.time() - query_start) * 1000, 3)
+    entry = {
+        "ts": round(query_start, 3),
+        "tenant": get_tenant_id(),
+        "kb_version": get_kb_version(knowledge_df) if knowledge_df is not None else None,
+        "query": desensitize(user_query),
+        "source": result["source"],
+        "intent": result["intent"],
+        "status": result["status"],
+        "reply": desensitize(result["reply"]),
+        "stages": stage_ms,
+    }
+    if result.get("deadline_hits"):
+        entry["deadline_hits"] = result["deadline_hits"]
+    if result.get("corrected_query"):
+        entry["corrected_query"] = desensitize(result["corrected_query"])
+    if rule_result is not None:
+        entry["rule_source"] = rule_result["source"]
+        entry["rule_intent"] = rule_result["intent"]
+    llm_response = result.get("llm_response")
+    if llm_response is not None:
+        entry["llm"] = {key: llm_response.get(key) for key in
+                        ("ok", "model", "status_code", "error", "input_tokens", "output_tokens")}
+        entry["llm"]["text"] = desensitize(llm_response.get("text"))
+    recorder.record(entry)
 
-**重要指令**：
-1. 请优先参考下面的知识库信息
-2. 如果知识库信息能回答用户问题，请基于知识库信息生成简洁回复
-3. 如果知识库信息不完整，可以补充你的专业知识。
-4. 但是涉及到你不确定且知识库完全没出现的内容时，请说抱歉我不知道，建议您联系客服或查看公司官网或产品说明书。
-5. 注意不要泄露任何隐私信息
-6. 保持回答简洁明了
 
-**知识库参考信息**：
-{relevant_knowledge if relevant_knowledge else "（暂无相关参考信息）"}
+# ====== 按需性能剖析：对接下来N次查询做cProfile和tracemalloc统计 ======
 
-**对话历史(最近3轮)**：
-{history_text if history_text else "（暂无历史对话）"}
+# 汇总中单独列出的函数
+PROFILE_FOCUS_FUNCTIONS = ["process_query", "rule_engine", "find_in_knowledge_base", "fuzzy_extract_one",
+                           "desensitize", "build_prompt", "ai_enhancement_with_knowledge", "generate_statistics_chart"]
 
-**当前用户问题**：
-{user_query}
 
-请生成简洁、友好的客服回复："""
+@st.cache_resource
+def get_request_profiler():
+    """进程内共享的剖析器，未启用时 run() 直接调用原函数"""
+    return RequestProfiler(os.getenv("PROFILE_DIR", "profiles"), focus_functions=PROFILE_FOCUS_FUNCTIONS)
 
-    try:
-        # 获取API密钥
-        api_key = st.session_state.get('api_key', '')
-        if not api_key:
-            api_key = os.getenv('DASHSCOPE_API_KEY', '')
-            if not api_key:
-                return {
-                    "source": "AI模型",
-                    "intent": "未识别",
-                    "reply": "⚠️ 未配置API密钥，请在侧边栏设置",
-                    "latency": time.time() - start_time,
-                    "status": "failed"
-                }
-        
-        response = Generation.call(
-            model="qwen-plus",
-            prompt=full_prompt,
-            temperature=0.3,
-            api_key=api_key
-        )
-        
-        end_time = time.time()
-        
-        if response.status_code == 200:
-            reply = response.output.text
-            reply = desensitize(reply)
-                        
-            return {
-                "source": "AI模型" + ("（外观咨询）" if is_appearance_question else "（增强版）"),
-                "intent": "外观属性咨询" if is_appearance_question else "未识别",
-                "reply": reply,
-                "latency": end_time - start_time,
-                "status": "success"
-            }
-        else:
-            return {
-                "source": "AI模型",
-                "intent": "未识别",
-                "reply": f"请求失败，请稍后再试 (错误码: {response.status_code})",
-                "latency": end_time - start_time,
-                "status": "failed"
-            }
-    except Exception as e:
-        end_time = time.time()
-        return {
-            "source": "AI模型",
-            "intent": "未识别",
-            "reply": f"API调用异常: {str(e)[:50]}...",
-            "latency": end_time - start_time,
-            "status": "failed"
-        }
 
-def process_query(user_query):
+def record_deadline_hits(result, deadline):
+    """把本次请求中超时的阶段附加到结果，并计入超时请求数"""
+    if not deadline.hits:
+        return
+    result["deadline_hits"] = list(deadline.hits)
+    stats = get_deadline_stats()
+    with stats["lock"]:
+        stats["requests_hit"] += 1
+
+
+def process_query(user_query, deadline=None):
     """
     知识库优先,匹配失败时调用增强版AI模型（带知识库上下文）
+
+    对大概率未命中的问题，AI请求与知识库匹配并行执行（推测执行）。
+    deadline 为整个请求的截止时间（默认按 DEADLINE_CONFIG 新建），知识库阶段为AI调用预留时间
     """
     print(f"\n=== DEBUG process_query 开始 ===")
     print(f"用户查询: {user_query}")
     
+    query_start = time.time()
+    stage_start = time.perf_counter()
+    stage_timings = {}
     knowledge_df = st.session_state.knowledge_df
-    
+    if deadline is None:
+        deadline = new_request_deadline()
+
+    # 推测执行：提前发起AI请求
+    speculative_future, speculation_bucket = start_speculative_ai(user_query, knowledge_df, deadline)
+    stage_timings["speculation"] = time.perf_counter() - stage_start
+
     # 直接使用规则引擎
-    rule_result = rule_engine(user_query, knowledge_df)
+    stage_start = time.perf_counter()
+    rule_result = rule_engine(user_query, knowledge_df, deadline.reserve(DEADLINE_CONFIG["llm_reserve"]))
+    stage_timings["rule_engine"] = time.perf_counter() - stage_start
     
     print(f"DEBUG: rule_engine 返回状态: {rule_result['status']}")
     print(f"DEBUG: rule_engine 返回source: {rule_result['source']}")
+
+    # 因超时未完整匹配的结果不用于校准未命中预测
+    if speculation_bucket != "系统预设" and not deadline.hits:
+        record_speculation_outcome(speculation_bucket, rule_result["status"] != "success")
+
+    speculative_result = None
+    if speculative_future is not None:
+        stage_start = time.perf_counter()
+        speculative_result = settle_speculation(speculative_future, rule_result, query_start)
+        stage_timings["speculation_wait"] = time.perf_counter() - stage_start
     
     if rule_result["status"] == "success":
         print(f"DEBUG: 使用知识库/预设回复")
@@ -629,17 +3399,31 @@ def process_query(user_query):
             "reply": rule_result["reply"],
             "source": rule_result["source"],
             "time": time.strftime("%H:%M:%S"),
-            "latency": rule_result["latency"]
+            "latency": rule_result["latency"],
+            "id": uuid.uuid4().hex[:12],
+            "tenant": get_tenant_id()
         })
+        rule_result["conversation_id"] = st.session_state.all_conversations[-1]["id"]
+        record_deadline_hits(rule_result, deadline)
+        persist_session_state(st.session_state.all_conversations[-1])
+        record_traffic(user_query, rule_result, None, stage_timings, query_start)
+        get_tenant_registry().record_request(get_tenant_id(), time.time() - query_start, stage_timings["rule_engine"])
         return rule_result
     else:
-        print(f"DEBUG: 调用AI增强版")
-        # 知识库无法回答，调用增强版AI
-        ai_result = ai_enhancement_with_knowledge(
-            user_query, 
-            st.session_state.history,
-            knowledge_df
-        )
+        if speculative_result is not None:
+            print(f"DEBUG: 使用推测执行的AI结果")
+            ai_result = speculative_result
+        else:
+            print(f"DEBUG: 调用AI增强版")
+            # 知识库无法回答，调用增强版AI
+            stage_start = time.perf_counter()
+            ai_result = ai_enhancement_with_knowledge(
+                user_query, 
+                st.session_state.history,
+                knowledge_df,
+                deadline=deadline
+            )
+            stage_timings["llm"] = time.perf_counter() - stage_start
         
         # 记录到对话历史
         st.session_state.history.appendleft((user_query, ai_result["reply"]))
@@ -648,8 +3432,19 @@ def process_query(user_query):
             "reply": ai_result["reply"],
             "source": ai_result["source"],
             "time": time.strftime("%H:%M:%S"),
-            "latency": ai_result["latency"]
+            "latency": ai_result["latency"],
+            "prompt_tokens": ai_result.get("prompt_tokens"),
+            "prompt_budget": ai_result.get("prompt_budget"),
+            "id": uuid.uuid4().hex[:12],
+            "tenant": get_tenant_id()
         })
+        ai_result["conversation_id"] = st.session_state.all_conversations[-1]["id"]
+        if ai_result.get("model") and not ai_result.get("cached"):
+            record_llm_volume("llm", ai_result["latency"])
+        record_deadline_hits(ai_result, deadline)
+        persist_session_state(st.session_state.all_conversations[-1])
+        record_traffic(user_query, ai_result, rule_result, stage_timings, query_start)
+        get_tenant_registry().record_request(get_tenant_id(), time.time() - query_start, stage_timings["rule_engine"])
         return ai_result
 
 
@@ -681,8 +3476,671 @@ def generate_statistics_chart():
     return fig
 
 
+# ====== 界面区块：各区块作为 fragment 独立重跑，知识库统计和图表缓存，记录每次渲染的服务端耗时 ======
+UI_CONFIG = {
+    "fragments": os.getenv("UI_FRAGMENTS", "1") != "0",  # 关闭后每次交互都重跑整个页面（用于对比渲染耗时）
+    "memoize": os.getenv("UI_MEMOIZE", "1") != "0",  # 知识库统计按版本缓存、统计图表按对话记录缓存
+    "render_window": 200,  # 每个区块保留的最近渲染耗时数
+    "chart_dpi": 80,
+    "statistics_refresh_seconds": 10,  # 性能统计区块的自动刷新间隔（提问只重跑工作台区块）
+}
+RENDER_SECTION_LABELS = {"app": "整页", "workbench": "客服工作台", "kb_details": "知识库详情",
+                         "desensitize_demo": "脱敏演示", "statistics": "性能统计", "kb_load": "知识库加载"}
+
+
+@st.cache_resource
+def get_render_stats():
+    """各界面区块最近的渲染耗时（进程内共享）；app 为整页重跑，其余为各区块（含 fragment 单独重跑）"""
+    return {"lock": threading.Lock(), "sections": {}}
+
+
+@contextlib.contextmanager
+def render_timer(section):
+    """统计一个区块的渲染耗时；本会话最近一次的耗时同时保存在 session_state.render_timings"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stats = get_render_stats()
+        with stats["lock"]:
+            samples = stats["sections"].get(section)
+            if samples is None:
+                samples = stats["sections"][section] = deque(maxlen=UI_CONFIG["render_window"])
+            samples.append(elapsed)
+        st.session_state.setdefault('render_timings', {})[section] = elapsed
+
+
+def ui_fragment(section, run_every=None):
+    """把界面区块包装为可独立重跑的 fragment（UI_CONFIG 关闭时为普通函数），并统计每次渲染耗时"""
+    def decorator(func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            with render_timer(section):
+                return func(*args, **kwargs)
+        return st.fragment(timed, run_every=run_every) if UI_CONFIG["fragments"] else timed
+    return decorator
+
+
+def compute_kb_summary(knowledge_df):
+    """知识库详情中展示的统计：问题类型分布、示例问题、平均回答长度"""
+    summary = {"rows": len(knowledge_df), "type_counts": [], "type_count": 0, "samples": [],
+               "avg_answer_chars": float(knowledge_df['标准回答'].str.len().mean()) if len(knowledge_df) else 0.0}
+    sample_size = min(5, len(knowledge_df))
+    if '问题类型' in knowledge_df.columns:
+        type_counts = knowledge_df['问题类型'].value_counts()
+        summary["type_counts"] = [(type_name, int(count)) for type_name, count in type_counts.items()]
+        summary["type_count"] = len(type_counts)
+    if summary["type_count"] > 1:
+        # 每个类型取第一条问题
+        first_rows = knowledge_df.drop_duplicates('问题类型')
+        summary["samples"] = first_rows['问题'].head(sample_size).tolist()
+    else:
+        summary["samples"] = knowledge_df['问题'].sample(sample_size).tolist()
+    return summary
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def cached_kb_summary(kb_version, _knowledge_df):
+    """按知识库版本缓存统计（DataFrame 不参与哈希）"""
+    return compute_kb_summary(_knowledge_df)
+
+
+def get_kb_summary(knowledge_df):
+    if UI_CONFIG["memoize"]:
+        return cached_kb_summary(get_kb_version(knowledge_df), knowledge_df)
+    return compute_kb_summary(knowledge_df)
+
+
+def get_statistics_chart_png():
+    """统计图表渲染为PNG；对话记录没有变化时直接返回上次的图片，不重新绘制"""
+    conversations = st.session_state.all_conversations
+    if not conversations:
+        return None
+    signature = (len(conversations), conversations[-1].get("id"))
+    cached = st.session_state.get('statistics_chart')
+    if UI_CONFIG["memoize"] and cached is not None and cached[0] == signature:
+        return cached[1]
+    fig = get_request_profiler().run(generate_statistics_chart, counted=False)
+    if fig is None:
+        return None
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", dpi=UI_CONFIG["chart_dpi"])
+    plt.close(fig)
+    png = buffer.getvalue()
+    st.session_state.statistics_chart = (signature, png)
+    return png
+
+
+@ui_fragment("workbench")
+def render_workbench():
+    """客服工作台：示例问题、提问表单、回复和对话历史；点击示例问题、反馈、删除记录时只重跑本区块"""
+
+    # 上一次运行中提交的反馈
+    feedback_notice = st.session_state.pop('feedback_notice', None)
+    if feedback_notice:
+        st.toast(feedback_notice)
+
+    # 初始化 session_state
+    if 'user_query' not in st.session_state:
+        st.session_state.user_query = ""
+    if 'query_submitted' not in st.session_state:
+        st.session_state.query_submitted = False
+
+    # 示例问题列表 - 按类别分组
+    examples_by_category = {
+        "电机技术咨询": [
+            "M0601C电机带减速器吗?",
+            "M0603C电机支持CAN通信吗?",
+            "电机可以用24V电压吗?",
+            "有代码例程和上位机吗?"
+        ],
+        "物流查询": [
+            "什么时候发货？",
+            "快递几天能到?",
+            "发什么快递？",
+            "运费怎么算？"
+        ],
+        "发票咨询": [
+            "可以开发票吗？",
+            "可以开专票吗？",
+            "发票怎么开？",
+            "发票开错了可以重开吗？"
+        ],
+        "价格与售后": [
+            "产品有优惠吗？能便宜点吗?",
+            "怎么申请退货？",
+            "保修期多久?",
+            "运费可以便宜吗？"
+        ]
+    }
+
+    # 显示示例问题
+    st.markdown("**快速提问（点击直接使用）**")
+
+    # 创建一个容器来显示示例按钮
+    example_container = st.container()
+
+    # 使用tab显示不同类别
+    tabs = example_container.tabs(list(examples_by_category.keys()))
+
+    for tab_idx, (category, examples) in enumerate(examples_by_category.items()):
+        with tabs[tab_idx]:
+            cols = st.columns(2)
+            for idx, example in enumerate(examples):
+                col_idx = idx % 2
+                with cols[col_idx]:
+                    # 定义按钮点击回调函数
+                    def set_example_query(example=example):
+                        st.session_state.user_query = example
+                        st.session_state.query_submitted = True
+
+                    btn_text = f"📌 {example[:20]}..." if len(example) > 20 else f"📌 {example}"
+                    st.button(
+                        btn_text,
+                        key=f"ex_btn_{category}_{idx}",
+                        on_click=set_example_query,
+                        use_container_width=True
+                    )
+
+    st.markdown("---")
+
+    # 使用 form 来管理输入和提交
+    with st.form(key="query_form", clear_on_submit=False):
+        # 显示当前已选中的问题
+        current_query = st.session_state.user_query
+        query_display = st.text_input(
+            "已选问题:",
+            value=current_query,
+            disabled=True,
+            key="query_display"
+        )
+
+        # 允许用户编辑
+        user_query = st.text_area(
+            "编辑或输入新问题：",
+            value=current_query,
+            placeholder="例如:M0601C电机带减速器吗?编码器是绝对式的吗?",
+            height=100,
+            key="user_input"
+        )
+
+        # 提交按钮
+        submit_col1, submit_col2 = st.columns([2, 1])
+        with submit_col1:
+            submitted = st.form_submit_button("🚀 获取AI回复", type="primary", use_container_width=True)
+        with submit_col2:
+            clear_clicked = st.form_submit_button("🗑️ 清空", type="secondary", use_container_width=True)
+
+        # 当清空按钮被点击时
+        if clear_clicked:
+            st.session_state.user_query = ""
+            # 这里不需要 rerun，因为清空后，表单重新渲染时会使用空值
+
+        # 当表单提交时
+        if submitted and user_query:
+            # 更新 session_state
+            st.session_state.user_query = user_query
+            st.session_state.query_submitted = True
+
+    # 当 query_submitted 为 True 时，处理查询
+    if st.session_state.query_submitted and st.session_state.user_query:
+        # 重置提交状态
+        st.session_state.query_submitted = False
+
+        if st.session_state.knowledge_df is None:
+            st.warning("⚠️ 请先上传知识库数据")
+        else:
+            with st.spinner("正在生成回复..."):
+                request_deadline = new_request_deadline()
+                result = get_request_profiler().run(process_query, st.session_state.user_query, request_deadline)
+
+                # 显示结果
+                st.markdown("---")
+
+                # ============ 错误处理部分 ============
+                if result["status"] == "failed":
+                    st.error(f"⚠️ 系统处理遇到问题: {result['reply']}")
+
+                    # 提供备选方案
+                    st.markdown("### 🔍 建议尝试以下方法:")
+                    st.markdown("1. 将复杂问题拆分为多个简单问题询问")
+                    st.markdown("2. 检查API密钥是否正确配置")
+                    st.markdown("3. 稍后重试或联系技术支持")
+
+                    # 如果知识库有相关内容，尝试提供一些可能的答案
+                    if st.session_state.knowledge_df is not None:
+                        # 尝试从知识库中找到部分相关答案
+                        query_lower = st.session_state.user_query.lower()
+                        related_questions = []
+
+                        # 检查常见关键词
+                        keywords = ["代码", "例程", "上位机", "电机", "控制", "软件"]
+                        for keyword in keywords:
+                            if keyword in query_lower:
+                                matches = st.session_state.knowledge_df[
+                                    st.session_state.knowledge_df['问题'].str.contains(keyword, case=False, na=False)
+                                ]
+                                if not matches.empty:
+                                    for _, row in matches.head(2).iterrows():
+                                        related_questions.append({
+                                            "问题": row['问题'],
+                                            "答案": row['标准回答']
+                                        })
+
+                        if related_questions:
+                            st.markdown("### 📚 知识库相关问答:")
+                            for i, item in enumerate(related_questions[:3], 1):
+                                with st.expander(f"相关问答 {i}: {item['问题'][:30]}..."):
+                                    st.markdown(f"**问题:** {item['问题']}")
+                                    st.markdown(f"**答案:** {item['答案']}")
+
+                    # 结束当前处理
+                    st.stop()
+
+                # ============ 正常结果显示 ============
+                with st.container():
+                    st.markdown("### 🤖 AI回复建议")
+
+                    # 显示来源标签
+                    source_text = result["source"]
+                    if "知识库" in source_text:
+                        source_color = "#4CAF50"  # 绿色
+                        icon = "📚"
+                    elif "AI模型" in source_text:
+                        source_color = "#2196F3"  # 蓝色
+                        icon = "🤖"
+                    elif "系统预设" in source_text:
+                        source_color = "#9C27B0"  # 紫色
+                        icon = "⚙️"
+                    else:
+                        source_color = "#FF9800"  # 橙色
+                        icon = "🔧"
+
+                    # 显示意图标签
+                    intent_text = result.get("intent", "未识别")
+                    intent_colors = {
+                        "发票咨询": "#FF5722",
+                        "物流查询": "#3F51B5",
+                        "退货政策": "#E91E63",
+                        "售后政策": "#009688",
+                        "价格咨询": "#FF9800",
+                        "电机技术咨询": "#795548",
+                        "通用问答": "#9C27B0",
+                        "感谢与告别": "#607D8B",
+                        "未识别": "#9E9E9E"
+                    }
+                    intent_color = intent_colors.get(intent_text, "#9E9E9E")
+
+                    col_source, col_intent, col_time = st.columns([2, 2, 1])
+                    with col_source:
+                        st.markdown(f"""
+                        <div style="background-color:{source_color}; color:white; padding:5px 10px; 
+                                    border-radius:5px; display:inline-block; margin-bottom:10px;">
+                            {icon} {source_text}
+                        </div>
+                        """, unsafe_allow_html=True)
+                    with col_intent:
+                        st.markdown(f"""
+                        <div style="background-color:{intent_color}; color:white; padding:5px 10px; 
+                                    border-radius:5px; display:inline-block; margin-bottom:10px;">
+                            🏷️ {intent_text}
+                        </div>
+                        """, unsafe_allow_html=True)
+                    with col_time:
+                        st.markdown(f"""
+                        <div style="background-color:#616161; color:white; padding:5px 10px; 
+                                    border-radius:5px; display:inline-block; margin-bottom:10px;">
+                            ⏱️ {result["latency"]:.2f}秒
+                        </div>
+                        """, unsafe_allow_html=True)
+
+                    # 显示回复内容
+                    st.markdown(f"""
+                    <div style="background-color:#f5f5f5; padding:15px; border-radius:5px; 
+                                border-left:4px solid {source_color}; margin:10px 0;">
+                        {result["reply"]}
+                    </div>
+                    """, unsafe_allow_html=True)
+
+                    # 一键复制按钮
+                    st.code(result["reply"], language=None)
+
+                    # 提示信息
+                    if "知识库" in source_text:
+                        st.caption("✅ 此回复来自知识库标准答案，准确可靠")
+                    elif "AI模型" in source_text:
+                        st.caption("🤖 此回复由AI生成，请仔细核对")
+                    elif "系统预设" in source_text:
+                        st.caption("⚙️ 此回复来自系统预设模板")
+
+                    # 添加用户反馈功能
+                    st.markdown("---")
+                    st.subheader("💬 反馈这个回答")
+
+                    # 使用回调记录反馈：按钮点击后页面重新运行，回复区域不再显示，回调在此之前执行
+                    conversation_id = result.get("conversation_id")
+                    col_fb1, col_fb2, col_fb3 = st.columns(3)
+                    with col_fb1:
+                        st.button("👍 回答准确", use_container_width=True, key=f"fb_pos_{conversation_id}",
+                                  on_click=record_feedback, args=(conversation_id, "positive"))
+                    with col_fb2:
+                        st.button("👎 回答不准确", use_container_width=True, key=f"fb_neg_{conversation_id}",
+                                  on_click=record_feedback, args=(conversation_id, "negative"))
+                    with col_fb3:
+                        st.button("🤔 不确定", use_container_width=True, key=f"fb_unsure_{conversation_id}",
+                                  on_click=record_feedback, args=(conversation_id, "unsure"))
+
+    # 对话历史
+    st.markdown("---")
+    st.subheader("📜 对话历史")
+
+    if len(st.session_state.all_conversations) > 0:
+        # 只显示最近5条，删除时需换算回完整记录中的位置
+        recent_offset = max(0, len(st.session_state.all_conversations) - 5)
+        for i, conv in enumerate(st.session_state.all_conversations[-5:]):
+            with st.expander(f"{conv['time']} - {conv['query'][:30]}..."):
+                col_a, col_b = st.columns([3, 1])
+                with col_a:
+                    st.markdown(f"**用户问题:** {conv['query']}")
+                    st.markdown(f"**客服回复:** {conv['reply']}")
+                with col_b:
+                    source_text = conv['source']
+                    if "知识库" in source_text:
+                        source_badge = "🟢 知识库"
+                    elif "AI模型" in source_text:
+                        source_badge = "🔵 AI生成"
+                    elif "系统预设" in source_text:
+                        source_badge = "🟣 系统预设"
+                    else:
+                        source_badge = f"🟠 {source_text}"
+                    st.caption(f"来源: {source_badge}")
+                    st.caption(f"耗时: {conv['latency']:.2f}秒")
+                    if conv.get('prompt_tokens'):
+                        st.caption(f"Prompt: {conv['prompt_tokens']}/{conv['prompt_budget']} tokens")
+                    if conv.get('feedback'):
+                        st.caption(f"反馈: {FEEDBACK_LABELS[conv['feedback']]}")
+
+                    # 添加删除按钮（回调在重跑之前执行，重跑时列表已更新）
+                    st.button(f"🗑️ 删除", key=f"delete_{i}", on_click=delete_conversation,
+                              args=(recent_offset + i,))
+    else:
+        st.info("暂无对话历史，请先提问")
+
+    # 导出对话记录（后台任务，问题和回复均脱敏）
+    with st.expander("📤 导出对话记录"):
+        col_fmt, col_scope = st.columns(2)
+        with col_fmt:
+            export_format = st.selectbox("格式", list(EXPORT_FORMATS), key="export_format")
+        with col_scope:
+            export_scope = st.radio("范围", ["当前会话", "本租户全部会话"], key="export_scope", horizontal=True)
+        if st.button("开始导出"):
+            st.session_state.export_job_id = start_conversation_export(
+                export_format, get_tenant_id(), get_session_id() if export_scope == "当前会话" else None)
+
+        export_job = get_export_job(st.session_state.get('export_job_id'))
+        if export_job is not None:
+            progress = export_job.progress()
+            if progress["status"] in ("pending", "running"):
+                total = progress["total"]
+                st.progress(min(progress["rows"] / total, 1.0) if total else 0.0,
+                            text=f"已导出 {progress['rows']} 条" + (f" / {total}" if total else ""))
+                col_refresh, col_cancel = st.columns(2)
+                col_refresh.button("刷新进度", key="export_refresh")
+                col_cancel.button("取消导出", key="export_cancel", on_click=export_job.cancel)
+            elif progress["status"] == "done":
+                elapsed = progress["finished"] - progress["started"]
+                st.success(f"导出完成: {progress['rows']} 条 · {progress['bytes'] / 1024:.0f}KB · {elapsed:.1f}秒")
+                if progress["bytes"] <= EXPORT_CONFIG["max_download_mb"] * 1024 * 1024:
+                    with open(progress["path"], "rb") as f:
+                        st.download_button("下载导出文件", f, file_name=os.path.basename(progress["path"]))
+                else:
+                    st.caption(f"文件较大，请在服务器上获取: {progress['path']}")
+            elif progress["status"] == "failed":
+                st.error(f"导出失败: {progress['error']}")
+            else:
+                st.info("导出已取消")
+
+
+@ui_fragment("kb_details")
+def render_kb_details():
+    """知识库状态和详情（统计按知识库版本缓存）"""
+    # 知识库状态
+    if st.session_state.knowledge_df is not None:
+        summary = get_kb_summary(st.session_state.knowledge_df)
+        st.success(f"✅ 知识库已加载")
+        st.metric("知识条目", summary["rows"])
+
+        # 显示知识库统计信息
+        with st.expander("📋 知识库详情"):
+            # 问题类型分布
+            if summary["type_counts"]:
+                st.write("**问题类型分布:**")
+                for type_name, count in summary["type_counts"]:
+                    # 创建水平条形图效果
+                    percent = count / summary["rows"] * 100
+                    st.progress(percent / 100, text=f"{type_name}: {count}条 ({percent:.1f}%)")
+            else:
+                st.write("知识库未标注问题类型")
+
+            # 示例问题展示（优先展示不同类型的问题）
+            st.write("**示例问题:**")
+            for q in summary["samples"]:
+                st.caption(f"• {q[:25]}..." if len(q) > 25 else f"• {q}")
+
+            # 显示当前生效的路由规则
+            rules = get_routing_rules()
+            st.write(f"**规则库覆盖类别（规则版本 {rules.version}）:**")
+            for category in rules.intents:
+                st.caption(f"• {category} ({len(rules.patterns[category])}个关键词)")
+
+            # 添加知识库导出功能
+            st.markdown("---")
+            if st.button("📥 导出知识库统计", use_container_width=True):
+                # 创建统计DataFrame
+                stats_df = pd.DataFrame({
+                    '指标': ['总问题数', '问题类型数', '平均回答长度'],
+                    '数值': [
+                        summary["rows"],
+                        summary["type_count"],
+                        summary["avg_answer_chars"]
+                    ]
+                })
+                st.dataframe(stats_df, use_container_width=True)
+    else:
+        st.warning("📁 等待加载知识库")
+        st.info("请上传包含三列(问题、标准回答、问题类型)的Excel文件")
+
+
+@ui_fragment("desensitize_demo")
+def render_desensitize_demo():
+    """脱敏演示"""
+    # 脱敏演示
+    st.markdown("---")
+    st.subheader("🔒 脱敏演示")
+
+    # 使用session_state存储测试文本
+    if 'test_text' not in st.session_state:
+        st.session_state.test_text = "我的手机是15766265746, 地址是杭州市西湖区文三路"
+
+    test_text = st.text_area(
+        "输入测试文本:",
+        value=st.session_state.test_text,
+        height=100,
+        key="test_input"
+    )
+
+    # 添加一个按钮来触发脱敏
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        if st.button("运行脱敏测试", type="primary"):
+            st.session_state.test_text = test_text
+
+            # 直接测试脱敏函数
+            st.markdown("### 测试结果")
+
+            # 1. 先显示原始文本
+            st.markdown("**原始文本:**")
+            st.code(test_text)
+
+            # 2. 调用脱敏函数
+            result = desensitize(test_text)
+
+            # 3. 显示脱敏结果
+            st.markdown("**脱敏结果:**")
+            st.code(result)
+
+            # 4. 显示对比
+            if result != test_text:
+                st.success("✅ 脱敏成功!")
+            else:
+                st.error("❌ 脱敏失败! 文本没有变化。")
+
+
+def render_kb_load_status():
+    """所属租户的知识库加载进度；只有加载进行中才渲染定时刷新的 fragment，本会话发起的加载完成后显示导入报告"""
+    entry = get_kb_load_job(get_tenant_id())
+    if entry is None:
+        return
+    job_id, job = entry
+    if job.progress()["status"] in ("pending", "running"):
+        poll_kb_load_progress(job_id, job)
+    else:
+        show_kb_load_progress(job_id, job, False)
+
+
+@ui_fragment("kb_load", run_every=KB_LOAD_CONFIG["poll_seconds"])
+def poll_kb_load_progress(job_id, job):
+    """加载进行中的进度区块：定时刷新，加载结束后重跑整页，之后的页面不再渲染本区块，刷新随之停止"""
+    show_kb_load_progress(job_id, job, True)
+
+
+def show_kb_load_progress(job_id, job, polling):
+    progress = job.progress()
+    status = progress["status"]
+    if status in ("pending", "running"):
+        running = [KB_LOAD_STAGE_LABELS[stage["name"]] for stage in progress["stages"] if stage["status"] == "running"]
+        st.progress(progress["completed"] / progress["total"],
+                    text=f"正在加载知识库 ({progress['completed']}/{progress['total']}): {'、'.join(running) or '等待中'}")
+        st.caption("加载完成前继续使用当前知识库回答")
+        return
+
+    if st.session_state.get('kb_load_seen') != job_id:
+        # 加载结束后切换本会话的知识库；定时刷新的 fragment 中还需要重跑整页，工作台才会使用新知识库
+        st.session_state.kb_load_seen = job_id
+        if status == "done":
+            bind_tenant_kb()
+            persist_session_state()
+        if polling:
+            st.rerun()
+    if st.session_state.get('kb_load_started') != job_id:
+        return
+
+    if status == "cancelled":
+        st.info("本次加载已被更新的上传取代")
+        return
+    if status == "failed":
+        stage = KB_LOAD_STAGE_LABELS.get(progress["failed_stage"], "未知阶段")
+        st.error(f"知识库加载失败（{stage}）: {progress['error']}")
+        return
+
+    summary = job.context["summary"]
+    st.success(f"✅ 成功加载 {summary['rows']} 条知识记录")
+    st.caption(" · ".join(f"{KB_LOAD_STAGE_LABELS[stage['name']]} {stage['seconds']:.2f}s"
+                          for stage in progress["stages"] if stage["status"] == "done")
+               + f" · 总耗时 {progress['finished'] - progress['started']:.2f}s")
+    ingest_report = summary["ingest_report"]
+    if ingest_report:
+        st.caption(f"导入 {ingest_report['sheets']} 个工作表 · "
+                   f"丢弃空行 {ingest_report['rows_dropped']} · "
+                   f"{ingest_report['rows_per_sec']:.0f} 行/秒")
+        if ingest_report['skipped_sheets']:
+            st.warning(f"以下工作表缺少必需列，已跳过: {', '.join(ingest_report['skipped_sheets'])}")
+
+    # 显示问题类型分布，体现新架构优势
+    type_info = ", ".join([f"{k}({v}条)" for k, v in summary["type_counts"].items()])
+    st.info(f"**问题类型分布:** {type_info}")
+
+    # 显示规则库覆盖情况
+    st.info(f"**规则库覆盖:** {summary['rule_categories']}个意图类别")
+
+
+@ui_fragment("statistics", run_every=UI_CONFIG["statistics_refresh_seconds"])
+def render_statistics():
+    """性能统计：与提问流程分离，定时刷新；图表按对话记录缓存"""
+    # 统计图表
+    st.markdown("---")
+    st.subheader("📈 性能统计")
+
+    if len(st.session_state.all_conversations) > 0:
+        # 图表不在提问流程中绘制：本区块定时刷新，对话记录没有变化时复用上次的图片
+        chart_png = get_statistics_chart_png()
+        if chart_png:
+            st.image(chart_png, use_container_width=True)
+
+        # 简单统计
+        df_stats = pd.DataFrame(st.session_state.all_conversations)
+        if not df_stats.empty:
+            avg_latency = df_stats['latency'].mean()
+
+            # 新的统计逻辑：知识库命中 vs AI生成 vs 系统预设
+            kb_count = len(df_stats[df_stats['source'].str.contains('知识库')])
+            ai_count = len(df_stats[df_stats['source'].str.contains('AI模型')])
+            sys_count = len(df_stats[df_stats['source'].str.contains('系统预设')])
+            other_count = len(df_stats) - kb_count - ai_count - sys_count
+
+            st.metric("平均响应时间", f"{avg_latency:.2f}秒")
+
+            # 显示回答来源分布
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("知识库命中", kb_count)
+            with col2:
+                st.metric("AI生成", ai_count)
+            with col3:
+                st.metric("系统预设", sys_count)
+
+            # 计算命中率
+            if len(df_stats) > 0:
+                hit_rate = (kb_count + sys_count) / len(df_stats) * 100
+                st.progress(hit_rate / 100, text=f"知识库+预设命中率: {hit_rate:.1f}%")
+
+            # 添加性能建议
+            with st.expander("📊 性能分析建议"):
+                if avg_latency > 2.0:
+                    st.warning("⚠️ 平均响应时间较长，建议:")
+                    st.markdown("""
+                    1. 检查API网络连接
+                    2. 考虑使用本地缓存
+                    3. 优化知识库匹配算法
+                    """)
+                else:
+                    st.success("✅ 响应时间正常")
+
+                if hit_rate < 50:
+                    st.warning(f"⚠️ 知识库命中率较低 ({hit_rate:.1f}%)，建议:")
+                    st.markdown("""
+                    1. 扩充知识库内容
+                    2. 优化关键词匹配规则
+                    3. 添加更多示例问题
+                    """)
+                else:
+                    st.success(f"✅ 知识库命中率良好 ({hit_rate:.1f}%)")
+
+
 # Streamlit界面
 def main():
+    with render_timer("app"):
+        render_app()
+
+
+def render_app():
+    restore_session_state()
+    bind_tenant_kb()
+    start_cache_warmup(st.session_state.knowledge_df, st.session_state.rule_base, get_api_key())
+    if GENERATED_TIER_CONFIG["enabled"] and st.session_state.rule_base is not None:
+        get_promotion_job(get_tenant_id(), extract_model_codes(st.session_state.rule_base))
+
     st.title("🤖 机器人客服AI助手演示系统")
     st.markdown("---")
 
@@ -702,6 +4160,7 @@ def main():
             # 当用户输入API密钥后，保存到session_state
             if api_key and api_key != current_api_key:
                 st.session_state['api_key'] = api_key
+                persist_session_state()
                 st.success("API密钥已更新!")
 
             # 添加一个测试连接按钮
@@ -709,16 +4168,17 @@ def main():
                 if st.session_state.get('api_key'):
                     dashscope.api_key = st.session_state['api_key']
                     try:
-                        # 简单测试调用
-                        test_response = Generation.call(
-                            model="qwen-plus",
-                            prompt="你好",
-                            temperature=0.1
-                        )
-                        if test_response.status_code == 200:
+                        # 简单测试调用，用量同样计入账本
+                        test_start = time.time()
+                        test_response = call_llm("qwen-plus", get_model_router().config["models"]["qwen-plus"],
+                                                 "你好", st.session_state['api_key'], temperature=0.1)
+                        test_response["model"] = "qwen-plus"
+                        record_llm_usage(test_response, time.time() - test_start, "API测试", "你好",
+                                         {"intent": "API测试", "session_id": get_session_id(), "kind": "api_test"})
+                        if test_response["ok"]:
                             st.success("API连接成功!")
                         else:
-                            st.error(f"API连接失败: {test_response.message}")
+                            st.error(f"API连接失败: {test_response['error']}")
                     except Exception as e:
                         st.error(f"连接异常: {str(e)}")
                 else:
@@ -726,29 +4186,19 @@ def main():
 
         # 数据上传
         st.subheader("📊 数据上传")
-        uploaded_file = st.file_uploader("上传知识库Excel文件", type=['xlsx'],
-                                         help="请确保文件包含'问题'、'问题类型'、'标准回答'三列")
+        uploaded_file = st.file_uploader("上传知识库文件", type=['xlsx', 'csv', 'parquet'],
+                                         help="请确保文件包含'问题'、'问题类型'、'标准回答'三列，"
+                                              "Excel的多个工作表会合并导入")
 
         if uploaded_file is not None:
             if st.button("加载知识库"):
-                with st.spinner("正在加载知识库..."):
-                    # 调用更新后的加载函数，现在返回两个值
-                    df, rule_base = load_knowledge_base(uploaded_file)
-                    if df is not None:
-                        # 更新Session State变量名
-                        st.session_state.knowledge_df = df
-                        st.session_state.rule_base = rule_base
-                        st.success(f"✅ 成功加载 {len(df)} 条知识记录")
-
-                        # 显示问题类型分布，体现新架构优势
-                        if '问题类型' in df.columns:
-                            type_counts = df['问题类型'].value_counts()
-                            type_info = ", ".join([f"{k}({v}条)" for k, v in type_counts.items()])
-                            st.info(f"**问题类型分布:** {type_info}")
-
-                            # 显示规则库覆盖情况
-                            rule_categories = list(rule_base.keys())
-                            st.info(f"**规则库覆盖:** {len(rule_categories)}个意图类别")
+                tenant_id = get_tenant_id()
+                # 解析和索引构建在后台进行，完成前本租户的会话继续使用当前知识库
+                st.session_state.kb_load_started = start_kb_load(tenant_id, uploaded_file, get_api_key())
+                if not KB_LOAD_CONFIG["background"]:
+                    with st.spinner("正在加载知识库..."):
+                        get_kb_load_job(tenant_id)[1].wait()
+        render_kb_load_status()
 
         # 系统状态 - 更新变量名
         st.subheader("📈 系统状态")
@@ -756,462 +4206,364 @@ def main():
         st.metric("历史窗口大小", len(st.session_state.history))
         if st.session_state.knowledge_df is not None:
             st.metric("知识库条目", len(st.session_state.knowledge_df))
-        if st.session_state.rule_base is not None:
-            st.metric("规则库类别", len(st.session_state.rule_base))
+        st.metric("规则库类别", len(get_routing_rules().intents))
 
-        # 清空对话按钮
-        if st.button("清空对话历史"):
-            st.session_state.history.clear()
-            st.session_state.all_conversations.clear()
-            st.success("对话历史已清空")
+        # 路由规则：rules.json 修改后自动重新加载，无需重新上传知识库
+        with st.expander("🧭 路由规则"):
+            rule_watcher = get_rule_watcher(get_tenant_id())
+            rule_stats = rule_watcher.stats()
+            col_version, col_keywords = st.columns(2)
+            col_version.metric("规则版本", rule_stats["version"])
+            col_keywords.metric("关键词", rule_stats["keywords"])
+            st.caption(f"{rule_stats['path']} · {rule_stats['intents']} 个意图 · 编译 {rule_stats['compile_ms']:.1f}ms · "
+                       f"加载于 {time.strftime('%H:%M:%S', time.localtime(rule_stats['loaded_at']))} · "
+                       f"重新加载 {rule_stats['reloads']} 次 · 失败 {rule_stats['failures']} 次")
+            if rule_stats["last_error"]:
+                st.error(f"最近一次加载失败，继续使用版本 {rule_stats['version']}: {rule_stats['last_error']}")
+            for warning in rule_stats["warnings"]:
+                st.warning(warning)
+            if st.button("重新加载规则", key="reload_rules"):
+                ok, message = rule_watcher.reload()
+                (st.success if ok else st.error)(message)
 
-    # 主界面 - 两列布局
-    col1, col2 = st.columns([2, 1])
+        # 多租户：常驻内存占用和各租户的请求耗时
+        with st.expander(f"🏢 租户: {get_tenant_id()}"):
+            tenant_registry = get_tenant_registry()
+            tenant_stats = tenant_registry.stats()
+            memory_budget = tenant_stats["memory_budget"]
+            st.progress(min(tenant_stats["resident_bytes"] / memory_budget, 1.0) if memory_budget else 0.0,
+                        text=f"常驻 {tenant_stats['resident']} 个租户 · "
+                             f"{tenant_stats['resident_bytes'] / 1024 / 1024:.1f}/{memory_budget / 1024 / 1024:.0f}MB")
+            if tenant_stats["tenants"]:
+                tenant_df = pd.DataFrame([
+                    {"租户": row["tenant"], "知识库版本": (row["kb_version"] or "-")[:8],
+                     "状态": ("常驻⚠️" if row["oversized"] else "常驻") if row["resident"] else "已卸载",
+                     "内存(MB)": round(row["memory_mb"], 1), "请求": row["requests"],
+                     "P50(毫秒)": round(row["p50_ms"], 1), "P95(毫秒)": round(row["p95_ms"], 1),
+                     "知识库P95(毫秒)": round(row["kb_p95_ms"], 1), "加载": row["loads"],
+                     "平均加载(秒)": round(row["avg_load_seconds"], 2), "卸载": row["evictions"]}
+                    for row in tenant_stats["tenants"]])
+                st.dataframe(tenant_df, hide_index=True, use_container_width=True)
+                resident_tenants = [row["tenant"] for row in tenant_stats["tenants"] if row["resident"]]
+                if resident_tenants:
+                    col_tenant, col_unload = st.columns([2, 1])
+                    unload_target = col_tenant.selectbox("租户", resident_tenants, key="tenant_unload_target",
+                                                         label_visibility="collapsed")
+                    if col_unload.button("卸载", key="tenant_unload"):
+                        if tenant_registry.unload(unload_target):
+                            st.success(f"已卸载租户 {unload_target}，下次访问时从快照重新加载")
+                        else:
+                            st.warning("该租户的知识库快照尚未保存，暂不能卸载")
+            st.caption("通过URL参数 ?tenant=租户ID 访问对应租户的知识库；⚠️ 表示占用超过预算一半，内存不足时优先卸载")
 
-    with col1:
-        st.subheader("💬 客服工作台")
+        # 缓存预热进度与实例就绪状态
+        warmup_state = get_warmup_state(get_tenant_id())
+        with warmup_state["lock"]:
+            warmup = {key: value for key, value in warmup_state.items() if key != "lock"}
+        if warmup["ready"]:
+            st.success("✅ 实例已就绪（缓存预热完成）" if warmup["kb_version"] else "✅ 实例已就绪")
+        elif warmup["status"] == "running":
+            st.info("🔥 缓存预热中，热门问题的匹配结果正在预先计算")
+        with st.expander("🔥 缓存预热"):
+            if warmup["queries"]:
+                st.progress(min(warmup["matched"] / warmup["queries"], 1.0),
+                            text=f"匹配预热 {warmup['matched']}/{warmup['queries']} · 知识库命中 {warmup['kb_hits']}")
+            if warmup["llm_total"]:
+                st.progress(min(warmup["llm_done"] / warmup["llm_total"], 1.0),
+                            text=f"AI回复预生成 {warmup['llm_done']}/{warmup['llm_total']} · 成功 {warmup['llm_cached']}")
+            if warmup["started"] and warmup["finished"]:
+                st.caption(f"预热耗时 {warmup['finished'] - warmup['started']:.1f}秒")
+            if warmup["error"]:
+                st.warning(f"预热失败: {warmup['error']}")
+            match_stats = get_match_cache().stats()
+            response_stats = get_response_cache().stats()
+            st.caption(f"匹配缓存 {match_stats['entries']} 条 · 命中 {match_stats['hits']}/{match_stats['lookups']} · "
+                       f"节省 {match_stats['saved_seconds'] * 1000:.1f}毫秒")
+            st.caption(f"AI回复缓存 {response_stats['entries']} 条 · 命中 {response_stats['hits']}/{response_stats['lookups']} · "
+                       f"节省 {response_stats['saved_seconds']:.1f}秒 / {response_stats['saved_tokens']} tokens")
+            if st.button("重新预热", disabled=st.session_state.knowledge_df is None):
+                start_cache_warmup(st.session_state.knowledge_df, st.session_state.rule_base, get_api_key(), force=True)
+                st.rerun()
 
-        # 初始化 session_state
-        if 'user_query' not in st.session_state:
-            st.session_state.user_query = ""
-        if 'query_submitted' not in st.session_state:
-            st.session_state.query_submitted = False
-
-        # 示例问题列表 - 按类别分组
-        examples_by_category = {
-            "电机技术咨询": [
-                "M0601C电机带减速器吗?",
-                "M0603C电机支持CAN通信吗?",
-                "电机可以用24V电压吗?",
-                "有代码例程和上位机吗?"
-            ],
-            "物流查询": [
-                "什么时候发货？",
-                "快递几天能到?",
-                "发什么快递？",
-                "运费怎么算？"
-            ],
-            "发票咨询": [
-                "可以开发票吗？",
-                "可以开专票吗？",
-                "发票怎么开？",
-                "发票开错了可以重开吗？"
-            ],
-            "价格与售后": [
-                "产品有优惠吗？能便宜点吗?",
-                "怎么申请退货？",
-                "保修期多久?",
-                "运费可以便宜吗？"
-            ]
-        }
+        # 推测执行配置与统计
+        with st.expander("⚡ 推测执行"):
+            config = get_speculation_config()
+            spec_enabled = st.checkbox("启用推测执行", value=config["enabled"],
+                                       help="对大概率无法命中知识库的问题，在匹配知识库的同时提前请求AI")
+            spec_threshold = st.slider("未命中概率阈值", 0.0, 1.0, float(config["miss_threshold"]), 0.05)
+            spec_budget = st.number_input("每小时允许浪费的AI调用", min_value=0,
+                                          value=int(config["wasted_budget"]), step=5)
+            st.session_state.speculation_config = {
+                "enabled": spec_enabled,
+                "miss_threshold": spec_threshold,
+                "wasted_budget": int(spec_budget)
+            }
 
-        # 显示示例问题
-        st.markdown("**快速提问（点击直接使用）**")
-
-        # 创建一个容器来显示示例按钮
-        example_container = st.container()
-
-        # 使用tab显示不同类别
-        tabs = example_container.tabs(list(examples_by_category.keys()))
-
-        for tab_idx, (category, examples) in enumerate(examples_by_category.items()):
-            with tabs[tab_idx]:
-                cols = st.columns(2)
-                for idx, example in enumerate(examples):
-                    col_idx = idx % 2
-                    with cols[col_idx]:
-                        # 定义按钮点击回调函数
-                        def set_example_query(example=example):
-                            st.session_state.user_query = example
-                            st.session_state.query_submitted = True
-
-                        btn_text = f"📌 {example[:20]}..." if len(example) > 20 else f"📌 {example}"
-                        st.button(
-                            btn_text,
-                            key=f"ex_btn_{category}_{idx}",
-                            on_click=set_example_query,
-                            use_container_width=True
-                        )
-
-        st.markdown("---")
-
-        # 使用 form 来管理输入和提交
-        with st.form(key="query_form", clear_on_submit=False):
-            # 显示当前已选中的问题
-            current_query = st.session_state.user_query
-            query_display = st.text_input(
-                "已选问题:",
-                value=current_query,
-                disabled=True,
-                key="query_display"
-            )
+            spec_stats = get_speculation_stats()
+            launched = spec_stats["launched"]
+            spec_hit_rate = spec_stats["used"] / launched * 100 if launched else 0
+            st.metric("推测命中率", f"{spec_hit_rate:.1f}%")
+            st.metric("累计节省时间", f"{spec_stats['latency_saved']:.2f}秒")
+            st.caption(f"发起 {launched} · 采用 {spec_stats['used']} · 浪费 {spec_stats['wasted']} · "
+                       f"取消 {spec_stats['cancelled']} · 预算跳过 {spec_stats['budget_skipped']}")
 
-            # 允许用户编辑
-            user_query = st.text_area(
-                "编辑或输入新问题：",
-                value=current_query,
-                placeholder="例如:M0601C电机带减速器吗?编码器是绝对式的吗?",
-                height=100,
-                key="user_input"
-            )
+        # Prompt预算配置与用量
+        with st.expander("✂️ Prompt预算"):
+            budget = get_prompt_budget()
+            total_tokens = st.number_input("Prompt总预算(tokens)", min_value=200,
+                                           value=int(budget["total_tokens"]), step=100)
+            knowledge_tokens = st.number_input("知识库片段上限(tokens)", min_value=50,
+                                               value=int(budget["knowledge_tokens"]), step=50)
+            history_tokens = st.number_input("对话历史上限(tokens)", min_value=0,
+                                             value=int(budget["history_tokens"]), step=50)
+            st.session_state.prompt_budget = {
+                "total_tokens": int(total_tokens),
+                "knowledge_tokens": int(knowledge_tokens),
+                "history_tokens": int(history_tokens)
+            }
 
-            # 提交按钮
-            submit_col1, submit_col2 = st.columns([2, 1])
-            with submit_col1:
-                submitted = st.form_submit_button("🚀 获取AI回复", type="primary", use_container_width=True)
-            with submit_col2:
-                clear_clicked = st.form_submit_button("🗑️ 清空", type="secondary", use_container_width=True)
-
-            # 当清空按钮被点击时
-            if clear_clicked:
-                st.session_state.user_query = ""
-                # 这里不需要 rerun，因为清空后，表单重新渲染时会使用空值
-
-            # 当表单提交时
-            if submitted and user_query:
-                # 更新 session_state
-                st.session_state.user_query = user_query
-                st.session_state.query_submitted = True
-
-        # 当 query_submitted 为 True 时，处理查询
-        if st.session_state.query_submitted and st.session_state.user_query:
-            # 重置提交状态
-            st.session_state.query_submitted = False
-
-            if st.session_state.knowledge_df is None:
-                st.warning("⚠️ 请先上传知识库数据")
+            prompt_records = [conv for conv in st.session_state.all_conversations if conv.get("prompt_tokens")]
+            if prompt_records:
+                avg_tokens = sum(conv["prompt_tokens"] for conv in prompt_records) / len(prompt_records)
+                avg_usage = sum(conv["prompt_tokens"] / conv["prompt_budget"] for conv in prompt_records) / len(prompt_records)
+                st.metric("平均Prompt大小", f"{avg_tokens:.0f} tokens")
+                st.progress(min(avg_usage, 1.0), text=f"平均预算使用率: {avg_usage:.0%}")
+
+        # 未命中缓存统计
+        with st.expander("🚫 未命中缓存"):
+            neg_stats = get_negative_cache().stats()
+            st.metric("缓存命中率", f"{neg_stats['hit_rate']:.1%}")
+            st.metric("节省匹配时间", f"{neg_stats['saved_seconds'] * 1000:.1f}毫秒")
+            st.caption(f"缓存条目 {neg_stats['entries']} · 命中 {neg_stats['hits']}/{neg_stats['lookups']} · "
+                       f"淘汰 {neg_stats['evictions']}")
+            if st.button("清空未命中缓存"):
+                get_negative_cache().invalidate()
+                st.success("未命中缓存已清空")
+
+        # 两级匹配缓存：一级为进程内的命中/未命中缓存，二级为各实例共享的后端
+        with st.expander("🗄️ 匹配缓存分级"):
+            neg_stats = get_negative_cache().stats()
+            match_stats = get_match_cache().stats()
+            l1_hits = neg_stats["hits"] + match_stats["hits"]
+            col_l1, col_l2 = st.columns(2)
+            col_l1.metric("一级命中率", f"{l1_hits / neg_stats['lookups']:.1%}" if neg_stats["lookups"] else "-",
+                          help=f"进程内 · 节省 {(neg_stats['saved_seconds'] + match_stats['saved_seconds']) * 1000:.1f}毫秒")
+            shared_cache = get_shared_match_cache()
+            if shared_cache is None:
+                col_l2.metric("二级命中率", "未启用", help="设置 SHARED_CACHE_BACKEND=sqlite 或 tcp 启用")
             else:
-                with st.spinner("正在生成回复..."):
-                    result = process_query(st.session_state.user_query)
+                shared_stats = shared_cache.stats()
+                col_l2.metric("二级命中率", f"{shared_stats['hit_rate']:.1%}",
+                              help=f"{shared_stats['backend']} · 节省 {shared_stats['saved_seconds'] * 1000:.1f}毫秒")
+                st.caption(f"二级 {shared_stats['backend']} · 命中 {shared_stats['hits']}/{shared_stats['lookups']}"
+                           f"（其中未命中结果 {shared_stats['negative_hits']}） · "
+                           f"平均读取 {shared_stats['avg_lookup_ms']:.2f}毫秒 · 写入 {shared_stats['writes']} · "
+                           f"待写 {shared_stats['pending']} · 丢弃 {shared_stats['dropped']} · 错误 {shared_stats['errors']}"
+                           f"（跳过 {shared_stats['skipped']}）")
+                if shared_stats["last_error"]:
+                    st.warning(f"共享缓存最近一次错误: {shared_stats['last_error']}")
 
-                    # 显示结果
-                    st.markdown("---")
-                    
-                    # ============ 错误处理部分 ============
-                    if result["status"] == "failed":
-                        st.error(f"⚠️ 系统处理遇到问题: {result['reply']}")
-                        
-                        # 提供备选方案
-                        st.markdown("### 🔍 建议尝试以下方法:")
-                        st.markdown("1. 将复杂问题拆分为多个简单问题询问")
-                        st.markdown("2. 检查API密钥是否正确配置")
-                        st.markdown("3. 稍后重试或联系技术支持")
-                        
-                        # 如果知识库有相关内容，尝试提供一些可能的答案
-                        if st.session_state.knowledge_df is not None:
-                            # 尝试从知识库中找到部分相关答案
-                            query_lower = st.session_state.user_query.lower()
-                            related_questions = []
-                            
-                            # 检查常见关键词
-                            keywords = ["代码", "例程", "上位机", "电机", "控制", "软件"]
-                            for keyword in keywords:
-                                if keyword in query_lower:
-                                    matches = st.session_state.knowledge_df[
-                                        st.session_state.knowledge_df['问题'].str.contains(keyword, case=False, na=False)
-                                    ]
-                                    if not matches.empty:
-                                        for _, row in matches.head(2).iterrows():
-                                            related_questions.append({
-                                                "问题": row['问题'],
-                                                "答案": row['标准回答']
-                                            })
-                            
-                            if related_questions:
-                                st.markdown("### 📚 知识库相关问答:")
-                                for i, item in enumerate(related_questions[:3], 1):
-                                    with st.expander(f"相关问答 {i}: {item['问题'][:30]}..."):
-                                        st.markdown(f"**问题:** {item['问题']}")
-                                        st.markdown(f"**答案:** {item['答案']}")
-                        
-                        # 结束当前处理
-                        st.stop()
-
-                    # ============ 正常结果显示 ============
-                    with st.container():
-                        st.markdown("### 🤖 AI回复建议")
-
-                        # 显示来源标签
-                        source_text = result["source"]
-                        if "知识库" in source_text:
-                            source_color = "#4CAF50"  # 绿色
-                            icon = "📚"
-                        elif "AI模型" in source_text:
-                            source_color = "#2196F3"  # 蓝色
-                            icon = "🤖"
-                        elif "系统预设" in source_text:
-                            source_color = "#9C27B0"  # 紫色
-                            icon = "⚙️"
-                        else:
-                            source_color = "#FF9800"  # 橙色
-                            icon = "🔧"
-
-                        # 显示意图标签
-                        intent_text = result.get("intent", "未识别")
-                        intent_colors = {
-                            "发票咨询": "#FF5722",
-                            "物流查询": "#3F51B5",
-                            "退货政策": "#E91E63",
-                            "售后政策": "#009688",
-                            "价格咨询": "#FF9800",
-                            "电机技术咨询": "#795548",
-                            "通用问答": "#9C27B0",
-                            "感谢与告别": "#607D8B",
-                            "未识别": "#9E9E9E"
-                        }
-                        intent_color = intent_colors.get(intent_text, "#9E9E9E")
-
-                        col_source, col_intent, col_time = st.columns([2, 2, 1])
-                        with col_source:
-                            st.markdown(f"""
-                            <div style="background-color:{source_color}; color:white; padding:5px 10px; 
-                                        border-radius:5px; display:inline-block; margin-bottom:10px;">
-                                {icon} {source_text}
-                            </div>
-                            """, unsafe_allow_html=True)
-                        with col_intent:
-                            st.markdown(f"""
-                            <div style="background-color:{intent_color}; color:white; padding:5px 10px; 
-                                        border-radius:5px; display:inline-block; margin-bottom:10px;">
-                                🏷️ {intent_text}
-                            </div>
-                            """, unsafe_allow_html=True)
-                        with col_time:
-                            st.markdown(f"""
-                            <div style="background-color:#616161; color:white; padding:5px 10px; 
-                                        border-radius:5px; display:inline-block; margin-bottom:10px;">
-                                ⏱️ {result["latency"]:.2f}秒
-                            </div>
-                            """, unsafe_allow_html=True)
-
-                        # 显示回复内容
-                        st.markdown(f"""
-                        <div style="background-color:#f5f5f5; padding:15px; border-radius:5px; 
-                                    border-left:4px solid {source_color}; margin:10px 0;">
-                            {result["reply"]}
-                        </div>
-                        """, unsafe_allow_html=True)
+        # 拼音/错字纠错统计
+        with st.expander("✏️ 拼音纠错"):
+            typo_stats = get_typo_stats()
+            with typo_stats["lock"]:
+                typo_snapshot = dict(typo_stats, kinds=dict(typo_stats["kinds"]))
+            col_typo1, col_typo2 = st.columns(2)
+            col_typo1.metric("纠正后命中", typo_snapshot["kb_hits"] + typo_snapshot["preset_hits"],
+                             help="纠正后由知识库或预设回复回答、省去的AI调用数")
+            col_typo2.metric("平均耗时", f"{typo_snapshot['seconds'] / max(1, typo_snapshot['attempts']) * 1000:.1f}毫秒",
+                             help="每次知识库未命中时纠错阶段增加的耗时")
+            kinds = " · ".join(f"{kind} {count}" for kind, count in typo_snapshot["kinds"].items())
+            st.caption(f"尝试 {typo_snapshot['attempts']} · 有纠正 {typo_snapshot['corrected']}"
+                       + (f" · {kinds}" if kinds else "")
+                       + f" · 拼音表: {'pypinyin' if lazy_pinyin is not None else '内置常用字'}"
+                       + ("" if TYPO_CONFIG["enabled"] else " · 已关闭"))
 
-                        # 一键复制按钮
-                        st.code(result["reply"], language=None)
+        # AI回答沉淀
+        with st.expander("🧠 AI回答沉淀"):
+            tier = get_generated_tier(get_tenant_id())
+            tier.refresh()
+            active_entries = tier.active_entries()
+            volume_hours = list(get_llm_volume_stats()["hours"].items())
+            llm_calls = sum(bucket["llm_calls"] for _, bucket in volume_hours)
+            generated_hits = sum(bucket["generated_hits"] for _, bucket in volume_hours)
+            saved_seconds = sum(bucket["saved_seconds"] for _, bucket in volume_hours)
+            col_tier1, col_tier2 = st.columns(2)
+            col_tier1.metric("生效条目", len(active_entries), help=f"版本 {tier.version}")
+            col_tier2.metric("节省AI调用", generated_hits,
+                             help=f"占AI调用与沉淀命中之和的 {generated_hits / max(1, llm_calls + generated_hits):.1%}")
+            st.caption(f"实际AI调用 {llm_calls} 次 · 估计节省 {saved_seconds:.1f}秒")
+            if volume_hours:
+                volume_df = pd.DataFrame(
+                    [{"小时": hour, "AI调用": bucket["llm_calls"], "沉淀命中": bucket["generated_hits"]}
+                     for hour, bucket in volume_hours]).set_index("小时")
+                st.line_chart(volume_df)
+            if st.button("立即沉淀"):
+                result = run_generated_promotion(extract_model_codes(st.session_state.rule_base), get_tenant_id())
+                st.success(f"聚类 {result['clusters']} 类，新升级 {result['promoted']} 条，更新 {result['updated']} 条")
+            for entry in active_entries:
+                st.markdown(f"**{entry['question'][:30]}**")
+                st.caption(f"{entry['answer'][:60]}")
+                st.caption(f"AI回答 {entry['count']} 次 · 👍{entry['positive']} 👎{entry['negative']} · "
+                           f"命中 {entry.get('hits', 0)} 次 · 第{entry['promoted_version']}版升级")
+                st.button("降级", key=f"demote_{entry['id']}", on_click=tier.demote, args=(entry['id'],))
 
-                        # 提示信息
-                        if "知识库" in source_text:
-                            st.caption("✅ 此回复来自知识库标准答案，准确可靠")
-                        elif "AI模型" in source_text:
-                            st.caption("🤖 此回复由AI生成，请仔细核对")
-                        elif "系统预设" in source_text:
-                            st.caption("⚙️ 此回复来自系统预设模板")
-                        
-                        # 添加用户反馈功能
-                        st.markdown("---")
-                        st.subheader("💬 反馈这个回答")
-                        
-                        col_fb1, col_fb2, col_fb3 = st.columns(3)
-                        with col_fb1:
-                            if st.button("👍 回答准确", use_container_width=True):
-                                st.success("感谢您的反馈！")
-                        with col_fb2:
-                            if st.button("👎 回答不准确", use_container_width=True):
-                                st.error("抱歉回答有误，我们会改进！")
-                        with col_fb3:
-                            if st.button("🤔 不确定", use_container_width=True):
-                                st.info("感谢反馈，我们会检查这个问题。")
-
-        # 对话历史
-        st.markdown("---")
-        st.subheader("📜 对话历史")
-
-        if len(st.session_state.all_conversations) > 0:
-            for i, conv in enumerate(st.session_state.all_conversations[-5:]):
-                with st.expander(f"{conv['time']} - {conv['query'][:30]}..."):
-                    col_a, col_b = st.columns([3, 1])
-                    with col_a:
-                        st.markdown(f"**用户问题:** {conv['query']}")
-                        st.markdown(f"**客服回复:** {conv['reply']}")
-                    with col_b:
-                        source_text = conv['source']
-                        if "知识库" in source_text:
-                            source_badge = "🟢 知识库"
-                        elif "AI模型" in source_text:
-                            source_badge = "🔵 AI生成"
-                        elif "系统预设" in source_text:
-                            source_badge = "🟣 系统预设"
-                        else:
-                            source_badge = f"🟠 {source_text}"
-                        st.caption(f"来源: {source_badge}")
-                        st.caption(f"耗时: {conv['latency']:.2f}秒")
-                        
-                        # 添加删除按钮
-                        if st.button(f"🗑️ 删除", key=f"delete_{i}"):
-                            # 从对话历史中删除
-                            del st.session_state.all_conversations[i]
-                            st.rerun()
-        else:
-            st.info("暂无对话历史，请先提问")
+        # 问题规范化统计
+        with st.expander("🔤 问题规范化"):
+            canonical_stats = get_canonical_stats()
+            lookups = canonical_stats["lookups"]
+            st.metric("规范化后精确命中", canonical_stats["canonical_hits"],
+                      help="原始问题未能精确匹配、规范化后精确命中的次数（原本会进入子串/模糊匹配或调用AI）")
+            if lookups:
+                st.caption(f"精确匹配 {canonical_stats['exact_hits'] + canonical_stats['canonical_hits']}/{lookups} · "
+                           f"其中规范化贡献 {canonical_stats['canonical_hits'] / lookups:.1%}")
+            st.caption(f"型号规则: {', '.join(get_query_canonicalizer().model_codes) or '无'} · "
+                       f"繁简转换: {'opencc' if OpenCC is not None else '内置常用字表'}")
 
-    with col2:
-        st.subheader("📊 系统信息")
+        # 模型路由统计
+        with st.expander("🔀 模型路由"):
+            for model, model_stats in get_model_router().snapshot().items():
+                calls = model_stats["calls"]
+                avg_latency = model_stats["total_latency"] / calls if calls else 0
+                st.write(f"**{model}**")
+                st.caption(f"调用 {calls} 次 · 平均 {avg_latency:.2f}秒 · EWMA {model_stats['latency_ewma']:.2f}秒 · "
+                           f"错误率 {model_stats['error_ewma']:.0%} · 超时 {model_stats['timeouts']}")
+                st.caption(f"输入 {model_stats['input_tokens']} tokens · 输出 {model_stats['output_tokens']} tokens")
 
-        # 知识库状态
-        if st.session_state.knowledge_df is not None:
-            df = st.session_state.knowledge_df
-            st.success(f"✅ 知识库已加载")
-            st.metric("知识条目", len(df))
-
-            # 显示知识库统计信息
-            with st.expander("📋 知识库详情"):
-                # 问题类型分布
-                if '问题类型' in df.columns:
-                    st.write("**问题类型分布:**")
-                    type_counts = df['问题类型'].value_counts()
-                    for type_name, count in type_counts.items():
-                        # 创建水平条形图效果
-                        percent = count / len(df) * 100
-                        st.progress(percent / 100, text=f"{type_name}: {count}条 ({percent:.1f}%)")
-                else:
-                    st.write("知识库未标注问题类型")
-
-                # 示例问题展示
-                st.write("**示例问题:**")
-                # 优先展示不同类型的问题
-                sample_size = min(5, len(df))
-                if '问题类型' in df.columns and df['问题类型'].nunique() > 1:
-                    # 尝试从不同类别取样
-                    samples = []
-                    for type_name in df['问题类型'].unique():
-                        type_samples = df[df['问题类型'] == type_name].head(1)
-                        samples.extend(type_samples['问题'].tolist())
-                    samples = samples[:sample_size]
-                else:
-                    samples = df['问题'].sample(sample_size).tolist()
-
-                for q in samples:
-                    st.caption(f"• {q[:25]}..." if len(q) > 25 else f"• {q}")
-
-                # 显示规则库信息
-                if st.session_state.rule_base is not None:
-                    st.write("**规则库覆盖类别:**")
-                    rule_categories = list(st.session_state.rule_base.keys())
-                    for category in rule_categories:
-                        pattern_count = len(st.session_state.rule_base[category]["patterns"])
-                        st.caption(f"• {category} ({pattern_count}个关键词)")
-                        
-                # 添加知识库导出功能
-                st.markdown("---")
-                if st.button("📥 导出知识库统计", use_container_width=True):
-                    # 创建统计DataFrame
-                    stats_df = pd.DataFrame({
-                        '指标': ['总问题数', '问题类型数', '平均回答长度'],
-                        '数值': [
-                            len(df),
-                            df['问题类型'].nunique() if '问题类型' in df.columns else 0,
-                            df['标准回答'].str.len().mean()
-                        ]
-                    })
-                    st.dataframe(stats_df, use_container_width=True)
-        else:
-            st.warning("📁 等待加载知识库")
-            st.info("请上传包含三列(问题、标准回答、问题类型)的Excel文件")
+        # 模型用量与预算
+        with st.expander("💰 模型用量"):
+            ledger = get_usage_ledger()
+            usage = ledger.day_summary()
+            total = usage["total"]
+            today_tokens = total["input_tokens"] + total["output_tokens"]
+            col_usage1, col_usage2 = st.columns(2)
+            col_usage1.metric("今日tokens", f"{today_tokens:,}",
+                              help=f"输入 {total['input_tokens']:,} · 输出 {total['output_tokens']:,}")
+            col_usage2.metric("今日费用", f"¥{total['cost']:.4f}", help=f"调用 {total['calls']} 次 · 失败 {total['failures']} 次")
+            if ledger.daily_tokens:
+                st.progress(min(today_tokens / ledger.daily_tokens, 1.0),
+                            text=f"每日预算 {today_tokens:,}/{ledger.daily_tokens:,} tokens")
+            if usage["degraded"]:
+                st.warning(f"预算耗尽，今日已有 {usage['degraded']} 个问题降级为知识库回答")
+            session_usage = ledger.session_usage(get_session_id())
+            st.caption(f"当前会话: {session_usage['calls']} 次调用 · "
+                       f"{session_usage['input_tokens'] + session_usage['output_tokens']:,} tokens · "
+                       f"¥{session_usage['cost']:.4f}")
+            dimension_labels = {"intent": "意图", "branch": "Prompt分支", "model": "模型", "kind": "调用类型"}
+            dimension = st.selectbox("分组", list(dimension_labels), format_func=dimension_labels.get,
+                                     key="usage_dimension")
+            if usage[dimension]:
+                usage_df = pd.DataFrame([
+                    {dimension_labels[dimension]: key, "调用": bucket["calls"],
+                     "tokens": bucket["input_tokens"] + bucket["output_tokens"],
+                     "费用(元)": round(bucket["cost"], 4),
+                     "平均耗时(秒)": round(bucket["latency"] / bucket["calls"], 2) if bucket["calls"] else 0.0}
+                    for key, bucket in usage[dimension].items()]).sort_values("tokens", ascending=False)
+                st.dataframe(usage_df, hide_index=True, use_container_width=True)
+            new_budget = st.number_input("每日token预算（0为不限制）", min_value=0, step=10000,
+                                         value=ledger.daily_tokens, key="usage_daily_budget")
+            if new_budget != ledger.daily_tokens:
+                ledger.daily_tokens = int(new_budget)
 
-        # 脱敏演示
-        st.markdown("---")
-        st.subheader("🔒 脱敏演示")
+        # 请求截止时间
+        with st.expander("⏱️ 请求时间预算"):
+            deadline_stats = get_deadline_stats()
+            with deadline_stats["lock"]:
+                deadline_requests = deadline_stats["requests"]
+                requests_hit = deadline_stats["requests_hit"]
+                stage_hits = dict(deadline_stats["hits"])
+            st.caption(f"每次请求 {DEADLINE_CONFIG['total_seconds']:.0f}秒 · 知识库阶段为AI预留 "
+                       f"{DEADLINE_CONFIG['llm_reserve']:.0f}秒" if DEADLINE_CONFIG["enabled"] else "未启用")
+            st.metric("超时请求", requests_hit,
+                      help=f"共 {deadline_requests} 次请求，超时的请求跳过了部分阶段或返回了部分结果")
+            stage_labels = {"compound": "合并问题拆分", "fuzzy": "模糊匹配", "prompt_context": "Prompt知识检索",
+                            "llm": "AI调用"}
+            for stage, count in sorted(stage_hits.items(), key=lambda item: -item[1]):
+                st.caption(f"{stage_labels.get(stage, stage)}: {count} 次")
 
-        # 使用session_state存储测试文本
-        if 'test_text' not in st.session_state:
-            st.session_state.test_text = "我的手机是15766265746, 地址是杭州市西湖区文三路"
+        # 会话存储状态
+        with st.expander("💾 会话存储"):
+            store_stats = get_session_store().stats()
+            st.caption(f"后端: {store_stats['backend']} · 会话ID: {get_session_id()[:8]}")
+            st.caption(f"会话 {store_stats['sessions']} 个 · 对话记录 {store_stats['conversations']} 条")
+            st.caption(f"已写入 {store_stats['writes']} 次 · 批量提交 {store_stats['flushes']} 次 · "
+                       f"待写入 {store_stats['pending']}")
 
-        test_text = st.text_area(
-            "输入测试文本:",
-            value=st.session_state.test_text,
-            height=100,
-            key="test_input"
-        )
+        # 流量录制
+        with st.expander("⏺️ 流量录制"):
+            recorder = get_traffic_recorder()
+            recorder.enabled = st.checkbox("录制线上流量", value=recorder.enabled,
+                                           help="录制脱敏后的问题、路由结果、阶段耗时和AI响应，供 replay.py 重放")
+            recorder_stats = recorder.stats()
+            st.caption(f"已录制 {recorder_stats['recorded']} 条 · 缓冲 {recorder_stats['buffered']} 条")
+            for path in recorder_stats['files']:
+                st.caption(f"文件: {path}")
+            if st.button("立即写入文件"):
+                recorder.flush()
 
-        # 添加一个按钮来触发脱敏
-        col1, col2 = st.columns([3, 1])
-        with col1:
-            if st.button("运行脱敏测试", type="primary"):
-                st.session_state.test_text = test_text
+        # 性能剖析
+        with st.expander("🔬 性能剖析"):
+            profiler = get_request_profiler()
+            profile_calls = st.number_input("剖析接下来的查询次数", min_value=1, max_value=100, value=5)
+            profiler.cpu_time = st.checkbox("统计CPU时间", value=profiler.cpu_time,
+                                            help="关闭后统计墙钟时间（包含等待AI响应的时间）")
+            profiler.track_memory = st.checkbox("统计内存分配", value=profiler.track_memory)
+            if profiler.armed:
+                st.info(f"剖析中，还剩 {profiler.remaining} 次查询")
+                if st.button("取消剖析"):
+                    profiler.disarm()
+            elif st.button("开始剖析"):
+                profiler.arm(int(profile_calls))
+                st.info(f"将剖析接下来的 {int(profile_calls)} 次查询")
 
-                # 直接测试脱敏函数
-                st.markdown("### 测试结果")
+            report = profiler.last_report
+            if report:
+                total_seconds = sum(call["seconds"] for call in report["calls"])
+                st.caption(f"上次剖析: {len(report['calls'])} 次调用 · 共 {total_seconds:.2f}秒 · "
+                           f"{report['timer']} · 峰值内存增量 {report['peak_memory_kb']:.0f}KB")
+                if report["focus_functions"]:
+                    st.dataframe(pd.DataFrame(report["focus_functions"]).round(2), hide_index=True)
+                if report["allocations"]:
+                    st.write("**内存分配热点**")
+                    allocations = pd.DataFrame(report["allocations"]).round(1)
+                    allocations["location"] = allocations["location"].map(
+                        lambda location: os.path.basename(location))
+                    st.dataframe(allocations.head(10), hide_index=True)
+                st.caption(f"导出目录: {report['directory']}（profile.folded 可拖入 speedscope）")
 
-                # 1. 先显示原始文本
-                st.markdown("**原始文本:**")
-                st.code(test_text)
+        # 界面渲染耗时：app 为整页重跑，其余区块在 fragment 模式下点击区块内按钮时单独重跑
+        with st.expander("🖥️ 界面渲染耗时"):
+            render_stats = get_render_stats()
+            with render_stats["lock"]:
+                render_samples = {section: list(samples) for section, samples in render_stats["sections"].items()}
+            if render_samples:
+                st.dataframe(pd.DataFrame([
+                    {"区块": RENDER_SECTION_LABELS.get(section, section), "次数": len(samples),
+                     "P50(毫秒)": round(float(np.percentile(samples, 50)) * 1000, 1),
+                     "P95(毫秒)": round(float(np.percentile(samples, 95)) * 1000, 1),
+                     "最近(毫秒)": round(samples[-1] * 1000, 1)}
+                    for section, samples in render_samples.items()]), hide_index=True, use_container_width=True)
+            st.caption("独立重跑: " + ("已启用，点击示例问题等只重跑所在区块" if UI_CONFIG["fragments"]
+                                       else "未启用，每次交互重跑整个页面"))
 
-                # 2. 调用脱敏函数
-                result = desensitize(test_text)
+        # 清空对话按钮
+        if st.button("清空对话历史"):
+            st.session_state.history.clear()
+            st.session_state.all_conversations.clear()
+            persist_conversations()
+            st.success("对话历史已清空")
 
-                # 3. 显示脱敏结果
-                st.markdown("**脱敏结果:**")
-                st.code(result)
+    # 主界面 - 两列布局
+    col1, col2 = st.columns([2, 1])
 
-                # 4. 显示对比
-                if result != test_text:
-                    st.success("✅ 脱敏成功!")
-                else:
-                    st.error("❌ 脱敏失败! 文本没有变化。")
-
-        # 统计图表
-        st.markdown("---")
-        st.subheader("📈 性能统计")
-
-        if len(st.session_state.all_conversations) > 0:
-            fig = generate_statistics_chart()
-            if fig:
-                st.pyplot(fig)
-
-            # 简单统计
-            df_stats = pd.DataFrame(st.session_state.all_conversations)
-            if not df_stats.empty:
-                avg_latency = df_stats['latency'].mean()
-
-                # 新的统计逻辑：知识库命中 vs AI生成 vs 系统预设
-                kb_count = len(df_stats[df_stats['source'].str.contains('知识库')])
-                ai_count = len(df_stats[df_stats['source'].str.contains('AI模型')])
-                sys_count = len(df_stats[df_stats['source'].str.contains('系统预设')])
-                other_count = len(df_stats) - kb_count - ai_count - sys_count
-
-                st.metric("平均响应时间", f"{avg_latency:.2f}秒")
-
-                # 显示回答来源分布
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    st.metric("知识库命中", kb_count)
-                with col2:
-                    st.metric("AI生成", ai_count)
-                with col3:
-                    st.metric("系统预设", sys_count)
-
-                # 计算命中率
-                if len(df_stats) > 0:
-                    hit_rate = (kb_count + sys_count) / len(df_stats) * 100
-                    st.progress(hit_rate / 100, text=f"知识库+预设命中率: {hit_rate:.1f}%")
-                    
-                # 添加性能建议
-                with st.expander("📊 性能分析建议"):
-                    if avg_latency > 2.0:
-                        st.warning("⚠️ 平均响应时间较长，建议:")
-                        st.markdown("""
-                        1. 检查API网络连接
-                        2. 考虑使用本地缓存
-                        3. 优化知识库匹配算法
-                        """)
-                    else:
-                        st.success("✅ 响应时间正常")
-                        
-                    if hit_rate < 50:
-                        st.warning(f"⚠️ 知识库命中率较低 ({hit_rate:.1f}%)，建议:")
-                        st.markdown("""
-                        1. 扩充知识库内容
-                        2. 优化关键词匹配规则
-                        3. 添加更多示例问题
-                        """)
-                    else:
-                        st.success(f"✅ 知识库命中率良好 ({hit_rate:.1f}%)")
+    with col1:
+        render_workbench()
+
+    with col2:
+        st.subheader("📊 系统信息")
+        render_kb_details()
+        render_desensitize_demo()
+        render_statistics()
 
     # 页脚
     st.markdown("---")
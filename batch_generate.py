@@ -0,0 +1,292 @@
+"""
+离线批量生成：修改Prompt模板后，为大量已知未命中知识库的问题重新生成AI回答，供人工审阅
+
+用法：
+    python batch_generate.py questions.txt --kb 知识库.xlsx --out batch/answers.jsonl
+    python batch_generate.py traffic/*.jsonl.gz --kb 知识库.xlsx --out batch/answers.jsonl --concurrency 8 --rate 4
+    python batch_generate.py questions.csv --kb 知识库.xlsx --out batch/answers.jsonl --fake-llm 0.3   # 本地模拟模型演练
+
+输入：.txt 每行一个问题；.csv 取 query 或 问题 列；.jsonl / .jsonl.gz 为流量录制或对话导出文件，只取AI回答过的问题。
+Prompt 与线上一致（app.build_prompt 的技术/外观/通用分支，空对话历史），经模型路由调用，用量计入账本（调用类型 batch）；
+现在已能由知识库或预设回复回答的问题默认不调用模型，只记录知识库回答。
+
+结果逐条追加到输出JSONL（问题和回复已脱敏），输出文件同时是检查点：中断后用相同参数重新运行，
+已完成的问题自动跳过，失败的问题重新生成。
+"""
+import argparse
+import contextlib
+import csv
+import glob
+import gzip
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from replay import load_app, percentile
+
+# 检查点中视为已完成、重新运行时跳过的状态
+DONE_STATUSES = {"success", "kb"}
+
+
+def query_key(query):
+    """问题的检查点键（输出文件中的问题已脱敏，不能直接用于比对）"""
+    return hashlib.sha1(query.strip().encode("utf-8")).hexdigest()[:16]
+
+
+def iter_input_queries(path):
+    """按文件类型读取问题"""
+    if path.endswith(".csv"):
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            for row in csv.DictReader(f):
+                yield row.get("query") or row.get("问题") or ""
+    elif path.endswith(".jsonl") or path.endswith(".jsonl.gz"):
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                entry = json.loads(line)
+                # 流量录制和对话导出都带有来源，只取当时由AI回答的问题
+                if str(entry.get("source") or "AI模型").startswith("AI模型"):
+                    yield entry.get("query") or ""
+    else:
+        with open(path, encoding="utf-8") as f:
+            yield from f
+
+
+def read_queries(paths, limit=None):
+    """读取并去重（按去掉首尾空白后的原文），保持首次出现的顺序"""
+    queries = {}
+    for path in paths:
+        for query in iter_input_queries(path):
+            query = query.strip()
+            if query:
+                queries.setdefault(query_key(query), query)
+            if limit and len(queries) >= limit:
+                return queries
+    return queries
+
+
+def load_checkpoint(path):
+    """读取已有输出，返回 {键: 最后一次的状态}；中断时写了一半的末行会被截掉"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, "rb") as f:
+        data = f.read()
+    complete = data[:data.rfind(b"\n") + 1]
+    if len(complete) != len(data):
+        with open(path, "r+b") as f:
+            f.truncate(len(complete))
+    statuses = {}
+    for line in complete.decode("utf-8").splitlines():
+        if line.strip():
+            record = json.loads(line)
+            statuses[record["key"]] = record["status"]
+    return statuses
+
+
+class ResultWriter:
+    """线程安全的逐条追加写入，每条写完即flush，每隔若干条fsync一次"""
+
+    def __init__(self, path, sync_every=50):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8")
+        self.sync_every = sync_every
+        self.lock = threading.Lock()
+        self.written = 0
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            self.written += 1
+            if self.written % self.sync_every == 0:
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+
+def prepare(app, key, query, knowledge_df, tenant_id, include_matched):
+    """在主线程中判断是否已能由知识库回答并构建Prompt（后台线程只负责调用模型）"""
+    item = {"key": key, "query": query, "intent": app.detect_query_intent(query)}
+    if not include_matched:
+        rule_result = app.rule_engine(query, knowledge_df)
+        if rule_result["status"] == "success":
+            item["kb_result"] = rule_result
+            return item
+    item["prompt_info"] = app.build_prompt(query, [], knowledge_df, tenant_id=tenant_id)
+    return item
+
+
+def generate(app, item, api_key, limiter, temperature):
+    """限速后经模型路由调用一次，返回要写入的结果（已脱敏）"""
+    base = {"key": item["key"], "query": app.desensitize(item["query"]), "intent": item["intent"],
+            "generated_at": time.strftime("%Y-%m-%d %H:%M:%S")}
+    kb_result = item.get("kb_result")
+    if kb_result is not None:
+        return dict(base, status="kb", source=kb_result["source"], reply=app.desensitize(kb_result["reply"]))
+
+    prompt_info = item["prompt_info"]
+    branch, prompt = prompt_info["branch"], prompt_info["prompt"]
+    limiter.wait()
+    start = time.time()
+    try:
+        response = app.get_model_router().call(branch, prompt, api_key, temperature=temperature)
+    except Exception as e:
+        response = {"ok": False, "status_code": None, "text": "", "error": str(e)[:200], "model": None}
+    latency = time.time() - start
+    if response.get("model"):
+        app.record_llm_usage(response, latency, branch, prompt,
+                             {"intent": item["intent"], "session_id": "batch", "kind": "batch"})
+    return dict(base, status="success" if response["ok"] else "failed", branch=branch,
+                reply=app.desensitize(response["text"]) if response["ok"] else "",
+                error=None if response["ok"] else str(response["status_code"] or response["error"]),
+                model=response.get("model"), latency=round(latency, 3),
+                input_tokens=response.get("input_tokens") or 0, output_tokens=response.get("output_tokens") or 0,
+                prompt_tokens=prompt_info["prompt_tokens"], knowledge_answer=prompt_info["knowledge_answer"])
+
+
+def run_batch(app, items, writer, api_key, concurrency, rate, temperature, progress_every, out):
+    """
+    有界并发执行：同时在途的请求不超过 concurrency 的两倍，Prompt 按需构建，内存占用与问题总数无关
+
+    items 为惰性生成 prepare() 结果的迭代器；Ctrl+C 时停止提交，等待在途请求写完后返回
+    """
+    limiter = app.RateLimiter(rate)
+    stats = Counter()
+    latencies = []
+    start = time.perf_counter()
+    pending = set()
+    items = iter(items)
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch-generate") as executor:
+        try:
+            while pending or not exhausted:
+                while not exhausted and len(pending) < concurrency * 2:
+                    item = next(items, None)
+                    if item is None:
+                        exhausted = True
+                        break
+                    pending.add(executor.submit(generate, app, item, api_key, limiter, temperature))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record = future.result()
+                    writer.write(record)
+                    stats[record["status"]] += 1
+                    stats["input_tokens"] += record.get("input_tokens", 0)
+                    stats["output_tokens"] += record.get("output_tokens", 0)
+                    if "latency" in record:
+                        latencies.append(record["latency"])
+                    completed = stats["success"] + stats["failed"] + stats["kb"]
+                    if progress_every and completed % progress_every == 0:
+                        elapsed = time.perf_counter() - start
+                        print(f"  已完成 {completed} (成功 {stats['success']}, 失败 {stats['failed']}, "
+                              f"知识库 {stats['kb']}) {completed / elapsed:.1f} 条/秒", file=out, flush=True)
+        except KeyboardInterrupt:
+            stats["interrupted"] = 1
+            for future in pending:
+                future.cancel()
+            print("  已中断，等待在途请求完成...", file=out, flush=True)
+            for future in pending:
+                if not future.cancelled():
+                    record = future.result()
+                    writer.write(record)
+                    stats[record["status"]] += 1
+    stats["seconds"] = time.perf_counter() - start
+    return stats, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线批量生成AI回答（支持中断续跑）")
+    parser.add_argument("inputs", nargs="+", help="问题文件（.txt/.csv/.jsonl/.jsonl.gz），支持通配符")
+    parser.add_argument("--out", required=True, help="输出JSONL文件，同时作为检查点")
+    parser.add_argument("--kb", help="知识库文件（xlsx/csv/parquet），用于Prompt中的知识库片段和跳过已能匹配的问题")
+    parser.add_argument("--tenant", help="所属租户（用于查找该租户的AI沉淀知识），默认使用默认租户")
+    parser.add_argument("--concurrency", type=int, default=4, help="同时进行的模型调用数")
+    parser.add_argument("--rate", type=float, default=2.0, help="每秒最多发起的模型调用数，0为不限速")
+    parser.add_argument("--temperature", type=float, default=0.3)
+    parser.add_argument("--limit", type=int, help="最多读取的问题数（去重后）")
+    parser.add_argument("--include-matched", action="store_true", help="已能由知识库回答的问题也调用模型生成")
+    parser.add_argument("--api-key", default=os.getenv("DASHSCOPE_API_KEY", ""), help="DashScope API密钥")
+    parser.add_argument("--fake-llm", type=float, metavar="LATENCY",
+                        help="启动本地模拟模型服务（指定平均延迟秒数），所有模型都指向它")
+    parser.add_argument("--fake-fail-rate", type=float, default=0.0, help="模拟模型的失败率")
+    parser.add_argument("--progress", type=int, default=100, help="每完成多少条打印一次进度，0为不打印")
+    args = parser.parse_args()
+
+    paths = sorted({path for pattern in args.inputs for path in (glob.glob(pattern) or [pattern])})
+    queries = read_queries(paths, args.limit)
+    checkpoint = load_checkpoint(args.out)
+    todo = [(key, query) for key, query in queries.items() if checkpoint.get(key) not in DONE_STATUSES]
+    retrying = sum(1 for key, _ in todo if key in checkpoint)
+    print(f"读取 {len(paths)} 个文件, 问题 {len(queries)} 个; 检查点中已完成 {len(queries) - len(todo)} 个, "
+          f"待生成 {len(todo)} 个 (其中重试失败 {retrying} 个)")
+
+    app = load_app()
+    server = None
+    if args.fake_llm is not None:
+        from fake_llm_server import start_server
+        server = start_server("fake-llm", 0, args.fake_llm, jitter=args.fake_llm / 4, fail_rate=args.fake_fail_rate)
+        endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+        for model_config in app.get_model_router().config["models"].values():
+            model_config["endpoint"] = endpoint
+        print(f"使用模拟模型服务 {endpoint} (平均延迟 {args.fake_llm:.2f}秒, 失败率 {args.fake_fail_rate:.0%})")
+
+    knowledge_df, rule_base = None, None
+    tenant_id = args.tenant or app.TENANT_CONFIG["default"]
+    app.st.session_state.tenant_id = tenant_id
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if args.kb:
+            knowledge_df, rule_base = app.load_knowledge_base(args.kb)
+            if knowledge_df is None:
+                raise SystemExit(f"知识库加载失败: {args.kb}")
+            app.st.session_state.knowledge_df = knowledge_df
+            app.st.session_state.rule_base = rule_base
+    if not app.get_model_router().rank("general", "", args.api_key):
+        raise SystemExit("没有可用的模型：请通过 --api-key 或环境变量 DASHSCOPE_API_KEY 提供API密钥，或使用 --fake-llm")
+
+    out = sys.stdout
+    items = (prepare(app, key, query, knowledge_df, tenant_id, args.include_matched) for key, query in todo)
+    writer = ResultWriter(args.out)
+    try:
+        # 规则引擎和模型路由会打印调试信息，批量运行时屏蔽，只输出进度
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            stats, latencies = run_batch(app, items, writer, args.api_key, args.concurrency, args.rate,
+                                         args.temperature, args.progress, out)
+    finally:
+        writer.close()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            app.get_usage_ledger().flush()
+        if server is not None:
+            server.shutdown()
+
+    completed = stats["success"] + stats["failed"] + stats["kb"]
+    seconds = stats["seconds"] or 1e-9
+    print(f"\n完成 {completed} 条, 耗时 {stats['seconds']:.1f}秒 ({completed / seconds:.1f} 条/秒): "
+          f"成功 {stats['success']}, 失败 {stats['failed']}, 知识库已能回答 {stats['kb']}")
+    if latencies:
+        print(f"模型调用耗时 P50 {percentile(latencies, 0.5):.2f}秒  P95 {percentile(latencies, 0.95):.2f}秒; "
+              f"tokens 输入 {stats['input_tokens']} / 输出 {stats['output_tokens']}")
+    if stats["interrupted"] or stats["failed"]:
+        print(f"以相同参数重新运行即可继续（失败的问题会重试）: 结果已写入 {args.out}")
+    else:
+        print(f"结果已写入 {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,727 @@
+"""
+性能基准测试脚本
+
+用法：
+    python benchmark.py fuzzy --rows 100000 --queries 200    # 模糊匹配分片随核数的扩展性
+    python benchmark.py ingest --rows 200000 --sheets 4      # 流式多工作表导入 vs pd.read_excel
+    python benchmark.py memory --rows 100000                 # 紧凑知识库存储 vs DataFrame 每行字节数
+    python benchmark.py prefilter --rows 100000 [--kb 真实知识库.xlsx]  # 二元组BM25预筛选的召回率和延迟
+    python benchmark.py session --turns 5000 --sessions 50   # 会话状态持久化的每轮开销
+    python benchmark.py canonical --rows 20000 [--kb 真实知识库.xlsx]  # 问题规范化使多少问题改走精确匹配
+    python benchmark.py deadline --fuzzy-delay 0.1 --llm-latency 4   # 人为放慢模糊匹配和模型后的请求截止时间效果
+    python benchmark.py render --rows 100000 --history 500   # 点击示例问题时的服务端渲染耗时：整页重跑 vs 区块独立重跑
+    python benchmark.py rules --intents 8 100 1000 5000      # 意图识别耗时随规则数的变化：逐条子串查找 vs 编译后的自动机
+    python benchmark.py typo --rows 20000 --queries 300      # 注入同音字/拼音/错字后，纠错阶段省去的AI调用和增加的耗时
+    python benchmark.py sharedcache --backend tcp            # 两级匹配缓存：第二个实例冷启动时从共享缓存得到的命中和节省的耗时
+
+任一子命令前加 --profile 目录 可对整个运行过程做剖析，例如：
+    python benchmark.py --profile profiles prefilter --rows 20000
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import re
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+import pandas as pd
+from rapidfuzz import fuzz, process
+
+from fuzzy_shards import FuzzyShardService
+from kb_ingest import ingest_knowledge_base
+from profiling import RequestProfiler, print_report
+from replay import load_app
+from rule_config import CompiledRules
+from session_store import create_session_store, encode_conversation
+from shared_cache import SharedMatchCache, create_cache_backend, start_cache_server
+from typo_index import BUILTIN_PINYIN, BUILTIN_PINYIN_CHARS, CJK_RUN
+
+# 合成知识库使用的词表
+MOTOR_MODELS = ["M0601", "M0602", "M0603", "M0701", "M1502", "M1505", "P1010", "P2020", "M0801", "M1001"]
+MOTOR_ATTRIBUTES = ["额定电压", "最大扭矩", "额定转速", "编码器分辨率", "减速比", "波特率", "通信协议", "额定电流",
+                    "堵转扭矩", "位置环参数", "速度环参数", "电流环参数", "固件版本", "接线方式", "安装尺寸", "防护等级"]
+QUESTION_TEMPLATES = ["{model}电机的{attr}是多少?", "{model}的{attr}怎么设置?", "请问{model}支持修改{attr}吗?",
+                      "{model}电机{attr}有上位机可以调吗?", "{model}和{other}的{attr}一样吗?", "{model}{attr}的例程代码在哪?"]
+SERVICE_QUESTIONS = [("什么时候发货？", "物流查询"), ("快递几天能到?", "物流查询"), ("可以开发票吗？", "发票咨询"),
+                     ("怎么申请退货？", "退货政策"), ("保修期多久?", "售后政策"), ("有优惠吗？", "价格咨询")]
+
+
+def make_synthetic_kb(rows, seed=0):
+    """生成合成知识库：大量电机技术问题的不同问法，每个型号+参数共用一条标准回答"""
+    rng = random.Random(seed)
+    records = []
+    for i in range(rows):
+        if i % 20 == 0:
+            question, qtype = SERVICE_QUESTIONS[(i // 20) % len(SERVICE_QUESTIONS)]
+            records.append((f"{question}（{i}）", qtype, f"{qtype}标准回答，详情请咨询客服。"))
+            continue
+        model = rng.choice(MOTOR_MODELS) + rng.choice("ABC")
+        attr = rng.choice(MOTOR_ATTRIBUTES)
+        other = rng.choice(MOTOR_MODELS)
+        question = rng.choice(QUESTION_TEMPLATES).format(model=model, attr=attr, other=other)
+        answer = f"{model}电机的{attr}请参考产品规格书第{MOTOR_ATTRIBUTES.index(attr) + 1}页，如需调整可使用上位机配置。"
+        records.append((f"{question}#{i}", "电机技术咨询", answer))
+    return pd.DataFrame(records, columns=["问题", "问题类型", "标准回答"])
+
+
+def make_queries(kb_df, count, seed=1):
+    """从知识库问题派生测试查询：去掉编号并随机删改个别字符"""
+    rng = random.Random(seed)
+    queries = []
+    for question in rng.sample(kb_df['问题'].tolist(), count):
+        text = question.split("#")[0].split("（")[0]
+        chars = list(text)
+        if len(chars) > 4:
+            del chars[rng.randrange(len(chars))]
+        queries.append("".join(chars))
+    return queries
+
+
+def bench_fuzzy(args):
+    """对比单线程 extractOne 与不同分片数的耗时，并校验结果一致"""
+    kb_df = make_synthetic_kb(args.rows)
+    choices = kb_df['问题'].tolist()
+    queries = make_queries(kb_df, args.queries)
+    print(f"知识库 {len(choices)} 条, 查询 {len(queries)} 条, CPU核数 {os.cpu_count()}")
+
+    start = time.perf_counter()
+    baseline = [process.extractOne(q, choices, scorer=fuzz.token_set_ratio, score_cutoff=args.cutoff)
+                for q in queries]
+    single_ms = (time.perf_counter() - start) / len(queries) * 1000
+    print(f"{'单线程':<10}{single_ms:>10.2f} ms/查询")
+
+    shard_counts = sorted({n for n in [1, 2, 4, 8, 16, os.cpu_count() or 1] if n <= args.max_shards})
+    for num_shards in shard_counts:
+        service = FuzzyShardService(choices, num_shards)
+        service.extract_one(queries[0], args.cutoff)  # 预热工作进程
+        start = time.perf_counter()
+        results = [service.extract_one(q, args.cutoff) for q in queries]
+        shard_ms = (time.perf_counter() - start) / len(queries) * 1000
+        service.shutdown()
+
+        mismatches = sum(1 for a, b in zip(baseline, results)
+                         if (a is None) != (b is None) or (a is not None and (a[1], a[2]) != (b[1], b[2])))
+        print(f"{f'{num_shards}分片':<10}{shard_ms:>10.2f} ms/查询  加速比 {single_ms / shard_ms:>5.2f}x  "
+              f"结果不一致 {mismatches} 条")
+
+
+def bench_ingest(args):
+    """生成多工作表Excel，对比 pd.read_excel 整表读取与流式并行导入的吞吐和峰值内存"""
+    kb_df = make_synthetic_kb(args.rows)
+    path = os.path.join(tempfile.mkdtemp(), "kb_bench.xlsx")
+    sheet_rows = (len(kb_df) + args.sheets - 1) // args.sheets
+    with pd.ExcelWriter(path) as writer:
+        for i in range(args.sheets):
+            kb_df.iloc[i * sheet_rows:(i + 1) * sheet_rows].to_excel(writer, sheet_name=f"产品线{i + 1}", index=False)
+    print(f"测试文件 {path}: {len(kb_df)} 行, {args.sheets} 个工作表, {os.path.getsize(path) / 1024 / 1024:.1f}MB")
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    frames = pd.read_excel(path, sheet_name=None)
+    baseline_rows = sum(len(frame) for frame in frames.values())
+    baseline_seconds = time.perf_counter() - start
+    baseline_peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    tracemalloc.stop()
+    del frames
+    print(f"{'pd.read_excel':<16}{baseline_rows / baseline_seconds:>10.0f} 行/秒  峰值内存 {baseline_peak:>7.1f}MB")
+
+    for workers in sorted({1, args.workers}):
+        df, report = ingest_knowledge_base(path, max_workers=workers, track_memory=True)
+        print(f"{f'流式导入x{workers}':<16}{report['rows_per_sec']:>10.0f} 行/秒  "
+              f"峰值内存 {report['peak_memory_mb']:>7.1f}MB  保留 {report['rows_kept']} 行")
+    os.unlink(path)
+
+
+def bench_memory(args):
+    """对比 DataFrame（深度统计）与紧凑存储的每行字节数，以及精确/子串匹配耗时"""
+    app = load_app()
+    kb_df = make_synthetic_kb(args.rows)
+    # pandas 2.x 默认 object 列（每个单元格一个Python字符串）；pandas 3 默认使用Arrow字符串列
+    object_bytes = kb_df.astype(object).memory_usage(deep=True, index=True).sum()
+    df_bytes = kb_df.memory_usage(deep=True, index=True).sum()
+
+    start = time.perf_counter()
+    store = app.CompactKnowledgeBase(kb_df)
+    build_seconds = time.perf_counter() - start
+    store_bytes = store.nbytes()
+
+    print(f"知识库 {len(kb_df)} 行, 不同回答 {len(store.answers)} 条, 问题类型 {len(store.type_names)} 种")
+    print(f"{'DataFrame(object)':<20}{object_bytes / len(kb_df):>10.1f} 字节/行  共 {object_bytes / 1024 / 1024:.1f}MB")
+    print(f"{f'DataFrame({kb_df.dtypes.iloc[0]})':<20}{df_bytes / len(kb_df):>10.1f} 字节/行  "
+          f"共 {df_bytes / 1024 / 1024:.1f}MB")
+    print(f"{'紧凑存储':<20}{store_bytes / len(kb_df):>10.1f} 字节/行  共 {store_bytes / 1024 / 1024:.1f}MB  "
+          f"构建 {build_seconds:.2f}秒")
+
+    queries = [q.strip().lower() for q in make_queries(kb_df, args.queries)]
+    normalized = kb_df['问题'].str.strip().str.lower()
+    start = time.perf_counter()
+    for q in queries[:20]:
+        (normalized == q).any()
+        next((i for i, question in enumerate(normalized) if q in question or question in q), None)
+    df_ms = (time.perf_counter() - start) / min(20, len(queries)) * 1000
+    start = time.perf_counter()
+    for q in queries:
+        store.exact_lookup(q)
+        store.first_substring_match(q)
+    store_ms = (time.perf_counter() - start) / len(queries) * 1000
+    print(f"精确+子串匹配: DataFrame {df_ms:.2f} ms/查询, 紧凑存储 {store_ms:.3f} ms/查询")
+
+
+def bench_prefilter(args):
+    """对比全量 token_set_ratio 与二元组BM25预筛选后打分的 recall@1 和延迟"""
+    app = load_app()
+    datasets = [("合成知识库", make_synthetic_kb(args.rows))]
+    if args.kb:
+        real_df, _ = ingest_knowledge_base(args.kb)
+        datasets.append((os.path.basename(args.kb), real_df))
+
+    for label, kb_df in datasets:
+        store = app.CompactKnowledgeBase(kb_df)
+        start = time.perf_counter()
+        index = app.BigramBM25Index([store.normalized_question(i) for i in range(store.size)])
+        build_seconds = time.perf_counter() - start
+        choices = store.choices()
+        queries = make_queries(kb_df, min(args.queries, len(kb_df)))
+        print(f"[{label}] {store.size} 条, 索引构建 {build_seconds:.2f}秒, 索引 {index.nbytes() / 1024 / 1024:.1f}MB")
+
+        start = time.perf_counter()
+        exhaustive = [process.extractOne(q, choices, scorer=fuzz.token_set_ratio, score_cutoff=args.cutoff)
+                      for q in queries]
+        exhaustive_ms = (time.perf_counter() - start) / len(queries) * 1000
+        print(f"  全量打分        {exhaustive_ms:>8.2f} ms/查询")
+
+        for top_k in args.top_k:
+            start = time.perf_counter()
+            results = []
+            for q in queries:
+                candidates = index.top_candidates(q.strip().lower(), top_k, args.max_df_ratio)
+                result = process.extractOne(q, [choices[i] for i in candidates],
+                                            scorer=fuzz.token_set_ratio, score_cutoff=args.cutoff)
+                results.append(None if result is None else (result[0], result[1], candidates[result[2]]))
+            prefilter_ms = (time.perf_counter() - start) / len(queries) * 1000
+            same_row = sum(1 for a, b in zip(exhaustive, results) if a == b or (a is None and b is None))
+            same_score = sum(1 for a, b in zip(exhaustive, results)
+                             if (a is None and b is None) or (a is not None and b is not None and a[1] == b[1]))
+            print(f"  预筛选 top{top_k:<5} {prefilter_ms:>8.2f} ms/查询  加速比 {exhaustive_ms / prefilter_ms:>6.1f}x  "
+                  f"recall@1(同一行) {same_row / len(queries):.1%}  (同分) {same_score / len(queries):.1%}")
+
+
+def bench_session(args):
+    """测量每轮对话的持久化开销（主流程耗时）和全部写入完成的总耗时"""
+    rng = random.Random(0)
+    records = [{
+        "query": rng.choice(SERVICE_QUESTIONS)[0],
+        "reply": "标准回答，详情请咨询客服。" * rng.randint(1, 6),
+        "source": "知识库 (物流查询)",
+        "time": "12:00:00",
+        "latency": rng.random(),
+    } for _ in range(args.turns)]
+    json_bytes = sum(len(json.dumps(record, ensure_ascii=False).encode('utf-8')) for record in records)
+    compact_bytes = sum(len(encode_conversation(record)) for record in records)
+    print(f"{args.turns} 轮对话, {args.sessions} 个会话; 记录平均 JSON {json_bytes / len(records):.0f} 字节, "
+          f"紧凑编码 {compact_bytes / len(records):.0f} 字节")
+
+    workdir = tempfile.mkdtemp()
+    for backend in ["memory", "sqlite"]:
+        store = create_session_store(backend, os.path.join(workdir, f"{backend}.db"))
+        histories = {}
+        start = time.perf_counter()
+        for i, record in enumerate(records):
+            session_id = f"s{i % args.sessions}"
+            history = histories.setdefault(session_id, [])
+            history.insert(0, (record["query"], record["reply"]))
+            del history[3:]
+            store.save_state(session_id, history, "sk-bench", "kbversion")
+            store.append_conversation(session_id, record)
+        turn_ms = (time.perf_counter() - start) / len(records) * 1000
+        store.flush()
+        total_seconds = time.perf_counter() - start
+        stats = store.stats()
+        store.close()
+        print(f"{backend:<8}每轮 {turn_ms:.3f} ms  全部写入 {total_seconds:.2f}秒  批量提交 {stats['flushes']} 次")
+
+
+def make_variant(question, rng, to_traditional):
+    """模拟用户的不同写法：全角字符、客套语、结尾问号、型号中的空格、繁体字"""
+    variant = question
+    kind = rng.choice(["全角", "客套语", "问号", "型号空格", "繁体"])
+    if kind == "全角":
+        variant = "".join(chr(ord(c) + 0xFEE0) if "!" <= c <= "~" else c for c in variant)
+    elif kind == "客套语":
+        variant = rng.choice(["请问", "你好，", "您好，请问", "麻烦问一下"]) + variant
+    elif kind == "问号":
+        variant = variant.rstrip("?？") + rng.choice(["？", "?", "??", "？？"])
+    elif kind == "型号空格":
+        variant = re.sub(r'([A-Za-z])(\d{4})', lambda m: m.group(1) + rng.choice([" ", "-", " - "]) + m.group(2), variant)
+    else:
+        variant = variant.translate(to_traditional)
+    return kind, variant
+
+
+def bench_canonical(args):
+    """统计问题变体在规范化前后分别走到哪个匹配阶段，以及回答是否正确"""
+    app = load_app()
+    if args.kb:
+        path = args.kb
+    else:
+        path = os.path.join(tempfile.mkdtemp(), "kb_canonical.csv")
+        make_synthetic_kb(args.rows).to_csv(path, index=False)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        kb_df, rule_base = app.load_knowledge_base(path)
+    app.st.session_state.rule_base = rule_base
+    app.NEGATIVE_CACHE_CONFIG["enabled"] = False
+    store = app.get_kb_store(kb_df)
+
+    rng = random.Random(2)
+    rows = rng.sample(range(store.size), min(args.queries, store.size))
+    to_traditional = str.maketrans(app.SIMPLIFIED_CHARS, app.TRADITIONAL_CHARS)
+    variants = [(row,) + make_variant(store.question(row), rng, to_traditional) for row in rows]
+    print(f"知识库 {store.size} 条, 问题变体 {len(variants)} 条, "
+          f"型号规则 {', '.join(app.get_query_canonicalizer().model_codes)}")
+
+    outcomes = {}
+    for enabled in (False, True):
+        app.CANONICALIZE_CONFIG["enabled"] = enabled
+        stages = Counter()
+        by_kind = Counter()
+        correct = 0
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for row, kind, variant in variants:
+                if store.exact_lookup(variant.strip().lower()) is not None:
+                    stage = "精确匹配"
+                elif enabled and store.canonical_lookup(app.get_query_canonicalizer()(variant)) is not None:
+                    stage = "规范化精确匹配"
+                    by_kind[kind] += 1
+                else:
+                    stage = None
+                answer, _ = app.find_in_knowledge_base(variant, kb_df)
+                if stage is None:
+                    stage = "子串/模糊匹配" if answer is not None else "AI"
+                stages[stage] += 1
+                correct += answer == store.answer(row)
+        elapsed_ms = (time.perf_counter() - start) / len(variants) * 1000
+        outcomes[enabled] = stages
+        label = "规范化" if enabled else "不规范化"
+        summary = ", ".join(f"{stage} {count}" for stage, count in stages.most_common())
+        print(f"{label:<6}{elapsed_ms:>8.2f} ms/查询  回答正确 {correct / len(variants):.1%}  {summary}")
+        if enabled:
+            print(f"      规范化精确命中按变体类型: {dict(by_kind)}")
+
+    moved_fuzzy = outcomes[False]["子串/模糊匹配"] - outcomes[True]["子串/模糊匹配"]
+    moved_ai = outcomes[False]["AI"] - outcomes[True]["AI"]
+    print(f"改走精确匹配: 来自子串/模糊匹配 {moved_fuzzy} 条, 来自AI {moved_ai} 条")
+
+
+class SlowProcess:
+    """替换 app 中的 rapidfuzz.process：模糊打分按候选数人为放慢，模拟超大知识库的全量扫描"""
+
+    def __init__(self, seconds_per_1k):
+        self.seconds_per_1k = seconds_per_1k
+
+    def extractOne(self, query, choices, **kwargs):
+        time.sleep(len(choices) / 1000 * self.seconds_per_1k)
+        return process.extractOne(query, choices, **kwargs)
+
+    def extract(self, query, choices, **kwargs):
+        return process.extract(query, choices, **kwargs)
+
+
+def bench_deadline(args):
+    """放慢模糊匹配和模型服务，对比启用/不启用请求截止时间时的延迟分布、回答来源和各阶段超时次数"""
+    from fake_llm_server import start_server
+    app = load_app()
+    path = os.path.join(tempfile.mkdtemp(), "kb_deadline.csv")
+    kb_df = make_synthetic_kb(args.rows)
+    kb_df.to_csv(path, index=False)
+    # 关闭预筛选和分片，让技术问题走全量模糊打分；关闭匹配缓存、未命中缓存、AI回复缓存和推测执行，
+    # 两轮都真实执行各阶段，结果可比
+    app.FUZZY_PREFILTER_CONFIG["enabled"] = False
+    app.FUZZY_SHARD_CONFIG["enabled"] = False
+    app.MATCH_CACHE_CONFIG["enabled"] = False
+    app.NEGATIVE_CACHE_CONFIG["enabled"] = False
+    app.RESPONSE_CACHE_CONFIG["enabled"] = False
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        knowledge_df, rule_base = app.load_knowledge_base(path)
+    app.st.session_state.knowledge_df = knowledge_df
+    app.st.session_state.rule_base = rule_base
+    app.st.session_state.speculation_config = {"enabled": False}
+    app.process = SlowProcess(args.fuzzy_delay)
+
+    server = start_server("slow-llm", 0, args.llm_latency)
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+    for model_config in app.get_model_router().config["models"].values():
+        model_config["endpoint"] = endpoint
+    app.DEADLINE_CONFIG.update(total_seconds=args.deadline, llm_reserve=args.llm_reserve,
+                               min_llm_seconds=min(app.DEADLINE_CONFIG["min_llm_seconds"], args.llm_reserve))
+
+    technical = make_queries(kb_df, args.queries * 3, seed=3)
+    open_questions = ["电机可以在水下长期使用吗", "电机能不能用在无人机上", "电机坏了能上门维修吗", "电机适合做机器人关节吗"]
+    queries = (technical[:args.queries]
+               + [f"{a}和{b}" for a, b in zip(technical[args.queries::2], technical[args.queries + 1::2])]
+               + [open_questions[i % len(open_questions)] for i in range(args.queries)])
+    print(f"知识库 {len(kb_df)} 条; 模糊打分 {args.fuzzy_delay:.2f}秒/千条, 模型延迟 {args.llm_latency:.1f}秒; "
+          f"请求预算 {args.deadline:.1f}秒 (知识库阶段预留 {args.llm_reserve:.1f}秒给AI); 查询 {len(queries)} 条")
+
+    replies = {}
+    for enabled in (False, True):
+        app.DEADLINE_CONFIG["enabled"] = enabled
+        stats = app.get_deadline_stats()
+        hits_before = Counter(stats["hits"])
+        latencies = []
+        sources = Counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for query in queries:
+                app.st.session_state.history.clear()
+                start = time.perf_counter()
+                result = app.process_query(query)
+                latencies.append(time.perf_counter() - start)
+                replies.setdefault(enabled, []).append(result["reply"])
+                sources[result["source"].split("（")[0].split(" (")[0] + (f"/{result['degraded']}"
+                                                                      if result.get("degraded") else "")] += 1
+        latencies.sort()
+        hits = Counter(stats["hits"]) - hits_before
+        label = "启用截止时间" if enabled else "不限时"
+        print(f"{label:<8} P50 {latencies[len(latencies) // 2]:.2f}秒  P95 {latencies[int(len(latencies) * 0.95)]:.2f}秒  "
+              f"最大 {latencies[-1]:.2f}秒")
+        print(f"         来源: {dict(sources)}")
+        if enabled:
+            same = sum(1 for a, b in zip(replies[False], replies[True]) if a == b)
+            print(f"         各阶段超时: {dict(hits)}  回答与不限时相同 {same}/{len(queries)}")
+    server.shutdown()
+
+
+def bench_render(args):
+    """
+    用 AppTest 模拟点击示例问题，统计每次交互的服务端渲染耗时（app.render_timer 记录）
+
+    改动前的行为：关闭 fragment 和界面缓存，每次点击重跑整个页面（知识库统计、对话历史、图表全部重算），为实测值；
+    改动后：点击只重跑客服工作台区块，另列出此时整页重跑（如侧边栏操作）的耗时。
+    AppTest 每次都整页运行、不能单独重跑 fragment，改动后的数字是整页运行中工作台区块的计时，作为区块重跑耗时的估算，
+    不含 fragment 重跑本身的调度开销
+    """
+    import warnings
+    from streamlit.testing.v1 import AppTest
+    from fake_llm_server import start_server
+    warnings.simplefilter("ignore")  # 没有中文字体时 matplotlib 每次绘图都会告警
+    app = load_app()
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "kb_render.csv")
+    make_synthetic_kb(args.rows).to_csv(path, index=False)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        knowledge_df, rule_base = app.load_knowledge_base(path)
+
+    # 示例问题中需要AI回答的走本地模拟模型，避免失败结果提前结束页面渲染
+    server = start_server("render-llm", 0, 0.0)
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+    router_config = {"models": {name: dict(model, endpoint=endpoint)
+                                for name, model in app.MODEL_ROUTER_DEFAULTS["models"].items()}}
+    router_path = os.path.join(directory, "router.json")
+    with open(router_path, "w", encoding="utf-8") as f:
+        json.dump(router_config, f)
+    os.environ["MODEL_ROUTER_CONFIG"] = router_path
+    os.environ["CACHE_WARMUP"] = "0"
+
+    history = [{"query": f"历史问题{i}", "reply": f"历史回复{i}", "time": "12:00:00", "latency": 0.1 + (i % 7) / 10,
+                "source": ["知识库 (电机技术咨询)", "AI模型（增强版）", "系统预设"][i % 3], "id": f"h{i}"}
+               for i in range(args.history)]
+    print(f"知识库 {len(knowledge_df)} 条, 对话记录 {args.history} 条, 每种模式点击示例问题 {args.clicks} 次")
+
+    for label, fragments, memoize in (("改动前(整页重跑)", "0", "0"), ("改动后(区块估算)", "1", "1")):
+        os.environ["UI_FRAGMENTS"] = fragments
+        os.environ["UI_MEMOIZE"] = memoize
+        at = AppTest.from_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py"),
+                               default_timeout=120)
+        section_runs = {}
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            at.run()
+            at.session_state["knowledge_df"] = knowledge_df
+            at.session_state["rule_base"] = rule_base
+            at.session_state["all_conversations"] = list(history)
+            at.run()
+            for click in range(args.clicks + 1):
+                examples = [button for button in at.button if button.label.startswith("📌")]
+                examples[click % len(examples)].click()
+                at.run()
+                if at.exception:
+                    raise SystemExit(f"页面异常: {at.exception}")
+                if click == 0:
+                    continue  # 第一次点击包含首次绘图等一次性开销
+                for section, seconds in at.session_state["render_timings"].items():
+                    section_runs.setdefault(section, []).append(seconds * 1000)
+        interaction = sorted(section_runs["workbench" if fragments == "1" else "app"])
+        print(f"{label:<12} 每次点击 P50 {interaction[len(interaction) // 2]:8.1f}ms  "
+              f"P95 {interaction[int(len(interaction) * 0.95)]:8.1f}ms"
+              + ("  (整页运行中工作台区块的计时，非实测的 fragment 重跑)" if fragments == "1" else ""))
+        print("             整页运行中各区块 P50: " + ", ".join(
+            f"{section} {sorted(values)[len(values) // 2]:.1f}ms" for section, values in section_runs.items()))
+    server.shutdown()
+
+
+def bench_rules(args):
+    """在 rules.json 之后追加合成意图，对比逐条 `关键词 in 问题` 与编译后自动机的每次意图识别耗时"""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.json"), encoding="utf-8") as f:
+        base = json.load(f)
+    rng = random.Random(0)
+    queries = make_queries(make_synthetic_kb(5000), args.queries)
+    queries += [question for question, _ in SERVICE_QUESTIONS] * (args.queries // 50 + 1)
+
+    print(f"{len(queries)} 个查询; 基础规则 {len(base['intents'])} 个意图")
+    print(f"{'意图数':>8}{'关键词':>10}{'编译(毫秒)':>12}{'逐条(微秒/次)':>16}{'自动机(微秒/次)':>18}{'结果一致':>10}")
+    for intent_count in args.intents:
+        config = json.loads(json.dumps(base))
+        for i in range(max(0, intent_count - len(base["intents"]))):
+            # 合成意图追加在原有意图之后：真实问题大多不命中，逐条查找需要扫描全部关键词
+            config["intents"][f"合成意图{i}"] = {
+                "patterns": ["".join(chr(rng.randint(0x4E00, 0x9FA5)) for _ in range(rng.randint(2, 4)))
+                             for _ in range(args.patterns)]}
+        def linear(query):
+            query_lower = query.lower()
+            for intent, rule in config["intents"].items():
+                if any(word in query_lower for word in rule["patterns"]):
+                    return intent
+            return None
+
+        start = time.perf_counter()
+        rules = CompiledRules(config)
+        compile_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        expected = [linear(query) for query in queries]
+        linear_us = (time.perf_counter() - start) / len(queries) * 1e6
+        start = time.perf_counter()
+        actual = [rules.detect_intent(query.lower()) for query in queries]
+        compiled_us = (time.perf_counter() - start) / len(queries) * 1e6
+        print(f"{len(config['intents']):>8}{rules.keyword_count:>10}{compile_ms:>12.1f}{linear_us:>16.1f}"
+              f"{compiled_us:>18.1f}{'是' if expected == actual else '否':>10}")
+
+
+def make_typo(question, rng):
+    """模拟用户的错别字：同音字替换、一个词直接输入拼音、随机错一个字；无法注入时返回None"""
+    kind = rng.choice(["同音", "拼音", "错字"])
+    cjk = [i for i, char in enumerate(question) if CJK_RUN.match(char)]
+    if kind == "同音":
+        positions = [i for i in cjk if len(BUILTIN_PINYIN.get(BUILTIN_PINYIN_CHARS.get(question[i], ""), "")) > 1]
+        if not positions:
+            return kind, None
+        i = rng.choice(positions)
+        homophones = BUILTIN_PINYIN[BUILTIN_PINYIN_CHARS[question[i]]].replace(question[i], "")
+        return kind, question[:i] + rng.choice(homophones) + question[i + 1:]
+    if kind == "拼音":
+        positions = [i for i in cjk if i + 1 in cjk and question[i] in BUILTIN_PINYIN_CHARS
+                     and question[i + 1] in BUILTIN_PINYIN_CHARS]
+        if not positions:
+            return kind, None
+        i = rng.choice(positions)
+        letters = BUILTIN_PINYIN_CHARS[question[i]] + BUILTIN_PINYIN_CHARS[question[i + 1]]
+        return kind, question[:i] + letters + question[i + 2:]
+    if not cjk:
+        return kind, None
+    i = rng.choice(cjk)
+    return kind, question[:i] + rng.choice(list(BUILTIN_PINYIN_CHARS)) + question[i + 1:]
+
+
+def bench_typo(args):
+    """对知识库问题注入错别字，对比启用/不启用纠错时走AI的查询数、回答正确率和规则引擎耗时"""
+    app = load_app()
+    if args.kb:
+        path = args.kb
+    else:
+        path = os.path.join(tempfile.mkdtemp(), "kb_typo.csv")
+        make_synthetic_kb(args.rows).to_csv(path, index=False)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        kb_df, rule_base = app.load_knowledge_base(path)
+    app.st.session_state.rule_base = rule_base
+    app.NEGATIVE_CACHE_CONFIG["enabled"] = False
+    app.MATCH_CACHE_CONFIG["enabled"] = False
+    store = app.get_kb_store(kb_df)
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        term_index = app.get_kb_typo_index(store)
+    print(f"知识库 {store.size} 条, 纠错词条 {len(term_index)} 个 ({term_index.nbytes() / 1024:.0f}KB), "
+          f"构建 {time.perf_counter() - start:.2f}秒, 拼音表: {'pypinyin' if app.lazy_pinyin else '内置常用字'}")
+
+    rng = random.Random(3)
+    variants = []
+    for row in rng.sample(range(store.size), min(args.queries, store.size)):
+        question = store.question(row).split("#")[0].split("（")[0]
+        variants.append((row, "原问题", question))
+        kind, typo = make_typo(question, rng)
+        if typo is not None:
+            variants.append((row, kind, typo))
+    kinds = Counter(kind for _, kind, _ in variants)
+    print(f"查询 {len(variants)} 条: {dict(kinds)}")
+
+    outcomes = {}
+    for enabled in (False, True):
+        app.TYPO_CONFIG["enabled"] = enabled
+        to_ai, correct, seconds = Counter(), Counter(), Counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for row, kind, query in variants:
+                start = time.perf_counter()
+                result = app.rule_engine(query, kb_df)
+                seconds[kind] += time.perf_counter() - start
+                to_ai[kind] += result["status"] != "success"
+                correct[kind] += result["reply"] == store.answer(row)
+        outcomes[enabled] = (to_ai, seconds)
+        print(f"{'启用纠错' if enabled else '不纠错'}: 走AI {sum(to_ai.values())} 条, "
+              f"回答正确 {sum(correct.values()) / len(variants):.1%}")
+        for kind in kinds:
+            print(f"    {kind:<4} 走AI {to_ai[kind]:>4}/{kinds[kind]:<4} 回答正确 {correct[kind] / kinds[kind]:>6.1%}  "
+                  f"规则引擎 {seconds[kind] / kinds[kind] * 1000:>7.2f} ms/查询")
+
+    saved = sum(outcomes[False][0].values()) - sum(outcomes[True][0].values())
+    missed = sum(outcomes[False][0].values())
+    added_ms = (sum(outcomes[True][1].values()) - sum(outcomes[False][1].values())) / len(variants) * 1000
+    stats = app.get_typo_stats()
+    print(f"省去AI调用 {saved} 次（原走AI {missed} 次）; 平均每条查询增加 {added_ms:.2f} ms, "
+          f"每次纠错 {stats['seconds'] / max(1, stats['attempts']) * 1000:.2f} ms")
+
+
+def bench_sharedcache(args):
+    """
+    模拟两个应用实例：实例A冷启动处理一批查询并写入共享缓存，实例B清空进程内缓存后处理同一批查询，
+    再重复一轮（一级缓存已热）；对比各轮的每条查询耗时和各级命中
+    """
+    app = load_app()
+    path = os.path.join(tempfile.mkdtemp(), "kb_shared.csv")
+    make_synthetic_kb(args.rows).to_csv(path, index=False)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        kb_df, rule_base = app.load_knowledge_base(path)
+        app.get_kb_store(kb_df, rule_base)
+    app.st.session_state.rule_base = rule_base
+    queries = make_queries(kb_df, args.queries)
+    queries += [f"{question}能不能再便宜一点" for question, _ in SERVICE_QUESTIONS] * 5  # 完整匹配后仍未命中的问题
+
+    server = None
+    if args.backend == "tcp":
+        server = start_cache_server()
+        backend = create_cache_backend("tcp", f"127.0.0.1:{server.server_address[1]}")
+    else:
+        backend = create_cache_backend("sqlite", path=os.path.join(tempfile.mkdtemp(), "shared_cache.db"))
+    print(f"知识库 {len(kb_df)} 条, 查询 {len(queries)} 条, 二级后端 {backend.backend}")
+
+    def run(label, shared_cache, reset_l1):
+        if reset_l1:
+            app.get_negative_cache().invalidate()
+            app.get_match_cache().invalidate()
+        app.get_shared_match_cache = lambda: shared_cache
+        before = [cache.stats() for cache in (app.get_negative_cache(), app.get_match_cache())]
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for query in queries:
+                app.find_in_knowledge_base(query, kb_df)
+        elapsed_ms = (time.perf_counter() - start) / len(queries) * 1000
+        if shared_cache is not None:
+            shared_cache.flush(timeout=10)
+        after = [cache.stats() for cache in (app.get_negative_cache(), app.get_match_cache())]
+        l1_hits = sum(a["hits"] - b["hits"] for a, b in zip(after, before))
+        l1_saved = sum(a["saved_seconds"] - b["saved_seconds"] for a, b in zip(after, before))
+        summary = f"{label:<14}{elapsed_ms:>8.2f} ms/查询  一级命中 {l1_hits:>4} (节省 {l1_saved * 1000:>8.1f}ms)"
+        if shared_cache is not None:
+            stats = shared_cache.stats()
+            summary += (f"  二级命中 {stats['hits']:>4}/{stats['lookups']:<4} (节省 {stats['saved_seconds'] * 1000:>8.1f}ms, "
+                        f"平均读取 {stats['avg_lookup_ms']:.3f}ms)")
+        print(summary)
+
+    run("无二级缓存", None, True)
+    run("实例A 冷启动", SharedMatchCache(backend), True)
+    run("实例B 冷启动", SharedMatchCache(backend), True)
+    run("实例B 第二轮", SharedMatchCache(backend), False)
+    if server is not None:
+        server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="客服系统性能基准测试")
+    parser.add_argument("--profile", metavar="DIR", help="对本次运行做cProfile/tracemalloc剖析，结果导出到该目录")
+    parser.add_argument("--profile-wall", action="store_true", help="剖析时统计墙钟时间而不是CPU时间")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    fuzzy_parser = subparsers.add_parser("fuzzy", help="模糊匹配分片扩展性")
+    fuzzy_parser.add_argument("--rows", type=int, default=100000)
+    fuzzy_parser.add_argument("--queries", type=int, default=200)
+    fuzzy_parser.add_argument("--cutoff", type=float, default=50)
+    fuzzy_parser.add_argument("--max-shards", type=int, default=os.cpu_count() or 1)
+    fuzzy_parser.set_defaults(func=bench_fuzzy)
+
+    ingest_parser = subparsers.add_parser("ingest", help="知识库导入吞吐和峰值内存")
+    ingest_parser.add_argument("--rows", type=int, default=200000)
+    ingest_parser.add_argument("--sheets", type=int, default=4)
+    ingest_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    ingest_parser.set_defaults(func=bench_ingest)
+
+    memory_parser = subparsers.add_parser("memory", help="紧凑知识库存储的内存占用")
+    memory_parser.add_argument("--rows", type=int, default=100000)
+    memory_parser.add_argument("--queries", type=int, default=200)
+    memory_parser.set_defaults(func=bench_memory)
+
+    prefilter_parser = subparsers.add_parser("prefilter", help="二元组BM25预筛选的召回率和延迟")
+    prefilter_parser.add_argument("--rows", type=int, default=100000)
+    prefilter_parser.add_argument("--queries", type=int, default=200)
+    prefilter_parser.add_argument("--cutoff", type=float, default=50)
+    prefilter_parser.add_argument("--top-k", type=int, nargs="+", default=[100, 300, 1000])
+    prefilter_parser.add_argument("--max-df-ratio", type=float, default=0.3)
+    prefilter_parser.add_argument("--kb", help="真实知识库文件（xlsx/csv/parquet）")
+    prefilter_parser.set_defaults(func=bench_prefilter)
+
+    session_parser = subparsers.add_parser("session", help="会话状态持久化开销")
+    session_parser.add_argument("--turns", type=int, default=5000)
+    session_parser.add_argument("--sessions", type=int, default=50)
+    session_parser.set_defaults(func=bench_session)
+
+    canonical_parser = subparsers.add_parser("canonical", help="问题规范化对精确匹配命中率的影响")
+    canonical_parser.add_argument("--rows", type=int, default=20000)
+    canonical_parser.add_argument("--queries", type=int, default=300)
+    canonical_parser.add_argument("--kb", help="真实知识库文件（xlsx/csv/parquet）")
+    canonical_parser.set_defaults(func=bench_canonical)
+
+    deadline_parser = subparsers.add_parser("deadline", help="放慢各阶段后请求截止时间的效果")
+    deadline_parser.add_argument("--rows", type=int, default=20000)
+    deadline_parser.add_argument("--queries", type=int, default=4, help="每类查询（技术/合并/需要AI）的条数")
+    deadline_parser.add_argument("--fuzzy-delay", type=float, default=0.1, help="模糊打分每千条候选额外耗时（秒）")
+    deadline_parser.add_argument("--llm-latency", type=float, default=4.0, help="模拟模型服务的响应延迟（秒）")
+    deadline_parser.add_argument("--deadline", type=float, default=2.5, help="单次请求的时间预算（秒）")
+    deadline_parser.add_argument("--llm-reserve", type=float, default=1.0, help="知识库阶段为AI调用预留的时间（秒）")
+    deadline_parser.set_defaults(func=bench_deadline)
+
+    render_parser = subparsers.add_parser("render", help="点击示例问题的服务端渲染耗时")
+    render_parser.add_argument("--rows", type=int, default=100000)
+    render_parser.add_argument("--history", type=int, default=500, help="会话中已有的对话记录数")
+    render_parser.add_argument("--clicks", type=int, default=20)
+    render_parser.set_defaults(func=bench_render)
+
+    rules_parser = subparsers.add_parser("rules", help="意图识别耗时随规则数的变化")
+    rules_parser.add_argument("--intents", type=int, nargs="+", default=[8, 100, 1000, 5000])
+    rules_parser.add_argument("--patterns", type=int, default=10, help="每个合成意图的关键词数")
+    rules_parser.add_argument("--queries", type=int, default=1000)
+    rules_parser.set_defaults(func=bench_rules)
+
+    typo_parser = subparsers.add_parser("typo", help="拼音/错字纠错省去的AI调用和增加的耗时")
+    typo_parser.add_argument("--rows", type=int, default=20000)
+    typo_parser.add_argument("--queries", type=int, default=300)
+    typo_parser.add_argument("--kb", help="真实知识库文件（xlsx/csv/parquet）")
+    typo_parser.set_defaults(func=bench_typo)
+
+    shared_parser = subparsers.add_parser("sharedcache", help="两级匹配缓存在多实例间的命中和节省的耗时")
+    shared_parser.add_argument("--rows", type=int, default=20000)
+    shared_parser.add_argument("--queries", type=int, default=300)
+    shared_parser.add_argument("--backend", choices=["tcp", "sqlite"], default="tcp")
+    shared_parser.set_defaults(func=bench_sharedcache)
+
+    args = parser.parse_args()
+    if args.profile:
+        profiler = RequestProfiler(args.profile, cpu_time=not args.profile_wall)
+        profiler.arm(1)
+        profiler.run(args.func, args)
+        print_report(profiler.last_report)
+    else:
+        args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+对话记录导出：从会话存储按块读取对话记录，批量脱敏后在后台线程中逐块写入 CSV / JSONL / Parquet
+
+每次只在内存中保留一块记录，内存占用与对话总量无关；先写入 .part 临时文件，完成后再改名，
+导出中途失败或取消不会留下不完整的目标文件。
+"""
+import csv
+import json
+import os
+import threading
+import time
+
+EXPORT_FORMATS = {"csv": ".csv", "jsonl": ".jsonl", "parquet": ".parquet"}
+EXPORT_COLUMNS = ["session_id", "tenant", "created", "id", "time", "query", "reply", "source", "latency",
+                  "prompt_tokens", "prompt_budget", "feedback"]
+
+
+class ExportError(Exception):
+    """导出格式不支持或缺少依赖"""
+
+
+class CsvChunkWriter:
+    def __init__(self, path):
+        # 带BOM的UTF-8，Excel打开时中文不乱码
+        self.file = open(path, "w", encoding="utf-8-sig", newline="")
+        self.writer = csv.DictWriter(self.file, fieldnames=EXPORT_COLUMNS)
+        self.writer.writeheader()
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class JsonlChunkWriter:
+    def __init__(self, path):
+        self.file = open(path, "w", encoding="utf-8")
+
+    def write(self, rows):
+        self.file.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetChunkWriter:
+    """每块写成一个行组（需要pyarrow）"""
+
+    def __init__(self, path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ExportError("导出Parquet文件需要安装pyarrow")
+        self.pa = pa
+        self.schema = pa.schema([
+            ("session_id", pa.string()), ("tenant", pa.string()), ("created", pa.string()), ("id", pa.string()), ("time", pa.string()),
+            ("query", pa.string()), ("reply", pa.string()), ("source", pa.string()), ("latency", pa.float64()),
+            ("prompt_tokens", pa.int64()), ("prompt_budget", pa.int64()), ("feedback", pa.string()),
+        ])
+        self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+
+    def write(self, rows):
+        columns = {name: [row[name] for row in rows] for name in EXPORT_COLUMNS}
+        self.writer.write_table(self.pa.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+CHUNK_WRITERS = {"csv": CsvChunkWriter, "jsonl": JsonlChunkWriter, "parquet": ParquetChunkWriter}
+
+
+def export_rows(chunk, desensitize_batch):
+    """把一块 (会话ID, 创建时间, 对话记录) 转为导出行；问题和回复一起批量脱敏"""
+    texts = desensitize_batch([text for _, _, record in chunk for text in (record.get("query"), record.get("reply"))])
+    rows = []
+    for position, (session_id, created, record) in enumerate(chunk):
+        rows.append({
+            "session_id": session_id,
+            "tenant": record.get("tenant"),
+            "created": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created)),
+            "id": record.get("id"),
+            "time": record.get("time"),
+            "query": texts[2 * position],
+            "reply": texts[2 * position + 1],
+            "source": record.get("source"),
+            "latency": record.get("latency"),
+            "prompt_tokens": record.get("prompt_tokens"),
+            "prompt_budget": record.get("prompt_budget"),
+            "feedback": record.get("feedback"),
+        })
+    return rows
+
+
+class ConversationExportJob:
+    """
+    后台导出任务
+
+    用法：
+        job = ConversationExportJob(store, "exports/conversations.csv", "csv", desensitize_batch)
+        job.start()
+        job.progress()   # {"status", "rows", "total", "bytes", ...}
+    """
+
+    def __init__(self, store, path, fmt, desensitize_batch, session_id=None, chunk_size=1000, tenant_id=None,
+                 default_tenant=None):
+        if fmt not in CHUNK_WRITERS:
+            raise ExportError(f"不支持的导出格式: {fmt}")
+        self.store = store
+        self.path = path
+        self.fmt = fmt
+        self.desensitize_batch = desensitize_batch
+        self.session_id = session_id
+        self.chunk_size = chunk_size
+        self.tenant_id = tenant_id  # 指定时只导出该租户的记录（没有租户字段的记录属于 default_tenant）
+        self.default_tenant = default_tenant
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.state = {"status": "pending", "rows": 0, "chunks": 0, "total": None, "bytes": 0,
+                      "started": None, "finished": None, "error": None}
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="conversation-export", daemon=True)
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.cancelled = True
+
+    def progress(self):
+        with self.lock:
+            return dict(self.state, path=self.path, format=self.fmt)
+
+    def _update(self, **values):
+        with self.lock:
+            self.state.update(values)
+
+    def run(self):
+        part_path = self.path + ".part"
+        self._update(status="running", started=time.time())
+        writer = None
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # 先等待写入队列落盘，导出结果包含提交导出之前的全部对话
+            self.store.flush()
+            if self.session_id is None and self.tenant_id is None:
+                self._update(total=self.store.stats()["conversations"])
+            writer = CHUNK_WRITERS[self.fmt](part_path)
+            chunks = self.store.iter_conversations(self.session_id, chunk_size=self.chunk_size,
+                                                   tenant_id=self.tenant_id, default_tenant=self.default_tenant)
+            for chunk in chunks:
+                if self.cancelled:
+                    break
+                writer.write(export_rows(chunk, self.desensitize_batch))
+                with self.lock:
+                    self.state["rows"] += len(chunk)
+                    self.state["chunks"] += 1
+            writer.close()
+            writer = None
+            if self.cancelled:
+                os.remove(part_path)
+                self._update(status="cancelled", finished=time.time())
+                return
+            os.replace(part_path, self.path)
+            self._update(status="done", bytes=os.path.getsize(self.path), finished=time.time())
+        except Exception as e:
+            if writer is not None:
+                writer.close()
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            self._update(status="failed", error=str(e)[:200], finished=time.time())
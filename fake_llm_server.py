@@ -0,0 +1,90 @@
+"""
+本地模拟LLM服务：返回与DashScope Generation相同结构的JSON，用于离线测试模型路由、批量生成等功能
+
+用法示例（同时启动两个不同延迟的模拟模型）：
+    python fake_llm_server.py --serve qwen-turbo:8801:0.2 --serve qwen-plus:8802:1.5
+
+然后在 MODEL_ROUTER_CONFIG 指向的JSON中配置：
+    {"models": {"qwen-turbo": {"endpoint": "http://127.0.0.1:8801", "timeout": 2},
+                "qwen-plus": {"endpoint": "http://127.0.0.1:8802", "timeout": 5}}}
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_handler(name, latency, jitter, fail_rate):
+    """生成指定延迟特征的请求处理类"""
+
+    class FakeLLMHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+            prompt = request.get("prompt", "")
+
+            time.sleep(max(0.0, random.gauss(latency, jitter)))
+
+            if random.random() < fail_rate:
+                body = {"status_code": 500, "message": f"{name} 模拟故障"}
+            else:
+                # 回复中带上Prompt最后一行，便于核对请求内容
+                last_line = prompt.strip().splitlines()[-1] if prompt.strip() else ""
+                text = f"[{name}] 模拟回复：{last_line[:30]}"
+                body = {
+                    "status_code": 200,
+                    "output": {"text": text},
+                    # 粗略估算token：中文约每字一个token
+                    "usage": {"input_tokens": len(prompt), "output_tokens": len(text)},
+                }
+
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            try:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # 调用方已超时放弃（测试超时切换时的正常情况）
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeLLMHandler
+
+
+def start_server(name, port, latency, jitter=0.0, fail_rate=0.0, host="127.0.0.1"):
+    """在后台线程中启动一个模拟模型服务，返回server对象（调用shutdown()停止）"""
+    server = ThreadingHTTPServer((host, port), make_handler(name, latency, jitter, fail_rate))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟LLM服务")
+    parser.add_argument("--serve", action="append", required=True,
+                        help="模型名:端口:平均延迟秒数，可重复指定多个")
+    parser.add_argument("--jitter", type=float, default=0.05, help="延迟标准差（秒）")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="模拟失败概率")
+    args = parser.parse_args()
+
+    servers = []
+    for spec in args.serve:
+        name, port, latency = spec.split(":")
+        servers.append(start_server(name, int(port), float(latency), args.jitter, args.fail_rate))
+        print(f"模拟模型 {name} 已启动: http://127.0.0.1:{port} (平均延迟 {latency}秒)")
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+知识库模糊匹配分片服务：将知识库问题分片到常驻的工作进程中并行打分
+
+每个分片由一个单进程的进程池持有，分片数据只在启动时传递一次，之后每次查询只传递查询文本。
+各分片用相同的 score_cutoff 提前剪枝，结果按分数合并；分数相同时取全局索引最小的一条，
+与单线程 process.extractOne 的结果一致。
+
+工作进程函数必须位于可导入的模块中（streamlit 运行的脚本无法被子进程导入），因此单独成文件。
+工作进程用 forkserver（不支持时用 spawn）启动，不从多线程的 streamlit 进程或后台加载线程直接 fork，
+避免子进程继承其他线程持有的锁而死锁。
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from rapidfuzz import fuzz, process
+
+# 工作进程内的分片数据
+_shard_choices = None
+_shard_offset = 0
+
+
+def _init_shard(choices, offset):
+    """工作进程初始化：保存本分片的问题列表及其在全局列表中的起始位置"""
+    global _shard_choices, _shard_offset
+    _shard_choices = choices
+    _shard_offset = offset
+
+
+def _extract_in_shard(query, score_cutoff):
+    """在本分片内查找最佳匹配，返回 (分数, 全局索引, 匹配问题) 或 None"""
+    result = process.extractOne(
+        query,
+        _shard_choices,
+        scorer=fuzz.token_set_ratio,
+        score_cutoff=score_cutoff
+    )
+    if result is None:
+        return None
+    best_match, score, index = result
+    return score, _shard_offset + index, best_match
+
+
+def merge_shard_results(results):
+    """合并各分片结果：分数最高者胜出，分数相同取全局索引最小者"""
+    best = None
+    for result in results:
+        if result is None:
+            continue
+        if best is None or result[0] > best[0] or (result[0] == best[0] and result[1] < best[1]):
+            best = result
+    if best is None:
+        return None
+    score, index, best_match = best
+    return best_match, score, index
+
+
+class FuzzyShardService:
+    """
+    常驻进程池的分片模糊匹配服务
+
+    用法：
+        service = FuzzyShardService(questions, num_shards=4)
+        service.extract_one("电机支持CAN吗", score_cutoff=50)  # -> (问题, 分数, 索引) 或 None
+        service.extract_one_partial("电机支持CAN吗", 50, timeout=0.2)  # -> (结果, 是否所有分片都已完成)
+        service.shutdown()
+    """
+
+    def __init__(self, choices, num_shards):
+        choices = list(choices)
+        num_shards = max(1, min(num_shards, len(choices) or 1))
+        self.size = len(choices)
+        self.num_shards = num_shards
+
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+        shard_size = (len(choices) + num_shards - 1) // num_shards
+        self.executors = []
+        for offset in range(0, len(choices), shard_size or 1):
+            executor = ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=context,
+                initializer=_init_shard,
+                initargs=(choices[offset:offset + shard_size], offset)
+            )
+            self.executors.append(executor)
+
+    def extract_one(self, query, score_cutoff=0, timeout=None):
+        """返回与 process.extractOne 相同格式的 (匹配问题, 分数, 索引)，低于 score_cutoff 时返回 None"""
+        return self.extract_one_partial(query, score_cutoff, timeout)[0]
+
+    def extract_one_partial(self, query, score_cutoff=0, timeout=None):
+        """
+        最多等待 timeout 秒（None 为一直等待），返回 (已完成分片的合并结果, 是否所有分片都已完成)
+
+        超时未开始的分片任务被取消；已在运行的任务无法中断，在工作进程中算完后结果被丢弃
+        """
+        futures = [executor.submit(_extract_in_shard, query, score_cutoff) for executor in self.executors]
+        done, not_done = wait(futures, timeout=timeout)
+        for future in not_done:
+            future.cancel()
+        return merge_shard_results(future.result() for future in futures if future in done), not not_done
+
+    def shutdown(self):
+        """
+        关闭所有分片进程：取消排队的任务并等待工作进程退出
+
+        不等待时执行器的唤醒管道只关闭了一半，解释器退出时会报 Bad file descriptor；
+        取消排队任务后工作进程最多算完手头的一个分片，等待时间很短
+        """
+        for executor in self.executors:
+            executor.shutdown(wait=True, cancel_futures=True)
+        self.executors = []
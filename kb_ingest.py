@@ -0,0 +1,273 @@
+"""
+知识库导入流水线：流式读取Excel/CSV/Parquet，按块校验和清洗，多工作表并行解析
+
+Excel使用openpyxl只读流式模式逐行读取，不构建完整的工作簿对象；包含多个工作表（例如每个产品线一个）时，
+各工作表在独立的工作进程中并行解析。每块数据读入后立即去掉问题或标准回答为空的行，只保留所需的列。
+
+工作进程函数必须位于可导入的模块中（streamlit 运行的脚本无法被子进程导入），因此单独成文件。
+工作进程用 forkserver（不支持时用 spawn）启动，不从多线程的 streamlit 进程直接 fork。
+"""
+import io
+import multiprocessing
+import os
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from openpyxl import load_workbook
+
+REQUIRED_COLUMNS = ['问题', '问题类型', '标准回答']
+SOURCE_COLUMN = '来源表'
+DEFAULT_CHUNK_SIZE = 5000
+
+
+class KnowledgeBaseFormatError(ValueError):
+    """知识库文件格式不符合要求（缺少必需列、无法识别的文件类型等）"""
+
+
+class _ColumnBuilder:
+    """
+    按块累积清洗后的数据
+
+    直接追加到三列列表中，不为每块构建DataFrame；重复的问题类型和标准回答复用同一个字符串对象，
+    大知识库中“一条标准回答对应几十种问法”时可显著降低内存
+    """
+
+    def __init__(self):
+        self.questions = []
+        self.types = []
+        self.answers = []
+        self._shared = {}
+
+    def _share(self, text):
+        return self._shared.setdefault(text, text)
+
+    def add_chunk(self, rows):
+        """清洗一块数据：问题和标准回答统一转为字符串，丢弃其中任一为空（或只有空白）的行"""
+        for question, qtype, answer in rows:
+            if question is None or answer is None:
+                continue
+            if isinstance(question, float) and question != question:  # NaN
+                continue
+            if isinstance(answer, float) and answer != answer:
+                continue
+            question, answer = str(question), str(answer)
+            if not question.strip() or not answer.strip():
+                continue
+            if qtype is not None and not (isinstance(qtype, float) and qtype != qtype):
+                qtype = self._share(str(qtype))
+            else:
+                qtype = None
+            self.questions.append(question)
+            self.types.append(qtype)
+            self.answers.append(self._share(answer))
+
+    def to_frame(self, source):
+        df = pd.DataFrame({'问题': self.questions, '问题类型': self.types, '标准回答': self.answers})
+        df[SOURCE_COLUMN] = source
+        return df
+
+
+def _locate_columns(header, source):
+    """在表头中查找必需列的位置，缺少时抛出 KnowledgeBaseFormatError"""
+    header = [str(cell).strip() if cell is not None else "" for cell in header]
+    positions = []
+    for col in REQUIRED_COLUMNS:
+        if col not in header:
+            raise KnowledgeBaseFormatError(f"知识库文件必须包含'{col}'列（{source}）")
+        positions.append(header.index(col))
+    return positions
+
+
+def _with_memory_tracking(track_memory, func, *args):
+    """执行函数并返回 (结果, 峰值内存字节数)；不跟踪内存时峰值为0"""
+    if not track_memory:
+        return func(*args), 0
+    already_tracing = tracemalloc.is_tracing()
+    if not already_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        result = func(*args)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        if not already_tracing:
+            tracemalloc.stop()
+
+
+def _parse_excel_sheet(path, sheet_name, chunk_size):
+    """流式解析单个工作表，返回 (清洗后的DataFrame, 读取行数)"""
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet_name]
+        rows_iter = worksheet.iter_rows(values_only=True)
+        header = next(rows_iter, None)
+        if header is None:
+            return _ColumnBuilder().to_frame(sheet_name), 0
+        q_pos, t_pos, a_pos = _locate_columns(header, sheet_name)
+
+        builder = _ColumnBuilder()
+        buffer = []
+        rows_read = 0
+        for row in rows_iter:
+            rows_read += 1
+            width = len(row)
+            buffer.append((
+                row[q_pos] if q_pos < width else None,
+                row[t_pos] if t_pos < width else None,
+                row[a_pos] if a_pos < width else None,
+            ))
+            if len(buffer) >= chunk_size:
+                builder.add_chunk(buffer)
+                buffer = []
+        if buffer:
+            builder.add_chunk(buffer)
+    finally:
+        workbook.close()
+
+    return builder.to_frame(sheet_name), rows_read
+
+
+def _parse_excel_sheet_worker(path, sheet_name, chunk_size, track_memory):
+    """工作进程入口：解析工作表，返回 (DataFrame或None, 读取行数, 峰值内存, 错误信息)"""
+    try:
+        (df, rows_read), peak = _with_memory_tracking(track_memory, _parse_excel_sheet, path, sheet_name, chunk_size)
+    except KnowledgeBaseFormatError as e:
+        return None, 0, 0, str(e)
+    return df, rows_read, peak, None
+
+
+def _parse_csv(source, chunk_size):
+    """分块读取CSV"""
+    builder = _ColumnBuilder()
+    rows_read = 0
+    reader = pd.read_csv(source, dtype=str, chunksize=chunk_size, keep_default_na=True)
+    for i, chunk in enumerate(reader):
+        if i == 0:
+            _locate_columns(list(chunk.columns), "CSV")
+        rows_read += len(chunk)
+        builder.add_chunk(chunk[REQUIRED_COLUMNS].itertuples(index=False, name=None))
+    return builder.to_frame("CSV"), rows_read
+
+
+def _parse_parquet(source, chunk_size):
+    """按批读取Parquet（需要pyarrow）"""
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise KnowledgeBaseFormatError("读取Parquet文件需要安装pyarrow")
+
+    parquet_file = pq.ParquetFile(source)
+    _locate_columns(parquet_file.schema_arrow.names, "Parquet")
+    builder = _ColumnBuilder()
+    rows_read = 0
+    for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=REQUIRED_COLUMNS):
+        columns = [batch.column(col).to_pylist() for col in REQUIRED_COLUMNS]
+        rows_read += batch.num_rows
+        builder.add_chunk(zip(*columns))
+    return builder.to_frame("Parquet"), rows_read
+
+
+def _detect_format(name):
+    """根据文件名判断格式"""
+    ext = os.path.splitext(name or "")[1].lower()
+    if ext in (".xlsx", ".xlsm"):
+        return "excel"
+    if ext == ".csv":
+        return "csv"
+    if ext in (".parquet", ".pq"):
+        return "parquet"
+    raise KnowledgeBaseFormatError(f"不支持的知识库文件类型: {ext or name}")
+
+
+def _ingest_excel(path, chunk_size, max_workers, track_memory):
+    """解析Excel的全部工作表，返回 (DataFrame, 读取行数, 工作表数, 跳过的工作表, 工作进程峰值内存之和)"""
+    workbook = load_workbook(path, read_only=True)
+    sheet_names = workbook.sheetnames
+    workbook.close()
+
+    workers = min(len(sheet_names), max_workers or os.cpu_count() or 1)
+    if workers > 1:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = [executor.submit(_parse_excel_sheet_worker, path, sheet, chunk_size, track_memory)
+                       for sheet in sheet_names]
+            results = [future.result() for future in futures]
+    else:
+        # 单进程时由调用方统一跟踪内存
+        results = [_parse_excel_sheet_worker(path, sheet, chunk_size, False) for sheet in sheet_names]
+
+    # 缺少必需列的工作表（如说明页）跳过，全部工作表都不符合要求时报错
+    errors = [error for _, _, _, error in results if error]
+    frames = [df for df, _, _, error in results if not error]
+    if not frames:
+        raise KnowledgeBaseFormatError(errors[0] if errors else "Excel文件中没有工作表")
+    skipped_sheets = [sheet for sheet, result in zip(sheet_names, results) if result[3]]
+    rows_read = sum(result[1] for result in results)
+    worker_peak = sum(result[2] for result in results)
+    return pd.concat(frames, ignore_index=True), rows_read, len(frames), skipped_sheets, worker_peak
+
+
+def ingest_knowledge_base(source, name=None, chunk_size=DEFAULT_CHUNK_SIZE, max_workers=None, track_memory=False):
+    """
+    导入知识库，返回 (DataFrame, 导入报告)
+
+    source 可以是文件路径、bytes 或带 getvalue()/read() 的文件对象（如streamlit的UploadedFile），
+    name 用于判断格式，未指定时取 source 的文件名。DataFrame 包含 问题/问题类型/标准回答 三列，
+    以及记录数据来源工作表的 来源表 列。
+
+    报告包含读取行数、保留行数、工作表数（及跳过的缺列工作表）、耗时、每秒行数和峰值内存（MB）。
+    峰值内存为本进程的Python内存分配峰值，并行解析时再加上各工作进程的峰值（各进程同时运行，取和作为上界）。
+    track_memory 使用 tracemalloc，它对整个进程生效并拖慢所有线程，只在基准测试中开启；未开启时峰值内存为None。
+    """
+    start_time = time.perf_counter()
+    if name is None:
+        name = source if isinstance(source, str) else getattr(source, "name", "")
+    file_format = _detect_format(name)
+
+    if hasattr(source, "getvalue"):
+        source = source.getvalue()
+    elif hasattr(source, "read"):
+        source = source.read()
+
+    if file_format == "excel":
+        # 工作进程需要从文件读取，上传的内容先落到临时文件
+        temp_path = None
+        if isinstance(source, bytes):
+            with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as temp_file:
+                temp_file.write(source)
+                temp_path = temp_file.name
+            path = temp_path
+        else:
+            path = source
+        try:
+            (df, rows_read, sheets, skipped_sheets, worker_peak), peak = _with_memory_tracking(
+                track_memory, _ingest_excel, path, chunk_size, max_workers, track_memory)
+        finally:
+            if temp_path:
+                os.unlink(temp_path)
+        peak += worker_peak
+    else:
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+        parser = _parse_csv if file_format == "csv" else _parse_parquet
+        (df, rows_read), peak = _with_memory_tracking(track_memory, parser, source, chunk_size)
+        sheets = 1
+        skipped_sheets = []
+
+    elapsed = time.perf_counter() - start_time
+    report = {
+        "format": file_format,
+        "sheets": sheets,
+        "skipped_sheets": skipped_sheets,
+        "rows_read": rows_read,
+        "rows_kept": len(df),
+        "rows_dropped": rows_read - len(df),
+        "seconds": elapsed,
+        "rows_per_sec": rows_read / elapsed if elapsed > 0 else 0.0,
+        "peak_memory_mb": peak / 1024 / 1024 if track_memory else None,
+    }
+    return df, report
@@ -0,0 +1,109 @@
+"""
+知识库后台加载：解析文件、构建各项索引、保存快照和切换版本作为分阶段任务在后台线程中执行
+
+阶段按组顺序执行，同一组内相互独立的阶段（如规范化索引、BM25索引、快照保存）在线程池中并发执行；
+每个阶段的状态和耗时可随时读取，界面据此显示进度。任务被新的上传取代或取消后，在下一组开始前退出，
+不会执行之后的切换阶段，正在使用的旧版本知识库不受影响。
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class KnowledgeBaseLoadJob:
+    """
+    分阶段的后台加载任务
+
+    stages: [[(阶段名, 函数), ...], ...]，外层按顺序执行，内层同组并发执行；
+    函数接收共享的 context 字典，把结果写入其中，返回 False 表示该阶段不适用（记为 skipped）；
+    任务结束后 context 只保留 keep 中的键，任务对象不再持有知识库和索引
+
+    用法：
+        job = KnowledgeBaseLoadJob(stages, {"source": data})
+        job.start()
+        job.progress()   # {"status", "stages": [{"name", "status", "seconds"}, ...], ...}
+    """
+
+    def __init__(self, stages, context=None, max_workers=4, name="kb-load", keep=()):
+        self.stages = stages
+        self.context = context if context is not None else {}
+        self.keep = keep
+        self.max_workers = max_workers
+        self.name = name
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.done = threading.Event()
+        self.stage_states = [{"name": stage_name, "group": group_index, "status": "pending", "seconds": None}
+                             for group_index, group in enumerate(stages) for stage_name, _ in group]
+        self.state = {"status": "pending", "started": None, "finished": None, "error": None, "failed_stage": None}
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.cancelled = True
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def progress(self):
+        with self.lock:
+            stages = [dict(stage) for stage in self.stage_states]
+            finished = sum(stage["status"] in ("done", "skipped") for stage in stages)
+            return dict(self.state, stages=stages, completed=finished, total=len(stages))
+
+    def _set_stage(self, stage_name, **values):
+        with self.lock:
+            for stage in self.stage_states:
+                if stage["name"] == stage_name:
+                    stage.update(values)
+
+    def _run_stage(self, stage_name, func):
+        self._set_stage(stage_name, status="running")
+        start = time.perf_counter()
+        try:
+            applied = func(self.context)
+        except Exception:
+            self._set_stage(stage_name, status="failed", seconds=time.perf_counter() - start)
+            raise
+        self._set_stage(stage_name, status="skipped" if applied is False else "done",
+                        seconds=time.perf_counter() - start)
+
+    def run(self):
+        with self.lock:
+            self.state.update(status="running", started=time.time())
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+        try:
+            for group in self.stages:
+                if self.cancelled:
+                    with self.lock:
+                        self.state.update(status="cancelled", finished=time.time())
+                    return
+                if len(group) == 1:
+                    self._run_stage(*group[0])
+                    continue
+                futures = [(stage_name, executor.submit(self._run_stage, stage_name, func))
+                           for stage_name, func in group]
+                # 同组阶段全部结束后再报告第一个失败，避免后台仍在写入时进入下一组
+                errors = []
+                for stage_name, future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        errors.append((stage_name, e))
+                if errors:
+                    raise errors[0][1]
+            with self.lock:
+                self.state.update(status="done", finished=time.time())
+        except Exception as e:
+            with self.lock:
+                failed = [stage["name"] for stage in self.stage_states if stage["status"] == "failed"]
+                self.state.update(status="failed", error=str(e)[:200], finished=time.time(),
+                                  failed_stage=failed[0] if failed else None)
+        finally:
+            executor.shutdown(wait=False)
+            self.context = {key: value for key, value in self.context.items() if key in self.keep}
+            self.done.set()
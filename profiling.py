@@ -0,0 +1,250 @@
+"""
+按需性能剖析：对接下来 N 次调用做 cProfile 函数耗时统计和 tracemalloc 内存分配统计
+
+未启用时 run() 直接调用原函数，没有额外开销。完成 N 次调用后导出到 output_dir 下按时间命名的目录：
+- profile.prof：pstats格式，可用 snakeviz / python -m pstats 查看
+- profile.folded：折叠栈格式（单位微秒），可直接拖入 speedscope，或用 flamegraph.pl 生成火焰图
+- allocations.txt：按代码行汇总的内存分配（调用结束后仍保留的净增量）
+
+cProfile 只统计发起调用的线程，推测执行等后台线程中的耗时不在结果中；CPU时间模式使用 time.thread_time，
+只计本线程的CPU时间，streamlit 服务中其他会话线程的CPU消耗不会算到被剖析的请求上。
+开启 tracemalloc 后整体会变慢，函数之间的相对耗时仍可参考。
+"""
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# 折叠栈展开的最大深度，以及小于该值（微秒）的分支不再展开
+FOLDED_MAX_DEPTH = 64
+FOLDED_MIN_MICROSECONDS = 1
+
+
+def _function_label(func):
+    """pstats 的函数键 (文件, 行号, 函数名) -> 可读的名称"""
+    filename, line, name = func
+    if filename == "~":
+        return name
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+def folded_stacks(stats):
+    """
+    将 pstats 的调用关系展开成折叠栈 {"a;b;c": 微秒}
+
+    cProfile 只记录调用方-被调用方的边，没有完整调用栈；被调用函数的耗时按各调用方的累计耗时比例分摊
+    """
+    raw = stats.stats
+    children = {}
+    for func, (_, _, _, _, callers) in raw.items():
+        for caller in callers:
+            children.setdefault(caller, []).append(func)
+
+    folded = Counter()
+
+    def expand(func, stack, fraction, depth):
+        _, _, tottime, cumtime, _ = raw[func]
+        stack = stack + [_function_label(func).replace(";", ",")]
+        self_time = tottime * fraction * 1e6
+        if self_time >= FOLDED_MIN_MICROSECONDS:
+            folded[";".join(stack)] += self_time
+        if depth >= FOLDED_MAX_DEPTH:
+            return
+        for callee in children.get(func, []):
+            if _function_label(callee).replace(";", ",") in stack:
+                continue  # 递归调用不再展开
+            callee_cumtime = raw[callee][3]
+            edge_cumtime = raw[callee][4][func][3]
+            if callee_cumtime <= 0:
+                continue
+            callee_fraction = fraction * edge_cumtime / callee_cumtime
+            if callee_cumtime * callee_fraction * 1e6 < FOLDED_MIN_MICROSECONDS:
+                continue
+            expand(callee, stack, callee_fraction, depth + 1)
+
+    for func, (_, _, _, _, callers) in raw.items():
+        if not callers:
+            expand(func, [], 1.0, 0)
+    return {stack: int(round(value)) for stack, value in folded.items() if value >= FOLDED_MIN_MICROSECONDS}
+
+
+class RequestProfiler:
+    """
+    对接下来 N 次调用做剖析
+
+    用法：
+        profiler = RequestProfiler("profiles")
+        profiler.arm(5)
+        result = profiler.run(process_query, "问题")   # 前5次调用被剖析，第5次结束后自动导出
+        profiler.last_report                          # 汇总：函数耗时、内存分配、导出文件
+    """
+
+    def __init__(self, output_dir="profiles", top_functions=20, top_allocations=20, cpu_time=True,
+                 track_memory=True, focus_functions=None):
+        self.output_dir = output_dir
+        self.focus_functions = focus_functions  # 汇总中单独列出的函数名
+        self.top_functions = top_functions
+        self.top_allocations = top_allocations
+        self.cpu_time = cpu_time
+        self.track_memory = track_memory
+        self.remaining = 0
+        self.lock = threading.Lock()  # 同一时间只剖析一个调用，其他线程的调用照常执行
+        self.last_report = None
+        self._reset()
+
+    def _reset(self):
+        self.stats = None
+        self.calls = []
+        self.allocations = Counter()
+        self.allocation_counts = Counter()
+        self.peak_memory = 0
+
+    @property
+    def armed(self):
+        return self.remaining > 0
+
+    def arm(self, calls):
+        """剖析接下来的 calls 次调用"""
+        self._reset()
+        self.remaining = calls
+
+    def disarm(self):
+        """放弃当前剖析，不导出"""
+        self.remaining = 0
+        self._reset()
+
+    def run(self, func, *args, counted=True, **kwargs):
+        """
+        调用 func；处于剖析状态时记录其耗时和内存分配
+
+        counted=False 的调用（如图表生成）计入本次剖析结果，但不占用 N 次的名额
+        """
+        if not self.armed or not self.lock.acquire(blocking=False):
+            return func(*args, **kwargs)
+        try:
+            profile = cProfile.Profile(time.thread_time if self.cpu_time else time.perf_counter)
+            started_tracing = False
+            before = None
+            if self.track_memory:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    started_tracing = True
+                before = tracemalloc.take_snapshot()
+                baseline = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+            start = time.perf_counter()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                if before is not None:
+                    self._collect_allocations(before, baseline)
+                    if started_tracing:
+                        tracemalloc.stop()
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+                self.calls.append({"function": getattr(func, "__name__", str(func)), "seconds": elapsed})
+                if counted and self.remaining > 0:
+                    self.remaining -= 1
+                    if self.remaining == 0:
+                        self.export()
+        finally:
+            self.lock.release()
+
+    def _collect_allocations(self, before, baseline):
+        after = tracemalloc.take_snapshot()
+        self.peak_memory = max(self.peak_memory, tracemalloc.get_traced_memory()[1] - baseline)
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen *>")]
+        for stat in after.filter_traces(filters).compare_to(before.filter_traces(filters), "lineno"):
+            if stat.size_diff <= 0:
+                continue
+            frame = stat.traceback[0]
+            key = f"{frame.filename}:{frame.lineno}"
+            self.allocations[key] += stat.size_diff
+            self.allocation_counts[key] += stat.count_diff
+
+    def function_table(self, focus=None):
+        """按累计耗时排序的函数表；指定 focus 时只保留名称在其中的函数"""
+        if self.stats is None:
+            return []
+        rows = []
+        for func, (_, ncalls, tottime, cumtime, _) in self.stats.stats.items():
+            if focus is not None and func[2] not in focus:
+                continue
+            rows.append({
+                "function": _function_label(func),
+                "calls": ncalls,
+                "self_ms": tottime * 1000,
+                "cumulative_ms": cumtime * 1000,
+            })
+        rows.sort(key=lambda row: row["cumulative_ms"], reverse=True)
+        return rows[:self.top_functions]
+
+    def allocation_table(self):
+        """按净分配字节数排序的代码行"""
+        return [{"location": location, "kb": size / 1024, "blocks": self.allocation_counts[location]}
+                for location, size in self.allocations.most_common(self.top_allocations)]
+
+    def export(self):
+        """导出剖析文件并生成汇总，返回汇总字典"""
+        if self.stats is None:
+            return None
+        directory = base = os.path.join(self.output_dir, time.strftime("%Y%m%d-%H%M%S"))
+        suffix = 1
+        while os.path.exists(directory):
+            suffix += 1
+            directory = f"{base}-{suffix}"
+        os.makedirs(directory)
+
+        prof_path = os.path.join(directory, "profile.prof")
+        self.stats.dump_stats(prof_path)
+
+        folded_path = os.path.join(directory, "profile.folded")
+        with open(folded_path, "w", encoding="utf-8") as f:
+            for stack, value in sorted(folded_stacks(self.stats).items()):
+                f.write(f"{stack} {value}\n")
+
+        allocations = self.allocation_table()
+        allocations_path = os.path.join(directory, "allocations.txt")
+        with open(allocations_path, "w", encoding="utf-8") as f:
+            f.write(f"峰值内存增量 {self.peak_memory / 1024:.1f}KB\n")
+            f.write(f"{'净分配(KB)':>12}{'块数':>10}  位置\n")
+            for row in allocations:
+                f.write(f"{row['kb']:>12.1f}{row['blocks']:>10}  {row['location']}\n")
+
+        text = io.StringIO()
+        pstats.Stats(prof_path, stream=text).sort_stats("cumulative").print_stats(15)
+        self.last_report = {
+            "directory": directory,
+            "files": {"prof": prof_path, "folded": folded_path, "allocations": allocations_path},
+            "calls": self.calls,
+            "timer": "本线程CPU时间" if self.cpu_time else "墙钟时间",
+            "functions": self.function_table(),
+            "focus_functions": self.function_table(self.focus_functions) if self.focus_functions else [],
+            "allocations": allocations,
+            "peak_memory_kb": self.peak_memory / 1024,
+            "text": text.getvalue(),
+        }
+        self.remaining = 0
+        self._reset()
+        return self.last_report
+
+
+def print_report(report, top=10):
+    """在命令行打印剖析汇总（供 benchmark.py、replay.py 等入口使用）"""
+    if not report:
+        return
+    print(f"\n剖析结果（{report['timer']}）已导出到 {report['directory']}")
+    print(f"{'函数':<60}{'调用次数':>10}{'自身ms':>12}{'累计ms':>12}")
+    for row in report["functions"][:top]:
+        print(f"{row['function'][:58]:<60}{row['calls']:>10}{row['self_ms']:>12.1f}{row['cumulative_ms']:>12.1f}")
+    if report["allocations"]:
+        print(f"\n内存分配热点（峰值增量 {report['peak_memory_kb']:.0f}KB）")
+        for row in report["allocations"][:top]:
+            print(f"{row['kb']:>10.1f}KB {row['blocks']:>8}块  {row['location']}")
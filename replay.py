@@ -0,0 +1,211 @@
+"""
+流量重放工具：用 traffic_recorder 录制的线上流量重新驱动当前代码，对比路由、回复和各阶段耗时
+
+用法：
+    python replay.py traffic/traffic-20240601.jsonl.gz --kb 知识库.xlsx
+    python replay.py traffic/*.jsonl.gz --kb 知识库.xlsx --show 20 --report replay_report.json
+    python replay.py traffic/*.jsonl.gz --kb 知识库.xlsx --profile profiles   # 同时剖析重放过程
+
+AI响应直接使用录制的原始响应，不访问网络；录制时没有走AI、而新代码需要调用AI的查询返回固定的占位回复，
+并计入“缺少录制响应”。为保证结果可复现，重放时关闭推测执行。
+录制的问题已经脱敏，个别依赖手机号、订单号等原文的路由可能与线上不同。
+"""
+import argparse
+import contextlib
+import glob
+import json
+import os
+import time
+from collections import Counter
+
+from profiling import RequestProfiler, print_report as print_profile_report
+from traffic_recorder import iter_traffic
+
+REPLAY_PLACEHOLDER = "[重放] 录制中没有该问题的AI响应"
+
+
+def load_app():
+    """导入 app 模块（以 streamlit 裸模式运行，屏蔽其警告日志）"""
+    from streamlit.logger import set_log_level
+    # streamlit 为各子模块单独设置日志级别，set_log_level 会统一调高（含之后创建的logger）
+    set_log_level("error")
+    import app
+    return app
+
+
+def percentile(values, ratio):
+    """简单分位数（最近秩）"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(ratio * len(values)))]
+
+
+def replay_traffic(app, entries, knowledge_df=None, rule_base=None):
+    """
+    逐条重放，返回 [(录制记录, 重放记录), ...] 和统计
+
+    重放记录由 app.record_traffic 生成，与录制记录格式相同
+    """
+    st = app.st
+    st.session_state.knowledge_df = knowledge_df
+    st.session_state.rule_base = rule_base
+    st.session_state.speculation_config = {"enabled": False}
+
+    captured = []
+    recorder = app.get_traffic_recorder()
+    recorder.enabled = True
+    recorder.sink = captured.append
+
+    current = {}
+    stats = Counter()
+
+    def responder(user_query, branch, prompt):
+        llm = current.get("llm")
+        if llm is None:
+            stats["missing_llm"] += 1
+            return {"ok": True, "status_code": 200, "text": REPLAY_PLACEHOLDER, "error": None,
+                    "model": "replay", "input_tokens": 0, "output_tokens": 0}
+        stats["served_llm"] += 1
+        return dict(llm)
+
+    app.LLM_RESPONDER = responder
+    pairs = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for entry in entries:
+            current.clear()
+            current.update(entry)
+            # 每条查询独立重放，不携带上一条的对话窗口
+            st.session_state.history.clear()
+            st.session_state.all_conversations.clear()
+            captured.clear()
+            app.process_query(entry["query"])
+            pairs.append((entry, captured[-1]))
+    app.LLM_RESPONDER = None
+    recorder.sink = None
+    recorder.enabled = False
+    return pairs, stats
+
+
+def build_report(pairs, stats, max_diffs):
+    """汇总路由变化、回复变化和各阶段耗时变化"""
+    route_changes = []
+    answer_changes = []
+    transitions = Counter()
+    stage_values = {}
+    for recorded, replayed in pairs:
+        old_route = (recorded["source"], recorded["intent"], recorded["status"])
+        new_route = (replayed["source"], replayed["intent"], replayed["status"])
+        diff = {"query": recorded["query"], "old": old_route, "new": new_route,
+                "old_reply": recorded["reply"], "new_reply": replayed["reply"]}
+        if old_route != new_route:
+            transitions[(recorded["source"], replayed["source"])] += 1
+            route_changes.append(diff)
+        elif recorded["reply"] != replayed["reply"]:
+            answer_changes.append(diff)
+        for stage in set(recorded["stages"]) | set(replayed["stages"]):
+            old_values, new_values = stage_values.setdefault(stage, ([], []))
+            if stage in recorded["stages"]:
+                old_values.append(recorded["stages"][stage])
+            if stage in replayed["stages"]:
+                new_values.append(replayed["stages"][stage])
+
+    latency = {}
+    for stage, (old_values, new_values) in sorted(stage_values.items()):
+        latency[stage] = {
+            "recorded_count": len(old_values),
+            "replayed_count": len(new_values),
+            "recorded_mean_ms": sum(old_values) / len(old_values) if old_values else 0.0,
+            "replayed_mean_ms": sum(new_values) / len(new_values) if new_values else 0.0,
+            "recorded_p95_ms": percentile(old_values, 0.95),
+            "replayed_p95_ms": percentile(new_values, 0.95),
+        }
+    return {
+        "total": len(pairs),
+        "route_changed": len(route_changes),
+        "answer_changed": len(answer_changes),
+        "llm_served_from_recording": stats["served_llm"],
+        "llm_missing_recording": stats["missing_llm"],
+        "transitions": [{"old_source": old, "new_source": new, "count": count}
+                        for (old, new), count in transitions.most_common()],
+        "latency": latency,
+        "route_changes": route_changes[:max_diffs],
+        "answer_changes": answer_changes[:max_diffs],
+    }
+
+
+def print_report(report, show):
+    total = report["total"] or 1
+    print(f"重放 {report['total']} 条: 路由变化 {report['route_changed']} ({report['route_changed'] / total:.1%}), "
+          f"回复变化 {report['answer_changed']} ({report['answer_changed'] / total:.1%})")
+    print(f"AI响应: 使用录制 {report['llm_served_from_recording']} 条, 缺少录制 {report['llm_missing_recording']} 条")
+    if report["transitions"]:
+        print("\n路由迁移:")
+        for item in report["transitions"][:20]:
+            print(f"  {item['old_source']} -> {item['new_source']}: {item['count']}")
+    print("\n阶段耗时 (ms)     录制均值   重放均值   均值变化   录制P95   重放P95")
+    for stage, row in report["latency"].items():
+        delta = row["replayed_mean_ms"] - row["recorded_mean_ms"]
+        print(f"  {stage:<16}{row['recorded_mean_ms']:>9.2f}{row['replayed_mean_ms']:>11.2f}{delta:>+11.2f}"
+              f"{row['recorded_p95_ms']:>10.2f}{row['replayed_p95_ms']:>10.2f}")
+    for title, key in [("路由变化", "route_changes"), ("回复变化", "answer_changes")]:
+        if show and report[key]:
+            print(f"\n{title}示例:")
+            for diff in report[key][:show]:
+                print(f"  {diff['query'][:40]}")
+                old_reply = diff['old_reply'][:40].replace("\n", " ")
+                new_reply = diff['new_reply'][:40].replace("\n", " ")
+                print(f"    录制: {diff['old'][0]} / {diff['old'][1]} / {old_reply}")
+                print(f"    重放: {diff['new'][0]} / {diff['new'][1]} / {new_reply}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="重放录制的线上流量并对比结果")
+    parser.add_argument("traffic", nargs="+", help="录制文件（.jsonl.gz），支持通配符")
+    parser.add_argument("--kb", help="知识库文件（xlsx/csv/parquet），不指定时在无知识库的情况下重放")
+    parser.add_argument("--limit", type=int, help="最多重放的记录数")
+    parser.add_argument("--show", type=int, default=10, help="打印的差异示例条数")
+    parser.add_argument("--max-diffs", type=int, default=1000, help="报告中保留的差异条数上限")
+    parser.add_argument("--report", help="将完整报告写入JSON文件")
+    parser.add_argument("--profile", metavar="DIR", help="对重放过程做cProfile/tracemalloc剖析，结果导出到该目录")
+    args = parser.parse_args()
+
+    paths = sorted({path for pattern in args.traffic for path in (glob.glob(pattern) or [pattern])})
+    entries = list(iter_traffic(paths))
+    if args.limit:
+        entries = entries[:args.limit]
+
+    app = load_app()
+    knowledge_df, rule_base = None, None
+    if args.kb:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            knowledge_df, rule_base = app.load_knowledge_base(args.kb)
+        if knowledge_df is None:
+            raise SystemExit(f"知识库加载失败: {args.kb}")
+        kb_version = app.get_kb_version(knowledge_df)
+        other_versions = sum(1 for entry in entries if entry.get("kb_version") != kb_version)
+        print(f"知识库 {len(knowledge_df)} 条 (版本 {kb_version}); {other_versions} 条录制使用了其他版本的知识库")
+
+    start = time.perf_counter()
+    profiler = None
+    if args.profile:
+        profiler = RequestProfiler(args.profile, focus_functions=app.PROFILE_FOCUS_FUNCTIONS)
+        profiler.arm(1)
+        pairs, stats = profiler.run(replay_traffic, app, entries, knowledge_df, rule_base)
+    else:
+        pairs, stats = replay_traffic(app, entries, knowledge_df, rule_base)
+    elapsed = time.perf_counter() - start
+    print(f"读取 {len(paths)} 个文件, 重放耗时 {elapsed:.1f}秒 ({len(pairs) / elapsed if elapsed else 0:.0f} 条/秒)\n")
+
+    report = build_report(pairs, stats, args.max_diffs)
+    print_report(report, args.show)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n完整报告已写入 {args.report}")
+    if profiler is not None:
+        print_profile_report(profiler.last_report)
+
+
+if __name__ == "__main__":
+    main()
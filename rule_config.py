@@ -0,0 +1,263 @@
+"""
+路由规则配置：意图关键词和各类判断词表（外观、技术、合并问题连接词等）保存在 rules.json 中
+
+加载时先校验，再把每个词表编译为 Aho-Corasick 自动机：一次扫描问题文本即可得到全部命中的关键词，
+耗时只与问题长度有关，不随规则数和关键词数增长。文件修改后按修改时间自动重新加载，也可手动触发；
+新配置校验或编译失败时继续使用旧配置，与知识库的加载和版本无关。
+
+配置格式：
+    {"version": 版本号,
+     "intents": {意图: {"patterns": [关键词, ...], "reply": 可选的预设回复}, ...},   # 按顺序匹配，先匹配者优先
+     "vocabularies": {词表名: [关键词, ...], ...}}
+意图关键词与小写后的问题匹配，词表关键词与原问题匹配（区分大小写）。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+REQUIRED_VOCABULARIES = ("kb_appearance", "appearance", "appearance_technical_context", "technical",
+                         "prompt_appearance", "prompt_technical", "combination_connectors")
+
+
+class RuleConfigError(Exception):
+    """规则配置文件无法读取或校验失败"""
+
+
+class KeywordMatcher:
+    """
+    Aho-Corasick 多关键词匹配
+
+    keywords 按优先级排列；ranks 为每个关键词的排名（默认为其下标），first() 返回命中关键词中最小的排名
+    """
+
+    def __init__(self, keywords, ranks=None):
+        self.keywords = list(keywords)
+        ranks = list(range(len(self.keywords))) if ranks is None else list(ranks)
+        self.goto = [{}]
+        self.fail = [0]
+        outputs = [[]]
+        for index, keyword in enumerate(self.keywords):
+            state = 0
+            for char in keyword:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = self.goto[state][char] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    outputs.append([])
+                state = next_state
+            outputs[state].append(index)
+
+        # 按层（广度优先）计算失败指针，并把失败链上的输出合并到每个状态
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                outputs[next_state] = outputs[next_state] + outputs[self.fail[next_state]]
+                queue.append(next_state)
+        self.outputs = [tuple(sorted(set(found))) for found in outputs]
+        self.best = [min((ranks[index] for index in found), default=None) for found in self.outputs]
+
+    def _states(self, text):
+        goto, fail = self.goto, self.fail
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            yield state
+
+    def search(self, text):
+        """是否包含任一关键词"""
+        outputs = self.outputs
+        return any(outputs[state] for state in self._states(text))
+
+    def first(self, text):
+        """命中关键词中最小的排名，没有命中时返回None"""
+        best = None
+        for state in self._states(text):
+            rank = self.best[state]
+            if rank is not None and (best is None or rank < best):
+                best = rank
+        return best
+
+    def find_all(self, text):
+        """命中的关键词，按关键词列表中的顺序"""
+        found = set()
+        for state in self._states(text):
+            found.update(self.outputs[state])
+        return [self.keywords[index] for index in sorted(found)]
+
+
+def _string_list(value, where):
+    if not isinstance(value, list) or not value:
+        raise RuleConfigError(f"{where} 必须是非空列表")
+    for item in value:
+        if not isinstance(item, str) or not item:
+            raise RuleConfigError(f"{where} 中的关键词必须是非空字符串: {item!r}")
+    return value
+
+
+def validate_rules(config):
+    """校验配置结构，返回警告列表（不影响使用的问题）；结构错误时抛出 RuleConfigError"""
+    if not isinstance(config, dict):
+        raise RuleConfigError("规则配置必须是JSON对象")
+    if "version" not in config:
+        raise RuleConfigError("规则配置缺少 version")
+    intents = config.get("intents")
+    if not isinstance(intents, dict) or not intents:
+        raise RuleConfigError("intents 必须是非空对象")
+    warnings = []
+    for intent, rule in intents.items():
+        if not isinstance(rule, dict):
+            raise RuleConfigError(f"意图 {intent} 的配置必须是对象")
+        patterns = _string_list(rule.get("patterns"), f"意图 {intent} 的 patterns")
+        if "reply" in rule and (not isinstance(rule["reply"], str) or not rule["reply"].strip()):
+            raise RuleConfigError(f"意图 {intent} 的 reply 必须是非空字符串")
+        # 意图关键词与小写后的问题匹配，含大写字母的关键词不会命中
+        uppercase = [pattern for pattern in patterns if pattern != pattern.lower()]
+        if uppercase:
+            warnings.append(f"意图 {intent} 的关键词含大写字母，不会被匹配: {', '.join(uppercase)}")
+    vocabularies = config.get("vocabularies")
+    if not isinstance(vocabularies, dict):
+        raise RuleConfigError("vocabularies 必须是对象")
+    missing = [name for name in REQUIRED_VOCABULARIES if name not in vocabularies]
+    if missing:
+        raise RuleConfigError(f"vocabularies 缺少词表: {', '.join(missing)}")
+    for name, words in vocabularies.items():
+        _string_list(words, f"词表 {name}")
+    return warnings
+
+
+class CompiledRules:
+    """校验并编译后的路由规则（只读，可在多个线程间共享）"""
+
+    def __init__(self, config, source=None):
+        start = time.perf_counter()
+        self.warnings = validate_rules(config)
+        self.version = config["version"]
+        # 配置内容的哈希：version 由人工维护，改了规则却没改版本号时用它区分新旧配置
+        self.digest = hashlib.blake2b(json.dumps(config, ensure_ascii=False, sort_keys=True).encode("utf-8"),
+                                      digest_size=8).hexdigest()
+        self.source = source
+        self.intents = list(config["intents"])
+        self.patterns = {intent: list(rule["patterns"]) for intent, rule in config["intents"].items()}
+        self.replies = {intent: rule["reply"] for intent, rule in config["intents"].items() if "reply" in rule}
+        keywords, ranks = [], []
+        for rank, intent in enumerate(self.intents):
+            keywords.extend(self.patterns[intent])
+            ranks.extend([rank] * len(self.patterns[intent]))
+        self.intent_matcher = KeywordMatcher(keywords, ranks)
+        self.vocabularies = {name: list(words) for name, words in config["vocabularies"].items()}
+        self.matchers = {name: KeywordMatcher(words) for name, words in self.vocabularies.items()}
+        self.keyword_count = len(keywords) + sum(len(words) for words in self.vocabularies.values())
+        self.compile_seconds = time.perf_counter() - start
+
+    def rule_base(self):
+        """兼容原规则库格式的副本：{意图: {"patterns": [...]}}"""
+        return {intent: {"patterns": list(patterns)} for intent, patterns in self.patterns.items()}
+
+    def detect_intent(self, text_lower):
+        """按意图顺序返回第一个有关键词出现在（小写后的）问题中的意图，没有时返回None"""
+        rank = self.intent_matcher.first(text_lower)
+        return None if rank is None else self.intents[rank]
+
+    def contains(self, vocabulary, text):
+        return self.matchers[vocabulary].search(text)
+
+    def find(self, vocabulary, text):
+        """问题中出现的词表关键词，按词表顺序"""
+        return self.matchers[vocabulary].find_all(text)
+
+    def first(self, vocabulary, text):
+        """词表中第一个出现在问题中的关键词，没有时返回None"""
+        index = self.matchers[vocabulary].first(text)
+        return None if index is None else self.vocabularies[vocabulary][index]
+
+
+def load_rules(path):
+    """读取、校验并编译规则配置文件"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        raise RuleConfigError(f"无法读取规则配置 {path}: {e}")
+    return CompiledRules(config, path)
+
+
+class RuleConfigWatcher:
+    """
+    规则配置的热加载
+
+    current() 最多每 check_interval 秒检查一次文件修改时间，变化后重新加载；reload() 立即重新加载。
+    新配置无效时保留当前配置并记录错误；加载成功后调用 on_reload(新规则, 旧规则)。
+    指定 fallback_path 时 path 不存在则使用 fallback_path（如租户规则文件缺省时使用全局规则），
+    之后创建或删除 path 也按文件变化处理。首次加载失败时直接抛出 RuleConfigError。
+    """
+
+    def __init__(self, path, check_interval=2.0, on_reload=None, fallback_path=None):
+        self.path = path
+        self.fallback_path = fallback_path
+        self.check_interval = check_interval
+        self.on_reload = on_reload
+        self.lock = threading.Lock()
+        self.last_check = time.monotonic()
+        self.signature = self._signature()
+        self.rules = load_rules(self.active_path())
+        self.state = {"loaded_at": time.time(), "reloads": 0, "failures": 0, "last_error": None}
+
+    def active_path(self):
+        """当前使用的规则文件"""
+        if self.fallback_path is not None and not os.path.exists(self.path):
+            return self.fallback_path
+        return self.path
+
+    def _signature(self):
+        path = self.active_path()
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return path, stat.st_mtime_ns, stat.st_size
+
+    def current(self):
+        if self.check_interval is not None and time.monotonic() - self.last_check >= self.check_interval:
+            self.last_check = time.monotonic()
+            if self._signature() != self.signature:
+                self.reload()
+        return self.rules
+
+    def reload(self):
+        """立即重新加载，返回 (是否成功, 说明)"""
+        with self.lock:
+            signature = self._signature()
+            try:
+                rules = load_rules(self.active_path())
+            except RuleConfigError as e:
+                # 记录签名，同一个无效文件不会反复重试，修改后再次加载
+                self.signature = signature
+                self.state["failures"] += 1
+                self.state["last_error"] = str(e)[:300]
+                print(f"DEBUG: 规则配置重新加载失败，继续使用版本 {self.rules.version}: {e}")
+                return False, str(e)
+            previous, self.rules = self.rules, rules
+            self.signature = signature
+            self.state.update(loaded_at=time.time(), last_error=None)
+            self.state["reloads"] += 1
+        print(f"DEBUG: 规则配置已重新加载: 版本 {previous.version} -> {rules.version}, "
+              f"{len(rules.intents)} 个意图, {rules.keyword_count} 个关键词, 编译 {rules.compile_seconds * 1000:.1f}ms")
+        if self.on_reload is not None:
+            self.on_reload(rules, previous)
+        return True, f"已加载版本 {rules.version}"
+
+    def stats(self):
+        with self.lock:
+            rules = self.rules
+            return dict(self.state, path=self.active_path(), version=rules.version, intents=len(rules.intents),
+                        keywords=rules.keyword_count, compile_ms=rules.compile_seconds * 1000,
+                        warnings=list(rules.warnings))
@@ -0,0 +1,551 @@
+"""
+会话状态存储：将对话窗口、完整对话记录、API密钥和知识库引用从单个Streamlit进程的内存中外置
+
+提供两种后端：
+- InMemorySessionStore：进程内字典，单实例部署的默认选项
+- SQLiteSessionStore：多个应用实例共享同一个SQLite文件（本地KV存储的替代），任一实例都能接管任一会话
+
+写入采用批量延迟写（write-behind）：每轮对话只做序列化并放入队列，由后台线程合并成一个事务写入，
+对话主流程的持久化开销保持在亚毫秒级。本进程内的读取会先看尚未落盘的状态，保证读到自己的写入。
+
+知识库本身不随会话保存，会话中只记录知识库版本号；知识库快照按版本单独保存一次，
+其他实例恢复会话时按版本号加载快照。快照与其他记录一样是（压缩的）JSON文档，加载时不会执行任何代码，
+快照目录被他人写入时最多得到错误的知识库内容，而不会在应用进程中执行任意代码。
+
+另外提供按名称读写的共享文档（save_document/load_document），保存各实例共用的小型数据，如AI沉淀知识层。
+"""
+import json
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+# 对话记录的已知字段按固定顺序编码为数组，省去每条记录重复的键名；未知字段放在末尾的字典中
+CONVERSATION_FIELDS = ["query", "reply", "source", "time", "latency", "prompt_tokens", "prompt_budget"]
+
+# 超过该字节数的记录用zlib压缩
+COMPRESS_MIN_BYTES = 512
+
+
+def encode_record(obj):
+    """紧凑序列化：无空白的JSON，较长时zlib压缩；首字节标记编码方式"""
+    data = json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if len(data) >= COMPRESS_MIN_BYTES:
+        return b'z' + zlib.compress(data, 1)
+    return b'j' + data
+
+
+def decode_record(blob):
+    """encode_record 的逆操作"""
+    blob = bytes(blob)
+    data = zlib.decompress(blob[1:]) if blob[:1] == b'z' else blob[1:]
+    return json.loads(data.decode('utf-8'))
+
+
+def encode_conversation(record):
+    """对话记录 -> 字节串"""
+    values = [record.get(field) for field in CONVERSATION_FIELDS]
+    extras = {key: value for key, value in record.items() if key not in CONVERSATION_FIELDS}
+    if extras:
+        values.append(extras)
+    return encode_record(values)
+
+
+def decode_conversation(blob):
+    """字节串 -> 对话记录；值为None的可选字段不还原"""
+    values = decode_record(blob)
+    record = {}
+    for field, value in zip(CONVERSATION_FIELDS, values):
+        if value is not None or field in CONVERSATION_FIELDS[:5]:
+            record[field] = value
+    if len(values) > len(CONVERSATION_FIELDS):
+        record.update(values[-1])
+    return record
+
+
+def encode_state(history, api_key="", kb_version=None):
+    """会话状态：对话窗口（新的在前）、API密钥、知识库版本"""
+    return encode_record({"h": [list(turn) for turn in history], "k": api_key or "", "v": kb_version})
+
+
+def decode_state(blob):
+    """返回 {"history": [(问题, 回复), ...], "api_key": str, "kb_version": str或None}"""
+    state = decode_record(blob)
+    return {
+        "history": [tuple(turn) for turn in state.get("h", [])],
+        "api_key": state.get("k", ""),
+        "kb_version": state.get("v"),
+    }
+
+
+class InMemorySessionStore:
+    """
+    进程内会话存储（默认后端）
+
+    只在单个进程内共享：同一实例上重新连接的会话可以恢复，进程重启后丢失
+    """
+
+    backend = "memory"
+
+    def __init__(self, max_snapshots=4):
+        self.lock = threading.Lock()
+        self.states = {}
+        self.conversations = {}
+        self.snapshots = OrderedDict()
+        self.max_snapshots = max_snapshots
+        self.pinned = set()  # 租户正在使用的知识库版本，快照不参与淘汰
+        self.documents = {}
+        self.writes = 0
+
+    def save_state(self, session_id, history, api_key="", kb_version=None):
+        blob = encode_state(history, api_key, kb_version)
+        with self.lock:
+            self.states[session_id] = blob
+            self.writes += 1
+
+    def load_state(self, session_id):
+        with self.lock:
+            blob = self.states.get(session_id)
+        return decode_state(blob) if blob is not None else None
+
+    def append_conversation(self, session_id, record):
+        blob = encode_conversation(record)
+        with self.lock:
+            self.conversations.setdefault(session_id, []).append((time.time(), blob))
+            self.writes += 1
+
+    def replace_conversations(self, session_id, records):
+        now = time.time()
+        blobs = [(now, encode_conversation(record)) for record in records]
+        with self.lock:
+            self.conversations[session_id] = blobs
+            self.writes += 1
+
+    def update_conversation(self, session_id, index, fields):
+        """只更新第 index 条对话记录的部分字段，保留其创建时间"""
+        with self.lock:
+            blobs = self.conversations.get(session_id, [])
+            if not 0 <= index < len(blobs):
+                return
+            created, blob = blobs[index]
+            record = decode_conversation(blob)
+            record.update(fields)
+            blobs[index] = (created, encode_conversation(record))
+            self.writes += 1
+
+    def load_conversations(self, session_id):
+        with self.lock:
+            blobs = list(self.conversations.get(session_id, []))
+        return [decode_conversation(blob) for _, blob in blobs]
+
+    def iter_conversations(self, session_id=None, chunk_size=1000, tenant_id=None, default_tenant=None):
+        """
+        按块产出 [(会话ID, 创建时间, 对话记录), ...]
+
+        指定 tenant_id 时只产出该租户的记录；没有租户字段的记录属于 default_tenant
+        """
+        with self.lock:
+            items = [(sid, created, blob)
+                     for sid, blobs in self.conversations.items()
+                     if session_id is None or sid == session_id
+                     for created, blob in blobs]
+        for start in range(0, len(items), chunk_size):
+            chunk = [(sid, created, decode_conversation(blob)) for sid, created, blob in items[start:start + chunk_size]]
+            if tenant_id is not None:
+                chunk = [item for item in chunk if (item[2].get("tenant") or default_tenant) == tenant_id]
+            if chunk:
+                yield chunk
+
+    def save_kb_snapshot(self, kb_version, document):
+        blob = encode_record(document)
+        with self.lock:
+            self.snapshots[kb_version] = blob
+            self.snapshots.move_to_end(kb_version)
+            self._evict_snapshots()
+
+    def pin_kb_snapshots(self, kb_versions):
+        """
+        设置租户正在使用的知识库版本：这些快照一直保留（租户卸载后要靠它重新加载），
+        max_snapshots 只限制其余（仅供会话恢复的）快照，不再使用的版本解除固定后按最近写入顺序淘汰
+        """
+        with self.lock:
+            self.pinned = set(kb_versions)
+            self._evict_snapshots()
+
+    def _evict_snapshots(self):
+        """调用方持有锁"""
+        unpinned = [kb_version for kb_version in self.snapshots if kb_version not in self.pinned]
+        for kb_version in unpinned[:max(0, len(unpinned) - self.max_snapshots)]:
+            del self.snapshots[kb_version]
+
+    def has_kb_snapshot(self, kb_version):
+        with self.lock:
+            return kb_version in self.snapshots
+
+    def load_kb_snapshot(self, kb_version):
+        with self.lock:
+            blob = self.snapshots.get(kb_version)
+        return decode_record(blob) if blob is not None else None
+
+    def save_document(self, name, document):
+        blob = encode_record(document)
+        with self.lock:
+            self.documents[name] = blob
+            self.writes += 1
+
+    def load_document(self, name):
+        with self.lock:
+            blob = self.documents.get(name)
+        return decode_record(blob) if blob is not None else None
+
+    def update_document(self, name, update):
+        """原子地读取 -> update(文档或None) -> 写回，返回写入的文档"""
+        with self.lock:
+            blob = self.documents.get(name)
+            document = update(decode_record(blob) if blob is not None else None)
+            self.documents[name] = encode_record(document)
+            self.writes += 1
+        return document
+
+    def flush(self, timeout=None):
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                "backend": self.backend,
+                "sessions": len(self.states),
+                "conversations": sum(len(blobs) for blobs in self.conversations.values()),
+                "writes": self.writes,
+                "pending": 0,
+                "flushes": 0,
+            }
+
+    def close(self):
+        pass
+
+
+class SQLiteSessionStore:
+    """
+    基于SQLite文件的共享会话存储
+
+    多个应用实例指向同一个数据库文件即可共享会话（WAL模式，读写互不阻塞）；
+    知识库快照以压缩JSON文件保存在 snapshot_dir 中，文件名为知识库版本号。
+    写入由后台线程批量提交：积累到 batch_size 条或等待 flush_interval 秒后写入一个事务。
+    """
+
+    backend = "sqlite"
+
+    def __init__(self, path, snapshot_dir=None, flush_interval=0.05, batch_size=256):
+        self.path = path
+        self.snapshot_dir = snapshot_dir or os.path.join(os.path.dirname(os.path.abspath(path)), "kb_snapshots")
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.pending_states = {}  # 尚未落盘的最新会话状态，保证本进程读到自己的写入
+        self.pending_lock = threading.Lock()
+        self.writes = 0
+        self.flushes = 0
+        self.write_errors = 0
+
+        connection = self._connect()
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                state BLOB NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS conversations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                created REAL NOT NULL,
+                record BLOB NOT NULL,
+                tenant TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_conversations_session ON conversations (session_id, id);
+            CREATE TABLE IF NOT EXISTS documents (
+                name TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                updated REAL NOT NULL
+            );
+        """)
+        # 早期版本的表没有租户列：补上该列，已有记录的租户为NULL（属于默认租户）
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(conversations)")]
+        if "tenant" not in columns:
+            connection.execute("ALTER TABLE conversations ADD COLUMN tenant TEXT")
+        connection.execute("CREATE INDEX IF NOT EXISTS idx_conversations_tenant ON conversations (tenant, id)")
+        connection.commit()
+        connection.close()
+
+        self.writer = threading.Thread(target=self._write_loop, name="session-store-writer", daemon=True)
+        self.writer.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    # ====== 写入（后台线程批量提交）======
+
+    def save_state(self, session_id, history, api_key="", kb_version=None):
+        blob = encode_state(history, api_key, kb_version)
+        with self.pending_lock:
+            self.pending_states[session_id] = blob
+        self.queue.put(("state", session_id, blob, time.time()))
+
+    def append_conversation(self, session_id, record):
+        self.queue.put(("append", session_id, (encode_conversation(record), record.get("tenant")), time.time()))
+
+    def replace_conversations(self, session_id, records):
+        blobs = [(encode_conversation(record), record.get("tenant")) for record in records]
+        self.queue.put(("replace", session_id, blobs, time.time()))
+
+    def update_conversation(self, session_id, index, fields):
+        """只更新第 index 条对话记录的部分字段，保留其创建时间"""
+        self.queue.put(("update", session_id, index, dict(fields)))
+
+    def flush(self, timeout=None):
+        """等待此前提交的写入全部落盘，超时返回False"""
+        done = threading.Event()
+        self.queue.put(("flush", done))
+        return done.wait(timeout)
+
+    def _write_loop(self):
+        connection = self._connect()
+        while True:
+            batch = [self.queue.get()]
+            if batch[0][0] == "close":
+                break
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1][0] not in ("flush", "close"):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            closing = batch[-1][0] == "close"
+            if closing:
+                batch.pop()
+            self._apply_batch(connection, batch)
+            if closing:
+                break
+        connection.close()
+
+    def _apply_batch(self, connection, batch):
+        written_states = {}
+        try:
+            with connection:
+                for op in batch:
+                    kind = op[0]
+                    if kind == "state":
+                        _, session_id, blob, updated = op
+                        connection.execute(
+                            "INSERT INTO sessions (session_id, state, updated) VALUES (?, ?, ?) "
+                            "ON CONFLICT(session_id) DO UPDATE SET state=excluded.state, updated=excluded.updated",
+                            (session_id, blob, updated))
+                        written_states[session_id] = blob
+                    elif kind == "append":
+                        _, session_id, (blob, tenant), created = op
+                        connection.execute(
+                            "INSERT INTO conversations (session_id, created, record, tenant) VALUES (?, ?, ?, ?)",
+                            (session_id, created, blob, tenant))
+                    elif kind == "replace":
+                        _, session_id, blobs, created = op
+                        connection.execute("DELETE FROM conversations WHERE session_id = ?", (session_id,))
+                        connection.executemany(
+                            "INSERT INTO conversations (session_id, created, record, tenant) VALUES (?, ?, ?, ?)",
+                            [(session_id, created, blob, tenant) for blob, tenant in blobs])
+                    elif kind == "update":
+                        _, session_id, index, fields = op
+                        # 记录按自增ID排列，第 index 条即该会话按ID排序后的偏移位置
+                        row = connection.execute(
+                            "SELECT id, record FROM conversations WHERE session_id = ? ORDER BY id LIMIT 1 OFFSET ?",
+                            (session_id, index)).fetchone()
+                        if row is not None:
+                            record = decode_conversation(row[1])
+                            record.update(fields)
+                            connection.execute("UPDATE conversations SET record = ? WHERE id = ?",
+                                               (encode_conversation(record), row[0]))
+            self.writes += sum(1 for op in batch if op[0] != "flush")
+            self.flushes += 1
+        except sqlite3.Error as e:
+            self.write_errors += 1
+            print(f"DEBUG: 会话状态写入失败: {str(e)}")
+        finally:
+            # 已落盘（或写入失败）的状态不再作为未决状态；之后又有新写入的会话保留最新值
+            with self.pending_lock:
+                for session_id, blob in written_states.items():
+                    if self.pending_states.get(session_id) is blob:
+                        del self.pending_states[session_id]
+            for op in batch:
+                if op[0] == "flush":
+                    op[1].set()
+
+    # ====== 读取 ======
+
+    def load_state(self, session_id):
+        with self.pending_lock:
+            blob = self.pending_states.get(session_id)
+        if blob is None:
+            connection = self._connect()
+            try:
+                row = connection.execute("SELECT state FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            finally:
+                connection.close()
+            if row is None:
+                return None
+            blob = row[0]
+        return decode_state(blob)
+
+    def load_conversations(self, session_id):
+        # 恢复会话时才读取完整记录，先等待本进程未落盘的写入
+        self.flush(timeout=5)
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                "SELECT record FROM conversations WHERE session_id = ? ORDER BY id", (session_id,)).fetchall()
+        finally:
+            connection.close()
+        return [decode_conversation(row[0]) for row in rows]
+
+    def iter_conversations(self, session_id=None, chunk_size=1000, tenant_id=None, default_tenant=None):
+        """
+        按主键分页读取，按块产出 [(会话ID, 创建时间, 对话记录), ...]，内存占用与总记录数无关
+
+        指定 tenant_id 时只读取该租户的记录（按租户列查询）；租户列为NULL的记录属于 default_tenant
+        """
+        conditions = ["id > ?"]
+        params = []
+        if session_id is not None:
+            conditions.append("session_id = ?")
+            params.append(session_id)
+        if tenant_id is not None:
+            conditions.append("(tenant = ? OR tenant IS NULL)" if tenant_id == default_tenant else "tenant = ?")
+            params.append(tenant_id)
+        sql = (f"SELECT id, session_id, created, record FROM conversations WHERE {' AND '.join(conditions)} "
+               f"ORDER BY id LIMIT ?")
+        connection = self._connect()
+        try:
+            last_id = 0
+            while True:
+                rows = connection.execute(sql, [last_id] + params + [chunk_size]).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                yield [(sid, created, decode_conversation(record)) for _, sid, created, record in rows]
+        finally:
+            connection.close()
+
+    # ====== 共享文档（低频写入，直接同步提交）======
+
+    def save_document(self, name, document):
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    "INSERT INTO documents (name, value, updated) VALUES (?, ?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value=excluded.value, updated=excluded.updated",
+                    (name, encode_record(document), time.time()))
+        finally:
+            connection.close()
+
+    def load_document(self, name):
+        connection = self._connect()
+        try:
+            row = connection.execute("SELECT value FROM documents WHERE name = ?", (name,)).fetchone()
+        finally:
+            connection.close()
+        return decode_record(row[0]) if row is not None else None
+
+    def update_document(self, name, update):
+        """
+        原子地读取 -> update(文档或None) -> 写回，返回写入的文档
+
+        BEGIN IMMEDIATE 在读取前就取得写锁，多个实例同时更新同一文档时依次执行，不会丢失其他实例的修改
+        """
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute("SELECT value FROM documents WHERE name = ?", (name,)).fetchone()
+                document = update(decode_record(row[0]) if row is not None else None)
+                connection.execute(
+                    "INSERT INTO documents (name, value, updated) VALUES (?, ?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value=excluded.value, updated=excluded.updated",
+                    (name, encode_record(document), time.time()))
+            except BaseException:
+                connection.rollback()
+                raise
+            connection.commit()
+        finally:
+            connection.close()
+        return document
+
+    # ====== 知识库快照 ======
+
+    def _snapshot_path(self, kb_version):
+        return os.path.join(self.snapshot_dir, f"{kb_version}.json.z")
+
+    def save_kb_snapshot(self, kb_version, document):
+        """快照文档须可JSON序列化；写入临时文件后原子替换，其他实例不会读到写了一半的快照"""
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.snapshot_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(encode_record(document))
+            os.replace(temp_path, self._snapshot_path(kb_version))
+        except Exception:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def pin_kb_snapshots(self, kb_versions):
+        """快照文件不会被淘汰，无需固定"""
+
+    def has_kb_snapshot(self, kb_version):
+        return os.path.exists(self._snapshot_path(kb_version))
+
+    def load_kb_snapshot(self, kb_version):
+        path = self._snapshot_path(kb_version)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return decode_record(f.read())
+
+    def stats(self):
+        connection = self._connect()
+        try:
+            sessions = connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            conversations = connection.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+        finally:
+            connection.close()
+        return {
+            "backend": self.backend,
+            "sessions": sessions,
+            "conversations": conversations,
+            "writes": self.writes,
+            "pending": self.queue.qsize(),
+            "flushes": self.flushes,
+            "write_errors": self.write_errors,
+        }
+
+    def close(self):
+        """写完队列中剩余的数据后停止后台线程"""
+        self.queue.put(("close",))
+        self.writer.join(timeout=10)
+
+
+def create_session_store(backend="memory", path="session_state.db", snapshot_dir=None, **kwargs):
+    """按名称创建会话存储后端：memory 或 sqlite"""
+    if backend == "memory":
+        return InMemorySessionStore()
+    if backend == "sqlite":
+        return SQLiteSessionStore(path, snapshot_dir=snapshot_dir, **kwargs)
+    raise ValueError(f"未知的会话存储后端: {backend}")
@@ -0,0 +1,431 @@
+"""
+知识库匹配结果的共享（二级）缓存：多个应用实例共用同一份匹配结果，实例重启后也不必从冷缓存开始
+
+一级缓存是各进程内的LRU（app 中的命中缓存和未命中缓存），二级缓存放在可替换的共享后端上：
+- SQLiteCacheBackend：同一台机器上的多个实例共用一个SQLite文件
+- SocketCacheBackend：连接 CacheServer，一个简易的TCP键值服务（Redis/Memcached 的本地替身）
+其他后端只需实现 get(key)、set_many([(key, value), ...])、clear() 和 close()，值为字节串。
+
+键为 "命名空间:版本:问题摘要"，版本由调用方给出（知识库内容哈希 + 租户 + 路由规则内容哈希）：
+知识库或规则变化后新键自然不同，各实例不需要互相通知，旧键按TTL和容量淘汰。
+值为紧凑编码的 [回答, 问题类型, 匹配耗时]，回答为None表示已知未命中。
+
+写入放入队列由后台线程批量提交，不阻塞请求；后端出错时读取视为未命中、写入丢弃，
+之后 retry_after 秒内不再访问后端，避免每个请求都等待连接超时。
+
+启动本地缓存服务：
+    python shared_cache.py --port 8901 --max-entries 200000
+然后设置环境变量 SHARED_CACHE_BACKEND=tcp SHARED_CACHE_ADDRESS=127.0.0.1:8901
+"""
+import argparse
+import contextlib
+import hashlib
+import queue
+import socket
+import socketserver
+import sqlite3
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from session_store import decode_record, encode_record
+
+# 协议：请求为 操作(1字节) + 键长度(2字节) + 键 + 值长度(4字节) + 值；
+# 响应为 状态(1字节) + 值长度(4字节) + 值。set 请求的值中可包含多条 键长度+键+值长度+值
+OP_GET, OP_SET, OP_CLEAR = b'G', b'S', b'C'
+STATUS_FOUND, STATUS_MISSING, STATUS_OK = b'F', b'M', b'K'
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise ConnectionError("连接已关闭")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _pack_items(items):
+    parts = []
+    for key, value in items:
+        key_bytes = key.encode('utf-8')
+        parts.append(struct.pack('>H', len(key_bytes)) + key_bytes + struct.pack('>I', len(value)) + value)
+    return b''.join(parts)
+
+
+def _unpack_items(data):
+    items = []
+    position = 0
+    while position < len(data):
+        (key_size,) = struct.unpack_from('>H', data, position)
+        position += 2
+        key = data[position:position + key_size].decode('utf-8')
+        position += key_size
+        (value_size,) = struct.unpack_from('>I', data, position)
+        position += 4
+        items.append((key, data[position:position + value_size]))
+        position += value_size
+    return items
+
+
+class CacheServer(socketserver.ThreadingTCPServer):
+    """
+    进程内存中的LRU键值服务，供多个应用实例共享（测试和单机部署用）
+
+    条目超过 max_entries 时淘汰最久未使用的，超过 ttl 秒的条目读取时视为不存在
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, max_entries=200000, ttl=24 * 3600):
+        self.entries = OrderedDict()  # 键 -> (写入时间, 值)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        super().__init__(address, CacheRequestHandler)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set_many(self, items):
+        now = time.time()
+        with self.lock:
+            for key, value in items:
+                self.entries[key] = (now, value)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class CacheRequestHandler(socketserver.BaseRequestHandler):
+    """一个连接上顺序处理多个请求，直到客户端断开"""
+
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                op = _recv_exact(sock, 1)
+                (key_size,) = struct.unpack('>H', _recv_exact(sock, 2))
+                key = _recv_exact(sock, key_size).decode('utf-8')
+                (value_size,) = struct.unpack('>I', _recv_exact(sock, 4))
+                value = _recv_exact(sock, value_size)
+                if op == OP_GET:
+                    found = self.server.get(key)
+                    if found is None:
+                        sock.sendall(STATUS_MISSING + struct.pack('>I', 0))
+                    else:
+                        sock.sendall(STATUS_FOUND + struct.pack('>I', len(found)) + found)
+                else:
+                    if op == OP_SET:
+                        self.server.set_many(_unpack_items(value))
+                    elif op == OP_CLEAR:
+                        self.server.clear()
+                    sock.sendall(STATUS_OK + struct.pack('>I', 0))
+        except (ConnectionError, OSError, struct.error):
+            return
+
+
+def start_cache_server(port=0, host="127.0.0.1", max_entries=200000, ttl=24 * 3600):
+    """在后台线程中启动缓存服务，返回server对象（server.server_address 为实际地址，调用shutdown()停止）"""
+    server = CacheServer((host, port), max_entries, ttl)
+    threading.Thread(target=server.serve_forever, name="shared-cache-server", daemon=True).start()
+    return server
+
+
+class ConnectionPool:
+    """
+    线程间共享的小连接池
+
+    streamlit 每次重跑都在新线程中执行，按线程保存的连接会随线程越积越多；连接池在所有线程间复用连接：
+    connection() 取出空闲连接（没有时调用 connect 新建），正常用完放回，出现异常时关闭该连接不再放回。
+    空闲连接最多保留 max_idle 个，多余的直接关闭
+    """
+
+    def __init__(self, connect, max_idle=4):
+        self.connect = connect
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = []
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            conn = self.connect()
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+class SocketCacheBackend:
+    """CacheServer 的客户端：长连接放在线程间共享的连接池中，出错时关闭该连接并抛出 OSError，下次请求重新连接"""
+
+    backend = "tcp"
+
+    def __init__(self, address, timeout=0.2, max_idle=4):
+        host, _, port = address.rpartition(":")
+        self.address = (host or "127.0.0.1", int(port))
+        self.timeout = timeout
+        self.pool = ConnectionPool(self._connect, max_idle)
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _request(self, op, key, value=b''):
+        key_bytes = key.encode('utf-8')
+        with self.pool.connection() as sock:
+            sock.sendall(op + struct.pack('>H', len(key_bytes)) + key_bytes + struct.pack('>I', len(value)) + value)
+            status = _recv_exact(sock, 1)
+            (size,) = struct.unpack('>I', _recv_exact(sock, 4))
+            return status, _recv_exact(sock, size)
+
+    def get(self, key):
+        status, value = self._request(OP_GET, key)
+        return value if status == STATUS_FOUND else None
+
+    def set_many(self, items):
+        self._request(OP_SET, "", _pack_items(items))
+
+    def clear(self):
+        self._request(OP_CLEAR, "")
+
+    def close(self):
+        self.pool.close()
+
+
+class SQLiteCacheBackend:
+    """
+    基于SQLite文件的共享缓存（WAL模式）
+
+    连接放在线程间共享的连接池中；每写入 prune_every 批后删除过期条目，条目数超过 max_entries 时删除最早写入的
+    """
+
+    backend = "sqlite"
+
+    def __init__(self, path, max_entries=200000, ttl=24 * 3600, prune_every=64, max_idle=4):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self.batches = 0
+        self.pool = ConnectionPool(self._connect, max_idle)
+        with self.pool.connection() as connection, connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS match_cache "
+                               "(key TEXT PRIMARY KEY, value BLOB NOT NULL, updated REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS idx_match_cache_updated ON match_cache (updated)")
+
+    def _connect(self):
+        # 连接会被不同线程先后使用（同一时刻只有一个线程持有）
+        connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def get(self, key):
+        try:
+            with self.pool.connection() as connection:
+                row = connection.execute("SELECT value, updated FROM match_cache WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            raise OSError(str(e))
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return row[0]
+
+    def set_many(self, items):
+        now = time.time()
+        try:
+            with self.pool.connection() as connection, connection:
+                connection.executemany(
+                    "INSERT INTO match_cache (key, value, updated) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated=excluded.updated",
+                    [(key, value, now) for key, value in items])
+                self.batches += 1
+                if self.batches % self.prune_every == 0:
+                    connection.execute("DELETE FROM match_cache WHERE updated < ?", (now - self.ttl,))
+                    connection.execute(
+                        "DELETE FROM match_cache WHERE key IN (SELECT key FROM match_cache ORDER BY updated DESC "
+                        "LIMIT -1 OFFSET ?)", (self.max_entries,))
+        except sqlite3.Error as e:
+            raise OSError(str(e))
+
+    def clear(self):
+        with self.pool.connection() as connection, connection:
+            connection.execute("DELETE FROM match_cache")
+
+    def close(self):
+        self.pool.close()
+
+
+def create_cache_backend(backend, address=None, path="shared_cache.db", **kwargs):
+    """按名称创建共享缓存后端：tcp（address 为 主机:端口）或 sqlite；none 返回None"""
+    if backend in (None, "", "none"):
+        return None
+    if backend == "tcp":
+        return SocketCacheBackend(address, **kwargs)
+    if backend == "sqlite":
+        return SQLiteCacheBackend(path, **kwargs)
+    raise ValueError(f"未知的共享缓存后端: {backend}")
+
+
+class SharedMatchCache:
+    """
+    二级匹配结果缓存
+
+    get 同步读取后端，返回 (回答, 类型, 匹配耗时)，回答为None表示已知未命中，不在缓存中时返回None。
+    命中时按 写入时记录的匹配耗时 - 本次读取耗时 累计节省的时间。
+    put 只放入队列，后台线程每 flush_interval 秒或积累 batch_size 条后批量写入；队列满时丢弃。
+    """
+
+    def __init__(self, backend, namespace="kb-match", flush_interval=0.05, batch_size=256, max_pending=10000,
+                 retry_after=5.0):
+        self.backend = backend
+        self.namespace = namespace
+        self.retry_after = retry_after
+        self.down_until = 0.0
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue(max_pending)
+        self.lock = threading.Lock()
+        self.state = {"lookups": 0, "hits": 0, "negative_hits": 0, "errors": 0, "writes": 0, "dropped": 0, "skipped": 0,
+                      "lookup_seconds": 0.0, "saved_seconds": 0.0, "last_error": None}
+        self.writer = threading.Thread(target=self._write_loop, name="shared-cache-writer", daemon=True)
+        self.writer.start()
+
+    def key(self, version, query):
+        digest = hashlib.blake2b(query.encode('utf-8'), digest_size=12).hexdigest()
+        return f"{self.namespace}:{version}:{digest}"
+
+    def _error(self, e):
+        self.down_until = time.monotonic() + self.retry_after
+        with self.lock:
+            self.state["errors"] += 1
+            self.state["last_error"] = str(e)[:200]
+        print(f"DEBUG: 共享缓存不可用，{self.retry_after:g}秒内跳过: {e}")
+
+    def available(self):
+        return time.monotonic() >= self.down_until
+
+    def get(self, version, query):
+        if not self.available():
+            with self.lock:
+                self.state["skipped"] += 1
+            return None
+        start = time.perf_counter()
+        try:
+            blob = self.backend.get(self.key(version, query))
+        except OSError as e:
+            blob = None
+            self._error(e)
+        elapsed = time.perf_counter() - start
+        entry = decode_record(blob) if blob is not None else None
+        with self.lock:
+            self.state["lookups"] += 1
+            self.state["lookup_seconds"] += elapsed
+            if entry is not None:
+                self.state["hits"] += 1
+                self.state["negative_hits"] += entry[0] is None
+                self.state["saved_seconds"] += max(0.0, entry[2] - elapsed)
+        return tuple(entry) if entry is not None else None
+
+    def put(self, version, query, result, cost):
+        if not self.available():
+            with self.lock:
+                self.state["dropped"] += 1
+            return
+        reply, question_type = result if result is not None else (None, None)
+        blob = encode_record([reply, question_type, round(cost, 6)])
+        try:
+            self.queue.put_nowait((self.key(version, query), blob))
+        except queue.Full:
+            with self.lock:
+                self.state["dropped"] += 1
+
+    def flush(self, timeout=None):
+        """等待此前放入队列的写入提交完毕，超时返回False"""
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def _write_loop(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and not isinstance(batch[-1], threading.Event):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            items = list(OrderedDict(item for item in batch if not isinstance(item, threading.Event)).items())
+            if items:
+                try:
+                    self.backend.set_many(items)
+                    with self.lock:
+                        self.state["writes"] += len(items)
+                except OSError as e:
+                    self._error(e)
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def stats(self):
+        with self.lock:
+            state = dict(self.state)
+        state.update(backend=self.backend.backend, pending=self.queue.qsize(),
+                     hit_rate=state["hits"] / state["lookups"] if state["lookups"] else 0.0,
+                     avg_lookup_ms=state["lookup_seconds"] / state["lookups"] * 1000 if state["lookups"] else 0.0)
+        return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地共享缓存服务（匹配结果二级缓存的替身）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--max-entries", type=int, default=200000)
+    parser.add_argument("--ttl", type=float, default=24 * 3600, help="条目有效期（秒）")
+    args = parser.parse_args()
+    server = CacheServer((args.host, args.port), args.max_entries, args.ttl)
+    print(f"共享缓存服务: {args.host}:{args.port}，最多 {args.max_entries} 条")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
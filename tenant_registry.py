@@ -0,0 +1,231 @@
+"""
+多租户知识库注册表：每个租户（店铺/产品线）有自己的知识库版本、规则库和查询索引
+
+租户 -> 知识库版本的对应关系保存在会话存储的共享文档中，多个实例共用，任一实例上传后其他实例按版本加载。
+已加载（常驻）的租户按最近使用顺序排列，常驻内存超过预算时卸载最久未使用的租户，下次访问时再从知识库快照重新加载。
+占用超过预算一定比例的大租户优先卸载，单个大租户不会长期挤占其他租户的内存；正在访问的租户即使超出预算也保持加载。
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+
+DEFAULT_DOCUMENT = "tenants"
+
+
+def _percentile(values, ratio):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(ratio * len(values)))]
+
+
+class TenantRegistry:
+    """
+    线程安全的租户注册表
+
+    loader(租户, 知识库版本) -> (常驻对象, 字节数)，快照不存在时返回 None
+    can_reload(知识库版本) -> 是否能从快照恢复；不能恢复的租户不会被卸载
+    租户正在使用的知识库版本通过 store.pin_kb_snapshots 固定，卸载后快照不会再被淘汰
+    on_unload(租户, 知识库版本, 是否仍有其他常驻租户使用该版本)：卸载后释放该版本的共享索引
+    """
+
+    def __init__(self, store, loader, can_reload=None, on_unload=None, memory_budget=1024 * 1024 * 1024,
+                 max_share=0.5, document=DEFAULT_DOCUMENT, refresh_interval=5.0, latency_window=500):
+        self.store = store
+        self.loader = loader
+        self.can_reload = can_reload or (lambda kb_version: True)
+        self.on_unload = on_unload
+        self.memory_budget = memory_budget
+        self.max_share = max_share
+        self.document = document
+        self.refresh_interval = refresh_interval
+        self.latency_window = latency_window
+        self.lock = threading.Lock()
+        self.assignments = {}  # 租户 -> 知识库版本
+        self.resident = OrderedDict()  # 租户 -> {"kb_version", "value", "bytes"}，按最近使用排序
+        self.load_locks = {}  # 租户 -> 加载锁，同一租户只加载一次
+        self.metrics = {}
+        self.last_refresh = 0.0
+        self._refresh(force=True)
+
+    def _tenant_metrics(self, tenant_id):
+        """调用方持有锁"""
+        metrics = self.metrics.get(tenant_id)
+        if metrics is None:
+            metrics = self.metrics[tenant_id] = {
+                "requests": 0, "latencies": deque(maxlen=self.latency_window),
+                "kb_latencies": deque(maxlen=self.latency_window), "loads": 0, "load_seconds": 0.0,
+                "evictions": 0, "last_used": None}
+        return metrics
+
+    def _refresh(self, force=False):
+        """其他实例更新了租户知识库时重新读取对应关系"""
+        if self.store is None:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_refresh < self.refresh_interval:
+            return
+        self.last_refresh = now
+        document = self.store.load_document(self.document) or {"tenants": {}}
+        with self.lock:
+            self.assignments = {tenant_id: item["kb_version"] for tenant_id, item in document["tenants"].items()}
+            versions = set(self.assignments.values())
+        self.store.pin_kb_snapshots(versions)
+
+    def kb_version(self, tenant_id):
+        """租户当前的知识库版本，尚未上传过知识库时返回None"""
+        self._refresh()
+        with self.lock:
+            return self.assignments.get(tenant_id)
+
+    def tenants_using(self, kb_version):
+        """使用某个知识库版本的租户列表"""
+        with self.lock:
+            return [tenant_id for tenant_id, version in self.assignments.items() if version == kb_version]
+
+    def assign(self, tenant_id, kb_version, value, nbytes):
+        """登记租户的新知识库（已加载），写入共享文档并按预算卸载其他租户"""
+        with self.lock:
+            self.assignments[tenant_id] = kb_version
+            replaced = self._put(tenant_id, kb_version, value, nbytes)
+            self._tenant_metrics(tenant_id)["last_used"] = time.time()
+        self._release(tenant_id, replaced)
+        if self.store is not None:
+            def update(document):
+                document = document or {"tenants": {}}
+                document["tenants"][tenant_id] = {"kb_version": kb_version, "updated": time.time()}
+                return document
+
+            # 读取 -> 修改 -> 写回由存储原子执行，同时上传的租户（其他线程或实例）不会互相覆盖
+            document = self.store.update_document(self.document, update)
+            with self.lock:
+                self.assignments = {tenant: item["kb_version"] for tenant, item in document["tenants"].items()}
+                versions = set(self.assignments.values())
+            self.store.pin_kb_snapshots(versions)
+        self._enforce_budget(tenant_id)
+
+    def acquire(self, tenant_id):
+        """返回租户的常驻对象，未加载或版本已变化时从快照加载；租户没有知识库或快照缺失时返回None"""
+        kb_version = self.kb_version(tenant_id)
+        if kb_version is None:
+            return None
+        with self.lock:
+            entry = self.resident.get(tenant_id)
+            if entry is not None and entry["kb_version"] == kb_version:
+                self.resident.move_to_end(tenant_id)
+                self._tenant_metrics(tenant_id)["last_used"] = time.time()
+                return entry["value"]
+            load_lock = self.load_locks.setdefault(tenant_id, threading.Lock())
+        with load_lock:
+            with self.lock:
+                entry = self.resident.get(tenant_id)
+                if entry is not None and entry["kb_version"] == kb_version:
+                    return entry["value"]
+            # 加载在注册表锁外进行，大租户加载时不阻塞其他租户的请求
+            start = time.perf_counter()
+            loaded = self.loader(tenant_id, kb_version)
+            if loaded is None:
+                return None
+            value, nbytes = loaded
+            with self.lock:
+                replaced = self._put(tenant_id, kb_version, value, nbytes)
+                metrics = self._tenant_metrics(tenant_id)
+                metrics["loads"] += 1
+                metrics["load_seconds"] += time.perf_counter() - start
+                metrics["last_used"] = time.time()
+        self._release(tenant_id, replaced)
+        self._enforce_budget(tenant_id)
+        return value
+
+    def _put(self, tenant_id, kb_version, value, nbytes):
+        """放入常驻列表，返回被替换的旧版本条目（调用方持有锁）"""
+        previous = self.resident.get(tenant_id)
+        self.resident[tenant_id] = {"kb_version": kb_version, "value": value, "bytes": nbytes}
+        self.resident.move_to_end(tenant_id)
+        if previous is not None and previous["kb_version"] != kb_version:
+            return previous
+        return None
+
+    def _release(self, tenant_id, entry):
+        """租户换用新知识库后，释放旧版本的共享索引"""
+        if entry is None or self.on_unload is None:
+            return
+        with self.lock:
+            still_used = any(other["kb_version"] == entry["kb_version"] for other in self.resident.values())
+        self.on_unload(tenant_id, entry["kb_version"], still_used)
+
+    def _enforce_budget(self, protect=None):
+        """常驻内存超过预算时卸载租户：先卸载超出份额的大租户，再按最久未使用的顺序卸载"""
+        unloaded = []
+        with self.lock:
+            while sum(entry["bytes"] for entry in self.resident.values()) > self.memory_budget:
+                candidates = [tenant_id for tenant_id, entry in self.resident.items()
+                              if tenant_id != protect and self.can_reload(entry["kb_version"])]
+                if not candidates:
+                    break
+                oversized = [tenant_id for tenant_id in candidates
+                             if self.resident[tenant_id]["bytes"] > self.max_share * self.memory_budget]
+                victim = (oversized or candidates)[0]
+                unloaded.append((victim, self.resident.pop(victim)))
+                self._tenant_metrics(victim)["evictions"] += 1
+            still_used = {entry["kb_version"] for entry in self.resident.values()}
+        for tenant_id, entry in unloaded:
+            print(f"DEBUG: 卸载租户 {tenant_id} 的知识库 {entry['kb_version']}，释放 {entry['bytes'] / 1024 / 1024:.1f}MB")
+            if self.on_unload is not None:
+                self.on_unload(tenant_id, entry["kb_version"], entry["kb_version"] in still_used)
+        return len(unloaded)
+
+    def unload(self, tenant_id):
+        """手动卸载租户（快照不可用时不卸载），返回是否卸载"""
+        with self.lock:
+            entry = self.resident.get(tenant_id)
+            if entry is None or not self.can_reload(entry["kb_version"]):
+                return False
+            del self.resident[tenant_id]
+            self._tenant_metrics(tenant_id)["evictions"] += 1
+            still_used = any(other["kb_version"] == entry["kb_version"] for other in self.resident.values())
+        if self.on_unload is not None:
+            self.on_unload(tenant_id, entry["kb_version"], still_used)
+        return True
+
+    def record_request(self, tenant_id, seconds, kb_seconds=None):
+        """记录一次请求的总耗时和知识库阶段耗时"""
+        with self.lock:
+            metrics = self._tenant_metrics(tenant_id)
+            metrics["requests"] += 1
+            metrics["latencies"].append(seconds)
+            if kb_seconds is not None:
+                metrics["kb_latencies"].append(kb_seconds)
+            metrics["last_used"] = time.time()
+
+    def stats(self):
+        """整体内存占用和每个租户的指标，用于界面展示"""
+        with self.lock:
+            tenants = sorted(set(self.assignments) | set(self.metrics))
+            rows = []
+            for tenant_id in tenants:
+                entry = self.resident.get(tenant_id)
+                metrics = self._tenant_metrics(tenant_id)
+                latencies = list(metrics["latencies"])
+                kb_latencies = list(metrics["kb_latencies"])
+                rows.append({
+                    "tenant": tenant_id,
+                    "kb_version": self.assignments.get(tenant_id),
+                    "resident": entry is not None,
+                    "memory_mb": entry["bytes"] / 1024 / 1024 if entry else 0.0,
+                    "oversized": bool(entry) and entry["bytes"] > self.max_share * self.memory_budget,
+                    "requests": metrics["requests"],
+                    "p50_ms": _percentile(latencies, 0.5) * 1000,
+                    "p95_ms": _percentile(latencies, 0.95) * 1000,
+                    "kb_p95_ms": _percentile(kb_latencies, 0.95) * 1000,
+                    "loads": metrics["loads"],
+                    "avg_load_seconds": metrics["load_seconds"] / metrics["loads"] if metrics["loads"] else 0.0,
+                    "evictions": metrics["evictions"],
+                    "last_used": metrics["last_used"],
+                })
+            return {
+                "tenants": rows,
+                "resident": len(self.resident),
+                "resident_bytes": sum(entry["bytes"] for entry in self.resident.values()),
+                "memory_budget": self.memory_budget,
+            }
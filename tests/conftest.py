@@ -0,0 +1,33 @@
+"""测试公共夹具：以 streamlit 裸模式导入 app，并提供一个小知识库"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+KB_ROWS = [
+    ("M0601C电机带减速器吗?", "电机技术咨询", "M0601C电机不带减速器，如需减速器请选购M0601C-R版本。"),
+    ("M0603C电机支持CAN通信吗?", "电机技术咨询", "支持，M0603C支持CAN通信，默认波特率1Mbps。"),
+    ("电机可以用24V电压吗?", "电机技术咨询", "可以，电机额定电压24V，电压范围18-30V。"),
+    ("有代码例程和上位机吗?", "电机技术咨询", "有的，我们提供STM32例程代码和上位机软件，可在官网下载。"),
+    ("产品包装里有哪些配件?", "售前咨询", "包装内含电机本体、连接线和合格证。"),
+    ("支持哪些付款方式?", "售前咨询", "支持支付宝、微信和对公转账。"),
+]
+
+
+@pytest.fixture(scope="session")
+def app():
+    os.environ.pop("DASHSCOPE_API_KEY", None)
+    from replay import load_app
+    return load_app()
+
+
+@pytest.fixture(scope="session")
+def knowledge_df(app, tmp_path_factory):
+    path = tmp_path_factory.mktemp("kb") / "kb.csv"
+    lines = ["问题,问题类型,标准回答"] + [",".join(row) for row in KB_ROWS]
+    path.write_text("\n".join(lines), encoding="utf-8")
+    return app.parse_knowledge_base(str(path))
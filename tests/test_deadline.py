@@ -0,0 +1,116 @@
+"""请求截止时间：慢阶段触发超时、降级回复和各阶段命中计数"""
+import time
+
+import pytest
+
+
+@pytest.fixture
+def deadline_stats(app):
+    stats = app.get_deadline_stats()
+    with stats["lock"]:
+        stats["hits"].clear()
+    return stats
+
+
+def test_deadline_expires_and_counts_each_stage_once(app, deadline_stats):
+    deadline = app.Deadline(0.05, deadline_stats)
+    assert deadline.allows(0.01)
+    time.sleep(0.06)
+    assert deadline.expired()
+    assert not deadline.allows(0.01)
+    deadline.hit("fuzzy")
+    deadline.hit("fuzzy")
+    assert deadline.hits == ["fuzzy"]
+    assert deadline_stats["hits"]["fuzzy"] == 1
+
+
+def test_reserve_shares_hits_with_parent(app, deadline_stats):
+    deadline = app.Deadline(10, deadline_stats)
+    child = deadline.reserve(9.99)
+    time.sleep(0.02)
+    assert child.expired() and not deadline.expired()
+    child.hit("compound")
+    assert deadline.hits == ["compound"]
+
+
+def test_slow_fuzzy_stage_returns_partial_result(app, knowledge_df, deadline_stats, monkeypatch):
+    extract_one = app.process.extractOne
+
+    def slow_extract_one(*args, **kwargs):
+        time.sleep(0.05)
+        return extract_one(*args, **kwargs)
+
+    monkeypatch.setitem(app.DEADLINE_CONFIG, "fuzzy_chunk_rows", 2)
+    monkeypatch.setattr(app.process, "extractOne", slow_extract_one)
+    deadline = app.Deadline(0.08, deadline_stats)
+    result = app.fuzzy_extract_one("M0601C电机带减速器", knowledge_df, deadline=deadline)
+    # 只扫描了前两块就超时，返回已扫描部分中的最佳候选
+    assert result is not None and result[2] < 4
+    assert deadline.expired()
+    assert deadline.hits == ["fuzzy"]
+    assert deadline_stats["hits"]["fuzzy"] == 1
+
+
+def test_fuzzy_shards_stop_waiting_at_deadline(app, knowledge_df, deadline_stats, monkeypatch):
+    monkeypatch.setitem(app.FUZZY_SHARD_CONFIG, "enabled", True)
+    monkeypatch.setitem(app.FUZZY_SHARD_CONFIG, "num_shards", 2)
+    monkeypatch.setitem(app.FUZZY_SHARD_CONFIG, "min_kb_size", 0)
+    monkeypatch.setitem(app.FUZZY_PREFILTER_CONFIG, "enabled", False)
+    registry = app.get_fuzzy_shard_registry()
+    try:
+        # 工作进程首次使用时才启动，启动耗时远超截止时间
+        deadline = app.Deadline(0.01, deadline_stats)
+        start = time.perf_counter()
+        result = app.fuzzy_extract_one("M0601C电机带减速器", knowledge_df, deadline=deadline)
+        assert time.perf_counter() - start < 0.5
+        assert result is None
+        assert deadline.hits == ["fuzzy"]
+
+        # 不限时间时等待所有分片，结果与单线程打分一致
+        result = app.fuzzy_extract_one("M0601C电机带减速器", knowledge_df, deadline=app.Deadline.unlimited())
+        assert result is not None and result[2] == 0
+    finally:
+        with registry["lock"]:
+            service = registry["services"].pop(app.get_kb_version(knowledge_df), None)
+        if service is not None:
+            service.shutdown()
+
+
+def test_slow_kb_lookup_skips_typo_stage(app, knowledge_df, deadline_stats, monkeypatch):
+    def slow_find(user_query, knowledge_df, deadline=None, tenant_id=None):
+        time.sleep(0.05)
+        return None, None
+
+    monkeypatch.setattr(app, "find_in_knowledge_base", slow_find)
+    deadline = app.Deadline(0.03, deadline_stats)
+    result = app.rule_engine("电机带减速气吗", knowledge_df, deadline)
+    assert result["status"] != "success"
+    assert "typo" in deadline.hits
+    assert deadline_stats["hits"]["typo"] == 1
+
+
+def no_llm(user_query, branch, prompt):
+    raise AssertionError("截止时间不足时不应调用模型")
+
+
+def test_deadline_before_llm_returns_relaxed_knowledge_answer(app, knowledge_df, deadline_stats, monkeypatch):
+    monkeypatch.setattr(app, "LLM_RESPONDER", no_llm)
+    deadline = app.Deadline(app.DEADLINE_CONFIG["min_llm_seconds"] / 2, deadline_stats)
+    result = app.ai_enhancement_with_knowledge("包装有哪些配件", [], knowledge_df, api_key="test",
+                                               usage_context={"intent": "未识别"}, deadline=deadline)
+    assert result["degraded"] == "deadline"
+    assert result["source"] == app.DEGRADED_SOURCES["deadline"]
+    assert result["reply"] == "包装内含电机本体、连接线和合格证。"
+    assert deadline_stats["hits"]["llm"] == 1
+
+
+def test_deadline_before_llm_suggests_related_questions(app, knowledge_df, deadline_stats, monkeypatch):
+    monkeypatch.setattr(app, "LLM_RESPONDER", no_llm)
+    deadline = app.Deadline(app.DEADLINE_CONFIG["min_llm_seconds"] / 2, deadline_stats)
+    result = app.ai_enhancement_with_knowledge("付款方式有哪几种", [], knowledge_df, api_key="test",
+                                               usage_context={"intent": "未识别"}, deadline=deadline)
+    assert result["degraded"] == "deadline"
+    assert result["source"] == "知识库（相关问题）"
+    assert result["reply"].startswith(app.DEADLINE_EXCEEDED_REPLY)
+    assert "支持哪些付款方式?" in result["reply"]
+    assert deadline_stats["hits"]["llm"] == 1
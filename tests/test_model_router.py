@@ -0,0 +1,52 @@
+"""多模型路由：用两个不同延迟的本地模拟模型验证超时切换和按EWMA重新排序"""
+import pytest
+
+from fake_llm_server import start_server
+
+
+@pytest.fixture
+def endpoints():
+    # qwen-turbo 响应慢于其超时时间，qwen-plus 很快返回
+    servers = {"qwen-turbo": start_server("qwen-turbo", 0, 1.0), "qwen-plus": start_server("qwen-plus", 0, 0.05)}
+    yield {name: f"http://127.0.0.1:{server.server_address[1]}" for name, server in servers.items()}
+    for server in servers.values():
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def router(app, endpoints):
+    config = app.load_model_router_config()
+    config["models"] = {
+        "qwen-turbo": {"endpoint": endpoints["qwen-turbo"], "timeout": 0.3, "expected_latency": 0.2},
+        "qwen-plus": {"endpoint": endpoints["qwen-plus"], "timeout": 2, "expected_latency": 0.5},
+    }
+    config["branches"] = {"通用问题": ["qwen-turbo", "qwen-plus"]}
+    router = app.ModelRouter(config)
+    yield router
+    router.executor.shutdown(wait=False)
+
+
+def test_timeout_fails_over_to_next_tier(router):
+    assert router.rank("通用问题", "电机支持CAN吗", api_key=None) == ["qwen-turbo", "qwen-plus"]
+    result = router.call("通用问题", "电机支持CAN吗", api_key=None)
+    assert result["ok"]
+    assert result["model"] == "qwen-plus"
+    assert result["attempts"] == ["qwen-turbo", "qwen-plus"]
+    assert result["text"].startswith("[qwen-plus]")
+    stats = router.snapshot()
+    assert stats["qwen-turbo"]["timeouts"] == 1 and stats["qwen-turbo"]["failures"] == 1
+    assert stats["qwen-plus"]["calls"] == 1 and stats["qwen-plus"]["failures"] == 0
+
+
+def test_ewma_reranks_after_timeout(router):
+    router.call("通用问题", "电机支持CAN吗", api_key=None)
+    stats = router.snapshot()
+    assert stats["qwen-turbo"]["error_ewma"] > 0
+    assert stats["qwen-plus"]["latency_ewma"] < 0.5
+
+    # 超时推高了 qwen-turbo 的错误率，偏好靠后的 qwen-plus 排到前面，下一次直接调用它
+    assert router.rank("通用问题", "电机支持CAN吗", api_key=None) == ["qwen-plus", "qwen-turbo"]
+    result = router.call("通用问题", "电机支持CAN吗", api_key=None)
+    assert result["ok"] and result["attempts"] == ["qwen-plus"]
+    assert router.snapshot()["qwen-turbo"]["calls"] == 1
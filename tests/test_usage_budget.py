@@ -0,0 +1,33 @@
+"""用量预算：预算耗尽的会话只命中AI回复缓存，不再调用模型"""
+
+
+def test_exhausted_session_uses_cached_reply_then_degrades(app, knowledge_df, monkeypatch):
+    ledger = app.get_usage_ledger()
+    monkeypatch.setattr(ledger, "session_daily_tokens", 10)
+    ledger.record("qwen-turbo", 80, 40, 0.5, session_id="budget-test")
+    assert ledger.check_budget("budget-test") == "session"
+
+    def no_llm(*args, **kwargs):
+        raise AssertionError("预算耗尽后不应调用模型")
+
+    monkeypatch.setattr(app.ModelRouter, "call", no_llm)
+    usage_context = {"intent": "未识别", "session_id": "budget-test", "kind": "query"}
+    query = "电机能在零下四十度工作吗"
+    prompt_info = app.build_prompt(query, [], knowledge_df)
+    key = app.ResponseCache.key(app.get_kb_version(knowledge_df), app.TENANT_CONFIG["default"], prompt_info["branch"],
+                                prompt_info["prompt"])
+    cache = app.get_response_cache()
+    cache.put(key, {"text": "可以在零下二十度以上工作。", "model": "qwen-turbo", "ok": True,
+                    "input_tokens": 80, "output_tokens": 40, "latency": 0.5})
+    tokens_before = ledger.session_usage("budget-test")
+
+    # 缓存回复不消耗token，预算耗尽的会话仍然返回它
+    result = app.ai_enhancement_with_knowledge(query, [], knowledge_df, api_key="test", usage_context=usage_context)
+    assert result.get("cached") and result["reply"] == "可以在零下二十度以上工作。"
+    assert ledger.session_usage("budget-test") == tokens_before
+
+    # 未命中缓存时降级，不调用模型
+    with cache.lock:
+        cache.entries.clear()
+    result = app.ai_enhancement_with_knowledge(query, [], knowledge_df, api_key="test", usage_context=usage_context)
+    assert result["degraded"] == "session"
@@ -0,0 +1,82 @@
+"""
+线上流量录制：把每次 process_query 的脱敏问题、路由结果、各阶段耗时和AI原始响应写入压缩JSONL
+
+文件按日期切分（路径模板中的 strftime 占位符），每批记录写成一个独立的gzip成员追加到文件末尾，
+进程异常退出时最多丢失最后一批，已写入的部分始终可以完整读取。replay.py 读取这些文件重放流量。
+"""
+import gzip
+import json
+import os
+import threading
+import time
+
+DEFAULT_PATH_PATTERN = "traffic/traffic-%Y%m%d.jsonl.gz"
+
+
+class TrafficRecorder:
+    """
+    线程安全的流量录制器
+
+    record() 只把记录放入内存缓冲区，累计 batch_size 条或距上次写入超过 flush_interval 秒时写入文件；
+    设置 sink 后记录直接交给 sink(entry) 而不写文件（重放时用于收集新结果）
+    """
+
+    def __init__(self, path_pattern=DEFAULT_PATH_PATTERN, batch_size=100, flush_interval=5.0, enabled=False,
+                 sink=None):
+        self.path_pattern = path_pattern
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.recorded = 0
+        self.files = set()
+
+    def record(self, entry):
+        """录制一条记录（调用方负责脱敏）"""
+        if self.sink is not None:
+            self.sink(entry)
+            return
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+        with self.lock:
+            self.buffer.append(line)
+            self.recorded += 1
+            due = len(self.buffer) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """把缓冲区写成一个gzip成员追加到当天的文件"""
+        with self.lock:
+            lines, self.buffer = self.buffer, []
+            self.last_flush = time.monotonic()
+            if not lines:
+                return
+            path = time.strftime(self.path_pattern)
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(path, "ab") as f:
+                f.write(gzip.compress(("\n".join(lines) + "\n").encode('utf-8'), compresslevel=6))
+            self.files.add(path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "recorded": self.recorded,
+                "buffered": len(self.buffer),
+                "files": sorted(self.files),
+            }
+
+
+def iter_traffic(paths):
+    """依次读取录制文件中的记录"""
+    for path in paths:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
@@ -0,0 +1,275 @@
+"""
+拼音/错别字纠错索引：把问题中的同音错字（发漂 -> 发票）、直接输入的拼音（fapiao -> 发票）
+和个别错字（退贷 -> 退货）纠正为知识库和路由规则中的词条
+
+词条来自知识库问题中的高频2~4字片段和路由规则的关键词，按出现次数加权。每个词条建立三种键：
+- 拼音（不带声调）-> 词条：同音错字按拼音精确查找
+- 拼音的对称删除索引：输入拼音有个别字母错误时按编辑距离查找
+- 汉字的对称删除索引：个别错字按编辑距离（只允许替换）查找
+对称删除索引只保存每个键删除若干字符后的变体，查找时同样生成变体求交，再用编辑距离校验，
+查找耗时与词条数量无关。
+
+拼音优先使用 pypinyin（可选依赖，支持全部汉字和多音字词语）；未安装时使用内置的客服常用字表，
+表外的字没有拼音，只参与汉字错字纠正。
+"""
+import re
+from collections import Counter
+
+from rapidfuzz.distance import Levenshtein
+
+try:
+    from pypinyin import lazy_pinyin  # 可选依赖：完整的汉字拼音
+except ImportError:
+    lazy_pinyin = None
+
+# 未安装 pypinyin 时使用的常用字拼音表（拼音 -> 汉字），多音字取客服场景中的常见读音
+BUILTIN_PINYIN = {
+    "a": "啊阿", "ai": "爱哎挨矮碍", "an": "安按案暗岸", "ao": "奥澳",
+    "ba": "八把吧巴拔爸罢", "bai": "白百拜败摆", "ban": "办半板版般班搬伴", "bang": "帮棒邦绑",
+    "bao": "保报包宝抱饱爆", "bei": "被北备背倍杯贝", "ben": "本奔笨", "beng": "泵崩",
+    "bi": "比必笔币闭毕壁避", "bian": "边变编遍", "biao": "表标", "bie": "别", "bin": "宾",
+    "bing": "并病冰兵", "bo": "波播博拨", "bu": "不部步布补",
+    "cai": "才材采彩菜财", "can": "参残餐", "cang": "仓", "cao": "操草", "ce": "测策册侧", "ceng": "层",
+    "cha": "查差插茶", "chai": "拆", "chan": "产", "chang": "长常场厂", "chao": "超", "che": "车",
+    "chen": "陈沉", "cheng": "成程承城称乘", "chi": "持尺迟吃池", "chong": "充冲", "chu": "出处除初",
+    "chuan": "传船", "chuang": "窗", "chun": "春", "ci": "次此词", "cong": "从", "cun": "寸存村",
+    "cuo": "错",
+    "da": "大打达答", "dai": "带代待贷袋", "dan": "单但担蛋", "dang": "当档", "dao": "到道导",
+    "de": "的得", "deng": "等灯", "di": "地低第底递", "dian": "电点店", "diao": "掉", "ding": "定订",
+    "dong": "动东懂", "dou": "都", "du": "度读", "duan": "端短断段", "dui": "对", "duo": "多",
+    "e": "额", "er": "二而",
+    "fa": "发法罚", "fan": "范反返", "fang": "方放", "fei": "费非飞废", "fen": "分份",
+    "feng": "丰风封", "fu": "服付负复副附",
+    "gai": "改该", "gan": "感干", "gang": "钢刚", "gao": "高告", "ge": "个格", "gei": "给",
+    "gen": "根跟", "geng": "更", "gong": "公工供功共", "gou": "购够", "gu": "固故", "gua": "挂",
+    "guan": "关管观", "guang": "光", "gui": "规贵", "guo": "过国",
+    "hai": "还", "han": "含", "hao": "好号", "he": "和合", "hei": "黑", "hen": "很", "hong": "红",
+    "hou": "后候厚", "hu": "户", "hua": "话化", "huai": "坏", "huan": "换环", "huang": "黄",
+    "hui": "回会灰惠", "huo": "货获或火",
+    "ji": "机几积级计记寄及", "jia": "价加家假", "jian": "件间减检见", "jiang": "降", "jiao": "交",
+    "jie": "接结", "jin": "金进斤", "jing": "警径", "jiu": "久就", "ju": "据矩",
+    "kai": "开", "kan": "看", "ke": "客可克", "kou": "扣", "ku": "苦", "kuai": "快", "kuan": "宽款",
+    "la": "拉", "lai": "来", "lan": "蓝", "le": "了", "li": "例力", "liang": "亮量两", "liao": "料",
+    "liu": "流留六", "lv": "率绿铝",
+    "ma": "吗码", "mai": "买卖", "me": "么", "mei": "没", "men": "们", "mian": "免", "ming": "明",
+    "nan": "难", "neng": "能", "ni": "你", "nin": "您", "niu": "扭",
+    "pei": "配", "pian": "便", "piao": "票漂飘", "pin": "品", "ping": "评", "pu": "普",
+    "qi": "期其起器", "qian": "钱前", "qie": "且", "qing": "请轻", "qu": "取驱",
+    "ren": "人", "ru": "如",
+    "san": "三", "se": "色", "sha": "啥", "shang": "上", "shao": "少", "she": "设", "shen": "什申",
+    "sheng": "省", "shi": "是时示", "shou": "售收手受", "shu": "输属数束", "shui": "税", "shun": "顺",
+    "shuo": "说", "si": "司", "song": "送", "su": "塑速诉", "suan": "算",
+    "ta": "他", "tai": "态太抬", "te": "特", "ti": "体题", "tian": "天", "tiao": "条", "tie": "铁",
+    "ting": "停", "tong": "通同", "tou": "头", "tui": "退推",
+    "wai": "外", "wan": "晚完", "wei": "位维为围", "wen": "问", "wu": "务无物午误",
+    "xi": "系", "xia": "下", "xian": "显线", "xiang": "想", "xiao": "小", "xie": "谢协", "xin": "信辛",
+    "xing": "形型", "xiu": "修锈休", "xu": "需序",
+    "ya": "压", "yan": "颜", "yang": "样", "yao": "要", "ye": "也", "yi": "以一议宜", "yin": "银",
+    "yong": "用", "you": "有优", "yu": "于", "yuan": "源", "yun": "运",
+    "zai": "在再载", "zao": "早", "zen": "怎", "zeng": "增", "zhang": "障", "zhe": "折", "zheng": "政",
+    "zhi": "值支指质直置", "zhong": "重", "zhuan": "专转", "zhuang": "装状", "zi": "子",
+}
+BUILTIN_PINYIN_CHARS = {char: syllable for syllable, chars in BUILTIN_PINYIN.items() for char in chars}
+
+CJK_RUN = re.compile(r'[一-鿿]+')
+CJK_GAP = re.compile(r'(?<=[一-鿿]) +(?=[一-鿿])')
+ASCII_RUN = re.compile(r'[A-Za-z]+(?: +[A-Za-z]+)*')
+
+
+def pinyin_key(text):
+    """汉字串的拼音（不带声调、不分隔），有字查不到拼音时返回None"""
+    if lazy_pinyin is not None:
+        syllables = lazy_pinyin(text)
+        key = "".join(syllables)
+        return key if key.isascii() else None
+    syllables = [BUILTIN_PINYIN_CHARS.get(char) for char in text]
+    return None if None in syllables else "".join(syllables)
+
+
+class SymmetricDeleteIndex:
+    """对称删除索引：查找与给定字符串编辑距离不超过 max_distance 的键"""
+
+    def __init__(self, max_distance=1):
+        self.max_distance = max_distance
+        self.variants = {}  # 删除变体 -> 键列表
+
+    @staticmethod
+    def _deletes(word, distance):
+        found = {word}
+        frontier = {word}
+        for _ in range(distance):
+            frontier = {item[:i] + item[i + 1:] for item in frontier for i in range(len(item))}
+            found |= frontier
+        return found
+
+    def add(self, key):
+        for variant in self._deletes(key, self.max_distance):
+            self.variants.setdefault(variant, []).append(key)
+
+    def lookup(self, word, max_distance=None):
+        """返回 [(编辑距离, 键), ...]"""
+        max_distance = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        candidates = set()
+        for variant in self._deletes(word, max_distance):
+            candidates.update(self.variants.get(variant, ()))
+        results = []
+        for key in candidates:
+            distance = Levenshtein.distance(word, key, score_cutoff=max_distance)
+            if distance <= max_distance:
+                results.append((distance, key))
+        return results
+
+
+class TermIndex:
+    """
+    一组带权重的词条（2~4个汉字）的拼音和错字索引
+
+    substitution_min_chars: 错字纠正的最小词条长度；短词只差一个字时常是另一个正常用词（在哪/在吗），
+    这类词条只做同音和拼音纠正
+    """
+
+    def __init__(self, terms, pinyin_max_distance=1, substitution_min_chars=2):
+        self.terms = dict(terms)  # 词条 -> 权重
+        self.rank = {term: i for i, term in enumerate(self.terms)}  # 权重相同时先加入的词条优先，结果不受集合遍历顺序影响
+        self.substitution_min_chars = substitution_min_chars
+        self.by_pinyin = {}  # 拼音 -> 权重最高的词条
+        self.pinyin_deletes = SymmetricDeleteIndex(pinyin_max_distance)
+        self.char_deletes = SymmetricDeleteIndex(1)
+        for term, weight in self.terms.items():
+            self.char_deletes.add(term)
+            key = pinyin_key(term)
+            if key is None:
+                continue
+            best = self.by_pinyin.get(key)
+            if best is None:
+                self.pinyin_deletes.add(key)
+            if best is None or weight > self.terms[best]:
+                self.by_pinyin[key] = term
+
+    def __len__(self):
+        return len(self.terms)
+
+    def homophone(self, window):
+        """拼音与 window 相同的词条（权重最高者），没有时返回None"""
+        key = pinyin_key(window)
+        return None if key is None else self.by_pinyin.get(key)
+
+    def from_pinyin(self, letters, max_distance):
+        """与输入拼音编辑距离最小的词条，返回 (距离, 权重, 词条) 或 None"""
+        best = None
+        for distance, key in self.pinyin_deletes.lookup(letters, max_distance):
+            term = self.by_pinyin[key]
+            candidate = (distance, -self.terms[term], term)
+            if best is None or candidate < best:
+                best = candidate
+        return None if best is None else (best[0], -best[1], best[2])
+
+    def substitution(self, window):
+        """与 window 等长且只差一个字的词条，返回 (权重, 词条) 或 None"""
+        if len(window) < self.substitution_min_chars:
+            return None
+        best = None
+        for distance, term in self.char_deletes.lookup(window, 1):
+            if distance == 1 and len(term) == len(window):
+                candidate = (self.terms[term], -self.rank[term], term)
+                if best is None or candidate > best:
+                    best = candidate
+        return None if best is None else (best[0], best[2])
+
+    def nbytes(self):
+        """粗略估算：每个删除变体按约100字节计"""
+        return 100 * (len(self.terms) + len(self.pinyin_deletes.variants) + len(self.char_deletes.variants))
+
+
+def frequent_terms(texts, min_chars=2, max_chars=4, min_count=2, max_terms=10000):
+    """统计文本中出现在至少 min_count 条文本里的2~4字汉字片段，返回 {片段: 出现的文本数}"""
+    counts = Counter()
+    for text in texts:
+        grams = set()
+        for run in CJK_RUN.findall(text):
+            for size in range(min_chars, max_chars + 1):
+                grams.update(run[i:i + size] for i in range(len(run) - size + 1))
+        counts.update(grams)
+    return dict((term, count) for term, count in counts.most_common(max_terms) if count >= min_count)
+
+
+def correct_query(query, indexes, max_chars=4):
+    """
+    纠正问题中的同音错字、拼音和错字，返回 (纠正后的问题, [(原文, 纠正为, 类型), ...])
+
+    indexes 为多个 TermIndex（如知识库词条和路由关键词）。已经是词条的片段不做改动，
+    只有未被任何词条覆盖的汉字片段才尝试纠正，避免把正常用词改错。
+    """
+    def weight(term):
+        return max(index.terms.get(term, 0) for index in indexes)
+
+    def is_term(text):
+        return any(text in index.terms for index in indexes)
+
+    corrections = []
+    replacements = []  # (起始位置, 结束位置, 替换文本)
+
+    # 直接输入的拼音：连续的拼音单词先整体查找（fa piao），再逐词查找
+    for match in ASCII_RUN.finditer(query):
+        words = match.group(0).split()
+        groups = [(match.start(), match.end(), "".join(words).lower())] if len(words) > 1 else []
+        position = match.start()
+        for word in words:
+            start = query.index(word, position)
+            position = start + len(word)
+            groups.append((start, position, word.lower()))
+        for start, end, letters in groups:
+            if len(letters) < 4 or any(start < r_end and r_start < end for r_start, r_end, _ in replacements):
+                continue
+            # 短拼音只做精确查找，较长的允许一个字母的错误
+            max_distance = 0 if len(letters) < 6 else 1
+            found = [result for result in (index.from_pinyin(letters, max_distance) for index in indexes) if result]
+            if found:
+                distance, _, term = min(found, key=lambda item: (item[0], -item[1]))
+                replacements.append((start, end, term))
+                corrections.append((query[start:end], term, "拼音"))
+
+    # 汉字片段：先标出已是词条的位置，再在其余位置按长到短尝试同音和错字纠正
+    for run in CJK_RUN.finditer(query):
+        text, offset = run.group(0), run.start()
+        covered = [False] * len(text)
+        for size in range(2, max_chars + 1):
+            for i in range(len(text) - size + 1):
+                if is_term(text[i:i + size]):
+                    covered[i:i + size] = [True] * size
+        i = 0
+        while i < len(text):
+            replaced = False
+            for size in range(min(max_chars, len(text) - i), 1, -1):
+                if any(covered[i:i + size]):
+                    continue
+                window = text[i:i + size]
+                candidates = []
+                for index in indexes:
+                    term = index.homophone(window)
+                    if term is not None and term != window:
+                        candidates.append((0, weight(term), term, "同音"))
+                    found = index.substitution(window)
+                    if found is not None:
+                        candidates.append((1, found[0], found[1], "错字"))
+                if candidates:
+                    _, _, term, kind = min(candidates, key=lambda item: (item[0], -item[1]))
+                    replacements.append((offset + i, offset + i + size, term))
+                    corrections.append((window, term, kind))
+                    i += size
+                    replaced = True
+                    break
+            if not replaced:
+                i += 1
+
+    if not replacements:
+        return query, []
+    corrected = []
+    position = 0
+    for start, end, term in sorted(replacements):
+        corrected.append(query[position:start])
+        corrected.append(term)
+        position = end
+    corrected.append(query[position:])
+    # 拼音替换为汉字后，去掉汉字之间原有的空格（fa piao -> 发票）
+    return CJK_GAP.sub("", "".join(corrected)), corrections
@@ -0,0 +1,148 @@
+"""
+模型用量账本：记录每次模型调用的输入/输出token、模型、耗时和费用，按天增量汇总
+
+汇总维度：模型、意图、Prompt分支、会话、调用类型（正常查询/推测执行/API测试）。
+界面展示和预算判断都直接读取汇总结果，不需要扫描对话记录。
+
+账本保存在会话存储的共享文档中：本地只累积增量，定期把增量合并进文档，
+多个实例因此共享同一份当日用量和预算；进程重启后从文档恢复。
+合并不是事务操作，多个实例恰好同时合并时可能少计其中一方的一批增量。
+"""
+import threading
+import time
+
+DEFAULT_DOCUMENT = "usage_ledger"
+DIMENSIONS = ("model", "intent", "branch", "session", "kind")
+
+
+def _empty_bucket():
+    return {"calls": 0, "failures": 0, "input_tokens": 0, "output_tokens": 0, "cost": 0.0, "latency": 0.0}
+
+
+def _empty_day():
+    return {"total": _empty_bucket(), "degraded": 0, **{dimension: {} for dimension in DIMENSIONS}}
+
+
+def _add_bucket(target, source):
+    for field, value in source.items():
+        target[field] = target.get(field, 0) + value
+
+
+def _tokens(bucket):
+    return bucket["input_tokens"] + bucket["output_tokens"]
+
+
+def _merge_day(target, source):
+    _add_bucket(target["total"], source["total"])
+    target["degraded"] = target.get("degraded", 0) + source["degraded"]
+    for dimension in DIMENSIONS:
+        groups = target.setdefault(dimension, {})
+        for key, bucket in source[dimension].items():
+            _add_bucket(groups.setdefault(key, _empty_bucket()), bucket)
+
+
+class UsageLedger:
+    """
+    线程安全的用量账本
+
+    prices: {模型: (输入单价, 输出单价)}，单位为元/千tokens，未配置的模型费用记为0
+    daily_tokens / session_daily_tokens: 全部调用、单个会话的每日token上限，0表示不限制
+    """
+
+    def __init__(self, store=None, document=DEFAULT_DOCUMENT, prices=None, daily_tokens=0,
+                 session_daily_tokens=0, flush_interval=5.0, keep_days=7):
+        self.store = store
+        self.document = document
+        self.prices = prices or {}
+        self.daily_tokens = daily_tokens
+        self.session_daily_tokens = session_daily_tokens
+        self.flush_interval = flush_interval
+        self.keep_days = keep_days
+        self.lock = threading.Lock()
+        self.days = {}  # 日期 -> 汇总（已合并的共享数据 + 本地增量）
+        self.pending = {}  # 日期 -> 尚未合并进共享文档的本地增量
+        self.last_flush = time.monotonic()
+        if store is not None:
+            document = store.load_document(self.document)
+            if document:
+                self.days = document.get("days", {})
+
+    @staticmethod
+    def today():
+        return time.strftime("%Y-%m-%d")
+
+    def cost(self, model, input_tokens, output_tokens):
+        input_price, output_price = self.prices.get(model, (0.0, 0.0))
+        return (input_tokens * input_price + output_tokens * output_price) / 1000
+
+    def record(self, model, input_tokens, output_tokens, latency, ok=True, intent="未识别", branch="",
+               session_id="", kind="query"):
+        """记录一次模型调用，返回本次费用"""
+        cost = self.cost(model, input_tokens, output_tokens)
+        bucket = {"calls": 1, "failures": 0 if ok else 1, "input_tokens": input_tokens,
+                  "output_tokens": output_tokens, "cost": cost, "latency": latency}
+        keys = {"model": model or "未知", "intent": intent or "未识别", "branch": branch or "未知",
+                "session": session_id or "未知", "kind": kind}
+        day = self.today()
+        with self.lock:
+            for days in (self.days, self.pending):
+                summary = days.setdefault(day, _empty_day())
+                _add_bucket(summary["total"], bucket)
+                for dimension, key in keys.items():
+                    _add_bucket(summary[dimension].setdefault(key, _empty_bucket()), bucket)
+            due = time.monotonic() - self.last_flush >= self.flush_interval
+        if due:
+            self.flush()
+        return cost
+
+    def record_degraded(self):
+        """记录一次因预算耗尽而降级为知识库回答的请求"""
+        day = self.today()
+        with self.lock:
+            for days in (self.days, self.pending):
+                days.setdefault(day, _empty_day())["degraded"] += 1
+
+    def check_budget(self, session_id=None):
+        """预算耗尽时返回原因（daily / session），否则返回None"""
+        with self.lock:
+            summary = self.days.get(self.today())
+            if summary is None:
+                return None
+            if self.daily_tokens and _tokens(summary["total"]) >= self.daily_tokens:
+                return "daily"
+            if self.session_daily_tokens and session_id:
+                session = summary["session"].get(session_id)
+                if session and _tokens(session) >= self.session_daily_tokens:
+                    return "session"
+        return None
+
+    def flush(self):
+        """把本地增量合并进共享文档，并用合并结果刷新本地汇总"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.monotonic()
+            if self.store is None:
+                return
+            document = self.store.load_document(self.document) or {"days": {}}
+            days = document["days"]
+            for day, summary in pending.items():
+                _merge_day(days.setdefault(day, _empty_day()), summary)
+            for day in sorted(days)[:-self.keep_days]:
+                del days[day]
+            self.store.save_document(self.document, {"days": days})
+            self.days = days
+
+    def day_summary(self, day=None):
+        """某天（默认今天）的汇总副本"""
+        with self.lock:
+            summary = self.days.get(day or self.today()) or _empty_day()
+            return {"total": dict(summary["total"]), "degraded": summary["degraded"],
+                    **{dimension: {key: dict(bucket) for key, bucket in summary[dimension].items()}
+                       for dimension in DIMENSIONS}}
+
+    def session_usage(self, session_id, day=None):
+        """某个会话当天的用量"""
+        with self.lock:
+            summary = self.days.get(day or self.today())
+            bucket = summary["session"].get(session_id) if summary else None
+            return dict(bucket) if bucket else _empty_bucket()